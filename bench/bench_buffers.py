@@ -0,0 +1,110 @@
+#! /usr/bin/env python
+"""Memory allocated and throughput when reading, hashing and sending files,
+with a new bytes object per block and with pooled buffers.
+
+Each block is fed to md5 and sha256, then split into 64 KB slices as the
+HTTP body producer does.  Under tracemalloc, the peak allocation of each
+block is summed, which counts the copies made on the way; throughput is
+measured separately, without tracing.
+
+    $ python bench/bench_buffers.py [files] [file_kb] [block_kb]
+"""
+import io
+import os
+import sys
+import time
+import tracemalloc
+import os.path as osp
+from hashlib import md5, sha256
+from shutil import rmtree
+from tempfile import mkdtemp
+
+from pydio.util import buffers
+
+SEND_SIZE = 1 << 16  # FileBodyProducer's read size
+
+
+def send(body):
+    while body.read(SEND_SIZE):
+        pass
+
+
+def copying(path, block_size, pool, probe):
+    digesters = md5(), sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            for d in digesters:
+                d.update(block)
+            send(io.BytesIO(block))
+            probe()
+
+
+def pooled(path, block_size, pool, probe):
+    digesters = md5(), sha256()
+    with open(path, "rb") as f:
+        for block in buffers.blocks(f, pool):
+            for d in digesters:
+                d.update(block)
+            send(buffers.BufferReader(block))
+            probe()
+
+
+class Probe:
+    """Sums the peak traced memory of each block"""
+
+    def __init__(self):
+        self.allocated = 0
+        self.blocks = 0
+        tracemalloc.reset_peak()
+        self._base = tracemalloc.get_traced_memory()[0]
+
+    def __call__(self):
+        current, peak = tracemalloc.get_traced_memory()
+        self.allocated += peak - self._base
+        self.blocks += 1
+        tracemalloc.reset_peak()
+        self._base = current
+
+
+def run(fn, paths, block_size):
+    pool = buffers.BufferPool(block_size)
+    t0 = time.perf_counter()
+    for path in paths:
+        fn(path, block_size, pool, lambda: None)
+    elapsed = time.perf_counter() - t0
+
+    pool = buffers.BufferPool(block_size)
+    tracemalloc.start()
+    probe = Probe()
+    for path in paths:
+        fn(path, block_size, pool, probe)
+    tracemalloc.stop()
+    return elapsed, probe, pool
+
+
+def main(n="64", file_kb="4096", block_kb="1024"):
+    n, size, block_size = int(n), int(file_kb) << 10, int(block_kb) << 10
+    wd = mkdtemp()
+    try:
+        paths = []
+        for i in range(n):
+            paths.append(osp.join(wd, str(i)))
+            with open(paths[-1], "wb") as f:
+                f.write(os.urandom(size))
+
+        print("{0} files of {1} KB in {2} KB blocks".format(
+            n, file_kb, block_kb))
+        print("{0:<8} {1:>8} {2:>16} {3:>16}".format(
+            "reads", "MB/s", "KB alloc/block", "pool buffers"))
+        for name, fn in (("copying", copying), ("pooled", pooled)):
+            elapsed, probe, pool = run(fn, paths, block_size)
+            print("{0:<8} {1:>8.0f} {2:>16.0f} {3:>16}".format(
+                name, n * size / elapsed / (1 << 20),
+                probe.allocated / probe.blocks / 1024,
+                pool.allocated if fn is pooled else "-"))
+    finally:
+        rmtree(wd)
+
+
+if __name__ == "__main__":
+    main(*sys.argv[1:])
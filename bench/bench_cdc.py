@@ -0,0 +1,66 @@
+#! /usr/bin/env python
+"""Deduplication ratio and throughput of content-defined chunking against
+fixed-size blocks, on a synthetic corpus of successive file versions.
+
+    $ python bench/bench_cdc.py [n_versions] [file_size]
+"""
+import os
+import sys
+import time
+import random
+from hashlib import blake2b
+
+from pydio.util.cdc import Chunker
+
+
+def versions(n, size, seed=0):
+    """Yield `n` versions of a file, each derived from the previous one by a
+    few random insertions, deletions and overwrites.
+    """
+    rand = random.Random(seed)
+    content = bytearray(os.urandom(size))
+    for _ in range(n):
+        yield bytes(content)
+        for _ in range(4):
+            i = rand.randrange(len(content))
+            edit = rand.choice(("insert", "delete", "overwrite"))
+            if edit == "insert":
+                content[i:i] = os.urandom(rand.randrange(1, 4096))
+            elif edit == "delete":
+                del content[i:i + rand.randrange(1, 4096)]
+            else:
+                content[i:i + 100] = os.urandom(100)
+
+
+def fixed(data, block_size=8 << 10):
+    return [
+        (blake2b(data[i:i + block_size], digest_size=20).digest(),
+         len(data[i:i + block_size]))
+        for i in range(0, len(data), block_size)
+    ]
+
+
+def cdc(data, chunker=Chunker()):
+    return chunker.update(data) + chunker.final()
+
+
+def main(n="8", size=str(4 << 20)):
+    corpus = list(versions(int(n), int(size)))
+    logical = sum(map(len, corpus))
+
+    print("{0:>8} {1:>12} {2:>8} {3:>8}".format(
+        "method", "unique MB", "ratio", "MB/s"))
+    for name, fn in (("fixed", fixed), ("cdc", cdc)):
+        unique = {}
+        t0 = time.process_time()
+        for content in corpus:
+            unique.update(fn(content))
+        elapsed = time.process_time() - t0
+
+        stored = sum(unique.values())
+        print("{0:>8} {1:>12.1f} {2:>8.2f} {3:>8.1f}".format(
+            name, stored / 1e6, logical / stored, logical / elapsed / 1e6))
+
+
+if __name__ == "__main__":
+    main(*sys.argv[1:])
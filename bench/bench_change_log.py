@@ -0,0 +1,74 @@
+#! /usr/bin/env python
+"""StateManager throughput with changes logged by triggers and by the
+StateManager itself: creates, content updates, and deletes of whole
+directories.
+
+    $ python bench/bench_change_log.py [directories] [files per directory]
+"""
+import os
+import sys
+import time
+from tempfile import mkdtemp
+from shutil import rmtree
+
+from twisted.internet import defer, task
+
+from pydio.engine import sqlite
+from pydio.util.adbapi import ConnectionManager
+
+
+def inode(path, i):
+    return dict(node_path=path, bytesize=i, md5="{0:032x}".format(i),
+                mtime=1.5e9 + i, stat_result=b"stat")
+
+
+@defer.inlineCallbacks
+def timed(fn, items):
+    t0 = time.perf_counter()
+    for item in items:
+        yield fn(item)
+    return len(items) / (time.perf_counter() - t0)
+
+
+@defer.inlineCallbacks
+def run(wd, log_changes, dirs, files):
+    db = ConnectionManager(os.path.join(wd, "{0}.sqlite".format(log_changes)))
+    try:
+        yield db.runInteraction(sqlite.migrate)
+        yield db.runInteraction(sqlite.set_triggers, not log_changes)
+        stateman = sqlite.StateManager(db, log_changes=log_changes)
+
+        paths = ["/ws/dir{0}/file{1}.txt".format(d, f)
+                 for d in range(dirs) for f in range(files)]
+        create = yield timed(
+            lambda p: stateman.create(inode(p, 0)), paths,
+        )
+        modify = yield timed(
+            lambda p: stateman.modify(inode(p, 1)), paths,
+        )
+        delete = yield timed(
+            lambda d: stateman.delete(inode("/ws/dir{0}".format(d), 0)),
+            range(dirs),
+        )
+        (logged,), = yield db.runQuery("SELECT COUNT(*) FROM ajxp_changes;")
+    finally:
+        yield db.close()
+
+    print("{0:<12} create {1:>6.0f}/s, modify {2:>6.0f}/s, "
+          "delete {3:>6.0f} files/s, {4} changes".format(
+              "statemanager" if log_changes else "triggers",
+              create, modify, delete * files, logged))
+
+
+@defer.inlineCallbacks
+def main(reactor, dirs="20", files="500"):
+    wd = mkdtemp()
+    try:
+        for log_changes in (False, True):
+            yield run(wd, log_changes, int(dirs), int(files))
+    finally:
+        rmtree(wd)
+
+
+if __name__ == "__main__":
+    task.react(main, sys.argv[1:])
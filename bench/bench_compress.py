@@ -0,0 +1,96 @@
+#! /usr/bin/env python
+"""Upload time with and without transfer compression, over a throttled link
+to the local stand-in server.
+
+    $ python bench/bench_compress.py [bandwidth] [file_size]
+"""
+import os
+import sys
+import time
+import os.path as osp
+from shutil import rmtree
+from tempfile import mkdtemp
+
+from twisted.internet import defer, task
+
+from pydio.engine import sqlite
+from pydio.util.adbapi import ConnectionManager
+from pydio.storage import http, transfer
+from pydio.test import fakeserver
+
+
+def corpus(size):
+    rows = b"".join(
+        "{0},customer-{1},{2:.2f},2017-03-{3:02d}\n".format(
+            i, i % 977, i * 1.37, i % 28 + 1).encode()
+        for i in range(size // 32)
+    )
+    yield "data.csv", rows[:size]
+    yield "report.xml", (b"<row><cell>value</cell><cell>%d</cell></row>\n"
+                         * (size // 40))[:size]
+    yield "video.mp4", os.urandom(size)
+    yield "blob.bin", os.urandom(size)
+
+
+@defer.inlineCallbacks
+def run(root, files, bandwidth, compression):
+    port, api = fakeserver.listen(root, bandwidth=bandwidth)
+    server = "http://127.0.0.1:{0}".format(port.getHost().port)
+    client = http.Client(server, "ws", timeout=600, compression=compression)
+
+    db = ConnectionManager(":memory:")
+    with open(sqlite.SQL_INIT_FILE) as f:
+        yield db.runInteraction(lambda c, s: c.executescript(s), f.read())
+
+    pipeline = transfer.TransferPipeline(
+        client, sqlite.TransferLog(db), chunk_size=1 << 20,
+    )
+
+    results = []
+    for path in files:
+        client.compression_stats.__init__()
+        t0, c0 = time.perf_counter(), time.process_time()
+        yield pipeline.upload(path, "/" + osp.basename(path))
+        results.append((
+            osp.basename(path),
+            time.perf_counter() - t0,
+            time.process_time() - c0,
+            client.compression_stats.ratio(),
+        ))
+
+    yield client.close()
+    yield port.stopListening()
+    db.close()
+    rmtree(osp.join(root, "ws"))
+    os.mkdir(osp.join(root, "ws"))
+    defer.returnValue(results)
+
+
+@defer.inlineCallbacks
+def main(reactor, bandwidth=str(4 << 20), size=str(8 << 20)):
+    bandwidth, size = int(bandwidth), int(size)
+    root, src = mkdtemp(), mkdtemp()
+    os.mkdir(osp.join(root, "ws"))
+
+    files = []
+    for name, content in corpus(size):
+        files.append(osp.join(src, name))
+        with open(files[-1], "wb") as f:
+            f.write(content)
+
+    print("link: {0:.1f} MB/s".format(bandwidth / 1e6))
+    print("{0:>12} {1:>12} {2:>8} {3:>8} {4:>8}".format(
+        "file", "compression", "ratio", "wall s", "CPU s"))
+    try:
+        for compression in (False, True):
+            results = yield run(root, files, bandwidth, compression)
+            for name, wall, cpu, ratio in results:
+                print("{0:>12} {1:>12} {2:>8.2f} {3:>8.2f} {4:>8.2f}".format(
+                    name, "on" if compression else "off", ratio, wall, cpu))
+    finally:
+        rmtree(root)
+        rmtree(src)
+
+
+if __name__ == "__main__":
+    task.react(main, sys.argv[1:])
@@ -0,0 +1,60 @@
+#! /usr/bin/env python
+"""Bytes transferred and CPU time of block deltas for typical edit patterns.
+
+    $ python bench/bench_delta.py [file_size] [block_size]
+"""
+import os
+import sys
+import time
+import os.path as osp
+from shutil import rmtree
+from tempfile import mkdtemp
+
+from pydio.util import delta
+
+
+def edits(basis):
+    edited = bytearray(basis)
+    edited[len(basis) // 2] ^= 0xff
+    yield "unchanged", basis
+    yield "append 1MB", basis + os.urandom(1 << 20)
+    yield "in-place edit", bytes(edited)
+    yield "insert at start", os.urandom(100) + basis
+    yield "rewrite", os.urandom(len(basis))
+
+
+def main(size=str(64 << 20), block_size=str(1 << 16)):
+    size, block_size = int(size), int(block_size)
+    wd = mkdtemp()
+    basis_path, new_path = osp.join(wd, "basis"), osp.join(wd, "new")
+
+    basis = os.urandom(size)
+    with open(basis_path, "wb") as f:
+        f.write(basis)
+
+    t0 = time.process_time()
+    sig = delta.signature(basis_path, block_size)
+    print("signature: {0:.3f}s CPU, {1} bytes".format(
+        time.process_time() - t0, len(sig.blocks)))
+
+    print("{0:>16} {1:>12} {2:>12} {3:>8} {4:>8}".format(
+        "edit", "file bytes", "sent bytes", "ratio", "CPU s"))
+    try:
+        for name, content in edits(basis):
+            with open(new_path, "wb") as f:
+                f.write(content)
+
+            t0 = time.process_time()
+            ops = delta.delta(new_path, sig, max_literal=len(content) // 2)
+            elapsed = time.process_time() - t0
+
+            # abandoned deltas fall back to sending the whole file
+            sent = len(content) if ops is None else delta.encoded_size(ops)
+            print("{0:>16} {1:>12} {2:>12} {3:>8.4f} {4:>8.3f}".format(
+                name, len(content), sent, sent / len(content), elapsed))
+    finally:
+        rmtree(wd)
+
+
+if __name__ == "__main__":
+    main(*sys.argv[1:])
@@ -0,0 +1,63 @@
+#! /usr/bin/env python
+"""Cost of each extra digest computed in the hashing pass, compared with
+reading the file once per digest.
+
+    $ python bench/bench_digests.py [size]
+"""
+import os
+import sys
+import time
+from tempfile import mkstemp
+
+from pydio.storage import hashing
+
+SETS = (
+    ("md5",),
+    ("md5", "blake2b"),
+    ("md5", "sha256"),
+    ("md5", "signature"),
+    ("md5", "blake2b", "signature"),
+    ("md5", "blake2b", "sha256", "signature"),
+)
+
+
+def timed(fn, *args, **kw):
+    best = float("inf")
+    for _ in range(3):
+        t0 = time.perf_counter()
+        fn(*args, **kw)
+        best = min(best, time.perf_counter() - t0)
+    return best
+
+
+def main(size=str(256 << 20)):
+    size = int(size)
+    fd, path = mkstemp()
+    try:
+        with os.fdopen(fd, "wb") as f:
+            for _ in range(size >> 20):
+                f.write(os.urandom(1 << 20))
+
+        read = timed(hashing.hash_file, path, digests=())
+        single = {
+            name: timed(hashing.hash_file, path, digests=(name,))
+            for name in hashing.DIGESTERS
+        }
+
+        print("{0} MB file, read only: {1:.0f} MB/s".format(
+            size >> 20, size / read / 1e6))
+        print("{0:>36} {1:>8} {2:>10} {3:>12}".format(
+            "digests", "MB/s", "extra s", "separate s"))
+        base = single["md5"]
+        for names in SETS:
+            elapsed = timed(hashing.hash_file, path, digests=names)
+            separate = sum(single[n] for n in names)
+            print("{0:>36} {1:>8.0f} {2:>10.3f} {3:>12.3f}".format(
+                "+".join(names), size / elapsed / 1e6, elapsed - base,
+                separate))
+    finally:
+        os.remove(path)
+
+
+if __name__ == "__main__":
+    main(*sys.argv[1:])
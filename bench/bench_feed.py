@@ -0,0 +1,83 @@
+#! /usr/bin/env python
+"""Cost of refreshing a large remote workspace that receives a trickle of
+changes, by following the server's change cursor or by listing it.
+
+    $ python bench/bench_feed.py [directories] [files_per_directory]
+"""
+import os
+import sys
+import time
+import os.path as osp
+from shutil import rmtree
+from tempfile import mkdtemp
+
+from zope.interface import implementer
+
+from twisted.internet import defer, task
+
+from pydio.engine import IStateManager
+from pydio.storage import http
+from pydio.test import fakeserver
+
+
+@implementer(IStateManager)
+class StateManager:
+    def __init__(self):
+        self.updates = 0
+
+    def _update(self, inode, directory=False):
+        self.updates += 1
+
+    create = delete = modify = move = _update
+
+
+@defer.inlineCallbacks
+def run(root, feed, rounds=5, trickle=10):
+    port, api = fakeserver.listen(root)
+    api.feed = feed
+    server = "http://127.0.0.1:{0}".format(port.getHost().port)
+    rd = http.RemoteDirectory(server, "ws")
+    rd.connect_state_manager(StateManager())
+    yield rd.refresh()  # initial listing
+
+    ws = osp.join(root, "ws")
+    requests, elapsed = 0, 0.
+    for r in range(rounds):
+        for i in range(trickle):
+            path = "/d{0}/new{1}-{2}.txt".format(i, r, i)
+            with open(osp.join(ws, path.lstrip("/")), "wb") as f:
+                f.write(b"x")
+            api.record("ws", "create", path)
+
+        api.actions.clear()
+        t0 = time.perf_counter()
+        yield rd.refresh()
+        elapsed += time.perf_counter() - t0
+        requests += sum(api.actions.values())
+
+    yield rd.client.close()
+    yield port.stopListening()
+    print("{0:<8} {1:>8.1f} requests/refresh {2:>8.1f} ms/refresh".format(
+        "feed" if feed else "listing", requests / rounds,
+        1e3 * elapsed / rounds))
+
+
+@defer.inlineCallbacks
+def main(reactor, dirs="200", files="50"):
+    dirs, files = int(dirs), int(files)
+    root = mkdtemp()
+    try:
+        for d in range(dirs):
+            dir_path = osp.join(root, "ws", "d{0}".format(d))
+            os.makedirs(dir_path)
+            for f in range(files):
+                with open(osp.join(dir_path, "f{0}".format(f)), "wb") as fp:
+                    fp.write(b"x")
+        yield run(root, True)
+        yield run(root, False)
+    finally:
+        rmtree(root)
+
+
+if __name__ == "__main__":
+    task.react(main, sys.argv[1:])
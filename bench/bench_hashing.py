@@ -0,0 +1,68 @@
+#! /usr/bin/env python
+"""Hashing throughput of the inline, thread and process pool backends, on
+mixes of small and large files.
+
+    $ python bench/bench_hashing.py [workers] [total_size]
+"""
+import os
+import sys
+import time
+import os.path as osp
+from shutil import rmtree
+from tempfile import mkdtemp
+
+from twisted.internet import defer, task
+
+from pydio.storage import hashing
+
+
+def mixes(total):
+    yield "small", 16 << 10, total // (16 << 10)
+    yield "medium", 1 << 20, total // (1 << 20)
+    yield "large", 32 << 20, max(total // (32 << 20), 1)
+
+
+def backends(workers):
+    yield "inline", lambda: hashing.InlineHasher()
+    yield "threads", lambda: hashing.ThreadHasher()
+    yield "processes", lambda: hashing.ProcessHasher(workers)
+    yield "processes*", lambda: hashing.ProcessHasher(workers, min_size=0)
+
+
+@defer.inlineCallbacks
+def main(reactor, workers=str(os.cpu_count() or 1), total=str(128 << 20)):
+    workers, total = int(workers), int(total)
+    wd = mkdtemp()
+
+    print("{0} workers; processes* sends small files to processes too".format(
+        workers))
+    print("{0:>8} {1:>12} {2:>8} {3:>8}".format(
+        "mix", "backend", "files/s", "MB/s"))
+    try:
+        for mix, size, n in mixes(total):
+            paths = []
+            for i in range(n):
+                paths.append(osp.join(wd, "{0}-{1}".format(mix, i)))
+                with open(paths[-1], "wb") as f:
+                    f.write(os.urandom(size))
+
+            for name, factory in backends(workers):
+                hasher = factory()
+                yield hasher.hash(paths[0])  # warm up pools
+
+                t0 = time.perf_counter()
+                yield defer.gatherResults(map(hasher.hash, paths))
+                elapsed = time.perf_counter() - t0
+                hasher.close()
+
+                print("{0:>8} {1:>12} {2:>8.0f} {3:>8.1f}".format(
+                    mix, name, n / elapsed, n * size / elapsed / 1e6))
+
+            for path in paths:
+                os.remove(path)
+    finally:
+        rmtree(wd)
+
+
+if __name__ == "__main__":
+    task.react(main, sys.argv[1:])
@@ -0,0 +1,63 @@
+#! /usr/bin/env python
+"""Metadata throughput against the local stand-in server.
+
+Compares persistent connection pools of various sizes with one connection per
+request, with and without injected latency.
+
+    $ python bench/bench_http.py [n_requests]
+"""
+import os
+import sys
+import time
+import os.path as osp
+from shutil import rmtree
+from tempfile import mkdtemp
+
+from twisted.internet import defer, task
+
+from pydio.storage import http
+from pydio.test import fakeserver
+
+
+@defer.inlineCallbacks
+def run(reactor, root, n, poolsize, persistent, latency):
+    port, _ = fakeserver.listen(root, latency=latency)
+    server = "http://127.0.0.1:{0}".format(port.getHost().port)
+    client = http.Client(server, "ws", poolsize=poolsize)
+    client.pool.persistent = persistent
+
+    paths = ["/f{0}.txt".format(i % 100) for i in range(n)]
+    t0 = time.perf_counter()
+    yield client.stat_many(paths)
+    elapsed = time.perf_counter() - t0
+
+    yield client.close()
+    yield port.stopListening()
+    defer.returnValue(elapsed)
+
+
+@defer.inlineCallbacks
+def main(reactor, n="2000"):
+    n = int(n)
+    root = mkdtemp()
+    os.mkdir(osp.join(root, "ws"))
+    for i in range(100):
+        with open(osp.join(root, "ws", "f{0}.txt".format(i)), "wb") as f:
+            f.write(os.urandom(4096))
+
+    print("{0:>8} {1:>10} {2:>8} {3:>10}".format(
+        "latency", "persistent", "poolsize", "stat/s"))
+    try:
+        for latency in (0, .005):
+            for persistent, poolsize in ((False, 4), (True, 1),
+                                         (True, 4), (True, 16)):
+                elapsed = yield run(reactor, root, n, poolsize,
+                                    persistent, latency)
+                print("{0:>8} {1:>10} {2:>8} {3:>10.0f}".format(
+                    latency, str(persistent), poolsize, n / elapsed))
+    finally:
+        rmtree(root)
+
+
+if __name__ == "__main__":
+    task.react(main, sys.argv[1:])
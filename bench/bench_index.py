@@ -0,0 +1,82 @@
+#! /usr/bin/env python
+"""Path lookups through the in-memory index versus SQLite queries through
+the connection pool, and the memory used per indexed path.
+
+    $ python bench/bench_index.py [paths] [lookups]
+"""
+import os
+import sys
+import time
+import random
+import tracemalloc
+from tempfile import mkdtemp
+from shutil import rmtree
+
+from twisted.internet import defer, task
+
+from pydio.engine import sqlite
+from pydio.util.adbapi import ConnectionManager
+
+
+def populate(c, n):
+    with open(sqlite.SQL_INIT_FILE) as f:
+        c.executescript(f.read())
+    c.executemany(
+        "INSERT INTO ajxp_index (node_path, bytesize, md5, mtime) "
+        "VALUES (?,?,?,?);",
+        (("/ws/dir{0}/file{1}.txt".format(i // 100, i), i,
+          "{0:032x}".format(i), 1.5e9 + i) for i in range(n)),
+    )
+
+
+@defer.inlineCallbacks
+def lookups(fn, paths):
+    t0 = time.perf_counter()
+    for path in paths:
+        yield fn(path)
+    return len(paths) / (time.perf_counter() - t0)
+
+
+@defer.inlineCallbacks
+def main(reactor, n="200000", m="20000"):
+    n, m = int(n), int(m)
+    wd = mkdtemp()
+    db = ConnectionManager(os.path.join(wd, "bench.sqlite"))
+    try:
+        yield db.runInteraction(populate, n)
+        paths = ["/ws/dir{0}/file{1}.txt".format(i // 100, i)
+                 for i in random.sample(range(n), m)]
+
+        def query(path):
+            return db.runQuery(
+                "SELECT node_id, md5, bytesize, mtime FROM ajxp_index "
+                "WHERE node_path=?;",
+                (path,),
+            )
+
+        rate = yield lookups(query, paths)
+        print("{0} paths; sqlite queries: {1:.0f} lookups/s".format(n, rate))
+
+        for budget in (None, 64 << 20, 16 << 20):
+            index = sqlite.PathIndex(db, budget)
+
+            tracemalloc.start()
+            t0 = time.perf_counter()
+            loaded = yield index.load()
+            elapsed = time.perf_counter() - t0
+            used, _ = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+
+            rate = yield lookups(index.get, paths)
+            print("budget {0:>6}: loaded {1} in {2:.2f}s, {3:.0f} B/path, "
+                  "{4:.0f} lookups/s, {5:.0%} from memory".format(
+                      "none" if budget is None else "{0}M".format(budget >> 20),
+                      loaded, elapsed, used / loaded, rate,
+                      index.hits / (index.hits + index.misses)))
+    finally:
+        yield db.close()
+        rmtree(wd)
+
+
+if __name__ == "__main__":
+    task.react(main, sys.argv[1:])
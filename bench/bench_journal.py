@@ -0,0 +1,96 @@
+#! /usr/bin/env python
+"""Cost of journaling events, with a sync per event and with group commits,
+and time to recover the pending events after a crash, compared with a walk
+listing and stat-ing the whole tree.
+
+    $ python bench/bench_journal.py [events] [tree_files] [pending]
+"""
+import os
+import sys
+import time
+import os.path as osp
+from shutil import rmtree
+from tempfile import mkdtemp
+
+from watchdog import events
+
+from pydio.storage.journal import Journal
+
+GROUP = 256  # events per group commit, about a sync_interval's worth
+
+
+def append(path, n, every):
+    """Journal and commit `n` events, syncing every `every` appends (never
+    if 0).  Returns events per second.
+    """
+    j = Journal(path)
+    t0 = time.perf_counter()
+    pending = []
+    for i in range(n):
+        pending.append(j.append(events.FileModifiedEvent(
+            "/home/me/sync/dir{0}/file{1}.txt".format(i % 100, i),
+        )))
+        if every and i % every == every - 1:
+            j.flush()
+        if len(pending) > GROUP:
+            j.commit(pending.pop(0))
+    elapsed = time.perf_counter() - t0
+    j.close()
+    os.remove(path)
+    return n / elapsed
+
+
+def walk(root):
+    n = 0
+    stack = [root]
+    while stack:
+        with os.scandir(stack.pop()) as it:
+            for entry in it:
+                entry.stat()
+                n += 1
+                if entry.is_dir():
+                    stack.append(entry.path)
+    return n
+
+
+def main(n="20000", tree="50000", pending="100"):
+    n, tree, pending = int(n), int(tree), int(pending)
+    wd = mkdtemp()
+    try:
+        path = osp.join(wd, "journal")
+        print("{0:<20} {1:>10}".format("journaling", "events/s"))
+        for name, every in (("no sync", 0), ("sync per event", 1),
+                            ("group commit", GROUP)):
+            print("{0:<20} {1:>10.0f}".format(name, append(path, n, every)))
+
+        root = osp.join(wd, "tree")
+        for i in range(tree):
+            d = osp.join(root, str(i // 1000))
+            if i % 1000 == 0:
+                os.makedirs(d)
+            open(osp.join(d, str(i)), "wb").close()
+
+        j = Journal(path)
+        for i in range(tree):  # a long history, mostly committed
+            seq = j.append(events.FileModifiedEvent(osp.join(root, str(i))))
+            if i >= pending:
+                j.commit(seq)
+            if i % GROUP == GROUP - 1:
+                j.flush()
+        # crash: not closed
+
+        t0 = time.perf_counter()
+        recovered = len(Journal(path).pending())
+        recovery = time.perf_counter() - t0
+        t0 = time.perf_counter()
+        listed = walk(root)
+        walked = time.perf_counter() - t0
+        print("\nrecover {0} pending events: {1:.1f} ms".format(
+            recovered, recovery * 1000))
+        print("walk {0} entries: {1:.1f} ms".format(listed, walked * 1000))
+    finally:
+        rmtree(wd)
+
+
+if __name__ == "__main__":
+    main(*sys.argv[1:])
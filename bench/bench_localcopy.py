@@ -0,0 +1,73 @@
+#! /usr/bin/env python
+"""Local-to-local copy throughput of each kernel-side method, compared with
+a Python read/write loop, for one large file and for many small ones.
+
+The temporary directory is created under the current directory unless one
+is given, so that reflinks can be measured on a copy-on-write filesystem.
+
+    $ python bench/bench_localcopy.py [large_mb] [small_files] [dir]
+"""
+import os
+import sys
+import time
+import os.path as osp
+from shutil import rmtree
+from tempfile import mkdtemp
+
+from pydio.storage import localcopy
+
+
+def drop(path):
+    if osp.exists(path):
+        os.remove(path)
+
+
+def run(name, method, pairs):
+    methods = [(name, method)]
+    total = 0
+    t0 = time.perf_counter()
+    try:
+        for src, dst in pairs:
+            _, st = localcopy.copy_file(src, dst, methods)
+            total += st.st_size
+    except OSError as e:
+        return None, str(e)
+    finally:
+        for _, dst in pairs:
+            drop(dst)
+    return time.perf_counter() - t0, total
+
+
+def main(large_mb="256", n_small="2000", where="."):
+    wd = mkdtemp(dir=where)
+    try:
+        large = osp.join(wd, "large.bin")
+        with open(large, "wb") as f:
+            for _ in range(int(large_mb)):
+                f.write(os.urandom(1 << 20))
+
+        os.mkdir(osp.join(wd, "small"))
+        small = []
+        for i in range(int(n_small)):
+            path = osp.join(wd, "small", "f{0}".format(i))
+            with open(path, "wb") as f:
+                f.write(os.urandom(4096))
+            small.append((path, path + ".copy"))
+
+        print("{0:<16} {1:>12} {2:>14}".format(
+            "method", "large MB/s", "small files/s"))
+        for name, method in localcopy.METHODS:
+            elapsed, total = run(name, method, [(large, large + ".copy")])
+            if elapsed is None:
+                print("{0:<16} unsupported ({1})".format(name, total))
+                continue
+            small_elapsed, _ = run(name, method, small)
+            print("{0:<16} {1:>12.0f} {2:>14.0f}".format(
+                name, total / elapsed / (1 << 20), len(small) / small_elapsed,
+            ))
+    finally:
+        rmtree(wd)
+
+
+if __name__ == "__main__":
+    main(*sys.argv[1:])
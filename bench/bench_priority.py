@@ -0,0 +1,74 @@
+#! /usr/bin/env python
+"""Queue wait times of small and large files behind a backlog of transfers,
+first come first served and in priority order.  Transfers are simulated at a
+fixed throughput on a virtual clock.
+
+    $ python bench/bench_priority.py [files] [slots]
+"""
+import sys
+import random
+
+from twisted.internet import defer, task
+
+from pydio.util.priority import PriorityScheduler
+
+THROUGHPUT = 50 << 20  # bytes per second
+
+
+def workload(n, rng):
+    """(arrival time, path, size, age) of `n` files: mostly documents, some
+    large media and a few huge backups, arriving over ten minutes
+    """
+    files = []
+    for i in range(n):
+        r = rng.random()
+        if r < .8:
+            size, kind = rng.randint(1 << 10, 1 << 20), "small"
+        elif r < .995:
+            size, kind = rng.randint(10 << 20, 200 << 20), "large"
+        else:
+            size, kind = rng.randint(5 << 30, 50 << 30), "huge"
+        path = "/{0}/{1}".format(kind, i)
+        files.append((rng.uniform(0, 600), path, size, rng.expovariate(1e-4)))
+    return sorted(files)
+
+
+def simulate(files, slots, fifo):
+    clock = task.Clock()
+    weights = dict(size_rate=0, recency_weight=0) if fifo else {}
+    s = PriorityScheduler(slots, clock=clock, **weights)
+    waits = {}
+
+    def transfer(path, size, queued):
+        waits[path] = clock.seconds() - queued
+        return task.deferLater(clock, size / THROUGHPUT * slots, lambda: 0)
+
+    for arrival, path, size, age in files:
+        clock.advance(arrival - clock.seconds())
+        s.run(path, size, arrival - age, transfer, path, size, arrival)
+    while s.running:
+        clock.advance(1)
+    return waits
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(p * len(values)))]
+
+
+def main(reactor, n="2000", slots="4"):
+    files = workload(int(n), random.Random(1))
+    print("{0:<9} {1:<6} {2:>10} {3:>10} {4:>10}".format(
+        "order", "kind", "mean wait", "p95 wait", "max wait"))
+    for fifo in (True, False):
+        waits = simulate(files, int(slots), fifo)
+        for kind in ("small", "large", "huge"):
+            w = [v for p, v in waits.items() if p.startswith("/" + kind)]
+            print("{0:<9} {1:<6} {2:>9.0f}s {3:>9.0f}s {4:>9.0f}s".format(
+                "fifo" if fifo else "priority", kind, sum(w) / len(w),
+                percentile(w, .95), max(w)))
+    return defer.succeed(None)
+
+
+if __name__ == "__main__":
+    task.react(main, sys.argv[1:])
@@ -0,0 +1,77 @@
+#! /usr/bin/env python
+"""Reconciliation of offline changes with directory snapshots, versus a
+rescan of every directory.
+
+A tree of `dirs` directories of `files` files is indexed, then files are
+added to 1% of the directories and reconciled.
+
+    $ python bench/bench_reconcile.py [dirs] [files per directory]
+"""
+import os
+import sys
+import time
+from tempfile import mkdtemp
+from shutil import rmtree
+
+from twisted.internet import defer, task
+
+from pydio.engine import sqlite
+from pydio.storage import fs
+from pydio.storage.hashing import InlineHasher
+from pydio.util.adbapi import ConnectionManager
+
+
+def handler(db, ws, snapshots):
+    index = sqlite.PathIndex(db)
+    return fs.EventHandler(
+        sqlite.StateManager(db, index, snapshots=snapshots), ws,
+        filters=dict(include=["*"]), hasher=InlineHasher(), index=index,
+        snapshots=snapshots,
+    )
+
+
+@defer.inlineCallbacks
+def timed(h, label, deep=False):
+    t0 = time.perf_counter()
+    stats = yield h.reconcile(deep)
+    print("{0:<24} {1:>7.2f}s  listed {2:>6}, rescanned {3:>5}".format(
+        label, time.perf_counter() - t0, stats["listed"], stats["rescanned"],
+    ))
+
+
+@defer.inlineCallbacks
+def main(reactor, dirs="2000", files="20"):
+    dirs, files = int(dirs), int(files)
+    wd = mkdtemp()
+    ws = os.path.join(wd, "ws")
+    db = ConnectionManager(os.path.join(wd, "bench.sqlite"))
+    try:
+        for d in range(dirs):
+            path = os.path.join(ws, "d{0:03}".format(d % 100),
+                                "d{0}".format(d))
+            os.makedirs(path)
+            for f in range(files):
+                with open(os.path.join(path, "{0}.txt".format(f)), "w") as fd:
+                    fd.write(path)
+        yield db.runInteraction(sqlite.migrate)
+        snapshots = sqlite.SnapshotStore(db)
+
+        yield timed(handler(db, ws, snapshots), "initial scan")
+        yield timed(handler(db, ws, snapshots), "unchanged")
+
+        for d in range(0, dirs, 101):
+            path = os.path.join(ws, "d{0:03}".format(d % 100),
+                                "d{0}".format(d), "offline.txt")
+            with open(path, "w") as fd:
+                fd.write(path)
+
+        yield timed(handler(db, ws, snapshots), "1% changed, snapshots")
+        yield timed(handler(db, ws, snapshots), "deep walk", deep=True)
+        yield timed(handler(db, ws, None), "rescan everything")
+    finally:
+        yield db.close()
+        rmtree(wd)
+
+
+if __name__ == "__main__":
+    task.react(main, sys.argv[1:])
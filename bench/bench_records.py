@@ -0,0 +1,68 @@
+#! /usr/bin/env python
+"""Memory and access time of 1M inodes held as dicts versus Inode records.
+
+    $ python bench/bench_records.py [n]
+"""
+import gc
+import sys
+import time
+import tracemalloc
+
+from pydio.util.records import Inode
+
+KEYS = ("node_id", "node_path", "bytesize", "md5", "mtime")
+
+
+def rows(n):
+    for i in range(n):
+        yield (i, "/ws/dir{0}/file{1}.txt".format(i // 100, i), i,
+               "{0:032x}".format(i), 1.5e9 + i)
+
+
+def as_dicts(n):
+    return [dict(zip(KEYS, row)) for row in rows(n)]
+
+
+def as_records(n):
+    return [Inode(*row) for row in rows(n)]
+
+
+def measure(build, n):
+    gc.collect()
+    tracemalloc.start()
+    t0 = time.perf_counter()
+    records = build(n)
+    elapsed = time.perf_counter() - t0
+    used, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return records, used, elapsed
+
+
+def main(n="1000000"):
+    n = int(n)
+
+    print("{0} inodes; container sizes exclude the field values".format(n))
+    print("{0:>8} {1:>8} {2:>12} {3:>10} {4:>10} {5:>10}".format(
+        "type", "MB", "B/container", "build s", "item s", "attr s"))
+    for name, build in (("dict", as_dicts), ("Inode", as_records)):
+        records, used, elapsed = measure(build, n)
+
+        t0 = time.perf_counter()
+        for r in records:
+            r["md5"], r["bytesize"], r.get("chunks")
+        item = time.perf_counter() - t0
+
+        attr = float("nan")
+        if name == "Inode":
+            t0 = time.perf_counter()
+            for r in records:
+                r.md5, r.bytesize, getattr(r, "chunks", None)
+            attr = time.perf_counter() - t0
+
+        print("{0:>8} {1:>8.0f} {2:>12} {3:>10.2f} {4:>10.2f} {5:>10.2f}".format(
+            name, used / 1e6, sys.getsizeof(records[0]), elapsed, item, attr))
+        del records
+
+
+if __name__ == "__main__":
+    main(*sys.argv[1:])
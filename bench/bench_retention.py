@@ -0,0 +1,73 @@
+#! /usr/bin/env python
+"""Database size and update throughput of a long-running engine, with and
+without change pruning and incremental vacuum.
+
+    $ python bench/bench_retention.py [rounds] [files]
+"""
+import os
+import sys
+import time
+from shutil import rmtree
+from tempfile import mkdtemp
+
+from twisted.internet import defer, task
+
+from pydio.engine import sqlite
+from pydio.util.adbapi import ConnectionManager
+
+
+def inode(i, r):
+    return dict(node_path="/ws/file{0}.txt".format(i), bytesize=r,
+                md5="{0:032x}".format(r), mtime=float(r))
+
+
+@defer.inlineCallbacks
+def run(path, rounds, files, maintain):
+    db = ConnectionManager(path)
+    with open(sqlite.SQL_INIT_FILE) as f:
+        yield db.runInteraction(lambda c, s: c.executescript(s), f.read())
+
+    stateman = sqlite.StateManager(db)
+    stream = sqlite.DiffStream(db)
+    maintenance = sqlite.Maintenance(db, stream)
+
+    t0 = time.perf_counter()
+    for r in range(rounds):
+        for i in range(files):
+            if r == 0:
+                yield stateman.create(inode(i, r))
+            else:
+                yield stateman.modify(inode(i, r))
+        yield stream.next()
+        stream.ack()
+        if maintain:
+            yield maintenance.run()  # prunes
+            yield maintenance.run()  # idle: vacuums
+    elapsed = time.perf_counter() - t0
+
+    stats = yield maintenance.stats()
+    yield db.close()
+    return rounds * files / elapsed, stats
+
+
+@defer.inlineCallbacks
+def main(reactor, rounds="20", files="2000"):
+    rounds, files = int(rounds), int(files)
+    wd = mkdtemp()
+
+    print("{0} rounds of {1} updates".format(rounds, files))
+    print("{0:>12} {1:>10} {2:>8} {3:>8} {4:>12}".format(
+        "maintenance", "updates/s", "KB", "free", "changes"))
+    try:
+        for maintain in (False, True):
+            path = os.path.join(wd, "{0}.sqlite".format(maintain))
+            rate, stats = yield run(path, rounds, files, maintain)
+            print("{0:>12} {1:>10.0f} {2:>8} {3:>8} {4:>12}".format(
+                "on" if maintain else "off", rate, stats["size"] >> 10,
+                stats["freelist_count"], stats["ajxp_changes"]))
+    finally:
+        rmtree(wd)
+
+
+if __name__ == "__main__":
+    task.react(main, sys.argv[1:])
@@ -0,0 +1,88 @@
+#! /usr/bin/env python
+"""Insert and update throughput, and database size, with the unversioned
+schema's indexes and with the current schema.
+
+Each write is its own transaction, as in StateManager.
+
+    $ python bench/bench_schema.py [n]
+"""
+import os
+import sys
+import time
+import sqlite3
+from shutil import rmtree
+from tempfile import mkdtemp
+
+from pydio.engine.sqlite import SQL_INIT_FILE
+from pydio.engine.sqlite.sqlite import INODE_COLUMNS, UPSERT_INODE
+
+UNVERSIONED_INDEXES = """
+    DROP INDEX index_node_path;
+    DROP INDEX index_md5;
+    CREATE INDEX changes_node_id ON ajxp_changes( node_id );
+    CREATE INDEX changes_type ON ajxp_changes( type );
+    CREATE INDEX changes_node_source ON ajxp_changes( source );
+    CREATE INDEX index_node_id ON ajxp_index( node_id );
+    CREATE INDEX index_node_path ON ajxp_index( node_path );
+    CREATE INDEX index_bytesize ON ajxp_index( bytesize );
+    CREATE INDEX index_md5 ON ajxp_index( md5 );
+"""
+
+INSERT = "INSERT INTO ajxp_index (node_path,{0}) VALUES (?,{1});".format(
+    ",".join(INODE_COLUMNS), ",".join("?" * len(INODE_COLUMNS)),
+)
+UPDATE = "UPDATE ajxp_index SET {0} WHERE node_path=?;".format(
+    ", ".join(c + "=?" for c in INODE_COLUMNS),
+)
+
+
+def row(i, version):
+    values = (i, "{0:032x}".format(i * version), 1.5e9 + version, b"stat")
+    return values + (None,) * (len(INODE_COLUMNS) - len(values))
+
+
+def run(path, unversioned, n):
+    conn = sqlite3.connect(path)
+    with open(SQL_INIT_FILE) as f:
+        conn.executescript(f.read())
+    if unversioned:
+        conn.executescript(UNVERSIONED_INDEXES)
+
+    paths = ["/ws/dir{0}/file{1}.txt".format(i // 100, i) for i in range(n)]
+    rates = []
+    for version in (1, 2):
+        t0 = time.perf_counter()
+        for i, p in enumerate(paths):
+            if unversioned:
+                if version == 1:
+                    conn.execute(INSERT, (p,) + row(i, version))
+                else:
+                    conn.execute(UPDATE, row(i, version) + (p,))
+            else:
+                conn.execute(UPSERT_INODE, (p,) + row(i, version)).fetchall()
+            conn.commit()
+        rates.append(n / (time.perf_counter() - t0))
+
+    conn.close()
+    return rates, os.path.getsize(path)
+
+
+def main(n="20000"):
+    n = int(n)
+    wd = mkdtemp()
+    print("{0} paths, inserted then updated".format(n))
+    print("{0:>12} {1:>10} {2:>10} {3:>8}".format(
+        "schema", "inserts/s", "updates/s", "KB"))
+    try:
+        for unversioned in (True, False):
+            path = os.path.join(wd, "{0}.sqlite".format(unversioned))
+            (inserts, updates), size = run(path, unversioned, n)
+            print("{0:>12} {1:>10.0f} {2:>10.0f} {3:>8}".format(
+                "unversioned" if unversioned else "current",
+                inserts, updates, size >> 10))
+    finally:
+        rmtree(wd)
+
+
+if __name__ == "__main__":
+    main(*sys.argv[1:])
@@ -0,0 +1,81 @@
+#! /usr/bin/env python
+"""Chunked transfer throughput against the local stand-in server, with
+injected latency and dropped connections.
+
+    $ python bench/bench_transfer.py [n_files] [file_size]
+"""
+import os
+import sys
+import time
+import os.path as osp
+from shutil import rmtree
+from tempfile import mkdtemp
+
+from twisted.internet import defer, task
+
+from pydio.engine import sqlite
+from pydio.util.adbapi import ConnectionManager
+from pydio.storage import http, transfer
+from pydio.test import fakeserver
+
+
+@defer.inlineCallbacks
+def run(root, files, concurrency, latency, drop_rate):
+    port, api = fakeserver.listen(root, latency=latency, drop_rate=drop_rate,
+                                  seed=1)
+    server = "http://127.0.0.1:{0}".format(port.getHost().port)
+    client = http.Client(server, "ws", poolsize=concurrency, timeout=5)
+
+    db = ConnectionManager(":memory:")
+    with open(sqlite.SQL_INIT_FILE) as f:
+        yield db.runInteraction(lambda c, s: c.executescript(s), f.read())
+
+    pipeline = transfer.TransferPipeline(
+        client, sqlite.TransferLog(db), chunk_size=1 << 20,
+        concurrency=concurrency, backoff=.01, max_retries=100,
+    )
+
+    t0 = time.perf_counter()
+    yield defer.gatherResults([
+        pipeline.upload(p, "/" + osp.basename(p)) for p in files
+    ])
+    elapsed = time.perf_counter() - t0
+
+    yield client.close()
+    yield port.stopListening()
+    db.close()
+    rmtree(osp.join(root, "ws"))
+    os.mkdir(osp.join(root, "ws"))
+    defer.returnValue((elapsed, api.dropped))
+
+
+@defer.inlineCallbacks
+def main(reactor, n="16", size=str(8 << 20)):
+    n, size = int(n), int(size)
+    root = mkdtemp()
+    src = mkdtemp()
+    os.mkdir(osp.join(root, "ws"))
+
+    files = []
+    for i in range(n):
+        files.append(osp.join(src, "f{0}.bin".format(i)))
+        with open(files[-1], "wb") as f:
+            f.write(os.urandom(size))
+
+    print("{0:>8} {1:>6} {2:>12} {3:>8} {4:>8}".format(
+        "latency", "drops", "concurrency", "MB/s", "dropped"))
+    try:
+        for latency, drop_rate in ((0, 0), (.01, 0), (.01, .1)):
+            for concurrency in (1, 4):
+                elapsed, dropped = yield run(root, files, concurrency,
+                                             latency, drop_rate)
+                print("{0:>8} {1:>6} {2:>12} {3:>8.1f} {4:>8}".format(
+                    latency, drop_rate, concurrency,
+                    n * size / elapsed / 1e6, dropped))
+    finally:
+        rmtree(root)
+        rmtree(src)
+
+
+if __name__ == "__main__":
+    task.react(main, sys.argv[1:])
@@ -0,0 +1,68 @@
+#! /usr/bin/env python
+"""Cost of watching a large tree with a budget of inotify watches and an
+mtime poller for the rest, compared with watching every directory.
+
+    $ python bench/bench_watch.py [directories] [budget]
+"""
+import os
+import sys
+import time
+import heapq
+from tempfile import mkdtemp
+from shutil import rmtree
+
+from twisted.internet import defer, task
+
+from pydio.storage import watch
+
+
+class Handler:
+    def filter_path(self, path, is_dir=False):
+        return True
+
+    def on_modified(self, ev):
+        return defer.succeed(None)
+
+    def reconcile(self, deep=False):
+        return defer.succeed({})
+
+
+@defer.inlineCallbacks
+def run(ws, budget, label):
+    w = watch.HybridWatcher(Handler(), ws, budget=budget)
+    t0 = time.perf_counter()
+    yield w.startService()
+    started = time.perf_counter() - t0
+
+    # poll every polled directory once
+    for d in w.dirs.values():
+        d.due = 0
+        heapq.heappush(w._polls, (0, d.path))
+    yield w.poll()
+    stats = w.stats()
+    yield w.stopService()
+
+    print("{0:<12} start {1:>5.2f}s, {2:>6} watched ({3:>4.0%}), {4:>6} "
+          "polled at {5:.1f} us/stat, {6:.0f} stats/s once idle".format(
+              label, started, stats["watched"], stats["coverage"],
+              stats["polled"], 1e6 * stats["poll_time"] / max(stats["polls"], 1),
+              stats["polled"] / w.max_interval,
+          ))
+
+
+@defer.inlineCallbacks
+def main(reactor, n="20000", budget="2000"):
+    n, budget = int(n), int(budget)
+    wd = mkdtemp()
+    try:
+        for i in range(n):
+            os.makedirs(os.path.join(wd, "d{0:03}".format(i % 100),
+                                     "d{0}".format(i)))
+        yield run(wd, budget, "budget {0}".format(budget))
+        yield run(wd, n + 101, "watch all")
+    finally:
+        rmtree(wd)
+
+
+if __name__ == "__main__":
+    task.react(main, sys.argv[1:])
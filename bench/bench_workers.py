@@ -0,0 +1,97 @@
+#! /usr/bin/env python
+"""Aggregate event and hashing throughput of jobs spread over worker
+processes, against the number of processes.
+
+    $ python bench/bench_workers.py [n_jobs] [files_per_job] [file_size]
+"""
+import os
+import sys
+import time
+import os.path as osp
+from shutil import rmtree
+from tempfile import mkdtemp
+
+from twisted.internet import defer, task
+
+from pydio.sched import Scheduler
+from pydio.test import fakeserver
+
+
+@defer.inlineCallbacks
+def indexed(scheduler):
+    status = yield scheduler.status()
+    defer.returnValue(sum(
+        sum(s.get("local", {}).values()) for s in status.values()
+    ))
+
+
+@defer.inlineCallbacks
+def run(reactor, server, staged, n_jobs, processes):
+    dirs = [mkdtemp() for _ in range(n_jobs)]
+    jobs = {
+        "job{0}".format(i): dict(
+            directory=d, filters=dict(include=["*"], exclude=[]),
+            server=server, workspace="ws", direction="down", frequency=1,
+        )
+        for i, d in enumerate(dirs)
+    }
+
+    scheduler = Scheduler(jobs, processes=processes)
+    scheduler.startService()
+    while True:
+        status = yield scheduler.status()
+        if all(s["running"] for s in status.values()):
+            break
+        yield task.deferLater(reactor, .1, lambda: None)
+
+    # hard links create complete files, which yields one event per file
+    t0 = time.perf_counter()
+    for d in dirs:
+        for path in staged:
+            os.link(path, osp.join(d, osp.basename(path)))
+
+    expected = n_jobs * len(staged)
+    while (yield indexed(scheduler)) < expected:
+        yield task.deferLater(reactor, .05, lambda: None)
+    elapsed = time.perf_counter() - t0
+
+    yield scheduler.stopService()
+    for d in dirs:
+        rmtree(d)
+    defer.returnValue(elapsed)
+
+
+@defer.inlineCallbacks
+def main(reactor, n_jobs="8", n_files="200", size=str(1 << 20)):
+    n_jobs, n_files, size = int(n_jobs), int(n_files), int(size)
+    root, src = mkdtemp(), mkdtemp()
+    os.mkdir(osp.join(root, "ws"))
+    port, _ = fakeserver.listen(root)
+    server = "http://127.0.0.1:{0}".format(port.getHost().port)
+
+    staged = []
+    for i in range(n_files):
+        staged.append(osp.join(src, "f{0}.bin".format(i)))
+        with open(staged[-1], "wb") as f:
+            f.write(os.urandom(size))
+
+    cores = os.cpu_count() or 1
+    print("{0} jobs x {1} files of {2} bytes, {3} cores".format(
+        n_jobs, n_files, size, cores))
+    print("{0:>10} {1:>10} {2:>10} {3:>8}".format(
+        "processes", "seconds", "events/s", "MB/s"))
+    try:
+        for processes in [None] + sorted({1, 2, cores, 2 * cores}):
+            elapsed = yield run(reactor, server, staged, n_jobs, processes)
+            total = n_jobs * n_files
+            print("{0:>10} {1:>10.2f} {2:>10.0f} {3:>8.1f}".format(
+                processes or "inline", elapsed, total / elapsed,
+                total * size / elapsed / 1e6))
+    finally:
+        yield port.stopListening()
+        rmtree(root)
+        rmtree(src)
+
+
+if __name__ == "__main__":
+    task.react(main, sys.argv[1:])
@@ -12,11 +12,22 @@ class IDiffEngine(IService):
 
     updater = Attribute("IStateManager")
     stream = Attribute("IDiffStream")
+    queue = Attribute("IWorkQueue")
+    transfers = Attribute("ITransferLog")
+    signatures = Attribute("ISignatureStore")
+    chunks = Attribute("IChunkIndex")
+    index = Attribute("IPathIndex")
+    snapshots = Attribute("ISnapshotStore")
+    cursor = Attribute("ICursorStore")
 
 
 class IStateManager(Interface):
     """IStateManager receives changes to inodes and updates the state of an
     ISynchronizable, usually triggering the creation of a diff as a side-effect.
+
+    Inodes are pydio.util.records.Inode records, or any mapping with the same
+    keys.  They may carry a `chunks` list of (digest, bytesize) pairs, which is
+    recorded in the chunk index.
     """
 
     def create(inode, directory=False):
@@ -37,3 +48,142 @@ class IDiffStream(Interface):
 
     def next():
         """Produce next batch of diffs"""
+
+    def ack():
+        """Acknowledge the diffs produced so far, which may then be pruned"""
+
+
+class IWorkQueue(Interface):
+    """Tracks the processing status of each inode.
+
+    Inodes move through NEW -> QUEUED -> TRANSFERRING -> DONE, or back to NEW
+    with a backoff delay when processing fails.  Inodes that exhaust their
+    retries are parked as FAILED.
+    """
+
+    def claim(n):
+        """Atomically move up to `n` due NEW inodes to QUEUED and return them"""
+
+    def start(node_ids):
+        """Mark QUEUED inodes as TRANSFERRING"""
+
+    def done(node_ids):
+        """Mark TRANSFERRING inodes as DONE"""
+
+    def fail(node_id, detail=None):
+        """Schedule a retry for an inode, or park it as FAILED"""
+
+    def recover():
+        """Return inodes that were claimed but never completed to NEW"""
+
+
+class ITransferLog(Interface):
+    """Records the progress of chunked transfers so that they can be resumed"""
+
+    def get(node_path, direction):
+        """Return the saved (offset, bytesize, md5), or None"""
+
+    def save(node_path, direction, offset, bytesize, md5):
+        """Record that `offset` bytes were acknowledged"""
+
+    def clear(node_path, direction):
+        """Forget a completed or abandoned transfer"""
+
+
+class ISignatureStore(Interface):
+    """Stores the block signature of the last synchronized version of a file"""
+
+    def get(node_path):
+        """Return the saved pydio.util.delta.Signature, or None"""
+
+    def indexed(node_path):
+        """Return the Signature computed when the file was last indexed, or
+        None if the hasher does not compute block signatures.
+        """
+
+    def save(node_path, signature):
+        """Save the signature of an indexed file"""
+
+
+class IChunkIndex(Interface):
+    """Index of the content-defined chunks of indexed files"""
+
+    def chunks_of(node_path):
+        """Return the (digest, bytesize) chunk list of a file"""
+
+    def synced_duplicate(md5):
+        """Return the path of an already-synchronized file with identical
+        content, or None
+        """
+
+    def stats():
+        """Return a dict of logical bytes, unique bytes and dedup ratio"""
+
+    def prune():
+        """Forget chunks that are no longer referenced by any file.  Fires
+        with their number.
+        """
+
+
+class IPathIndex(Interface):
+    """In-memory map of indexed paths to IndexEntry(node_id, md5, bytesize,
+    mtime), kept in step with `ajxp_index` by the IStateManager.
+
+    The index may hold only part of `ajxp_index` if it has a memory budget.
+    """
+
+    complete = Attribute("True if every indexed path is held in memory")
+
+    def load():
+        """Fill the index from `ajxp_index` in one query"""
+
+    def peek(node_path):
+        """Return the entry held in memory, or None.  Never queries the
+        database, so it may be called from any thread.
+        """
+
+    def get(node_path):
+        """Fire with the entry for `node_path`, or None if it isn't indexed.
+        The database is only queried if the index is not complete.
+        """
+
+    def children(node_path):
+        """Fire with {node_path: entry} for the paths indexed directly under
+        the directory `node_path`
+        """
+
+    def subtree(node_path):
+        """Fire with {node_path: entry} for `node_path` and the paths indexed
+        beneath it
+        """
+
+
+class ISnapshotStore(Interface):
+    """Stores the (mtime, digest) of each directory's listing as of its last
+    scan, so that changes made while the filesystem was not watched can be
+    found without listing unchanged directories.
+    """
+
+    def load():
+        """Fire with {dir_path: (mtime, digest)}"""
+
+    def save(snapshots):
+        """Save an iterable of (dir_path, mtime, digest)"""
+
+    def discard(dir_path):
+        """Forget the snapshots of a directory and of its subdirectories"""
+
+    def empty():
+        """Fire with True if no directory has a snapshot"""
+
+
+class ICursorStore(Interface):
+    """Stores the change cursor of a remote workspace, so that a restart
+    follows its changes from where the last run stopped.
+    """
+
+    def load():
+        """Fire with the saved cursor, or None"""
+
+    def save(cursor):
+        """Replace the saved cursor"""
@@ -1,2 +1,7 @@
 #! /usr/bin/env python
-from .sqlite import Engine, DiffStream, StateManager, SQL_INIT_FILE
+from .sqlite import (
+    Engine, DiffStream, StateManager, WorkQueue, TransferLog, SignatureStore,
+    ChunkIndex, SnapshotStore, CursorStore, PathIndex, IndexEntry,
+    Maintenance, migrate, set_triggers, SQL_INIT_FILE, SCHEMA_VERSION,
+    TRIGGERS,
+)
@@ -0,0 +1,26 @@
+-- Version 1: bring the unversioned schema (user_version 0) up to date with
+-- the work queue, transfer progress, delta signatures, chunk index and
+-- content hashes.  Triggers are recreated by set_triggers.
+
+BEGIN;
+
+ALTER TABLE ajxp_node_status ADD COLUMN "attempts" INTEGER NOT NULL DEFAULT 0;
+ALTER TABLE ajxp_node_status ADD COLUMN "next_attempt" NUMERIC NOT NULL DEFAULT 0;
+
+ALTER TABLE ajxp_index ADD COLUMN blake2b TEXT;
+ALTER TABLE ajxp_index ADD COLUMN sha256 TEXT;
+ALTER TABLE ajxp_index ADD COLUMN block_size INTEGER;
+ALTER TABLE ajxp_index ADD COLUMN blocks BLOB;
+
+CREATE TABLE IF NOT EXISTS ajxp_transfers ( node_path TEXT NOT NULL, direction TEXT NOT NULL, offset INTEGER NOT NULL DEFAULT 0, bytesize NUMERIC, md5 TEXT, PRIMARY KEY (node_path, direction) );
+CREATE TABLE IF NOT EXISTS ajxp_signatures ( node_id INTEGER PRIMARY KEY, md5 TEXT, bytesize NUMERIC, block_size INTEGER, blocks BLOB );
+CREATE TABLE IF NOT EXISTS ajxp_chunks ( digest BLOB PRIMARY KEY, bytesize INTEGER NOT NULL ) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS ajxp_file_chunks ( node_id INTEGER NOT NULL, seq INTEGER NOT NULL, digest BLOB NOT NULL, PRIMARY KEY (node_id, seq) ) WITHOUT ROWID;
+
+DROP INDEX IF EXISTS node_status_status;
+CREATE INDEX node_status_status ON ajxp_node_status( status, next_attempt );
+CREATE INDEX IF NOT EXISTS file_chunks_digest ON ajxp_file_chunks( digest );
+
+PRAGMA user_version = 1;
+
+COMMIT;
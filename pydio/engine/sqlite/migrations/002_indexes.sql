@@ -0,0 +1,24 @@
+-- Drop indexes that are redundant (node_id is the rowid) or never read, make
+-- node_path unique, keeping the most recent row of duplicated paths, and
+-- cover the duplicate lookup by md5.
+
+BEGIN;
+
+DROP INDEX IF EXISTS index_node_id;
+DROP INDEX IF EXISTS index_bytesize;
+DROP INDEX IF EXISTS changes_node_id;
+DROP INDEX IF EXISTS changes_type;
+DROP INDEX IF EXISTS changes_node_source;
+DROP INDEX IF EXISTS index_node_path;
+DROP INDEX IF EXISTS index_md5;
+
+DELETE FROM ajxp_index WHERE node_id NOT IN (
+    SELECT MAX(node_id) FROM ajxp_index GROUP BY node_path
+);
+
+CREATE UNIQUE INDEX index_node_path ON ajxp_index( node_path );
+CREATE INDEX index_md5 ON ajxp_index( md5, node_path );
+
+PRAGMA user_version = 2;
+
+COMMIT;
@@ -0,0 +1,10 @@
+-- Per-directory snapshots (mtime and listing digest), used to reconcile
+-- changes made while the daemon was not watching.
+
+BEGIN;
+
+CREATE TABLE IF NOT EXISTS ajxp_snapshots ( dir_path TEXT PRIMARY KEY, mtime NUMERIC NOT NULL, digest BLOB NOT NULL ) WITHOUT ROWID;
+
+PRAGMA user_version = 3;
+
+COMMIT;
@@ -0,0 +1,10 @@
+-- Requeue an inode only when its content changes: STATUS_UPDATE is dropped
+-- here and recreated from pydio.sql by set_triggers.
+
+BEGIN;
+
+DROP TRIGGER IF EXISTS STATUS_UPDATE;
+
+PRAGMA user_version = 4;
+
+COMMIT;
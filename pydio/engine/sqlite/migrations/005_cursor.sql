@@ -0,0 +1,9 @@
+-- The change cursor of a remote workspace, in a single row.
+
+BEGIN;
+
+CREATE TABLE IF NOT EXISTS ajxp_cursor ( id INTEGER PRIMARY KEY CHECK (id = 0), cursor );
+
+PRAGMA user_version = 5;
+
+COMMIT;
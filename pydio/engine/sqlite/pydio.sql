@@ -1,20 +1,29 @@
+PRAGMA auto_vacuum = INCREMENTAL;
+
 CREATE TABLE ajxp_changes ( seq INTEGER PRIMARY KEY AUTOINCREMENT, node_id NUMERIC, type TEXT, source TEXT, target TEXT, deleted_md5 TEXT );
-CREATE TABLE ajxp_index ( node_id INTEGER PRIMARY KEY AUTOINCREMENT, node_path TEXT, bytesize NUMERIC, md5 TEXT, mtime NUMERIC, stat_result BLOB);
+CREATE TABLE ajxp_index ( node_id INTEGER PRIMARY KEY AUTOINCREMENT, node_path TEXT, bytesize NUMERIC, md5 TEXT, mtime NUMERIC, stat_result BLOB, blake2b TEXT, sha256 TEXT, block_size INTEGER, blocks BLOB);
 CREATE TABLE ajxp_last_buffer ( id INTEGER PRIMARY KEY AUTOINCREMENT, type TEXT, location TEXT, source TEXT, target TEXT );
-CREATE TABLE ajxp_node_status ("node_id" INTEGER PRIMARY KEY  NOT NULL , "status" TEXT NOT NULL  DEFAULT 'NEW', "detail" TEXT);
+CREATE TABLE ajxp_node_status ("node_id" INTEGER PRIMARY KEY  NOT NULL , "status" TEXT NOT NULL  DEFAULT 'NEW', "detail" TEXT, "attempts" INTEGER NOT NULL DEFAULT 0, "next_attempt" NUMERIC NOT NULL DEFAULT 0);
+CREATE TABLE ajxp_transfers ( node_path TEXT NOT NULL, direction TEXT NOT NULL, offset INTEGER NOT NULL DEFAULT 0, bytesize NUMERIC, md5 TEXT, PRIMARY KEY (node_path, direction) );
+CREATE TABLE ajxp_signatures ( node_id INTEGER PRIMARY KEY, md5 TEXT, bytesize NUMERIC, block_size INTEGER, blocks BLOB );
+CREATE TABLE ajxp_chunks ( digest BLOB PRIMARY KEY, bytesize INTEGER NOT NULL ) WITHOUT ROWID;
+CREATE TABLE ajxp_file_chunks ( node_id INTEGER NOT NULL, seq INTEGER NOT NULL, digest BLOB NOT NULL, PRIMARY KEY (node_id, seq) ) WITHOUT ROWID;
+CREATE TABLE ajxp_snapshots ( dir_path TEXT PRIMARY KEY, mtime NUMERIC NOT NULL, digest BLOB NOT NULL ) WITHOUT ROWID;
+CREATE TABLE ajxp_cursor ( id INTEGER PRIMARY KEY CHECK (id = 0), cursor );
 CREATE TABLE events (id INTEGER PRIMARY KEY AUTOINCREMENT, type text, message text, source text, target text, action text, status text, date text);
 
 CREATE TRIGGER LOG_DELETE AFTER DELETE ON ajxp_index BEGIN INSERT INTO ajxp_changes (node_id,source,target,type,deleted_md5) VALUES (old.node_id, old.node_path, "NULL", "delete", old.md5); END;
 CREATE TRIGGER LOG_INSERT AFTER INSERT ON ajxp_index BEGIN INSERT INTO ajxp_changes (node_id,source,target,type) VALUES (new.node_id, "NULL", new.node_path, "create"); END;
 CREATE TRIGGER LOG_UPDATE_CONTENT AFTER UPDATE ON "ajxp_index" FOR EACH ROW BEGIN INSERT INTO "ajxp_changes" (node_id,source,target,type) VALUES (new.node_id, old.node_path, new.node_path, CASE WHEN old.node_path = new.node_path THEN "content" ELSE "path" END);END;
+CREATE TRIGGER CHUNKS_DELETE AFTER DELETE ON "ajxp_index" BEGIN DELETE FROM ajxp_file_chunks WHERE node_id=old.node_id; END;
+CREATE TRIGGER SIGNATURE_DELETE AFTER DELETE ON "ajxp_index" BEGIN DELETE FROM ajxp_signatures WHERE node_id=old.node_id; END;
 CREATE TRIGGER STATUS_DELETE AFTER DELETE ON "ajxp_index" BEGIN DELETE FROM ajxp_node_status WHERE node_id=old.node_id; END;
 CREATE TRIGGER STATUS_INSERT AFTER INSERT ON "ajxp_index" BEGIN INSERT INTO ajxp_node_status (node_id) VALUES (new.node_id); END;
+CREATE TRIGGER STATUS_UPDATE AFTER UPDATE OF md5, bytesize, mtime ON "ajxp_index" FOR EACH ROW WHEN old.md5 IS NOT new.md5 OR old.bytesize IS NOT new.bytesize OR old.mtime IS NOT new.mtime BEGIN UPDATE ajxp_node_status SET status='NEW', detail=NULL, attempts=0, next_attempt=0 WHERE node_id=new.node_id; END;
+
+CREATE UNIQUE INDEX index_node_path ON ajxp_index( node_path );
+CREATE INDEX index_md5 ON ajxp_index( md5, node_path );
+CREATE INDEX file_chunks_digest ON ajxp_file_chunks( digest );
+CREATE INDEX node_status_status ON ajxp_node_status( status, next_attempt );
 
-CREATE INDEX changes_node_id ON ajxp_changes( node_id );
-CREATE INDEX changes_type ON ajxp_changes( type );
-CREATE INDEX changes_node_source ON ajxp_changes( source );
-CREATE INDEX index_node_id ON ajxp_index( node_id );
-CREATE INDEX index_node_path ON ajxp_index( node_path );
-CREATE INDEX index_bytesize ON ajxp_index( bytesize );
-CREATE INDEX index_md5 ON ajxp_index( md5 );
-CREATE INDEX node_status_status ON ajxp_node_status( status );
+PRAGMA user_version = 5;
@@ -1,76 +1,234 @@
 #! /usr/bin/env python
-from os import makedirs
+import sys
+from os import makedirs, listdir
 import os.path as osp
 from functools import wraps
+from datetime import datetime, timezone
+from collections import OrderedDict, namedtuple
 
 from zope.interface import implementer
 
 from twisted.logger import Logger
-from twisted.internet import defer
-from twisted.internet.threads import deferToThread
+from twisted.internet import defer, task
 from twisted.application.service import Service
 
 from pydio.util.adbapi import ConnectionManager
-from pydio.engine import IDiffEngine, IStateManager, IDiffStream
+from pydio.engine import (
+    IDiffEngine, IStateManager, IDiffStream, IWorkQueue, ITransferLog,
+    ISignatureStore, IChunkIndex, IPathIndex, ISnapshotStore, ICursorStore,
+)
+from pydio.util.delta import Signature
+from pydio.util.records import Inode, Change
 
 SQL_INIT_FILE = osp.join(osp.dirname(__file__), "pydio.sql")
+MIGRATIONS_DIR = osp.join(osp.dirname(__file__), "migrations")
+
+# the version SQL_INIT_FILE creates; migration N upgrades a schema to N
+SCHEMA_VERSION = 5
+
+# ajxp_index columns written by StateManager.create and StateManager.modify
+INODE_COLUMNS = (
+    "bytesize", "md5", "mtime", "stat_result",
+    "blake2b", "sha256", "block_size", "blocks",
+)
+
+# the columns whose change requeues an inode (see STATUS_UPDATE)
+CONTENT_COLUMNS = ("md5", "bytesize", "mtime")
 
 def values_as_tuple(d, *param):
     """Return the values for each key in `param` as a tuple"""
     return tuple(map(d.get, param))
 
 
+def _save_chunks(c, node_path, chunks):
+    """Replace the chunk list of an indexed file"""
+    c.execute("SELECT node_id FROM ajxp_index WHERE node_path=?;", (node_path,))
+    row = c.fetchone()
+    if row is None:
+        return
+    node_id, = row
+
+    c.executemany(
+        "INSERT OR IGNORE INTO ajxp_chunks (digest, bytesize) VALUES (?,?);",
+        chunks,
+    )
+    c.execute("DELETE FROM ajxp_file_chunks WHERE node_id=?;", (node_id,))
+    c.executemany(
+        "INSERT INTO ajxp_file_chunks (node_id, seq, digest) VALUES (?,?,?);",
+        ((node_id, seq, digest) for seq, (digest, _) in enumerate(chunks)),
+    )
+
+
+def migrations(version):
+    """Yield the (version, script) of each migration above `version`, in
+    order.
+    """
+    for name in sorted(listdir(MIGRATIONS_DIR)):
+        target = int(name.split("_", 1)[0])
+        if target > version:
+            with open(osp.join(MIGRATIONS_DIR, name)) as f:
+                yield target, f.read()
+
+
+def migrate(c):
+    """Create the schema, or bring an existing one up to SCHEMA_VERSION.
+    Returns the version found, or None if the database was empty.
+    """
+    c.execute(
+        "SELECT 1 FROM sqlite_master WHERE type='table' AND name='ajxp_index';"
+    )
+    if c.fetchone() is None:
+        with open(SQL_INIT_FILE) as f:
+            c.executescript(f.read())
+        return None
+
+    c.execute("PRAGMA user_version;")
+    version, = c.fetchone()
+    for target, script in migrations(version):
+        Engine.log.info("migrating schema to version {v}", v=target)
+        c.executescript(script)
+    return version
+
+
+# the triggers that log changes and maintain dependent rows, replaced by
+# StateManager(log_changes=True)
+TRIGGERS = (
+    "LOG_DELETE", "LOG_INSERT", "LOG_UPDATE_CONTENT", "CHUNKS_DELETE",
+    "SIGNATURE_DELETE", "STATUS_DELETE", "STATUS_INSERT", "STATUS_UPDATE",
+)
+
+
+def set_triggers(c, enabled):
+    """Drop the TRIGGERS, or recreate those that are missing from their
+    definitions in SQL_INIT_FILE.
+    """
+    c.execute("SELECT name FROM sqlite_master WHERE type='trigger';")
+    present = {name for name, in c.fetchall()}
+
+    if not enabled:
+        for name in present.intersection(TRIGGERS):
+            c.execute("DROP TRIGGER {0};".format(name))
+        return
+
+    missing = set(TRIGGERS) - present
+    if missing:
+        with open(SQL_INIT_FILE) as f:
+            for line in f:
+                if line.startswith("CREATE TRIGGER"):
+                    if line.split()[2] in missing:
+                        c.execute(line)
+
+
+def _subtree(node_path):
+    """Return `node_path`, and bounds on the paths beneath it, such that an
+    index on node_path can serve the lookup.
+    """
+    prefix = osp.join(node_path, "")
+    return node_path, prefix, prefix[:-1] + chr(ord("/") + 1)
+
+
 @implementer(IDiffEngine)
 class Engine(Service):
+    """SQLite-backed IDiffEngine.  `index_budget` caps the memory used by the
+    in-memory path index, in bytes.  Database maintenance runs every
+    `maintenance_interval` seconds.
+
+    Changes are logged by triggers, unless `triggers` is False, in which case
+    the StateManager logs them in batches and the triggers are dropped.
+    """
 
     log = Logger()
 
-    def __init__(self, db_file):
+    def __init__(self, db_file, index_budget=None, maintenance_interval=60,
+                 triggers=True):
         super().__init__()
+        self.triggers = triggers
 
         self.log.debug("opening database in {path}", path=db_file.strip(":"))
         self._db_file = db_file
         self._db = ConnectionManager(db_file)
+        self._stream = DiffStream(self._db)
+        self._index = PathIndex(self._db, index_budget)
+        self._snapshots = SnapshotStore(self._db)
+        self._cursor = CursorStore(self._db)
+        self.maintenance = Maintenance(self._db, self._stream)
+        self._maintenance_interval = maintenance_interval
+        self._maintenance_loop = task.LoopingCall(self._maintain)
 
     @defer.inlineCallbacks
     def _init_db(self):
-        from sqlite3 import OperationalError
-
         if self._db_file != ":memory:":
             root_path, _ = osp.split(self._db_file)
             if not osp.exists(root_path):
                 makedirs(root_path)
 
-        def run_startup_script():
-            with open(SQL_INIT_FILE) as f:
-                run_script = lambda c, s: c.executescript(s)
-                self._db.runInteraction(run_script, f.read())
-                self.log.debug("database initialized")
-
-        try:
-            yield self._db.runQuery("SELECT * FROM ajxp_index LIMIT 1;")
-            self.log.debug("resuming with existing database")
-        except OperationalError:
-            self.log.info("initializing db from `{p}`", p=SQL_INIT_FILE)
-            yield deferToThread(run_startup_script)
+        version = yield self._db.runInteraction(migrate)
+        yield self._db.runInteraction(set_triggers, self.triggers)
+        if version is None:
+            self.log.info("initialized db from `{p}`", p=SQL_INIT_FILE)
+            return
+
+        self.log.debug("resuming with existing database")
+        n = yield self.queue.recover()
+        self.log.debug("re-queued {n} interrupted inodes", n=n)
+        n = yield self._index.load()
+        self.log.debug("loaded {n} paths into the index", n=n)
+        yield self.maintenance.enable_auto_vacuum()
+
+    def _maintain(self):
+        return self.maintenance.run().addErrback(
+            lambda f: self.log.failure("database maintenance failed", f)
+        )
 
     def startService(self):
         self.log.debug("starting diff engine")
         super().startService()
+        self._maintenance_loop.start(self._maintenance_interval, now=False)
         return self._init_db()
 
     def stopService(self):
         self.log.debug("halting")
         super().stopService()
+        if self._maintenance_loop.running:
+            self._maintenance_loop.stop()
         return self._db.close()
 
     @property
     def updater(self):
-        return StateManager(self._db)
+        return StateManager(self._db, self._index, not self.triggers,
+                            self._snapshots, self._cursor)
 
     @property
     def stream(self):
-        return DiffStream(self._db)
+        return self._stream
+
+    @property
+    def queue(self):
+        return WorkQueue(self._db)
+
+    @property
+    def transfers(self):
+        return TransferLog(self._db)
+
+    @property
+    def signatures(self):
+        return SignatureStore(self._db)
+
+    @property
+    def chunks(self):
+        return ChunkIndex(self._db)
+
+    @property
+    def index(self):
+        return self._index
+
+    @property
+    def snapshots(self):
+        return self._snapshots
+
+    @property
+    def cursor(self):
+        return self._cursor
 
 
 @implementer(IDiffStream)
@@ -80,10 +238,216 @@ class DiffStream:
 
     def __init__(self, db):
         self._db = db
+        self._seq = 0
+        self.acked = 0
 
     def next(self):
-        raise NotImplementedError("I shall return a tuple of diffs")
+        """Fire with a tuple of the Changes logged since the previous call"""
+        d = self._db.runQuery(
+            "SELECT seq, node_id, type, source, target, deleted_md5 "
+            "FROM ajxp_changes WHERE seq>? ORDER BY seq;",
+            (self._seq,),
+        )
+
+        def advance(rows):
+            if rows:
+                self._seq = rows[-1][0]
+            return tuple(Change(*row) for row in rows)
+
+        return d.addCallback(advance)
+
+    def ack(self):
+        self.acked = self._seq
+
+
+class Maintenance:
+    """Keeps the database from growing without bound.
 
+    Each pass deletes the changes acknowledged by the merger, and trims
+    `events` to its `max_events` most recent rows, none older than
+    `max_event_age` seconds.  If no inode changed since the previous pass,
+    the chunks no file references are pruned, and up to `vacuum_pages` free
+    pages are then returned to the filesystem.
+    """
+
+    log = Logger()
+
+    def __init__(self, db, stream, max_events=10000,
+                 max_event_age=30 * 86400, vacuum_pages=256, clock=None):
+        self._db = db
+        self._stream = stream
+        self.max_events = max_events
+        self.max_event_age = max_event_age
+        self.vacuum_pages = vacuum_pages
+
+        if clock is None:
+            from twisted.internet import reactor as clock
+        self._clock = clock
+
+        self._last_seq = None
+        self.pruned = 0
+        self.rotated = 0
+        self.chunks_pruned = 0
+        self.vacuumed = 0
+
+    def enable_auto_vacuum(self):
+        """Switch databases created without incremental auto-vacuum to it,
+        which takes a full VACUUM.
+        """
+        def enable(c):
+            c.execute("PRAGMA auto_vacuum;")
+            if c.fetchone()[0] != 2:
+                self.log.info("enabling incremental auto-vacuum")
+                c.execute("PRAGMA auto_vacuum = INCREMENTAL;")
+                c.execute("VACUUM;")
+
+        return self._db.runInteraction(enable)
+
+    def run(self):
+        return self._db.runInteraction(self._run, self._clock.seconds())
+
+    def _run(self, c, now):
+        c.execute("DELETE FROM ajxp_changes WHERE seq<=?;",
+                  (self._stream.acked,))
+        self.pruned += c.rowcount
+
+        # dates are stored as naive UTC, e.g. "2014-01-31 12:00:00"
+        cutoff = datetime.fromtimestamp(now - self.max_event_age, timezone.utc)
+        c.execute("DELETE FROM events WHERE date<?;",
+                  (cutoff.replace(tzinfo=None).isoformat(" "),))
+        self.rotated += c.rowcount
+        c.execute(
+            "DELETE FROM events WHERE id<=("
+            "  SELECT id FROM events ORDER BY id DESC LIMIT 1 OFFSET ?"
+            ");",
+            (self.max_events,),
+        )
+        self.rotated += c.rowcount
+
+        c.execute("SELECT seq FROM sqlite_sequence WHERE name='ajxp_changes';")
+        row = c.fetchone()
+        seq = row and row[0]
+        idle, self._last_seq = seq == self._last_seq, seq
+        if not idle:
+            return
+
+        self.chunks_pruned += _prune_chunks(c)
+        c.execute("PRAGMA freelist_count;")
+        free, = c.fetchone()
+        if free:
+            # sqlite3 only steps an execute()d pragma once, freeing a single
+            # page; executescript commits the pruning and runs it to the end
+            c.executescript("PRAGMA incremental_vacuum({0:d});".format(
+                self.vacuum_pages))
+            c.execute("PRAGMA freelist_count;")
+            self.vacuumed += free - c.fetchone()[0]
+
+    def stats(self):
+        """Fire with the database's size, page usage and row counts, and the
+        totals of rows pruned and pages vacuumed so far.
+        """
+        def collect(c):
+            stats = {}
+            for pragma in ("page_size", "page_count", "freelist_count"):
+                c.execute("PRAGMA {0};".format(pragma))
+                stats[pragma] = c.fetchone()[0]
+            for table in ("ajxp_index", "ajxp_changes", "events"):
+                c.execute("SELECT COUNT(*) FROM {0};".format(table))
+                stats[table] = c.fetchone()[0]
+
+            stats.update(
+                size=stats["page_size"] * stats["page_count"],
+                pruned=self.pruned,
+                rotated=self.rotated,
+                chunks_pruned=self.chunks_pruned,
+                vacuumed=self.vacuumed,
+            )
+            return stats
+
+        return self._db.runInteraction(collect)
+
+
+def _prune_chunks(c):
+    """Delete the chunks no file references, and return how many"""
+    c.execute(
+        "DELETE FROM ajxp_chunks WHERE digest NOT IN "
+        "(SELECT digest FROM ajxp_file_chunks);"
+    )
+    return c.rowcount
+
+
+def _log_upsert(c, node_ids, inode, old):
+    """Do the work of LOG_INSERT and STATUS_INSERT, or of LOG_UPDATE_CONTENT
+    and STATUS_UPDATE if the row existed with the (md5, bytesize, mtime)
+    `old`, for the `node_ids` the upsert returned: none if the row existed
+    unchanged.  Upserts never change a path.
+    """
+    node_path = inode["node_path"]
+    if old is not None:
+        c.executemany(
+            "INSERT INTO ajxp_changes (node_id,source,target,type) "
+            "VALUES (?,?,?,'content');",
+            [(node_id, node_path, node_path) for node_id in node_ids],
+        )
+        if tuple(old) == values_as_tuple(inode, *CONTENT_COLUMNS):
+            return
+        c.executemany(
+            "UPDATE ajxp_node_status SET status='NEW', detail=NULL, "
+            "attempts=0, next_attempt=0 WHERE node_id=?;",
+            [(node_id,) for node_id in node_ids],
+        )
+    else:
+        c.executemany(
+            "INSERT INTO ajxp_changes (node_id,source,target,type) "
+            "VALUES (?,'NULL',?,'create');",
+            [(node_id, node_path) for node_id in node_ids],
+        )
+        c.executemany(
+            "INSERT INTO ajxp_node_status (node_id) VALUES (?);",
+            [(node_id,) for node_id in node_ids],
+        )
+
+
+SUBTREE = "node_path=? OR (node_path>=? AND node_path<?)"
+
+
+def _log_delete(c, subtree):
+    """Do the work of LOG_DELETE, CHUNKS_DELETE, SIGNATURE_DELETE and
+    STATUS_DELETE for the rows of ajxp_index about to be deleted, with one
+    statement each.
+    """
+    c.execute(
+        "INSERT INTO ajxp_changes (node_id,source,target,type,deleted_md5) "
+        "SELECT node_id, node_path, 'NULL', 'delete', md5 FROM ajxp_index "
+        "WHERE " + SUBTREE + " ORDER BY node_path;",
+        subtree,
+    )
+    for table in ("ajxp_file_chunks", "ajxp_signatures", "ajxp_node_status"):
+        c.execute(
+            "DELETE FROM {0} WHERE node_id IN "
+            "(SELECT node_id FROM ajxp_index WHERE {1});".format(
+                table, SUBTREE,
+            ),
+            subtree,
+        )
+
+
+# an existing row is only updated, and its node_id returned, if its content
+# or digests changed, so that re-indexing an unchanged file neither logs a
+# change nor requeues it.  stat_result is left out, as atime changes it.
+UPSERT_INODE = (
+    "INSERT INTO ajxp_index (node_path,{0}) VALUES (?,{1}) "
+    "ON CONFLICT (node_path) DO UPDATE SET {2} WHERE {3} "
+    "RETURNING node_id;"
+).format(
+    ",".join(INODE_COLUMNS),
+    ",".join("?" * len(INODE_COLUMNS)),
+    ", ".join("{0}=excluded.{0}".format(c) for c in INODE_COLUMNS),
+    " OR ".join(
+        "ajxp_index.{0} IS NOT excluded.{0}".format(c)
+        for c in INODE_COLUMNS if c != "stat_result"
+    ),
+)
 
 def _log_state_change(verb):
     def decorator(fn):
@@ -92,7 +456,7 @@ def _log_state_change(verb):
             itype = ("file", "directory")[directory]
             self.log.debug("{verb} {itype} `{ipath}`",
                            verb=verb, itype=itype, ipath=inode["node_path"])
-            fn(self, inode, directory)
+            return fn(self, inode, directory)
         return logger
     return decorator
 
@@ -101,48 +465,517 @@ def _log_state_change(verb):
 class StateManager:
     """Manages the SQLite database's state, ensuring that it reflects the state
     of the filesystem.
+
+    If a PathIndex is given, it is updated once each mutation is committed.
+    Deleting a directory also deletes the snapshots of its subtree.  The
+    `snapshots` and `cursor` stores, if any, are exposed to the storage
+    layer.
+    If `log_changes` is set, the rows the TRIGGERS would write are written
+    by the StateManager instead, in the same transaction as the mutation,
+    with one statement per table rather than one trigger per row.
     """
 
     log = Logger()
 
-    def __init__(self, db):
+    def __init__(self, db, index=None, log_changes=False, snapshots=None,
+                 cursor=None):
         self._db = db
+        self.index = index
+        self.log_changes = log_changes
+        self.snapshots = snapshots
+        self.cursor = cursor
+
+    def _upsert(self, inode):
+        """Insert the inode, or update the row that has the same path"""
+        params = values_as_tuple(inode, "node_path", *INODE_COLUMNS)
+
+        def mutate(c):
+            if self.log_changes:
+                c.execute(
+                    "SELECT {0} FROM ajxp_index WHERE node_path=?;".format(
+                        ",".join(CONTENT_COLUMNS),
+                    ),
+                    params[:1],
+                )
+                old = c.fetchone()
+
+            c.execute(UPSERT_INODE, params)
+            node_ids = [node_id for node_id, in c.fetchall()]
+
+            if self.log_changes:
+                _log_upsert(c, node_ids, inode, old)
+            if inode.get("chunks") is not None:
+                _save_chunks(c, inode["node_path"], inode["chunks"])
+            return node_ids
+
+        return self._db.runInteraction(mutate).addCallback(
+            self._write_through, inode,
+        )
+
+    def _write_through(self, node_ids, inode):
+        if self.index is not None:
+            for node_id in node_ids:
+                self.index.put(inode["node_path"], IndexEntry(
+                    node_id, inode.get("md5"), inode.get("bytesize"),
+                    inode.get("mtime"),
+                ))
 
     @_log_state_change("create")
     def create(self, inode, directory=False):
-        params = values_as_tuple(
-            inode, "node_path", "bytesize", "md5", "mtime", "stat_result"
+        return self._upsert(inode)
+
+    @_log_state_change("delete")
+    def delete(self, inode, directory=False):
+        subtree = _subtree(inode["node_path"])
+
+        def remove(c):
+            if self.log_changes:
+                _log_delete(c, subtree)
+            c.execute(
+                "DELETE FROM ajxp_snapshots WHERE dir_path=? "
+                "OR (dir_path>=? AND dir_path<?);",
+                subtree,
+            )
+            c.execute(
+                "DELETE FROM ajxp_index WHERE " + SUBTREE +
+                " RETURNING node_path;",
+                subtree,
+            )
+            return c.fetchall()
+
+        return self._db.runInteraction(remove).addCallback(self._discard)
+
+    def _discard(self, rows):
+        if self.index is not None:
+            for node_path, in rows:
+                self.index.discard(node_path)
+
+    @_log_state_change("modify")
+    def modify(self, inode, directory=False):
+        return self._upsert(inode)
+
+    @_log_state_change("move")
+    def move(self, inode, directory=False):
+        raise NotImplementedError("I shall move an inode in ajxp_index")
+
+
+IndexEntry = namedtuple("IndexEntry", "node_id md5 bytesize mtime")
+
+# rough memory cost of an index entry, besides its path and md5 strings
+ENTRY_OVERHEAD = sys.getsizeof(IndexEntry(0, "", 0, 0.)) + 100
+
+
+@implementer(IPathIndex)
+class PathIndex:
+    """In-memory copy of the node_path, node_id, md5, bytesize and mtime
+    columns of `ajxp_index`.
+
+    If `budget` is set, least recently used entries are evicted to keep the
+    index within that many bytes (approximately).  Once an entry has been
+    evicted, lookups of paths that are not in memory go to the database.
+    """
+
+    log = Logger()
+
+    def __init__(self, db, budget=None):
+        self._db = db
+        self.budget = budget
+        self.complete = True
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _cost(self, node_path, entry):
+        return (sys.getsizeof(node_path) + sys.getsizeof(entry.md5) +
+                ENTRY_OVERHEAD)
+
+    def put(self, node_path, entry):
+        self.discard(node_path)
+        self._entries[node_path] = entry
+        self.size += self._cost(node_path, entry)
+
+        while self.budget is not None and self.size > self.budget:
+            evicted = self._entries.popitem(last=False)
+            self.size -= self._cost(*evicted)
+            self.complete = False
+
+    def discard(self, node_path):
+        entry = self._entries.pop(node_path, None)
+        if entry is not None:
+            self.size -= self._cost(node_path, entry)
+
+    def load(self):
+        """Replace the index' content with `ajxp_index`.  The most recently
+        created inodes are kept if the budget is exceeded.  Fires with the
+        number of entries loaded.
+        """
+        def fetch(c):
+            c.execute(
+                "SELECT node_path, node_id, md5, bytesize, mtime "
+                "FROM ajxp_index ORDER BY node_id;"
+            )
+            index = PathIndex(None, self.budget)
+            for rows in iter(lambda: c.fetchmany(4096), []):
+                for node_path, *entry in rows:
+                    index.put(node_path, IndexEntry(*entry))
+            return index
+
+        def swap(index):
+            self._entries = index._entries
+            self.size, self.complete = index.size, index.complete
+            return len(self._entries)
+
+        return self._db.runInteraction(fetch).addCallback(swap)
+
+    def peek(self, node_path):
+        try:
+            entry = self._entries[node_path]
+            self._entries.move_to_end(node_path)
+            return entry
+        except KeyError:  # possibly evicted by another thread meanwhile
+            return None
+
+    def get(self, node_path):
+        entry = self.peek(node_path)
+        if entry is not None or self.complete:
+            self.hits += 1
+            return defer.succeed(entry)
+
+        self.misses += 1
+        d = self._db.runQuery(
+            "SELECT node_id, md5, bytesize, mtime FROM ajxp_index "
+            "WHERE node_path=?;",
+            (node_path,),
         )
 
+        def cache(rows):
+            if not rows:
+                return None
+            entry = IndexEntry(*rows[0])
+            self.put(node_path, entry)
+            return entry
+
+        return d.addCallback(cache)
+
+    def children(self, node_path):
+        """Fire with {node_path: IndexEntry} for the direct children of the
+        directory `node_path`, in one range query over index_node_path.
+        """
+        prefix = osp.join(node_path, "")
+        d = self._db.runQuery(
+            "SELECT node_path, node_id, md5, bytesize, mtime FROM ajxp_index "
+            "WHERE node_path>=? AND node_path<? "
+            "AND instr(substr(node_path, ?), '/')=0;",
+            (prefix, prefix[:-1] + "0", len(prefix) + 1),
+        )
+        return d.addCallback(lambda rows: {
+            node_path: IndexEntry(*entry) for node_path, *entry in rows
+        })
+
+    def subtree(self, node_path):
+        """Fire with {node_path: IndexEntry} for `node_path` and every path
+        indexed beneath it.
+        """
+        d = self._db.runQuery(
+            "SELECT node_path, node_id, md5, bytesize, mtime FROM ajxp_index "
+            "WHERE " + SUBTREE + ";", _subtree(node_path),
+        )
+        return d.addCallback(lambda rows: {
+            node_path: IndexEntry(*entry) for node_path, *entry in rows
+        })
+
+    def stats(self):
+        return dict(entries=len(self), size=self.size, budget=self.budget,
+                    complete=self.complete, hits=self.hits,
+                    misses=self.misses)
+
+
+@implementer(IWorkQueue)
+class WorkQueue:
+    """A work queue backed by `ajxp_node_status`.
+
+    All lookups go through the (status, next_attempt) index, so finding due
+    work never scans the full table.
+    """
+
+    log = Logger()
+
+    def __init__(self, db, max_attempts=5, backoff=1., max_backoff=300.,
+                 clock=None):
+        self._db = db
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+
+        if clock is None:
+            from twisted.internet import reactor as clock
+        self._clock = clock
+
+    def _transition(self, node_ids, src, dst):
+        node_ids = tuple(node_ids)
         directive = (
-            "INSERT INTO ajxp_index (node_path,bytesize,md5,mtime,stat_result) "
-            "VALUES (?,?,?,?,?);"
+            "UPDATE ajxp_node_status SET status=? "
+            "WHERE status=? AND node_id IN ({0});"
+        ).format(",".join("?" * len(node_ids)))
+
+        return self._db.runOperation(directive, (dst, src) + node_ids)
+
+    def claim(self, n=64):
+        def claim_batch(c, now):
+            c.execute(
+                "UPDATE ajxp_node_status SET status='QUEUED' "
+                "WHERE node_id IN ("
+                "  SELECT node_id FROM ajxp_node_status "
+                "  WHERE status='NEW' AND next_attempt<=? "
+                "  ORDER BY next_attempt LIMIT ?"
+                ") RETURNING node_id;",
+                (now, n),
+            )
+            node_ids = tuple(nid for nid, in c.fetchall())
+
+            c.execute(
+                "SELECT node_id, node_path, bytesize, md5, mtime "
+                "FROM ajxp_index WHERE node_id IN ({0});".format(
+                    ",".join("?" * len(node_ids))
+                ),
+                node_ids,
+            )
+            return [Inode(*row) for row in c.fetchall()]
+
+        return self._db.runInteraction(claim_batch, self._clock.seconds())
+
+    def start(self, node_ids):
+        return self._transition(node_ids, "QUEUED", "TRANSFERRING")
+
+    def done(self, node_ids):
+        return self._transition(node_ids, "TRANSFERRING", "DONE")
+
+    def fail(self, node_id, detail=None):
+        """Reschedule `node_id` with exponential backoff.  Inodes are parked
+        as FAILED once `max_attempts` is reached.
+        """
+        self.log.debug("inode {nid} failed: {detail}",
+                       nid=node_id, detail=detail)
+
+        def reschedule(c, now):
+            c.execute(
+                "SELECT attempts FROM ajxp_node_status WHERE node_id=?;",
+                (node_id,),
+            )
+            row = c.fetchone()
+            if row is None:
+                return
+
+            attempts = row[0] + 1
+            delay = min(self.backoff * 2 ** (attempts - 1), self.max_backoff)
+            status = ("NEW", "FAILED")[attempts >= self.max_attempts]
+            c.execute(
+                "UPDATE ajxp_node_status "
+                "SET status=?, detail=?, attempts=?, next_attempt=? "
+                "WHERE node_id=?;",
+                (status, detail, attempts, now + delay, node_id),
+            )
+
+        return self._db.runInteraction(reschedule, self._clock.seconds())
+
+    def recover(self):
+        def requeue(c):
+            c.execute(
+                "UPDATE ajxp_node_status SET status='NEW' "
+                "WHERE status IN ('QUEUED', 'TRANSFERRING');"
+            )
+            return c.rowcount
+
+        return self._db.runInteraction(requeue)
+
+    def count(self, status="NEW"):
+        """Return the number of inodes with the given status"""
+        return self._db.runQuery(
+            "SELECT COUNT(*) FROM ajxp_node_status WHERE status=?;",
+            (status,),
+        ).addCallback(lambda rows: rows[0][0])
+
+    def counts(self):
+        """Return {status: number of inodes}"""
+        return self._db.runQuery(
+            "SELECT status, COUNT(*) FROM ajxp_node_status GROUP BY status;"
+        ).addCallback(dict)
+
+
+@implementer(ITransferLog)
+class TransferLog:
+    """Stores chunked transfer progress in `ajxp_transfers`"""
+
+    def __init__(self, db):
+        self._db = db
+
+    def get(self, node_path, direction):
+        d = self._db.runQuery(
+            "SELECT offset, bytesize, md5 FROM ajxp_transfers "
+            "WHERE node_path=? AND direction=?;",
+            (node_path, direction),
         )
+        return d.addCallback(lambda rows: rows[0] if rows else None)
 
-        return self._db.runOperation(directive, params)
+    def save(self, node_path, direction, offset, bytesize, md5):
+        return self._db.runOperation(
+            "INSERT OR REPLACE INTO ajxp_transfers "
+            "(node_path, direction, offset, bytesize, md5) VALUES (?,?,?,?,?);",
+            (node_path, direction, offset, bytesize, md5),
+        )
 
-    @_log_state_change("delete")
-    def delete(self, inode, directory=False):
-        path_pattern = inode["node_path"] + "%"
+    def clear(self, node_path, direction):
         return self._db.runOperation(
-            "DELETE FROM ajxp_index WHERE node_path LIKE ?;",
-            (path_pattern,),
+            "DELETE FROM ajxp_transfers WHERE node_path=? AND direction=?;",
+            (node_path, direction),
         )
 
-    @_log_state_change("modify")
-    def modify(self, inode, directory=False):
-        params = values_as_tuple(
-            inode,
-            "bytesize", "md5", "mtime", "stat_result", "node_path",
+
+@implementer(ISignatureStore)
+class SignatureStore:
+    """Stores block signatures in `ajxp_signatures`, keyed by node_id"""
+
+    def __init__(self, db):
+        self._db = db
+
+    def get(self, node_path):
+        d = self._db.runQuery(
+            "SELECT s.md5, s.bytesize, s.block_size, s.blocks "
+            "FROM ajxp_signatures s JOIN ajxp_index i USING (node_id) "
+            "WHERE i.node_path=?;",
+            (node_path,),
+        )
+        return d.addCallback(
+            lambda rows: Signature(*rows[0][:3], bytes(rows[0][3]))
+            if rows else None
         )
 
-        directive = (
-            "UPDATE ajxp_index SET bytesize=?, md5=?, mtime=?, stat_result=? "
-            "WHERE node_path=?;"
+    def indexed(self, node_path):
+        d = self._db.runQuery(
+            "SELECT md5, bytesize, block_size, blocks FROM ajxp_index "
+            "WHERE node_path=? AND blocks IS NOT NULL;",
+            (node_path,),
+        )
+        return d.addCallback(
+            lambda rows: Signature(*rows[0][:3], bytes(rows[0][3]))
+            if rows else None
         )
 
-        return self._db.runOperation(directive, params)
+    def save(self, node_path, signature):
+        return self._db.runOperation(
+            "INSERT OR REPLACE INTO ajxp_signatures "
+            "(node_id, md5, bytesize, block_size, blocks) "
+            "SELECT node_id, ?, ?, ?, ? FROM ajxp_index WHERE node_path=?;",
+            tuple(signature) + (node_path,),
+        )
 
-    @_log_state_change("move")
-    def move(self, inode, directory=False):
-        raise NotImplementedError("I shall move an inode in ajxp_index")
+
+@implementer(ISnapshotStore)
+class SnapshotStore:
+    """Stores directory snapshots in `ajxp_snapshots`"""
+
+    def __init__(self, db):
+        self._db = db
+
+    def load(self):
+        def fetch(c):
+            c.execute("SELECT dir_path, mtime, digest FROM ajxp_snapshots;")
+            snapshots = {}
+            for rows in iter(lambda: c.fetchmany(4096), []):
+                for dir_path, mtime, digest in rows:
+                    snapshots[dir_path] = (mtime, bytes(digest))
+            return snapshots
+
+        return self._db.runInteraction(fetch)
+
+    def save(self, snapshots):
+        return self._db.runInteraction(lambda c, s: c.executemany(
+            "INSERT OR REPLACE INTO ajxp_snapshots (dir_path, mtime, digest) "
+            "VALUES (?,?,?);", s,
+        ), list(snapshots))
+
+    def discard(self, dir_path):
+        return self._db.runOperation(
+            "DELETE FROM ajxp_snapshots WHERE dir_path=? "
+            "OR (dir_path>=? AND dir_path<?);",
+            _subtree(dir_path),
+        )
+
+    def empty(self):
+        return self._db.runQuery(
+            "SELECT NOT EXISTS (SELECT 1 FROM ajxp_snapshots);"
+        ).addCallback(lambda rows: bool(rows[0][0]))
+
+
+@implementer(ICursorStore)
+class CursorStore:
+    """Stores a remote change cursor in the single row of `ajxp_cursor`"""
+
+    def __init__(self, db):
+        self._db = db
+
+    def load(self):
+        return self._db.runQuery(
+            "SELECT cursor FROM ajxp_cursor WHERE id=0;"
+        ).addCallback(lambda rows: rows[0][0] if rows else None)
+
+    def save(self, cursor):
+        return self._db.runOperation(
+            "INSERT OR REPLACE INTO ajxp_cursor (id, cursor) VALUES (0,?);",
+            (cursor,),
+        )
+
+
+@implementer(IChunkIndex)
+class ChunkIndex:
+    """Deduplicating index of content-defined chunks.
+
+    `ajxp_chunks` holds one row per distinct chunk, `ajxp_file_chunks` the
+    ordered chunk list of each file.
+    """
+
+    def __init__(self, db):
+        self._db = db
+
+    def chunks_of(self, node_path):
+        d = self._db.runQuery(
+            "SELECT c.digest, c.bytesize FROM ajxp_file_chunks f "
+            "JOIN ajxp_chunks c USING (digest) "
+            "WHERE f.node_id=(SELECT node_id FROM ajxp_index WHERE node_path=?) "
+            "ORDER BY f.seq;",
+            (node_path,),
+        )
+        return d.addCallback(lambda rows: [(bytes(d), n) for d, n in rows])
+
+    def synced_duplicate(self, md5):
+        d = self._db.runQuery(
+            "SELECT i.node_path FROM ajxp_index i "
+            "JOIN ajxp_node_status s USING (node_id) "
+            "WHERE i.md5=? AND s.status='DONE' LIMIT 1;",
+            (md5,),
+        )
+        return d.addCallback(lambda rows: rows[0][0] if rows else None)
+
+    def stats(self):
+        def collect(c):
+            c.execute(
+                "SELECT COALESCE(SUM(c.bytesize), 0) FROM ajxp_file_chunks f "
+                "JOIN ajxp_chunks c USING (digest);"
+            )
+            logical, = c.fetchone()
+            c.execute("SELECT COALESCE(SUM(bytesize), 0) FROM ajxp_chunks;")
+            unique, = c.fetchone()
+            return dict(
+                logical=logical,
+                unique=unique,
+                ratio=logical / unique if unique else 1.,
+            )
+
+        return self._db.runInteraction(collect)
+
+    def prune(self):
+        return self._db.runInteraction(_prune_chunks)
@@ -24,6 +24,9 @@ class ISynchronizable(IService):
     def get_changes():
         """Get changes since last call"""
 
+    def ack_changes():
+        """Acknowledge the changes returned so far"""
+
     def assert_ready():
         """Assert that ISynchronizable is available and consistent, i.e. it is
         ready to merge.
@@ -8,15 +8,24 @@ from twisted.application.service import MultiService
 
 from . import IMerger, IMergeStrategy
 from .synchronizable import ISynchronizable
+from .storage.fs import LocalDirectory
+from .util.selection import Selection
 
 
 @implementer(IMerger)
 class TwoWayMerger(MultiService):
-    """Synchronize two ISynchronizables using an SQLite table"""
+    """Synchronize two ISynchronizables using an SQLite table.  Only the
+    subtrees in `selection`, a pydio.util.selection.Selection, are
+    transferred.
+
+    Remote paths are relative to the synchronized folder.  If the remote is
+    a LocalDirectory, whose index holds absolute paths, they are converted.
+    """
 
     log = Logger()
 
-    def __init__(self, local, remote, direction=None):
+    def __init__(self, local, remote, direction=None, transfers=None,
+                 batch_size=64, selection=None):
         super().__init__()
 
         verifyObject(ISynchronizable, local)
@@ -28,6 +37,9 @@ class TwoWayMerger(MultiService):
         self.addService(remote)
 
         self.direction = direction
+        self.transfers = transfers
+        self.batch_size = batch_size
+        self.selection = selection or Selection()
 
     def _fetch_changes(self):
         """Get local and remote changes"""
@@ -48,7 +60,115 @@ class TwoWayMerger(MultiService):
         # NOTE : Consider creating an interface, IMergeStrategy, that
         #        abstracts away the details of the merge algoritm.
 
-        # merge()  # TODO
+        yield self.merge()
+
+        # inode status lives in the work queues, so the changes are no longer
+        # needed once merged
+        self.local.ack_changes()
+        self.remote.ack_changes()
+
+    def merge(self):
+        """Transfer the content of pending inodes in the permitted direction(s)
+        """
+        if self.transfers is None:
+            return defer.succeed(None)
+
+        jobs = []
+        if self.direction != "down":
+            jobs.append(self._execute(self.local, self._upload))
+        if self.direction != "up":
+            jobs.append(self._execute(self.remote, self._download))
+        return defer.gatherResults(jobs)
+
+    @defer.inlineCallbacks
+    def _execute(self, side, transfer):
+        """Claim a batch of pending inodes from `side` and transfer them"""
+        batch = yield side.queue.claim(self.batch_size)
+        if not batch:
+            return
+
+        yield side.queue.start([inode["node_id"] for inode in batch])
+        results = yield defer.DeferredList(
+            [transfer(inode) for inode in batch], consumeErrors=True,
+        )
+
+        done = []
+        for inode, (ok, result) in zip(batch, results):
+            if ok:
+                done.append(inode["node_id"])
+            else:
+                self.log.failure("transfer of {path} failed", result,
+                                 path=inode["node_path"])
+                yield side.queue.fail(inode["node_id"],
+                                      result.getErrorMessage())
+        yield side.queue.done(done)
+
+    def _remote_relative(self, node_path):
+        """The folder-relative path of a node of the remote index"""
+        storage = getattr(self.remote, "istorage", None)
+        if isinstance(storage, LocalDirectory):
+            return storage.relative_path(node_path)
+        return node_path
+
+    def _remote_key(self, path):
+        """The remote index path of a folder-relative path"""
+        storage = getattr(self.remote, "istorage", None)
+        if isinstance(storage, LocalDirectory):
+            return storage.absolute_path(path)
+        return path
+
+    @defer.inlineCallbacks
+    def _indexed(self, side, path, inode):
+        """True if `side` already indexes identical content at `path`"""
+        if side.index is None or inode.get("md5") is None:
+            defer.returnValue(False)
+        entry = yield side.index.get(path)
+        defer.returnValue(entry is not None and entry.md5 == inode["md5"])
+
+    def _deselected(self, path):
+        if self.selection.selected(path):
+            return False
+        self.log.debug("{p} is not selected", p=path)
+        return True
+
+    @defer.inlineCallbacks
+    def _upload(self, inode):
+        path = self.local.istorage.relative_path(inode["node_path"])
+        if self._deselected(path):
+            return
+        if (yield self._indexed(self.remote, self._remote_key(path), inode)):
+            return
+        yield self.transfers.upload_node(inode, path)
+
+    @defer.inlineCallbacks
+    def _download(self, inode):
+        rel_path = self._remote_relative(inode["node_path"])
+        if self._deselected(rel_path):
+            return
+        path = self.local.istorage.absolute_path(rel_path)
+        if (yield self._indexed(self.local, path, inode)):
+            return
+        yield self.transfers.download_node(inode, path)
+
+    @defer.inlineCallbacks
+    def _synced(self, local_path, entry):
+        """True if the remote indexes the same content as `local_path`"""
+        if self.remote.index is None:
+            return False
+        path = self.local.istorage.relative_path(local_path)
+        remote = yield self.remote.index.get(self._remote_key(path))
+        return remote is not None and remote.md5 == entry.md5
+
+    @defer.inlineCallbacks
+    def set_selection(self, selection):
+        """Synchronize only `selection` from now on.  Deselected subtrees
+        are evicted from both sides, and local files are only removed if the
+        remote holds the same content.  Newly selected subtrees are fetched
+        from both sides, and transferred by the following syncs.
+        """
+        self.selection = selection
+        yield self.local.istorage.set_selection(selection, self._synced)
+        yield self.remote.istorage.set_selection(selection)
 
     def assert_volumes_ready(self):  # exported because it's a pure function
         """Verify that local and remote sync targets are present, accessible and
@@ -1,71 +1,374 @@
 #! /usr/bin/env python
+import os.path as osp
+
+from appdirs import user_data_dir
+
 from twisted.logger import Logger
+from twisted.internet import defer
 from twisted.application.service import MultiService
 from twisted.application.internet import TimerService
 
 from .engine import sqlite
 from .merger import TwoWayMerger
 from .synchronizable import Workspace
-from .storage import fs
+from .storage import fs, http
+from .storage.hashing import ProcessHasher, ThreadHasher
+from .storage.journal import Journal
+from .storage.localcopy import LocalTransfers
+from .storage.transfer import TransferPipeline
+from .util.cdc import Chunker
+from .util.priority import Priorities, PriorityScheduler
+from .util.ratelimit import Governor, Schedule, ScheduledLimits
+from .util.selection import Selection
+from .worker import WorkerProcess
+
+# the default parent of each job's data directory, which holds its databases
+DATA_DIR = user_data_dir(
+    appname="pydio-sync", appauthor="Abstrium SAS", roaming=True,
+)
+
+
+def limit_schedule(cfg):
+    """Build the Schedule described by the `limits` and `schedule` options"""
+    return Schedule(cfg.get("limits"), cfg.get("schedule", ()))
+
+
+def data_dir(name, cfg):
+    """Return the directory holding the databases of the job `name`: its
+    `data_dir` option, or a directory named after it in DATA_DIR
+    """
+    return osp.expanduser(cfg.get("data_dir") or osp.join(DATA_DIR, name))
+
+
+def remote_storage(cfg, governor=None, selection=None):
+    """Return the IStorage for the remote side of a job, rooted at its
+    `remote_folder`.  Falls back to a local stand-in directory if no server
+    is configured.
+    """
+    folder = cfg.get("remote_folder") or "/"
+    if not cfg.get("server"):
+        return fs.LocalDirectory(
+            osp.join("/tmp/wspace", folder.lstrip("/")),
+            filters=cfg["filters"], governor=governor, selection=selection,
+        )
+
+    return http.RemoteDirectory(
+        cfg["server"],
+        cfg["workspace"],
+        frequency=cfg.get("frequency", 10),
+        selection=selection,
+        page_size=cfg.get("page_size", 1000),
+        long_poll=cfg.get("long_poll", 0),
+        folder=folder,
+        user=cfg.get("user"),
+        password=cfg.get("password"),
+        timeout=cfg.get("timeout", 20),
+        poolsize=cfg.get("poolsize", 4),
+        trust_ssl=cfg.get("trust_ssl", False),
+    )
 
 
 class Job(MultiService):
+    """A synchronization job.  Its disk and network usage are limited by
+    `governor`, following the time-of-day `schedule`.  `queues` maps stage
+    names to the PrioritySchedulers that order the job's work.
+    """
 
     log = Logger()
 
-    def __init__(self, name, merger, trigger):
+    def __init__(self, name, merger, trigger, governor=None, schedule=None,
+                 queues=None):
         super().__init__()
         self.name = name
+        self.merger = merger
+        self.governor = governor or Governor()
+        self.limits = ScheduledLimits(self.governor, schedule)
+        self.queues = queues or {}
+
+        self.addService(self.limits)
         self.addService(merger)  # don't verify; we only need it as an IService
         self.addService(trigger)
 
+    def set_limits(self, limits=None, schedule=()):
+        """Replace the job's rate limits without restarting it"""
+        self.limits.schedule = Schedule(limits, schedule)
+
+    def set_selection(self, include=(), exclude=()):
+        """Replace the subtrees the job synchronizes without restarting it.
+        Fires once deselected subtrees are evicted and newly selected ones
+        are listed.
+        """
+        return self.merger.set_selection(Selection(include, exclude))
+
+    def set_priorities(self, priorities=None):
+        """Replace the priority classes of the job's subtrees, including for
+        queued work
+        """
+        for queue in self.queues.values():
+            queue.set_priorities(
+                Priorities(priorities, root=queue.priorities.root),
+            )
+
+    @defer.inlineCallbacks
+    def status(self):
+        """Fire with a JSON-serializable summary of the job's state"""
+        status = dict(running=bool(self.running), limits=self.governor.limits,
+                      selection=self.merger.selection.as_dict())
+        if self.queues:
+            status["queues"] = {
+                name: queue.stats() for name, queue in self.queues.items()
+            }
+        try:
+            status["local"], status["remote"], status["db"] = (
+                yield defer.gatherResults([
+                    self.merger.local.queue.counts(),
+                    self.merger.remote.queue.counts(),
+                    self.merger.local.iengine.maintenance.stats(),
+                ], consumeErrors=True)
+            )
+        except defer.FirstError as e:
+            status["error"] = e.subFailure.getErrorMessage()
+
+        watch_stats = getattr(self.merger.local.istorage, "watch_stats", None)
+        if watch_stats is not None:
+            status["watch"] = watch_stats()
+        journal = getattr(self.merger.local.istorage, "journal", None)
+        if journal is not None:
+            status["journal"] = journal.stats()
+        defer.returnValue(status)
+
     def startService(self):
         self.log.info("starting job {job.name}", job=self)
         super().startService()
 
     def stopService(self):
         self.log.info("stopping job {job.name}", job=self)
+        return super().stopService()
+
+
+def build_job(name, cfg, parent=None):
+    """Instantiate the components of a job and string them together"""
+    schedule = limit_schedule(cfg)
+    governor = Governor(schedule.limits_at(), parent=parent)
+
+    selection = Selection.from_config(cfg.get("selection"))
+    queues = dict(
+        hashing=PriorityScheduler(
+            cfg.get("hash_slots", 4 * (cfg.get("hash_processes") or 1)),
+            Priorities(cfg.get("priorities"), root=cfg["directory"]),
+        ),
+        transfers=PriorityScheduler(
+            cfg.get("poolsize", 4), Priorities(cfg.get("priorities")),
+        ),
+    )
+
+    chunker = Chunker if cfg.get("dedup") else None
+    if cfg.get("hash_processes"):
+        hasher = ProcessHasher(
+            cfg["hash_processes"], chunker=chunker, governor=governor,
+            digests=cfg.get("digests"), scheduler=queues["hashing"],
+        )
+    else:
+        hasher = ThreadHasher(chunker, governor, cfg.get("digests"),
+                              queues["hashing"])
+
+    journal = None
+    if cfg.get("journal"):
+        journal = Journal(osp.expanduser(cfg["journal"]))
+
+    # persisted, so that a restart resumes from the index and snapshots
+    db_dir = data_dir(name, cfg)
+    lw = Workspace(
+        sqlite.Engine(
+            osp.join(db_dir, "local.sqlite"),
+            index_budget=cfg.get("index_budget"),
+            triggers=cfg.get("triggers", True),
+        ),
+        fs.LocalDirectory(
+            cfg["directory"],
+            filters=cfg["filters"],
+            chunker=chunker,
+            governor=governor,
+            hasher=hasher,
+            reconcile_interval=cfg.get("reconcile_interval"),
+            watch_budget=cfg.get("watch_budget"),
+            selection=selection,
+            journal=journal,
+        ),
+    )
+
+    rw = Workspace(
+        sqlite.Engine(osp.join(db_dir, "remote.sqlite")),
+        remote_storage(cfg, governor, selection),
+    )
+
+    transfers = None
+    if isinstance(rw.istorage, http.RemoteDirectory):
+        transfers = TransferPipeline(
+            rw.istorage.client,
+            lw.iengine.transfers,
+            concurrency=cfg.get("poolsize", 4),
+            signatures=lw.iengine.signatures,
+            dedup=lw.iengine.chunks if cfg.get("dedup") else None,
+            to_remote=lw.istorage.relative_path,
+            governor=governor,
+            scheduler=queues["transfers"],
+        )
+    elif isinstance(rw.istorage, fs.LocalDirectory):
+        transfers = LocalTransfers(
+            lw.istorage, rw.istorage, governor=governor,
+            scheduler=queues["transfers"],
+        )
+
+    merger = TwoWayMerger(
+        lw, rw, direction=cfg.get("direction"), transfers=transfers,
+        selection=selection,
+    )
+    trigger = TimerService(cfg.pop("frequency", .025), merger.sync)
+
+    return Job(name, merger, trigger, governor, schedule, queues)
+
+
+def share_limits(limits, n):
+    """Split rate limits evenly between `n` processes"""
+    return {k: v / n for k, v in (limits or {}).items()}
+
+
+def share_schedule(schedule, n):
+    return [dict(w, limits=share_limits(w["limits"], n)) for w in schedule]
 
 
 class Scheduler(MultiService):
     """Scheduler is responsible for managing the lifecycle of Job instances as
     well as managing synchronization runs.
+
+    Jobs run in the scheduler's process unless `processes` is set, in which
+    case they are spread over that many supervised worker processes.  Global
+    limits are then split evenly between the workers.
     """
     log = Logger()
 
-    def __init__(self, jobs):
+    def __init__(self, jobs, limits=None, schedule=(), processes=None):
         """
         jobs : dict
             {job name : configuration options}
 
+        limits : dict
+            {resource : rate} limits shared by all jobs.  See
+            pydio.util.ratelimit for the resource names.
+
+        schedule : list
+            time-of-day windows overriding `limits`
+
+        processes : int
+            number of worker processes, or None to run jobs in-process
+
         """
         super().__init__()
+        self.processes = processes
+
+        if processes:
+            names = sorted(jobs)
+            n = min(processes, len(names))
+            for i in range(n):
+                group = {name: jobs[name] for name in names[i::n]}
+                self.addService(WorkerProcess(
+                    "worker-{0}".format(i), group,
+                    share_limits(limits, n), share_schedule(schedule, n),
+                ))
+            return
+
+        self.governor = Governor()
+        self.limits = ScheduledLimits(self.governor, Schedule(limits, schedule))
+        self.addService(self.limits)
 
         # For each job configuration, instantiate the requisite components
         # and string everything together using (multi)service(s).
         for name, cfg in jobs.items():
             self.log.debug("configuring job {name}", name=name)
+            self.addService(build_job(name, cfg, parent=self.governor))
 
-            lw = Workspace(
-                sqlite.Engine(":memory:"),
-                fs.LocalDirectory(cfg["directory"], filters=cfg["filters"]),
-            )
+    def __str__(self):
+        if self.processes:
+            return "<Scheduler with {0} worker processes>".format(
+                len(self.workers))
+        return "<Scheduler with {0} jobs>".format(len(self.jobs))
 
-            # DEBUG
-            rw = Workspace(
-                sqlite.Engine(":memory:"),
-                fs.LocalDirectory("/tmp/wspace", filters=cfg["filters"]),
-            )
-            # END DEBUG
+    @property
+    def jobs(self):
+        return [s for s in self.services if isinstance(s, Job)]
 
+    @property
+    def workers(self):
+        return [s for s in self.services if isinstance(s, WorkerProcess)]
 
-            merger = TwoWayMerger(lw, rw)
-            trigger = TimerService(cfg.pop("frequency", .025), merger.sync)
+    def job(self, name):
+        """Return the in-process Job called `name`"""
+        job = self.getServiceNamed(name)
+        if not isinstance(job, Job):
+            raise KeyError(name)
+        return job
 
-            self.addService(Job(name, merger, trigger))
+    def set_limits(self, limits=None, schedule=(), job=None):
+        """Replace the global rate limits, or those of the job named `job`,
+        without restarting any job.
+        """
+        if self.processes:
+            workers = self.workers
+            if job is None:
+                n = len(workers)
+                calls = [
+                    w.set_limits(share_limits(limits, n),
+                                 share_schedule(schedule, n))
+                    for w in workers
+                ]
+            else:
+                calls = [
+                    w.set_limits(limits, schedule, job)
+                    for w in workers if job in w.jobs
+                ]
+            return defer.gatherResults(calls)
 
-    def __str__(self):
-        return "<Scheduler with {0} jobs>".format(len(self.services))
+        if job is not None:
+            self.job(job).set_limits(limits, schedule)
+        else:
+            self.limits.schedule = Schedule(limits, schedule)
+        return defer.succeed(None)
+
+    def set_selection(self, job, include=(), exclude=()):
+        """Replace the subtrees synchronized by the job named `job`"""
+        if self.processes:
+            return defer.gatherResults([
+                w.set_selection(job, include, exclude)
+                for w in self.workers if job in w.jobs
+            ])
+        return self.job(job).set_selection(include, exclude)
+
+    def set_priorities(self, job, priorities=None):
+        """Replace the priority classes of the subtrees of the job named
+        `job`
+        """
+        if self.processes:
+            return defer.gatherResults([
+                w.set_priorities(job, priorities or {})
+                for w in self.workers if job in w.jobs
+            ])
+        self.job(job).set_priorities(priorities)
+        return defer.succeed(None)
+
+    @defer.inlineCallbacks
+    def status(self):
+        """Fire with {job name: status}, across all worker processes"""
+        services = self.workers if self.processes else self.jobs
+        results = yield defer.gatherResults([s.status() for s in services])
+
+        status = {}
+        if self.processes:
+            for r in results:
+                status.update(r)
+        else:
+            status = {job.name: r for job, r in zip(services, results)}
+        defer.returnValue(status)
 
     def startService(self):
         self.log.info("starting scheduler service")
@@ -73,4 +376,4 @@ class Scheduler(MultiService):
 
     def stopService(self):
         self.log.warn("stopping scheduler service")
-        super().stopService()
+        return super().stopService()
@@ -1,25 +1,32 @@
 #! /usr/bin/env python
-from os import stat
+import os
+from os import stat, scandir
 import os.path as osp
-from hashlib import md5
+import posixpath
 from pickle import dumps
 from fnmatch import fnmatch
+from hashlib import blake2b
 from functools import wraps
+from collections import defaultdict, OrderedDict
 
 from zope.interface import implementer
 from zope.interface.verify import verifyObject
 
 from twisted.logger import Logger
-from twisted.internet import defer
+from twisted.internet import defer, task
 from twisted.internet.threads import deferToThread
 from twisted.application.service import Service, MultiService
 
 from watchdog import events
-from watchdog.observers import Observer
 
 from pydio.util.blocking import threaded
+from pydio.util.ignore import IgnoreRules, IGNORE_FILE
+from pydio.util.selection import Selection, outermost
+from pydio.util.records import Inode
 from . import IDiffHandler, ISelectiveEventHandler
 from pydio.storage import IStorage
+from pydio.storage.hashing import ThreadHasher
+from pydio.storage.watch import HybridWatcher, TreeWatcher
 from pydio.engine import IStateManager
 
 MD5_DIRECTORY = "directory"
@@ -35,6 +42,57 @@ MODIFY_EVENTS = {events.FileModifiedEvent, events.DirModifiedEvent}
 MOVE_EVENTS = {events.FileMovedEvent, events.DirMovedEvent}
 
 ALL_EVENTS = FILE_EVENTS.union(DIR_EVENTS)
+HANDLED_EVENTS = {ev.event_type for ev in ALL_EVENTS}
+
+SNAPSHOT_DIGEST_SIZE = 16
+
+# partial files written by transfers and local copies, which are renamed
+# into place once complete
+PARTIAL_SUFFIXES = (".pydio_dl", ".pydio_cp")
+
+# digests of copied files kept until the copy is seen
+MAX_EXPECTED = 4096
+
+# seconds after a start from an intact journal before the directory is
+# reconciled, if no reconcile_interval is set
+DEFERRED_RECONCILE = 60
+
+# one periodic reconciliation in so many is deep, to find files modified in
+# place whose events were lost
+DEEP_RECONCILE_EVERY = 10
+
+# event class by is_directory
+CREATED = {False: events.FileCreatedEvent, True: events.DirCreatedEvent}
+DELETED = {False: events.FileDeletedEvent, True: events.DirDeletedEvent}
+
+
+def listing_digest(entries):
+    """Digest of a directory listing, as returned by EventHandler.listing.
+    The size and mtime of subdirectories are left out, so that changes
+    within a subdirectory do not invalidate its parent's snapshot.
+    """
+    h = blake2b(digest_size=SNAPSHOT_DIGEST_SIZE)
+    for path in sorted(entries):
+        is_dir, bytesize, mtime = entries[path]
+        if is_dir:
+            bytesize = mtime = 0
+        h.update("{0}\0{1:d}\0{2}\0{3!r}\n".format(
+            path, is_dir, bytesize, mtime,
+        ).encode("utf-8", "surrogateescape"))
+    return h.digest()
+
+
+def refreshes_ignores(fn):
+    """Reload the rules of an ignore file the event touches before it is
+    handled.
+    """
+    @wraps(fn)
+    def event_handler(self, ev):
+        for path in (ev.src_path, getattr(ev, "dest_path", "")):
+            if osp.basename(path) == IGNORE_FILE:
+                self.ignores.refresh(osp.dirname(path))
+        return fn(self, ev)
+    return event_handler
 
 
 def log_event(lvl="info"):
@@ -50,51 +108,229 @@ def log_event(lvl="info"):
 
 @implementer(IStorage)
 class LocalDirectory(MultiService):
+    """Watches a local directory.  Changes made while it was not watched are
+    found by a deep reconciliation when the service starts, since files
+    modified in place leave the mtime of their directory unchanged.  If
+    `reconcile_interval` is set, the directory is also reconciled every that
+    many seconds, deeply one time in DEEP_RECONCILE_EVERY, which recovers
+    from lost events (e.g. an inotify queue overflow, which watchdog does not
+    report).
+
+    The directory is watched by a TreeWatcher, which watches no ignored or
+    unselected subtree, or if `watch_budget` is set, by a HybridWatcher with
+    at most that many inotify watches.
+
+    Only the subtrees in `selection`, a pydio.util.selection.Selection, are
+    synchronized.
+
+    If a pydio.storage.journal.Journal is given, accepted events are journaled
+    until they are recorded, and those a crash interrupted are replayed when
+    the service starts.  If the journal was intact and the directory was
+    scanned by an earlier run, the start completes once they are replayed,
+    and the reconciliation is deferred to the first periodic one, or to
+    DEFERRED_RECONCILE seconds later.
+    """
 
     log = Logger()
 
-    def __init__(self, path, recursive=True, filters=None):
+    def __init__(self, path, recursive=True, filters=None, chunker=None,
+                 governor=None, hasher=None, reconcile_interval=None,
+                 watch_budget=None, selection=None, journal=None, clock=None):
         super().__init__()
 
         self._path = path
+        self._selection = selection or Selection()
         self._recursive = recursive
         self._filt = filters or {}
-        self._obs = Observer()
+        self._hasher = hasher or ThreadHasher(chunker, governor)
+        self._handlers = []
+        self._watch_budget = watch_budget
+        self._watchers = []
+        self._trees = []
+
+        self.journal = journal
+        if journal is not None:
+            journal.setServiceParent(self)  # stopped after the handlers
+
+        if clock is None:
+            from twisted.internet import reactor as clock
+        self._clock = clock
+        self._reconcile_interval = reconcile_interval
+        self._loop = task.LoopingCall(self._periodic_reconcile)
+        self._loop.clock = clock
+        self._passes = 0
+        self._delayed = None
 
     def connect_state_manager(self, istateman):
         verifyObject(IStateManager, istateman)
-        h = EventHandler(istateman, self._path, self._filt)
+        h = EventHandler(istateman, self._path, self._filt,
+                         hasher=self._hasher,
+                         index=getattr(istateman, "index", None),
+                         snapshots=getattr(istateman, "snapshots", None),
+                         selection=self._selection, journal=self.journal)
         self.addService(h)
-        self._obs.schedule(h, self._path, recursive=self._recursive)
+        self._handlers.append(h)
+
+        if self._watch_budget is None:
+            w = TreeWatcher(h, self._path, recursive=self._recursive)
+            w.setServiceParent(self)
+            self._trees.append(w)
+        else:
+            w = HybridWatcher(h, self._path, self._watch_budget)
+            w.setServiceParent(self)
+            self._watchers.append(w)
 
     def startService(self):
         self.log.info("syncing local directory {s._path}", s=self)
         super().startService()
-        self._obs.start()
+        # watch before reconciling, so that no change is missed
+        d = defer.gatherResults([w.watching for w in self._trees])
+        d.addCallback(lambda _: self.replay())
+        d.addCallback(lambda _: self._replayed_all())
+        d.addErrback(
+            lambda f: self.log.failure("could not replay the journal", f)
+        )
+        return d.addCallback(self._start_reconciling)
+
+    @defer.inlineCallbacks
+    def _replayed_all(self):
+        """Whether replaying the journal recorded every change the last run
+        left unrecorded, on top of the index and snapshots it saved
+        """
+        if self.journal is None or not self.journal.intact:
+            return False
+        for h in self._handlers:
+            scanned = yield h.scanned()
+            if not scanned:
+                return False
+        return True
+
+    def _start_reconciling(self, replayed_all):
+        if not self.running:
+            return
+        if self._reconcile_interval is not None:
+            self._loop.start(self._reconcile_interval, now=False)
+        if not replayed_all:
+            self._passes = 1  # the next periodic reconciliation is shallow
+            return self._reconcile(deep=True)
+
+        self.log.info("replayed the event journal, deferring reconciliation")
+        if self._reconcile_interval is None:
+            self._delayed = self._clock.callLater(
+                DEFERRED_RECONCILE, self._reconcile, True,
+            )
+
+    def replay(self):
+        """Record the journaled events the last run did not commit"""
+        return defer.gatherResults([h.replay() for h in self._handlers])
+
+    def reconcile(self, deep=False):
+        """Rescan the directories that changed since they were last scanned.
+        A `deep` reconciliation lists every directory, to also find files
+        modified in place.
+        """
+        return defer.gatherResults([h.reconcile(deep) for h in self._handlers])
+
+    @defer.inlineCallbacks
+    def set_selection(self, selection, synced=None):
+        """Synchronize `selection` from now on.  Deselected subtrees are
+        evicted (see EventHandler.evict) and no longer watched, and newly
+        selected ones are scanned and watched.
+        """
+        old, self._selection = self._selection, selection
+        fetch, evict = selection.changes(old)
+        for h in self._handlers:
+            h.selection = selection
+            for path in evict:
+                yield h.evict(self.absolute_path(path), synced)
+        for path in evict:
+            # the outermost directory that is no longer traversed
+            while path != "/" and not selection.traversed(
+                posixpath.dirname(path),
+            ):
+                path = posixpath.dirname(path)
+            for w in self._trees:
+                yield w.discover(self.absolute_path(path))
+
+        for path in fetch:
+            # the outermost directory that was not traversed until now
+            while path != "/" and not old.traversed(posixpath.dirname(path)):
+                path = posixpath.dirname(path)
+            for h in self._handlers:
+                yield h.fetch(self.absolute_path(path))
+            for w in self._watchers + self._trees:
+                yield w.discover(self.absolute_path(path))
+
+    def expect(self, path, bytesize, mtime, digests):
+        """Record the digests of a file about to be written at `path`, with
+        this size and mtime, so that it is indexed without being read.
+        """
+        for h in self._handlers:
+            h.expect(path, bytesize, mtime, digests)
+
+    def watch_stats(self):
+        """Return the coverage and poll cost of each HybridWatcher"""
+        return [w.stats() for w in self._watchers]
+
+    def _reconcile(self, deep=False):
+        return self.reconcile(deep).addErrback(
+            lambda f: self.log.failure("reconciliation failed", f)
+        )
+
+    def _periodic_reconcile(self):
+        deep = self._passes % DEEP_RECONCILE_EVERY == 0
+        self._passes += 1
+        return self._reconcile(deep)
 
     def stopService(self):
-        super().stopService()
-        self._obs.stop()
-        return deferToThread(self._obs.join)
+        d = super().stopService()
+        if self._loop.running:
+            self._loop.stop()
+        if self._delayed is not None and self._delayed.active():
+            self._delayed.cancel()
+        self._hasher.close()
+        return d
 
     def available(self):
         osp.exists(self._path)
 
+    def relative_path(self, path):
+        """Return `path` relative to the directory, with a leading slash"""
+        rel = osp.relpath(path, self._path)
+        return "/" if rel == "." else "/" + rel
+
+    def absolute_path(self, path):
+        """Inverse of `relative_path`"""
+        return osp.join(self._path, path.lstrip("/"))
+
 
 @implementer(IDiffHandler, ISelectiveEventHandler)
 class EventHandler(Service, events.FileSystemEventHandler):
 
     log = Logger()
 
-    def __init__(self, state_manager, base_path, filters=None):
+    def __init__(self, state_manager, base_path, filters=None, chunker=None,
+                 governor=None, hasher=None, index=None, snapshots=None,
+                 ignores=None, selection=None, journal=None):
         Service.__init__(self)
         events.FileSystemEventHandler.__init__(self)
 
         self._filt = filters or {}
+        self._hasher = hasher or ThreadHasher(chunker, governor)
+        self._index = index
+        self._snapshots = snapshots
+        self.selection = selection or Selection()
+        self.journal = journal
+        self._expected = OrderedDict()
 
         # add a trailing slash if it's not already there
         self._base_path = osp.join(osp.normpath(base_path), "")
 
+        if ignores is None:
+            ignores = IgnoreRules(base_path)
+        ignores.on_change = self._ignores_changed
+        self.ignores = ignores
+
         verifyObject(IStateManager, state_manager)
         self._state_manager = state_manager
 
@@ -115,33 +351,123 @@ class EventHandler(Service, events.FileSystemEventHandler):
     def relative_path(self, path):
         return osp.normpath(path).replace(self._base_path, "")
 
+    def _filter_globs(self, path):
+        included = self.match_any(self.include, path)
+        excluded = self.match_any(self.exclude, path)
+        non_root = osp.join(osp.normpath(path), "") != self._base_path
+        partial = path.endswith(PARTIAL_SUFFIXES)
+        return all((included, not excluded, non_root, not partial))
+
+    def _selected(self, path):
+        return self.selection.everything or self.selection.traversed(
+            self.relative_path(path),
+        )
+
+    def filter_path(self, path, is_dir=False):
+        """True if the handler records changes to `path`: it passes the
+        filters, lies within the selection and no ignore file excludes it.
+        """
+        return (self._filter_globs(path) and self._selected(path)
+                and not self.ignores.ignored(path, is_dir))
+
     def _filter_event(self, ev):
-        included = self.match_any(self.include, ev.src_path)
-        excluded = self.match_any(self.exclude, ev.src_path)
-        non_root = bool(self.relative_path(ev.src_path))
-        return all((included, not excluded, non_root))
+        return self.filter_path(ev.src_path, ev.is_directory)
+
+    def _ignores_changed(self, path):
+        """Entries below `path` may have been ignored or re-included: those
+        now included are recorded by a deep reconcile of the subtree.
+        Entries now ignored are left in the index, so that ignoring a file
+        never deletes it from the server.
+        """
+        from twisted.internet import reactor
+        self.log.info("ignore rules of {p} changed", p=path)
+        reactor.callFromThread(self.reconcile, True, path)
 
     def dispatch(self, ev):
         # Filter out irrelevant envents
         # No need to test this function.  It's covered by watchdog's unit tests.
-        if self._filter_event(ev):
-            events.FileSystemEventHandler.dispatch(self, ev)
-        else:
+        if (isinstance(ev, tuple(MOVE_EVENTS)) and not self._filter_event(ev)
+                and self.filter_path(ev.dest_path, ev.is_directory)):
+            # e.g. a partial file renamed into place
+            ev = CREATED[ev.is_directory](ev.dest_path)
+
+        if not self._filter_event(ev):
             self.log.debug("ignoring {ev}", ev=ev)
+        elif ev.event_type in HANDLED_EVENTS:
+            self.handle(ev)
+        else:
+            events.FileSystemEventHandler.dispatch(self, ev)
+
+    def handle(self, ev):
+        """Record an accepted event.  If there is a journal, the event is
+        journaled until the state manager has committed it.
+        """
+        if self.journal is None:
+            return self._handle(ev)
+        seq = self.journal.append(ev)
+        return self._handle(ev).addCallback(self._committed, seq)
+
+    def _committed(self, result, seq):
+        self.journal.commit(seq)
+        return result
+
+    @defer.inlineCallbacks
+    def replay(self):
+        """Record the journaled events that were never committed, e.g.
+        because the process crashed, in order.  Fires with their number.
+        """
+        if self.journal is None:
+            return 0
+        pending = self.journal.pending()
+        for seq, ev in pending:
+            if self._filter_event(ev):
+                try:
+                    yield self._handle(ev)
+                except Exception:
+                    self.log.failure("could not replay {ev}", ev=ev)
+                    continue
+            self.journal.commit(seq)
+        return len(pending)
+
+    def expect(self, path, bytesize, mtime, digests):
+        """Record the digests of a file about to be written at `path`.  They
+        are used instead of hashing it if it is seen with this size and
+        mtime, and if they include all the digests the hasher computes.
+        """
+        self._expected[path] = bytesize, mtime, digests
+        while len(self._expected) > MAX_EXPECTED:
+            self._expected.popitem(last=False)
+
+    def _expected_digests(self, inode):
+        expected = self._expected.pop(inode["node_path"], None)
+        if expected is None:
+            return None
+        bytesize, mtime, digests = expected
+        if (bytesize, mtime) != (inode["bytesize"], inode["mtime"]):
+            return None
+        if getattr(self._hasher, "chunker", None) is not None:
+            return None
+        if not set(getattr(self._hasher, "digests", ("md5",))) <= set(digests):
+            return None
+        return digests
 
-    @threaded
     def compute_file_hash(self, path):
-        with open(path, "rb") as f:
-            return md5(f.read()).hexdigest()
+        return self._hasher.hash(path)
 
     @defer.inlineCallbacks
     def _add_hash_to_inode(self, ev, inode):
+        expected = self._expected and self._expected_digests(inode)
         if ev.is_directory:
             inode["md5"] = MD5_DIRECTORY
+        elif expected:
+            self.log.debug("{p} is a known copy", p=inode["node_path"])
+            inode.update(expected)
         elif isinstance(ev, tuple(CREATE_EVENTS.union(MODIFY_EVENTS))):
-            inode["md5"] = yield self.compute_file_hash(ev.src_path)
+            digests = yield self.compute_file_hash(ev.src_path)
+            inode.update(digests)
         elif isinstance(ev, tuple(MOVE_EVENTS)):
-            inode["md5"] = yield self.compute_file_hash(ev.dest_path)
+            digests = yield self.compute_file_hash(ev.dest_path)
+            inode.update(digests)
         else:
             emsg = "mishandled {0}.  This should never happen"
             raise RuntimeError(emsg.format(type(ev)))
@@ -163,60 +489,322 @@ class EventHandler(Service, events.FileSystemEventHandler):
             stat_result=dumps(stat(path), protocol=4),
         )
 
+    def indexed(self, inode):
+        """True if the path index holds an Inode of the same size and mtime,
+        in which case its content is assumed to be unchanged.
+        """
+        if self._index is None:
+            return False
+        entry = self._index.peek(inode.node_path)
+        return entry is not None and (entry.bytesize, entry.mtime) == (
+            inode.bytesize, inode.mtime,
+        )
+
     @defer.inlineCallbacks
     def new_node(self, ev):
-        """Create a new dict representing an inode."""
+        """Create a new Inode record.  Returns None if the
+        inode is already indexed with the same size and mtime.
+        """
         if isinstance(ev, tuple(MOVE_EVENTS)):
-            inode = dict(node_path=ev.dest_path)
+            inode = Inode(node_path=ev.dest_path)
         else:
-            inode = dict(node_path=ev.src_path)
+            inode = Inode(node_path=ev.src_path)
 
         if isinstance(ev, tuple(ALL_EVENTS.difference(DELETE_EVENTS))):
-            yield defer.gatherResults((
-                self._add_hash_to_inode(ev, inode),
-                self._add_stat_to_inode(ev, inode),
-            ))
+            yield self._add_stat_to_inode(ev, inode)
+            if self.indexed(inode):
+                self.log.debug("{p} is unchanged", p=inode["node_path"])
+                return
+            yield self._add_hash_to_inode(ev, inode)
         defer.returnValue(inode)
 
+    def _update(self, inode, method, directory):
+        if inode is not None:
+            return method(inode, directory=directory)
+
+    @refreshes_ignores
     @log_event()
     def on_created(self, ev):
         """Called when an inode is created"""
         return self.new_node(ev).addCallback(
-            self._state_manager.create,
-            directory=ev.is_directory
+            self._update, self._state_manager.create, ev.is_directory,
         )
 
+    @refreshes_ignores
     @log_event()
     def on_deleted(self, ev):
         """Called when an inode is deleted"""
         return self.new_node(ev).addCallback(
-            self._state_manager.delete,
-            directory=ev.is_directory
+            self._update, self._state_manager.delete, ev.is_directory,
         )
 
+    def listing(self, path):
+        """List the directory `path` once.  Returns its mtime, read before
+        the listing, and {path: (is_dir, bytesize, mtime)} for the entries
+        that pass the filters and are not ignored.  `path` itself is assumed
+        not to be ignored.
+        """
+        mtime = stat(path).st_mtime
+        self.ignores.refresh(path)
+        ignored = self.ignores.matcher(path)
+
+        entries = {}
+        with scandir(path) as it:
+            for entry in it:
+                if not (self._filter_globs(entry.path)
+                        and self._selected(entry.path)):
+                    continue
+                try:
+                    is_dir = entry.is_dir()
+                    if ignored is not None and ignored(entry.path, is_dir):
+                        continue
+                    st = entry.stat()
+                    entries[entry.path] = (is_dir, st.st_size, st.st_mtime)
+                except OSError:
+                    pass  # removed since the listing; its own event follows
+        return mtime, entries
+
+    scan = threaded(listing)
+
+    def _indexed_children(self, path):
+        if self._index is None:
+            return defer.succeed({})
+        return self._index.children(path)
+
+    @defer.inlineCallbacks
+    def diff_directory(self, path, entries=None):
+        """Compare the entries of the directory `path` with its indexed
+        children.  Returns the created, deleted and modified events that bring
+        the index up to date.  Subdirectories are not descended into: their
+        own events report changes to their content.
+
+        Indexed children that are now filtered out or ignored are left
+        alone rather than reported as deleted.  Without a path index, every
+        entry is reported as created.
+        """
+        if entries is None:
+            try:
+                _, entries = yield self.scan(path)
+            except OSError:
+                return []  # removed or replaced; its own events follow
+        indexed = yield self._indexed_children(path)
+
+        evs = []
+        for node_path, entry in indexed.items():
+            is_dir = entry.md5 == MD5_DIRECTORY
+            if node_path in entries:
+                if entries[node_path][0] != is_dir:
+                    evs.append(DELETED[is_dir](node_path))
+            elif self.filter_path(node_path, is_dir):
+                evs.append(DELETED[is_dir](node_path))
+
+        for node_path, (is_dir, bytesize, mtime) in entries.items():
+            entry = indexed.get(node_path)
+            if entry is None or (entry.md5 == MD5_DIRECTORY) != is_dir:
+                evs.append(CREATED[is_dir](node_path))
+            elif not is_dir and (
+                (entry.bytesize, entry.mtime) != (bytesize, mtime)
+            ):
+                evs.append(events.FileModifiedEvent(node_path))
+
+        return evs
+
+    def _skip_vanished(self, failure, ev):
+        failure.trap(OSError)
+        self.log.debug("{p} vanished before it was recorded", p=ev.src_path)
+
+    def _handle(self, ev):
+        d = defer.maybeDeferred(getattr(self, "on_" + ev.event_type), ev)
+        return d.addErrback(self._skip_vanished, ev)
+
+    @defer.inlineCallbacks
+    def _apply(self, evs):
+        # deletes go first, in case an entry was replaced by another type
+        deleted = [ev for ev in evs if isinstance(ev, tuple(DELETE_EVENTS))]
+        yield defer.gatherResults([self._handle(ev) for ev in deleted])
+        yield defer.gatherResults(
+            [self._handle(ev) for ev in evs if ev not in deleted]
+        )
+
+    @defer.inlineCallbacks
+    def rescan(self, path, listing=None):
+        """Record the changes to the entries of the directory `path`, then
+        save its snapshot.  `listing` is the result of `scan`, if known.
+        """
+        if listing is None:
+            try:
+                listing = yield self.scan(path)
+            except OSError:
+                return  # removed or replaced; its own events follow
+        mtime, entries = listing
+
+        evs = yield self.diff_directory(path, entries)
+        yield self._apply(evs)
+        if self._snapshots is not None:
+            yield self._snapshots.save([(path, mtime, listing_digest(entries))])
+
+    @refreshes_ignores
     @log_event()
     def on_modified(self, ev):
-        """Called when an existing inode is modified"""
+        """Called when an existing inode is modified.  A modified directory
+        is listed once and diffed against its indexed children, and only the
+        entries that changed are recorded.
+        """
+        if ev.is_directory:
+            return self.rescan(osp.normpath(ev.src_path))
 
-        import ipdb; ipdb.set_trace()
+        d = self.new_node(ev).addErrback(self._skip_vanished, ev)
+        return d.addCallback(self._update, self._state_manager.modify, False)
 
-        # is it a directory?
-        #   if so, are their files contained within?
-        #       if so get a handle on the most recently updated file
-        #   else, return
-        #
-        #   is that file actually a file (as opposed to a subdir)?
-        #      if so, update the db.  (what about the others?)
-        #   else, return
-        #
-        # if it's not a directory:
-        #   check if the file still exists, if not, return, else update
+    def walk(self, snapshots, deep=False, root=None):
+        """Find the directories that changed since their snapshot was taken.
 
-        # tl;dr:  (1) if it's a dir, act on sub-inodes (2) update the db
+        Directories whose mtime matches their snapshot are not listed, unless
+        `deep` is set, since adding, removing or renaming an entry updates the
+        mtime of its directory; their subdirectories are found in the
+        snapshots.  Files modified in place are only found by a deep walk,
+        which lists every directory and compares the digest of its listing.
 
-        # self.mk_inode(ev).addCallback(self._state_manager.modify,
-        #                               directory=ev.is_directory)
+        The walk starts at `root`, the watched directory by default, and does
+        not enter ignored directories.
+
+        Blocking.  Returns the (path, listing) of the changed directories,
+        the paths of vanished directories, and the number of directories
+        visited and listed.
+        """
+        subdirs = defaultdict(list)
+        for path in snapshots:
+            subdirs[osp.dirname(path)].append(path)
+
+        changed, vanished, visited, listed = [], [], 0, 0
+        stack = [osp.normpath(root or self._base_path)]
+        while stack:
+            path = stack.pop()
+            snapshot = snapshots.get(path)
+            try:
+                if not deep and snapshot is not None:
+                    if stat(path).st_mtime == snapshot[0]:
+                        visited += 1
+                        stack.extend(p for p in subdirs[path]
+                                     if self.filter_path(p, True))
+                        continue
+                mtime, entries = self.listing(path)
+            except OSError:
+                vanished.append(path)  # the parent's rescan records it
+                continue
+
+            visited += 1
+            listed += 1
+            if snapshot != (mtime, listing_digest(entries)):
+                changed.append((path, (mtime, entries)))
+            stack.extend(p for p, (is_dir, _, _) in entries.items() if is_dir)
+
+        return changed, vanished, visited, listed
+
+    def scanned(self):
+        """Fire with whether an earlier run scanned the directory, i.e. its
+        snapshots are saved
+        """
+        if self._snapshots is None:
+            return defer.succeed(False)
+        return self._snapshots.empty().addCallback(lambda empty: not empty)
+
+    @defer.inlineCallbacks
+    def reconcile(self, deep=False, root=None):
+        """Record the changes made while the directory was not watched, e.g.
+        while the daemon was stopped, by rescanning the directories that
+        changed since their snapshot.  Without a snapshot store, every
+        directory is rescanned.  `root` restricts the reconcile to a
+        subtree.  Fires with a dict of statistics.
+        """
+        snapshots = {}
+        if self._snapshots is not None:
+            snapshots = yield self._snapshots.load()
+
+        changed, vanished, visited, listed = yield deferToThread(
+            self.walk, snapshots, deep, root,
+        )
+        for path in vanished:
+            if self._snapshots is not None:
+                yield self._snapshots.discard(path)
+        for path, listing in changed:
+            yield self.rescan(path, listing)
+
+        stats = dict(snapshots=len(snapshots), visited=visited, listed=listed,
+                     rescanned=len(changed), vanished=len(vanished))
+        self.log.info("reconciled {p}: {s}", p=root or self._base_path,
+                      s=stats)
+        return stats
 
+    @defer.inlineCallbacks
+    def fetch(self, path):
+        """Record the newly selected subtree `path`: its parent is rescanned,
+        to record `path` itself, and the subtree is reconciled.
+        """
+        if osp.join(path, "") != self._base_path:
+            yield self.rescan(osp.dirname(path))
+        yield self.reconcile(deep=True, root=path)
+
+    @threaded
+    def _unchanged(self, entries):
+        """The indexed files whose size and mtime did not change"""
+        unchanged = []
+        for path, entry in entries.items():
+            try:
+                st = stat(path)
+            except OSError:
+                continue
+            if (st.st_size, st.st_mtime) == (entry.bytesize, entry.mtime):
+                unchanged.append(path)
+        return unchanged
+
+    @threaded
+    def _remove(self, files, dirs):
+        for path in files:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        for path in sorted(dirs, reverse=True):  # children first
+            try:
+                os.rmdir(path)
+            except OSError:
+                pass  # not empty: it holds kept files
+
+    @defer.inlineCallbacks
+    def evict(self, path, synced=None):
+        """Stop recording the entries of the subtree `path` that are no
+        longer selected, and drop them from the index.
+
+        Files that did not change since they were indexed, and for which
+        `synced(path, entry)` fires True, are also removed from the disk,
+        along with the directories this empties.  Other files are kept.
+        Fires with the number of files removed.
+        """
+        if self._index is None:
+            return 0
+        entries = yield self._index.subtree(path)
+        entries = {p: e for p, e in entries.items() if not self._selected(p)}
+
+        files = {p: e for p, e in entries.items() if e.md5 != MD5_DIRECTORY}
+        removed = []
+        if synced is not None:
+            for p in (yield self._unchanged(files)):
+                if (yield synced(p, files[p])):
+                    removed.append(p)
+            dirs = set(entries) - set(files)
+            yield self._remove(removed, dirs)
+        self.log.info("evicted {p}: {n} files removed, {k} kept", p=path,
+                      n=len(removed), k=len(files) - len(removed))
+
+        for p in outermost(entries):
+            yield self._state_manager.delete(
+                Inode(node_path=p),
+                directory=entries[p].md5 == MD5_DIRECTORY,
+            )
+        return len(removed)
+
+    @refreshes_ignores
     @log_event()
     def on_moved(self, ev):
         """Called when an existing inode is moved"""
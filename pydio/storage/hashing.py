@@ -0,0 +1,331 @@
+#! /usr/bin/env python
+"""IHasher backends: inline, thread pool and process pool.
+
+Hashing many medium-sized files from threads is only partly parallel, since
+each block read and digest update re-acquires the GIL.  ProcessHasher sends
+batches of paths, rather than file contents, to a pool of worker processes,
+which read and hash the files themselves.  Files too small to amortize the
+round trip are hashed in threads instead.
+
+Each block read is fed to every configured digester, so that adding a digest
+costs CPU time but no extra I/O.  md5 is always computed, since the server
+protocol relies on it.  Blocks are read into buffers reused from one file to
+the next, and passed to the digesters without being copied.
+
+If a pydio.util.priority.PriorityScheduler is given, it bounds the number of
+files hashed at once, and queued files are hashed in its order rather than
+first come, first served.
+"""
+
+import os
+from zlib import adler32
+from hashlib import md5, blake2b, sha256
+from concurrent.futures import ProcessPoolExecutor
+
+from zope.interface import implementer
+
+from twisted.logger import Logger
+from twisted.internet import defer
+from twisted.internet.threads import deferToThread
+
+from pydio.util import buffers, ratelimit
+from pydio.util.delta import BLOCK
+from . import IHasher
+
+HASH_BLOCK_SIZE = 1 << 20
+SIGNATURE_BLOCK_SIZE = 1 << 16
+
+# read buffers shared by the hashing threads of a process
+BUFFERS = buffers.BufferPool(HASH_BLOCK_SIZE)
+
+
+class HashDigester:
+    """Feeds blocks to a hashlib object; the result is stored under `name`"""
+
+    def __init__(self, name, factory):
+        self.name = name
+        self._h = factory()
+
+    def update(self, block):
+        self._h.update(block)
+
+    def result(self):
+        return {self.name: self._h.hexdigest()}
+
+
+class SignatureDigester:
+    """Computes the pydio.util.delta block signature of a file from blocks of
+    any size.
+    """
+
+    def __init__(self, block_size=SIGNATURE_BLOCK_SIZE):
+        self.block_size = block_size
+        self._blocks = []
+        self._tail = b""
+
+    def _add(self, block):
+        self._blocks.append(BLOCK.pack(adler32(block), md5(block).digest()))
+
+    def update(self, block):
+        view = memoryview(block)
+        if self._tail:
+            needed = self.block_size - len(self._tail)
+            self._tail += view[:needed]
+            view = view[needed:]
+            if len(self._tail) < self.block_size:
+                return
+            self._add(self._tail)
+            self._tail = b""
+
+        n = len(view) - len(view) % self.block_size
+        for i in range(0, n, self.block_size):
+            self._add(view[i:i + self.block_size])
+        self._tail = bytes(view[n:])
+
+    def result(self):
+        if self._tail:
+            self._add(self._tail)
+            self._tail = b""
+        return dict(block_size=self.block_size, blocks=b"".join(self._blocks))
+
+
+# digests that may be listed in a job's `digests` option
+DIGESTERS = {
+    "md5": lambda: HashDigester("md5", md5),
+    "blake2b": lambda: HashDigester("blake2b", lambda: blake2b(digest_size=32)),
+    "sha256": lambda: HashDigester("sha256", sha256),
+    "signature": SignatureDigester,
+}
+
+DEFAULT_DIGESTS = ("md5",)
+
+
+def digest_names(digests=None):
+    """Validate a list of digest names, adding md5 if it is missing"""
+    names = ("md5",) + tuple(d for d in digests or () if d != "md5")
+    unknown = set(names) - DIGESTERS.keys()
+    if unknown:
+        raise ValueError("unknown digests {0}".format(sorted(unknown)))
+    return names
+
+
+def hash_file(path, chunker=None, throttle=None, digests=DEFAULT_DIGESTS):
+    """Read a file once, feeding each block to the digesters named in
+    `digests` and, if a chunker factory is given, to a chunker.  Returns a
+    dict of the results to merge into the inode.
+
+    If given, `throttle(resource, n)` is called before the file is opened and
+    after each block is read, with the size of the block, and may block to
+    slow hashing down.
+    """
+    digesters = [DIGESTERS[name]() for name in digests]
+    ck = chunker() if chunker is not None else None
+    chunks = []
+
+    if throttle is not None:
+        throttle(ratelimit.OPENS, 1)
+    with open(path, "rb") as f:
+        for block in buffers.blocks(f, BUFFERS):
+            if throttle is not None:
+                throttle(ratelimit.READ, len(block))
+            for digester in digesters:
+                digester.update(block)
+            if ck is not None:
+                chunks.extend(ck.update(block))
+
+    results = {}
+    for digester in digesters:
+        results.update(digester.result())
+    if ck is not None:
+        chunks.extend(ck.final())
+        results["chunks"] = chunks
+    return results
+
+
+def file_key(path):
+    """The (size, mtime) of `path` by which a scheduler orders its hashing,
+    or (None, None) if it cannot be read.
+    """
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None, None  # let hashing report the error
+    return st.st_size, st.st_mtime
+
+
+def hash_batch(paths, chunker=None, digests=DEFAULT_DIGESTS):
+    """Hash each file in `paths`.  Returns a list of (success, digests or
+    exception) pairs, so that one unreadable file does not fail the batch.
+    """
+    results = []
+    for path in paths:
+        try:
+            results.append((True, hash_file(path, chunker, digests=digests)))
+        except OSError as e:
+            results.append((False, e))
+    return results
+
+
+@implementer(IHasher)
+class InlineHasher:
+    """Hashes files in the calling thread.  Meant for benchmarks and tests."""
+
+    def __init__(self, chunker=None, digests=None):
+        self.chunker = chunker
+        self.digests = digest_names(digests)
+
+    def hash(self, path):
+        return defer.maybeDeferred(
+            hash_file, path, self.chunker, digests=self.digests,
+        )
+
+    def close(self):
+        pass
+
+
+@implementer(IHasher)
+class ThreadHasher:
+    """Hashes each file in twisted's thread pool.  If a Governor is given,
+    reads wait for their share of its limits, block by block.  If a
+    PriorityScheduler is given, files wait for one of its slots.
+    """
+
+    def __init__(self, chunker=None, governor=None, digests=None,
+                 scheduler=None):
+        self.chunker = chunker
+        self.governor = governor
+        self.digests = digest_names(digests)
+        self.scheduler = scheduler
+
+    def hash(self, path, key=None):
+        throttle = None
+        if self.governor is not None:
+            throttle = self.governor.blocking_consume
+        args = hash_file, path, self.chunker, throttle, self.digests
+        if self.scheduler is None:
+            return deferToThread(*args)
+
+        size, mtime = key or file_key(path)
+        return self.scheduler.run(path, size, mtime, deferToThread, *args)
+
+    def close(self):
+        pass
+
+
+@implementer(IHasher)
+class ProcessHasher:
+    """Hashes files in a pool of `workers` processes (one per core by
+    default).
+
+    Paths are queued and sent in batches of up to `batch_size`, at most
+    `batch_delay` seconds after the first one was queued.  Files smaller than
+    `min_size` bytes are hashed in threads.  If a Governor is given, each file
+    waits for its share of its limits before it is queued.  If a
+    PriorityScheduler is given, each file then waits for one of its slots,
+    which it holds until its batch is hashed.
+    """
+
+    log = Logger()
+
+    def __init__(self, workers=None, chunker=None, governor=None,
+                 digests=None, batch_size=32, batch_delay=.005,
+                 min_size=256 << 10, scheduler=None, reactor=None):
+        if reactor is None:
+            from twisted.internet import reactor
+        self._reactor = reactor
+
+        self.workers = workers
+        self.chunker = chunker
+        self.governor = governor
+        self.digests = digest_names(digests)
+        self.batch_size = batch_size
+        self.batch_delay = batch_delay
+        self.min_size = min_size
+        self.scheduler = scheduler
+
+        self._threads = ThreadHasher(chunker, governor, self.digests,
+                                     scheduler)
+        self._pool = None
+        self._queue = []
+        self._flush_call = None
+
+    @property
+    def pool(self):
+        if self._pool is None:
+            self._pool = ProcessPoolExecutor(self.workers)
+        return self._pool
+
+    def hash(self, path):
+        size, mtime = file_key(path)
+        if size is None or size < self.min_size:
+            return self._threads.hash(path, (size, mtime))
+
+        d = defer.Deferred()
+        # hash() may be called from a watchdog thread
+        self._reactor.callFromThread(
+            self._throttle_and_queue, path, size, mtime, d,
+        )
+        return d
+
+    @defer.inlineCallbacks
+    def _throttle_and_queue(self, path, size, mtime, d):
+        if self.governor is not None:
+            yield self.governor.consume(ratelimit.OPENS, 1)
+            yield self.governor.consume(ratelimit.READ, size)
+        if self.scheduler is not None:
+            yield self.scheduler.acquire(path, size, mtime)
+
+        self._queue.append((path, d))
+        if len(self._queue) >= self.batch_size:
+            self._flush()
+        elif self._flush_call is None:
+            self._flush_call = self._reactor.callLater(
+                self.batch_delay, self._flush,
+            )
+
+    def _flush(self):
+        if self._flush_call is not None and self._flush_call.active():
+            self._flush_call.cancel()
+        self._flush_call = None
+
+        batch, self._queue = self._queue, []
+        if not batch:
+            return
+
+        paths = [path for path, _ in batch]
+        pool = self.pool
+        future = pool.submit(hash_batch, paths, self.chunker, self.digests)
+        future.add_done_callback(
+            lambda f: self._reactor.callFromThread(self._done, batch, f, pool)
+        )
+
+    def _done(self, batch, future, pool):
+        if self.scheduler is not None:
+            for _ in batch:
+                self.scheduler.release()
+
+        try:
+            results = future.result()
+        except Exception as e:
+            # e.g. a worker was killed; hash this batch in threads instead,
+            # and later ones in a new pool.  Every batch pending in the
+            # broken pool fails too, but only the first one replaces it.
+            if pool is self._pool:
+                self.log.warn("hashing worker failed ({e}), falling back to "
+                              "threads", e=e)
+                self._pool = None
+                pool.shutdown(wait=False)
+            for path, d in batch:
+                self._threads.hash(path).chainDeferred(d)
+            return
+
+        for (path, d), (ok, result) in zip(batch, results):
+            if ok:
+                d.callback(result)
+            else:
+                d.errback(result)
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=False)
+            self._pool = None
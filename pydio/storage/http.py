@@ -0,0 +1,637 @@
+#! /usr/bin/env python
+"""IStorage implementation for the Pydio server API"""
+
+import json
+import time
+from base64 import b64encode
+from urllib.parse import quote, urlencode
+
+from zope.interface import implementer
+from zope.interface.verify import verifyObject
+
+from twisted.logger import Logger
+from twisted.internet import defer
+from twisted.application.service import MultiService
+from twisted.application.internet import TimerService
+from twisted.web.client import (
+    Agent, HTTPConnectionPool, IPolicyForHTTPS, FileBodyProducer, readBody
+)
+from twisted.web.http_headers import Headers
+from twisted.web import http
+
+from pydio.util import buffers, compress
+from pydio.util.blocking import threaded
+from pydio.util.records import Inode
+from pydio.util.selection import Selection, normalize, covers
+from pydio.storage import IStorage
+from pydio.engine import IStateManager
+
+MD5_DIRECTORY = "directory"
+
+
+class RequestError(Exception):
+    """Raised when the server replies with an unexpected status code"""
+
+    def __init__(self, method, url, code):
+        super().__init__("{0} {1} returned {2}".format(method, url, code))
+        self.code = code
+
+
+@implementer(IPolicyForHTTPS)
+class _InsecurePolicy:
+    """Accept any certificate.  Used when the job sets `trust_ssl`."""
+
+    def creatorForNetloc(self, hostname, port):
+        from twisted.internet import ssl
+        return ssl.CertificateOptions(verify=False)
+
+
+class Client:
+    """Thin client for the Pydio server API.
+
+    Requests share a persistent connection pool of `poolsize` connections per
+    host.  At most `poolsize` requests are in flight at once, so that bursts of
+    metadata requests are pipelined over warm connections instead of opening a
+    new connection per request.
+
+    Unless `compression` is disabled, the codecs supported by the server are
+    negotiated on first use.  Chunks are compressed and decompressed in the
+    thread pool, and the ratio and time spent per codec are recorded in
+    `compression_stats`.
+
+    Paths are relative to `folder`, a folder of the workspace, and start with
+    a slash.
+    """
+
+    log = Logger()
+
+    def __init__(self, server, workspace, user=None, password=None,
+                 timeout=20, poolsize=4, trust_ssl=False, compression=True,
+                 folder="/", reactor=None):
+        if reactor is None:
+            from twisted.internet import reactor
+        self._reactor = reactor
+
+        self.base_url = "{0}/api/{1}/".format(server.rstrip("/"), workspace)
+        self.folder = normalize(folder)
+        self._prefix = self.folder.rstrip("/")
+        self.timeout = timeout
+
+        self.pool = HTTPConnectionPool(reactor, persistent=True)
+        self.pool.maxPersistentPerHost = poolsize
+        self.pool.retryAutomatically = True
+
+        kw = dict(pool=self.pool, connectTimeout=timeout)
+        if trust_ssl:
+            kw["contextFactory"] = _InsecurePolicy()
+        self._agent = Agent(reactor, **kw)
+
+        self._sem = defer.DeferredSemaphore(poolsize)
+
+        self.compression = compression
+        self.compression_stats = compress.Stats()
+        self._encodings = None
+
+        self._headers = {b"user-agent": [b"pydio-sync"]}
+        if user is not None:
+            creds = "{0}:{1}".format(user, password or "").encode()
+            self._headers[b"authorization"] = [b"Basic " + b64encode(creds)]
+
+    def url(self, action, path="/", **params):
+        url = self.base_url + action + quote(self._prefix + path)
+        if params:
+            url += "?" + urlencode(params)
+        return url
+
+    def request(self, method, url, body=None, headers=None, ok=(http.OK,),
+                timeout=None):
+        """Issue a request and return a Deferred that fires with
+        (response, body bytes).  `timeout` overrides the client's.
+        """
+        timeout = self.timeout if timeout is None else timeout
+        hdr = Headers(self._headers)
+        for name, values in (headers or {}).items():
+            hdr.setRawHeaders(name, values)
+
+        if isinstance(body, (bytes, bytearray, memoryview)):
+            body = FileBodyProducer(buffers.BufferReader(body))
+
+        @defer.inlineCallbacks
+        def do_request():
+            d = self._agent.request(method, url.encode(), hdr, body)
+            d.addTimeout(timeout, self._reactor)
+            resp = yield d
+
+            d = readBody(resp)
+            d.addTimeout(timeout, self._reactor)
+            content = yield d
+
+            if resp.code not in ok:
+                raise RequestError(method.decode(), url, resp.code)
+            defer.returnValue((resp, content))
+
+        return self._sem.run(do_request)
+
+    def changes(self, cursor=None, limit=1000, wait=0):
+        """Fire with the changes made within the folder since `cursor`, at
+        most `limit` of them, as a dict with a list of `changes`, each with
+        its `seq`, `type` (create, modify or delete) and `node`; the
+        `cursor` to pass next; and whether `more` changes follow.  If there
+        are none, the server waits up to `wait` seconds for one (long poll).
+
+        Without a cursor, fires with the current cursor and no changes.
+        Fails with a RequestError of code GONE if the cursor is no longer
+        valid, and NOT_FOUND if the server has no change feed.
+        """
+        if cursor is None:
+            url = self.url("changes")
+        else:
+            url = self.url("changes", seq=cursor, limit=limit, wait=wait)
+        d = self._json(b"GET", url, timeout=self.timeout + wait)
+
+        def relative(page):
+            for change in page["changes"]:
+                self._relative(change["node"])
+            return page
+
+        return d.addCallback(relative)
+
+    def _json(self, method, url, **kw):
+        d = self.request(method, url, **kw)
+        return d.addCallback(lambda r: json.loads(r[1].decode()))
+
+    def stat(self, path):
+        """Fire with the inode dict for `path`, or None if it does not exist"""
+        d = self._json(b"GET", self.url("stat", path))
+
+        def not_found(f):
+            f.trap(RequestError)
+            if f.value.code != http.NOT_FOUND:
+                return f
+
+        return d.addErrback(not_found).addCallback(self._relative)
+
+    def stat_many(self, paths):
+        """Fire with {path: inode or None}.  Requests are issued concurrently
+        and pipelined over the connection pool.
+        """
+        paths = list(paths)
+        d = defer.gatherResults(map(self.stat, paths), consumeErrors=True)
+        return d.addCallback(lambda stats: dict(zip(paths, stats)))
+
+    def _relative(self, node):
+        """Make the path of an inode returned by the server relative to the
+        folder
+        """
+        if self._prefix and node is not None:
+            node["node_path"] = node["node_path"][len(self._prefix):] or "/"
+        return node
+
+    def ls(self, path="/"):
+        d = self._json(b"GET", self.url("ls", path))
+        return d.addCallback(lambda nodes: [self._relative(n) for n in nodes])
+
+    @defer.inlineCallbacks
+    def walk(self, path="/", prune=None):
+        """Fire with a list of all inodes beneath `path`.  Sibling directories
+        are listed concurrently.  If given, `prune(node_path)` tells whether
+        an inode is kept; the subtrees of directories it rejects are not
+        listed.
+        """
+        nodes, frontier = [], [path]
+        while frontier:
+            listings = yield defer.gatherResults(
+                map(self.ls, frontier), consumeErrors=True,
+            )
+            frontier = []
+            for children in listings:
+                if prune is not None:
+                    children = [
+                        n for n in children if prune(n["node_path"])
+                    ]
+                nodes.extend(Inode(**n) for n in children)
+                frontier.extend(
+                    n["node_path"] for n in children
+                    if n["md5"] == MD5_DIRECTORY
+                )
+        defer.returnValue(nodes)
+
+    def download(self, path):
+        return self.request(b"GET", self.url("download", path)).addCallback(
+            lambda r: r[1]
+        )
+
+    @defer.inlineCallbacks
+    def encodings(self):
+        """Fire with the content encodings supported by both ends.  Transfers
+        are not compressed while negotiation fails, and it is retried on the
+        next call.
+        """
+        if not self.compression:
+            defer.returnValue(())
+
+        if self._encodings is None:
+            try:
+                caps = yield self._json(b"GET", self.url("capabilities"))
+            except RequestError as e:
+                if e.code != http.NOT_FOUND:
+                    raise
+                caps = {}  # servers that predate compression support
+            except Exception as e:
+                self.log.info("could not negotiate compression ({e})", e=e)
+                defer.returnValue(())
+            self._encodings = tuple(
+                c for c in caps.get("encodings", ()) if c in compress.CODECS
+            )
+        defer.returnValue(self._encodings)
+
+    @defer.inlineCallbacks
+    def _encode(self, data, codec):
+        """Fire with (payload, encoding name), or with the data unchanged and
+        None if compressing it did not make it smaller.
+        """
+        encoded, elapsed = yield _timed(compress.encode, data, codec)
+        self.compression_stats.add(codec[0], len(data), len(encoded), elapsed)
+        if len(encoded) >= len(data):
+            defer.returnValue((data, None))
+        defer.returnValue((encoded, codec[0]))
+
+    @defer.inlineCallbacks
+    def _decode(self, data, name):
+        decoded, elapsed = yield _timed(compress.decode, data, name)
+        self.compression_stats.add(name, len(decoded), len(data), elapsed)
+        defer.returnValue(decoded)
+
+    @defer.inlineCallbacks
+    def download_range(self, path, offset, length, encodings=()):
+        """Fire with up to `length` bytes of `path`, starting at `offset`.  The
+        server may compress the range with one of `encodings`.
+        """
+        rng = "bytes={0}-{1}".format(offset, offset + length - 1).encode()
+        headers = {b"range": [rng]}
+        if encodings:
+            headers[b"accept-encoding"] = [", ".join(encodings).encode()]
+
+        resp, content = yield self.request(
+            b"GET", self.url("download", path),
+            headers=headers, ok=(http.OK, http.PARTIAL_CONTENT),
+        )
+
+        name = resp.headers.getRawHeaders(b"content-encoding", [None])[0]
+        if name is not None:
+            content = yield self._decode(content, name.decode())
+
+        if resp.code == http.OK:  # server ignored the range
+            content = content[offset:offset + length]
+        defer.returnValue(content)
+
+    def upload(self, path, body):
+        return self._json(b"PUT", self.url("upload/put", path), body=body)
+
+    def upload_patch(self, path, basis, reader):
+        """Patch the server's copy of `path`, whose checksum must be `basis`,
+        with an encoded delta read from the file-like `reader`.
+        """
+        url = self.url("upload/patch", path, basis=basis)
+        return self._json(b"PUT", url, body=FileBodyProducer(reader))
+
+    def upload_offset(self, path):
+        """Fire with the number of bytes of `path` the server has received in
+        an interrupted chunked upload.
+        """
+        d = self._json(b"GET", self.url("upload/offset", path))
+        return d.addCallback(lambda r: r["offset"])
+
+    @defer.inlineCallbacks
+    def upload_chunk(self, path, offset, total, data, codec=None):
+        """Append `data` to a chunked upload of a `total`-byte file, compressed
+        with the (codec, level) pair `codec` if it is not None.  Fires with the
+        server's response, whose `offset` is the acknowledged length.  `data`
+        may be any bytes-like object, such as a view of a pooled buffer; it
+        must not change until the request completes.
+        """
+        headers = {}
+        if codec is not None:
+            data, name = yield self._encode(data, codec)
+            if name is not None:
+                headers[b"content-encoding"] = [name.encode()]
+
+        url = self.url("upload/chunk", path, offset=offset, total=total)
+        try:
+            resp = yield self._json(b"PUT", url, body=data, headers=headers)
+        except RequestError as e:
+            if e.code != http.CONFLICT:
+                raise
+            resp = dict(offset=(yield self.upload_offset(path)))
+        defer.returnValue(resp)
+
+    def mkdir(self, path):
+        return self._json(b"POST", self.url("mkdir", path))
+
+    def delete(self, path):
+        return self.request(b"POST", self.url("delete", path))
+
+    def move(self, src, dest):
+        url = self.url("rename", src, dest=self._prefix + dest)
+        return self._json(b"POST", url).addCallback(self._relative)
+
+    def copy(self, src, dest):
+        """Copy a file server-side.  Fires with the inode of the copy."""
+        url = self.url("copy", src, dest=self._prefix + dest)
+        return self._json(b"POST", url).addCallback(self._relative)
+
+    def close(self):
+        return self.pool.closeCachedConnections()
+
+
+@threaded
+def _timed(fn, *args):
+    t0 = time.perf_counter()
+    result = fn(*args)
+    return result, time.perf_counter() - t0
+
+
+@implementer(IStorage)
+class RemoteDirectory(MultiService):
+    """A workspace on a Pydio server.
+
+    The workspace is listed once, then every `frequency` seconds only the
+    changes since the server's change cursor are requested, in pages of
+    `page_size`.  If `long_poll` is set, the server holds each request up to
+    that many seconds until a change happens.  The workspace is listed again
+    only if the server invalidates the cursor, and on every refresh if it
+    has no change feed.
+
+    Node paths are relative to the synchronized `folder` of the workspace and
+    start with a slash.  Only the subtrees in `selection`, a
+    pydio.util.selection.Selection, are listed.
+
+    If the state manager exposes a `cursor` store and an `index`, the cursor
+    is saved as changes are recorded, and the first refresh resumes from it,
+    comparing any listing with the indexed nodes: changes made while the
+    client was stopped, deletions included, are reported without listing the
+    workspace again.
+    """
+
+    log = Logger()
+
+    def __init__(self, server, workspace, frequency=10, selection=None,
+                 page_size=1000, long_poll=0, **kw):
+        super().__init__()
+
+        self.server = server
+        self.workspace = workspace
+        self.frequency = frequency
+        self.selection = selection or Selection()
+        self.page_size = page_size
+        self.long_poll = long_poll
+        self.client = Client(server, workspace, **kw)
+
+        self._state_manager = None
+        self._cursors = None
+        self._index = None
+        self._restored = False
+        self._snapshot = {}
+        self._reachable = False
+        self._refreshing = None
+
+        self._cursor = None
+        self._feed = True  # until the server proves otherwise
+        self.listings = 0
+        self.polls = 0
+
+    def __str__(self):
+        return "<RemoteDirectory {0}/{1}>".format(self.server, self.workspace)
+
+    def connect_state_manager(self, istateman):
+        verifyObject(IStateManager, istateman)
+        self._state_manager = istateman
+        self._cursors = getattr(istateman, "cursor", None)
+        self._index = getattr(istateman, "index", None)
+        self.addService(TimerService(self.frequency, self.refresh))
+
+    def startService(self):
+        self.log.info("syncing remote workspace {s}", s=self)
+        super().startService()
+
+    def stopService(self):
+        if self._refreshing is not None:
+            self._refreshing.cancel()  # e.g. a long poll
+        super().stopService()
+        return self.client.close()
+
+    def available(self):
+        return self._reachable
+
+    def refresh(self):
+        """Report the remote changes since the last refresh to the state
+        manager.
+        """
+        if self._refreshing is not None:
+            return self._refreshing
+        # _refresh may fire at once, in which case _refresh_done has
+        # already reset self._refreshing when addBoth returns
+        d = self._refreshing = self._refresh()
+        d.addBoth(self._refresh_done)
+        return d
+
+    def _refresh_done(self, result):
+        self._refreshing = None
+        return result
+
+    def _unreachable(self, e):
+        self._reachable = False
+        self.log.warn("{s} is unreachable: {e}", s=self, e=e)
+
+    @defer.inlineCallbacks
+    def _restore(self):
+        """Resume from the cursor and the nodes the last run recorded"""
+        if self._index is not None:
+            entries = yield self._index.subtree("/")
+            self._snapshot = {
+                path: Inode(node_path=path, md5=e.md5, bytesize=e.bytesize,
+                            mtime=e.mtime)
+                for path, e in entries.items()
+            }
+        if self._cursors is not None:
+            self._cursor = yield self._cursors.load()
+        self._restored = True
+
+    def _save_cursor(self):
+        if self._cursors is None:
+            return defer.succeed(None)
+        return self._cursors.save(self._cursor)
+
+    @defer.inlineCallbacks
+    def _refresh(self, roots=None):
+        if not self._restored:
+            yield self._restore()
+        if roots is None and self._cursor is not None:
+            try:
+                yield self._follow()
+                return
+            except defer.CancelledError:
+                return
+            except RequestError as e:
+                if e.code != http.GONE:
+                    self._unreachable(e)
+                    return
+                self.log.info("the change cursor of {s} was invalidated",
+                              s=self)
+                self._cursor = None
+                yield self._save_cursor()
+            except Exception as e:
+                self._unreachable(e)
+                return
+        yield self._list(roots)
+
+    @defer.inlineCallbacks
+    def _current_cursor(self):
+        """Fire with the server's change cursor, or None if it has no change
+        feed
+        """
+        if not self._feed:
+            return None
+        try:
+            page = yield self.client.changes()
+        except RequestError as e:
+            if e.code != http.NOT_FOUND:
+                raise
+            self.log.info("{s} has no change feed; listing it on every "
+                          "refresh", s=self)
+            self._feed = False
+            return None
+        return page["cursor"]
+
+    @defer.inlineCallbacks
+    def _follow(self):
+        """Report the changes since the cursor, page by page.  Only the first
+        request waits for changes.
+        """
+        wait = self.long_poll
+        while True:
+            page = yield self.client.changes(self._cursor, self.page_size,
+                                             wait)
+            self._reachable = True
+            self.polls += 1
+            yield self._apply_changes(page["changes"])
+            self._cursor = page["cursor"]
+            yield self._save_cursor()
+            if not page["more"]:
+                return
+            wait = 0
+
+    @defer.inlineCallbacks
+    def _apply_changes(self, changes):
+        """Report the changes from the feed that differ from the snapshot.
+        Changes may repeat what a listing already found.
+        """
+        sm = self._state_manager
+        for change in changes:
+            path = change["node"]["node_path"]
+            if not self.selection.traversed(path):
+                continue
+
+            old = self._snapshot.get(path)
+            if change["type"] == "delete":
+                if old is None:
+                    continue
+                del self._snapshot[path]
+                if _is_dir(old):
+                    prefix = path.rstrip("/") + "/"
+                    for p in [p for p in self._snapshot
+                              if p.startswith(prefix)]:
+                        del self._snapshot[p]
+                yield sm.delete(old, directory=_is_dir(old))
+                continue
+
+            inode = Inode(**change["node"])
+            self._snapshot[path] = inode
+            if old is None:
+                yield sm.create(inode, directory=_is_dir(inode))
+            elif _changed(old, inode):
+                yield sm.modify(inode, directory=_is_dir(inode))
+
+    @defer.inlineCallbacks
+    def _list(self, roots=None):
+        """List the selected nodes, or only those within or above `roots`,
+        and report the differences with the previous listing.  A complete
+        listing also records the cursor its changes are followed from.
+        """
+        selection = self.selection
+        if roots is None:
+            prune = selection.traversed
+        else:
+            def prune(path):
+                return selection.traversed(path) and covers(roots, path)
+
+        try:
+            if roots is None:
+                # changes made during the listing are reported again
+                cursor = yield self._current_cursor()
+            nodes = yield self.client.walk(prune=prune)
+        except defer.CancelledError:
+            return
+        except Exception as e:
+            self._unreachable(e)
+            return
+
+        self._reachable = True
+        listed = {n["node_path"]: n for n in nodes}
+        if roots is None:
+            before, snapshot = self._snapshot, listed
+        else:
+            before, snapshot = {}, {}
+            for path, inode in self._snapshot.items():
+                if covers(roots, path):
+                    before[path] = inode
+                else:
+                    snapshot[path] = inode
+            snapshot.update(listed)
+
+        yield self._apply(before, listed)
+        self._snapshot = snapshot
+        if roots is None:
+            self._cursor = cursor
+            self.listings += 1
+            yield self._save_cursor()
+
+    @defer.inlineCallbacks
+    def set_selection(self, selection):
+        """Synchronize `selection` from now on.  Only the subtrees whose
+        selection changed are listed: newly selected nodes are reported as
+        created, deselected ones as deleted.
+        """
+        while self._refreshing is not None:
+            try:
+                yield self._refreshing
+            except Exception:
+                pass  # logged by whoever started it
+
+        fetch, evict = selection.changes(self.selection)
+        self.selection = selection
+        if fetch or evict:
+            d = self._refreshing = self._refresh(fetch + evict)
+            d.addBoth(self._refresh_done)
+            yield d
+
+    @defer.inlineCallbacks
+    def _apply(self, before, after):
+        sm = self._state_manager
+        for path in sorted(before.keys() - after.keys()):
+            yield sm.delete(before[path], directory=_is_dir(before[path]))
+
+        for path in sorted(after):
+            inode = after[path]
+            if path not in before:
+                yield sm.create(inode, directory=_is_dir(inode))
+            elif _changed(before[path], inode):
+                yield sm.modify(inode, directory=_is_dir(inode))
+
+
+def _is_dir(inode):
+    return inode["md5"] == MD5_DIRECTORY
+
+
+def _changed(old, new):
+    return any(old[k] != new[k] for k in ("md5", "bytesize", "mtime"))
@@ -1,5 +1,5 @@
 #! /usr/bin/env python
-from zope.interface import Attribute
+from zope.interface import Interface, Attribute
 
 from twisted.application.service import IService
 
@@ -46,3 +46,15 @@ class IDiffHandler(IEventHandler):
 
     def on_moved(ev):
         """Called when an existing inode is moved"""
+
+
+class IHasher(Interface):
+    """Computes the digests of local files"""
+
+    def hash(path):
+        """Return a Deferred that fires with the digests of the file at `path`,
+        as a dict to merge into its inode.
+        """
+
+    def close():
+        """Release the resources held by the hasher"""
@@ -0,0 +1,254 @@
+#! /usr/bin/env python
+"""Crash-safe journal of the events an EventHandler accepted.
+
+An accepted event only reaches the index once the StateManager commits it,
+which can take a while if the file must be hashed first.  An event lost to a
+crash in between was only found by a deep reconciliation, since modifying a
+file in place does not change the mtime of its directory.
+
+The journal is a single append-only segment file.  Each accepted event is
+appended to it, and followed by a commit record once the StateManager has
+committed it.  Appends are plain writes: every `sync_interval` seconds, one
+fdatasync makes all the records appended since the last one durable (group
+commit), so that an event is only lost if the machine goes down within that
+interval.  Whenever no event is pending, the segment is truncated; if events
+stay pending while it grows past `max_size`, it is rewritten with only those
+once committed records make up most of it.  A restart thus reads at most
+`max_size` bytes or twice the size of the pending events, and replays the
+pending ones instead of walking the tree.
+
+Replaying an event that was in fact committed is harmless: its file is found
+unchanged in the index, or deleting it deletes nothing.  Commit records and
+truncations therefore need no sync of their own.
+
+Records are framed with their length and a CRC32, so that a record torn by a
+crash ends the segment.
+"""
+
+import os
+import json
+import struct
+import threading
+import os.path as osp
+from zlib import crc32
+from collections import OrderedDict
+
+from twisted.logger import Logger
+from twisted.internet import defer, task
+from twisted.application.service import Service
+
+from pydio.util.blocking import threaded
+from pydio.storage.fs import ALL_EVENTS
+
+FRAME = struct.Struct("<II")  # payload length, CRC32 of the payload
+
+EVENT_CLASSES = {(cls.event_type, cls.is_directory): cls for cls in ALL_EVENTS}
+
+datasync = getattr(os, "fdatasync", os.fsync)  # no fdatasync on macOS
+
+
+def encode(seq, ev=None):
+    """Frame the record of event `ev`, or the commit record of `seq` if no
+    event is given.
+    """
+    record = [seq]
+    if ev is not None:
+        record += [ev.event_type, ev.is_directory, ev.src_path, ev.dest_path]
+    payload = json.dumps(record).encode()
+    return FRAME.pack(len(payload), crc32(payload)) + payload
+
+
+def records(data):
+    """Yield the (seq, event) records framed in `data`, where the event of a
+    commit record is None, up to the first incomplete or corrupt one.
+    """
+    offset = 0
+    while offset + FRAME.size <= len(data):
+        length, crc = FRAME.unpack_from(data, offset)
+        offset += FRAME.size
+        payload = data[offset:offset + length]
+        if len(payload) < length or crc32(payload) != crc:
+            return
+        offset += length
+
+        seq, *event = json.loads(payload)
+        if not event:
+            yield seq, None
+            continue
+        event_type, is_dir, src_path, dest_path = event
+        yield seq, EVENT_CLASSES[event_type, is_dir](src_path, dest_path)
+
+
+def _sync_directory(path):
+    """Make a rename within the directory `path` durable, where possible"""
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return  # e.g. on Windows
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class Journal(Service):
+    """Append-only journal of accepted events, kept in the segment file
+    `path`.  Events are appended from any thread with `append`, and removed
+    with `commit` once recorded.  Opening a journal recovers the events left
+    pending by the last run, which `pending` returns.  `intact` is False if
+    the segment was missing or ended with a torn or corrupt record, in which
+    case events of the last run may have been lost.
+    """
+
+    log = Logger()
+
+    def __init__(self, path, sync_interval=.05, max_size=256 << 10,
+                 clock=None):
+        self.path = path
+        self.sync_interval = sync_interval
+        self.max_size = max_size
+
+        self._lock = threading.Lock()
+        self._pending = OrderedDict()  # {seq: (event, record)}
+        self._seq = 0
+        self._fd = None
+        self._size = 0
+        self._pending_size = 0
+        self._dirty = False
+        self._syncing = None
+        self.appended = 0
+        self.committed = 0
+        self.syncs = 0
+
+        if clock is None:
+            from twisted.internet import reactor as clock
+        self._loop = task.LoopingCall(self._sync)
+        self._loop.clock = clock
+        self._recover()
+
+    def _recover(self):
+        try:
+            with open(self.path, "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            data = None
+
+        size = 0
+        for seq, ev in records(data or b""):
+            self._seq = max(self._seq, seq)
+            record = encode(seq, ev)
+            size += len(record)
+            if ev is None:
+                self._pending.pop(seq, None)
+            else:
+                self._pending[seq] = ev, record
+        self.intact = data is not None and size == len(data)
+        if not self.intact:
+            self.log.warn("the event journal {path} is missing or corrupt",
+                          path=self.path)
+        if self._pending:
+            self.log.info("{n} journaled events were not committed",
+                          n=len(self._pending))
+        self._rewrite()
+
+    def _rewrite(self):
+        """Replace the segment with the records of the pending events"""
+        data = b"".join(record for _, record in self._pending.values())
+        tmp = self.path + ".tmp"
+        with open(tmp, "wb") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.path)
+        _sync_directory(osp.dirname(osp.abspath(self.path)))
+
+        if self._fd is not None:
+            os.close(self._fd)
+        self._fd = os.open(self.path, os.O_WRONLY | os.O_APPEND)
+        self._size = self._pending_size = len(data)
+        self._dirty = False
+
+    def append(self, ev):
+        """Journal an accepted event.  Returns its sequence number, which is
+        passed to `commit` once the event is recorded.
+        """
+        with self._lock:
+            self._seq += 1
+            record = encode(self._seq, ev)
+            os.write(self._fd, record)
+            self._pending[self._seq] = ev, record
+            self._size += len(record)
+            self._pending_size += len(record)
+            self._dirty = True
+            self.appended += 1
+            return self._seq
+
+    def commit(self, seq):
+        """Drop the event `seq` from the journal, once it is recorded"""
+        with self._lock:
+            ev, record = self._pending.pop(seq, (None, None))
+            if ev is None:
+                return
+            self.committed += 1
+            self._pending_size -= len(record)
+            if not self._pending:
+                os.ftruncate(self._fd, 0)
+                self._size = 0
+                return
+            record = encode(seq)
+            os.write(self._fd, record)
+            self._size += len(record)
+
+    def pending(self):
+        """The (seq, event) of the events not committed yet, in order"""
+        with self._lock:
+            return [(seq, ev) for seq, (ev, _) in self._pending.items()]
+
+    def flush(self):
+        """Make the events appended so far durable.  The segment is rewritten
+        instead if it outgrew `max_size` and committed records make up most
+        of it.  Blocking.
+        """
+        with self._lock:
+            if self._size > max(self.max_size, 2 * self._pending_size):
+                self._rewrite()
+                self.syncs += 1
+                return
+            if not self._dirty:
+                return
+            self._dirty = False
+            fd = self._fd
+        datasync(fd)
+        self.syncs += 1
+
+    sync = threaded(flush)
+
+    def _sync(self):
+        self._syncing = self.sync().addErrback(
+            lambda f: self.log.failure("could not sync the event journal", f)
+        )
+        return self._syncing
+
+    def stats(self):
+        with self._lock:
+            return dict(pending=len(self._pending), size=self._size,
+                        appended=self.appended, committed=self.committed,
+                        syncs=self.syncs)
+
+    def startService(self):
+        super().startService()
+        self._loop.start(self.sync_interval, now=False)
+
+    def stopService(self):
+        super().stopService()
+        if self._loop.running:
+            self._loop.stop()
+        d = self._syncing or defer.succeed(None)
+        return d.addCallback(lambda _: self.sync())
+
+    def close(self):
+        """Close the segment.  No event may be appended afterwards."""
+        with self._lock:
+            if self._fd is not None:
+                os.close(self._fd)
+                self._fd = None
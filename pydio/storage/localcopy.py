@@ -0,0 +1,199 @@
+#! /usr/bin/env python
+"""Kernel-side copies between two local directories.
+
+When both sides of a job are local directories, content is copied without
+passing through Python buffers: by cloning the file's extents (a reflink,
+on btrfs, XFS and other copy-on-write filesystems), else with
+`copy_file_range`, which the kernel may offload to the filesystem or the
+NFS/SMB server, else with `sendfile`.  A plain read/write loop is the last
+resort.  A method that fails because a filesystem does not support it is
+not tried again between the same two devices.
+
+Copies are written next to their destination and renamed into place, and
+keep the mode and mtime of their source.  Since the copy is identical to a
+file that is already indexed, its digests are handed to the destination
+directory, which records it without reading it again.
+"""
+
+import os
+import errno
+import os.path as osp
+from stat import S_IMODE
+
+from twisted.logger import Logger
+from twisted.internet import defer
+
+from pydio.util import buffers, ratelimit
+from pydio.util.blocking import threaded
+from pydio.util.priority import PriorityScheduler
+from pydio.storage.fs import MD5_DIRECTORY
+
+try:
+    import fcntl
+except ImportError:  # not on Windows
+    fcntl = None
+
+PARTIAL_SUFFIX = ".pydio_cp"
+COPY_BLOCK_SIZE = 1 << 20
+BUFFERS = buffers.BufferPool(COPY_BLOCK_SIZE)
+
+# ioctl cloning a whole file on Linux, _IOW(0x94, 9, int)
+FICLONE = 0x40049409
+
+# errors meaning that a method does not apply to a pair of files
+UNSUPPORTED = {
+    errno.EXDEV, errno.ENOSYS, errno.EOPNOTSUPP, errno.ENOTTY,
+    errno.EINVAL, errno.EBADF, errno.ETXTBSY,
+}
+
+
+def reflink(src, dst, size):
+    if fcntl is None:
+        raise OSError(errno.ENOSYS, "reflinks are not supported")
+    fcntl.ioctl(dst, FICLONE, src)
+
+
+def copy_range(src, dst, size):
+    offset = 0
+    while offset < size:
+        n = os.copy_file_range(src, dst, size - offset)
+        if n == 0:
+            break  # the source shrank
+        offset += n
+
+
+def sendfile(src, dst, size):
+    offset = 0
+    while offset < size:
+        n = os.sendfile(dst, src, offset, size - offset)
+        if n == 0:
+            break
+        offset += n
+
+
+def read_write(src, dst, size):
+    """Copy through a Python buffer; the baseline the other methods beat"""
+    with open(src, "rb", buffering=0, closefd=False) as f:
+        for block in buffers.blocks(f, BUFFERS):
+            os.write(dst, block)
+
+
+METHODS = [("reflink", reflink), ("read_write", read_write)]
+if hasattr(os, "copy_file_range"):
+    METHODS.insert(1, ("copy_file_range", copy_range))
+if hasattr(os, "sendfile"):
+    METHODS.insert(-1, ("sendfile", sendfile))
+
+# (method name, source device, destination device) known not to work
+_unsupported = set()
+
+
+def copy_file(src_path, dst_path, methods=None):
+    """Copy `src_path` to `dst_path` with the first of `methods` that works,
+    keeping its mode and mtime.  Returns (method name, os.stat_result of the
+    source at the time of the copy).
+    """
+    tmp = dst_path + PARTIAL_SUFFIX
+    src = os.open(src_path, os.O_RDONLY)
+    try:
+        st = os.fstat(src)
+        dst = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC,
+                      S_IMODE(st.st_mode) | 0o200)
+        try:
+            name = _copy(src, dst, st, methods or METHODS)
+        finally:
+            os.close(dst)
+        os.utime(tmp, ns=(st.st_atime_ns, st.st_mtime_ns))
+        os.chmod(tmp, S_IMODE(st.st_mode))
+        os.replace(tmp, dst_path)
+    except BaseException:
+        if osp.exists(tmp):
+            os.remove(tmp)
+        raise
+    finally:
+        os.close(src)
+    return name, st
+
+
+def _copy(src, dst, st, methods):
+    dst_dev = os.fstat(dst).st_dev
+    for name, method in methods:
+        key = name, st.st_dev, dst_dev
+        if key in _unsupported:
+            continue
+        try:
+            method(src, dst, st.st_size)
+            return name
+        except OSError as e:
+            if e.errno not in UNSUPPORTED or name == "read_write":
+                raise
+            _unsupported.add(key)
+            # start over from a clean destination
+            os.lseek(src, 0, os.SEEK_SET)
+            os.lseek(dst, 0, os.SEEK_SET)
+            os.ftruncate(dst, 0)
+    raise OSError(errno.ENOSYS, "no copy method applies")
+
+
+class LocalTransfers:
+    """Copies files between two LocalDirectories, with the interface of a
+    TransferPipeline: `local` is the job's directory and `remote` the one it
+    syncs with.  At most `concurrency` files are copied at once, in the order
+    of a PriorityScheduler.  If a Governor is given, each copy waits for its
+    share of the disk limits.
+    """
+
+    log = Logger()
+
+    def __init__(self, local, remote, concurrency=4, governor=None,
+                 scheduler=None, methods=None, clock=None):
+        self.local = local
+        self.remote = remote
+        self.governor = governor
+        self.methods = methods
+        self.scheduler = scheduler or PriorityScheduler(
+            concurrency, clock=clock,
+        )
+        self.bytes_copied = 0
+        self.copies = {}  # {method name: number of files}
+
+    def upload_node(self, inode, remote_path):
+        return self._copy_node(
+            inode, self.remote.absolute_path(remote_path), self.remote,
+            remote_path,
+        )
+
+    def download_node(self, inode, local_path):
+        rel_path = self.local.relative_path(local_path)
+        return self._copy_node(inode, local_path, self.local, rel_path)
+
+    @defer.inlineCallbacks
+    def _copy_node(self, inode, dst_path, dst_storage, rel_path):
+        if inode["md5"] == MD5_DIRECTORY:
+            yield threaded(os.makedirs)(dst_path, exist_ok=True)
+            return
+
+        yield self.scheduler.run(
+            rel_path, inode.get("bytesize"), inode.get("mtime"),
+            self._copy, inode, dst_path, dst_storage,
+        )
+
+    @defer.inlineCallbacks
+    def _copy(self, inode, dst_path, dst_storage):
+        if self.governor is not None:
+            yield self.governor.consume(ratelimit.OPENS, 1)
+            yield self.governor.consume(ratelimit.READ, inode["bytesize"] or 0)
+
+        # announced before the copy can be seen; it keeps the source's mtime,
+        # so the md5 only applies if the source did not change since indexed
+        dst_storage.expect(dst_path, inode["bytesize"], inode["mtime"],
+                           dict(md5=inode["md5"]))
+
+        yield threaded(os.makedirs)(osp.dirname(dst_path), exist_ok=True)
+        name, st = yield threaded(copy_file)(
+            inode["node_path"], dst_path, self.methods,
+        )
+        self.copies[name] = self.copies.get(name, 0) + 1
+        self.bytes_copied += st.st_size
+        self.log.debug("copied {src} to {dst} with {m}",
+                       src=inode["node_path"], dst=dst_path, m=name)
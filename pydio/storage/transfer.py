@@ -0,0 +1,379 @@
+#! /usr/bin/env python
+"""Chunked, resumable file transfers between a local directory and a Pydio
+server.
+"""
+
+import os
+import os.path as osp
+from twisted.logger import Logger
+from twisted.internet import defer
+from twisted.internet.task import deferLater
+
+from pydio.util import buffers, compress, delta, ratelimit
+from pydio.util.blocking import threaded
+from pydio.util.priority import PriorityScheduler
+from pydio.storage.http import RequestError, MD5_DIRECTORY
+from pydio.storage.hashing import hash_file
+
+UPLOAD = "up"
+DOWNLOAD = "down"
+PARTIAL_SUFFIX = ".pydio_dl"
+
+
+@threaded
+def read_chunk(path, offset, buf):
+    """Read the chunk at `offset` into `buf`.  Returns a memoryview of it."""
+    with open(path, "rb") as f:
+        f.seek(offset)
+        return buffers.readinto(f, buf)
+
+
+@threaded
+def write_chunk(path, offset, data):
+    with open(path, "r+b") as f:
+        f.seek(offset)
+        f.write(data)
+
+
+@threaded
+def prepare_partial(path, offset):
+    """Ensure the partial download file exists and is exactly `offset` bytes
+    long.  Returns the offset at which the download may resume.
+    """
+    os.makedirs(osp.dirname(path), exist_ok=True)
+    if not osp.exists(path) or osp.getsize(path) < offset:
+        offset = 0
+
+    with open(path, "ab") as f:
+        f.truncate(offset)
+    return offset
+
+
+@threaded
+def choose_codec(path, accepted):
+    """Pick the compression codec for the file at `path`, from a sample of its
+    first bytes.
+    """
+    with open(path, "rb") as f:
+        sample = f.read(compress.SAMPLE_SIZE)
+    return compress.choose(path, sample, accepted)
+
+
+@threaded
+def file_md5(path):
+    if not osp.isfile(path):
+        return None
+    return hash_file(path)["md5"]
+
+
+class TransferPipeline:
+    """Streams files to and from a Pydio server in fixed-size chunks.
+
+    At most `concurrency` files are transferred at once, in the order of a
+    pydio.util.priority.PriorityScheduler: small, recently modified files and
+    high-priority folders first.  Only one chunk per transfer is held in
+    memory, read into a buffer reused across chunks and files and sent without
+    being copied.  Progress is saved to an ITransferLog after
+    each acknowledged chunk, so that interrupted transfers resume from the last
+    acknowledged offset, including after a restart.  A resumed download is
+    checked against its checksum before it is moved into place, and
+    restarted from scratch if it does not match.
+
+    Chunks are compressed when the server supports it and the content of the
+    file is worth compressing.  Offsets always refer to uncompressed data.
+
+    If a Governor is provided, each chunk waits for its share of the disk and
+    network rate limits before it is read and sent, or requested.
+
+    If an ISignatureStore is provided, the block signature of each uploaded
+    file of at least `min_delta_size` bytes is saved.  When such a file is
+    modified, only a delta against the saved signature is sent, provided the
+    server still holds the version it describes and the delta is smaller than
+    `max_delta_ratio` of the file.
+
+    If an IChunkIndex is provided, files whose content is already present on
+    the server under another path are copied server-side rather than uploaded.
+    `to_remote` maps local paths to remote paths.
+    """
+
+    log = Logger()
+
+    def __init__(self, client, progress, chunk_size=4 << 20, concurrency=4,
+                 max_retries=5, backoff=1., signatures=None,
+                 block_size=1 << 16, min_delta_size=1 << 20,
+                 max_delta_ratio=.5, dedup=None, to_remote=None,
+                 governor=None, scheduler=None, clock=None):
+        self.client = client
+        self.progress = progress
+        self.chunk_size = chunk_size
+        self.max_retries = max_retries
+        self.backoff = backoff
+
+        self.signatures = signatures
+        self.block_size = block_size
+        self.min_delta_size = min_delta_size
+        self.max_delta_ratio = max_delta_ratio
+        self.bytes_sent = 0
+
+        self.dedup = dedup
+        self.to_remote = to_remote
+        self.governor = governor
+
+        if clock is None:
+            from twisted.internet import reactor as clock
+        self._clock = clock
+        self.scheduler = scheduler or PriorityScheduler(
+            concurrency, clock=clock,
+        )
+        self.buffers = buffers.BufferPool(
+            chunk_size, max_free=self.scheduler.slots,
+        )
+
+    def upload(self, local_path, remote_path, checksum=None, bytesize=None,
+               mtime=None):
+        return self.scheduler.run(
+            remote_path, bytesize, mtime,
+            self._upload, local_path, remote_path, checksum,
+        )
+
+    def download(self, remote_path, local_path, checksum=None, bytesize=None,
+                 mtime=None):
+        return self.scheduler.run(
+            remote_path, bytesize, mtime,
+            self._download, remote_path, local_path, checksum, bytesize,
+        )
+
+    @defer.inlineCallbacks
+    def upload_node(self, inode, remote_path):
+        """Upload the inode unless the server already holds identical content"""
+        if inode["md5"] == MD5_DIRECTORY:
+            yield self.client.mkdir(remote_path)
+            return
+
+        remote = yield self.client.stat(remote_path)
+        if remote is not None and remote["md5"] == inode["md5"]:
+            return
+
+        local_path = inode["node_path"]
+        if remote is None and self.dedup is not None:
+            copied = yield self._copy_duplicate(inode, remote_path)
+            if copied:
+                return
+
+        if remote is not None and self.signatures is not None:
+            patched = yield self._upload_delta(
+                local_path, remote_path, remote["md5"], inode["md5"],
+                inode.get("mtime"),
+            )
+            if patched:
+                return
+
+        yield self.upload(local_path, remote_path, inode["md5"],
+                          inode.get("bytesize"), inode.get("mtime"))
+        yield self._save_signature(local_path, inode["md5"])
+
+    @defer.inlineCallbacks
+    def _upload_delta(self, local_path, remote_path, basis, md5=None,
+                      mtime=None):
+        """Patch the remote file with a block delta.  Returns False if no
+        usable signature exists or the delta is not worth sending.
+        """
+        sig = yield self.signatures.get(local_path)
+        if sig is None or sig.md5 != basis:
+            defer.returnValue(False)
+
+        size = yield threaded(osp.getsize)(local_path)
+        max_literal = int(self.max_delta_ratio * size)
+        ops = yield threaded(delta.delta)(local_path, sig, max_literal)
+        if ops is None:
+            defer.returnValue(False)
+
+        encoded = delta.encoded_size(ops)
+
+        self.log.debug("sending {n} byte delta for {p}", n=encoded, p=local_path)
+        try:
+            yield self.scheduler.run(
+                remote_path, encoded, mtime, self.client.upload_patch,
+                remote_path, basis, delta.DeltaReader(local_path, ops),
+            )
+        except RequestError as e:
+            self.log.info("delta rejected for {p} ({e})", p=remote_path, e=e)
+            defer.returnValue(False)
+
+        self.bytes_sent += encoded
+        yield self._save_signature(local_path, md5)
+        defer.returnValue(True)
+
+    @defer.inlineCallbacks
+    def _copy_duplicate(self, inode, remote_path):
+        """Copy an already-synchronized file with identical content on the
+        server.  Returns False if there is none, or if it has changed.
+        """
+        src = yield self.dedup.synced_duplicate(inode["md5"])
+        if src is None or src == inode["node_path"]:
+            defer.returnValue(False)
+
+        try:
+            copy = yield self.client.copy(self.to_remote(src), remote_path)
+        except RequestError as e:
+            self.log.info("server-side copy failed ({e})", e=e)
+            defer.returnValue(False)
+
+        if copy["md5"] != inode["md5"]:
+            defer.returnValue(False)  # the remote duplicate has diverged
+
+        self.log.debug("copied {p} from {src} server-side", p=remote_path, src=src)
+        defer.returnValue(True)
+
+    @defer.inlineCallbacks
+    def _save_signature(self, local_path, md5=None):
+        """Save the signature of the file just sent.  The one computed when
+        the file was indexed is reused if it matches the content (`md5`) and
+        block size; otherwise the file is read again.
+        """
+        if self.signatures is None:
+            return
+
+        size = yield threaded(osp.getsize)(local_path)
+        if size < self.min_delta_size:
+            return
+
+        sig = None
+        if md5 is not None:
+            sig = yield self.signatures.indexed(local_path)
+        if sig is None or (sig.md5, sig.block_size) != (md5, self.block_size):
+            sig = yield threaded(delta.signature)(local_path, self.block_size)
+        yield self.signatures.save(local_path, sig)
+
+    @defer.inlineCallbacks
+    def download_node(self, inode, local_path):
+        """Download the inode unless the local file already holds identical
+        content.
+        """
+        if inode["md5"] == MD5_DIRECTORY:
+            yield threaded(os.makedirs)(local_path, exist_ok=True)
+            return
+
+        local = yield file_md5(local_path)
+        if local != inode["md5"]:
+            yield self.download(
+                inode["node_path"], local_path, inode["md5"], inode["bytesize"],
+                inode.get("mtime"),
+            )
+
+    def _throttle(self, resource, n):
+        if self.governor is None or not n:
+            return defer.succeed(None)
+        return self.governor.consume(resource, n)
+
+    def _retry(self, attempt, e, path):
+        if isinstance(e, RequestError) and e.code < 500:
+            raise e
+        if attempt > self.max_retries:
+            raise e
+
+        delay = self.backoff * 2 ** (attempt - 1)
+        self.log.warn("transfer of {path} interrupted ({e}), retrying in "
+                      "{delay}s", path=path, e=e, delay=delay)
+        return deferLater(self._clock, delay, lambda: None)
+
+    @defer.inlineCallbacks
+    def _upload(self, local_path, remote_path, checksum):
+        yield self._throttle(ratelimit.OPENS, 1)
+        total = yield threaded(osp.getsize)(local_path)
+
+        offset = 0
+        saved = yield self.progress.get(remote_path, UPLOAD)
+        if saved is not None and tuple(saved[1:]) == (total, checksum):
+            offset = None  # resume from the server's acknowledged offset
+
+        codec = None
+        encodings = yield self.client.encodings()
+        if encodings and total:
+            codec = yield choose_codec(local_path, encodings)
+            self.log.debug("compressing {p} with {c}", p=remote_path, c=codec)
+
+        with self.buffers.lease() as buf:
+            attempt = 0
+            while True:
+                try:
+                    if offset is None:
+                        offset = yield self.client.upload_offset(remote_path)
+                        self.log.debug("resuming upload of {p} at {o}",
+                                       p=remote_path, o=offset)
+
+                    while True:
+                        size = min(self.chunk_size, total - offset)
+                        yield self._throttle(ratelimit.READ, size)
+                        yield self._throttle(ratelimit.UPLOAD, size)
+                        data = yield read_chunk(local_path, offset, buf)
+                        resp = yield self.client.upload_chunk(
+                            remote_path, offset, total, data, codec,
+                        )
+                        self.bytes_sent += len(data)
+                        offset = resp["offset"]
+                        if offset >= total:
+                            break
+                        yield self.progress.save(
+                            remote_path, UPLOAD, offset, total, checksum,
+                        )
+                    break
+                except Exception as e:
+                    attempt += 1
+                    yield self._retry(attempt, e, remote_path)
+                    offset = None
+
+        yield self.progress.clear(remote_path, UPLOAD)
+        defer.returnValue(resp)
+
+    @defer.inlineCallbacks
+    def _download(self, remote_path, local_path, checksum, bytesize):
+        if bytesize is None:
+            inode = yield self.client.stat(remote_path)
+            bytesize, checksum = inode["bytesize"], inode["md5"]
+
+        yield self._throttle(ratelimit.OPENS, 1)
+        partial = local_path + PARTIAL_SUFFIX
+        saved = yield self.progress.get(local_path, DOWNLOAD)
+
+        offset = 0
+        if saved is not None and tuple(saved[1:]) == (bytesize, checksum):
+            offset = saved[0]
+        offset = yield prepare_partial(partial, offset)
+        resumed = offset > 0
+        encodings = yield self.client.encodings()
+
+        attempt = 0
+        while offset < bytesize:
+            try:
+                size = min(self.chunk_size, bytesize - offset)
+                yield self._throttle(ratelimit.DOWNLOAD, size)
+                data = yield self.client.download_range(
+                    remote_path, offset, size, encodings,
+                )
+                if not data:
+                    raise RequestError("GET", remote_path, 416)
+
+                yield write_chunk(partial, offset, data)
+                offset += len(data)
+                yield self.progress.save(
+                    local_path, DOWNLOAD, offset, bytesize, checksum,
+                )
+            except Exception as e:
+                attempt += 1
+                yield self._retry(attempt, e, remote_path)
+
+        if resumed and checksum is not None:
+            # the partial may have changed since it was written
+            actual = yield file_md5(partial)
+            if actual != checksum:
+                self.log.warn("resumed download of {p} does not match its "
+                              "checksum, restarting it", p=remote_path)
+                yield threaded(os.remove)(partial)
+                yield self.progress.clear(local_path, DOWNLOAD)
+                yield self._download(remote_path, local_path, checksum,
+                                     bytesize)
+                return
+
+        yield threaded(os.replace)(partial, local_path)
+        yield self.progress.clear(local_path, DOWNLOAD)
@@ -0,0 +1,630 @@
+#! /usr/bin/env python
+"""Hybrid inotify and polling directory watcher.
+
+inotify needs one watch per directory, and `fs.inotify.max_user_watches` caps
+them for the whole user, so watching a large tree recursively fails or
+silently misses events.  HybridWatcher spends a fixed budget of watches on
+the most active directories (the shallowest ones, until activity is known)
+and polls the mtime of the others.  A polled directory that does not change
+is polled less and less often, down to once every `max_interval` seconds; one
+that changes is polled every `min_interval` seconds again.  Every
+`rebalance_interval` seconds, the most active polled directories are promoted
+to watches and the least active watched ones are demoted.
+
+Changes are reported to an EventHandler as directory modify events, which it
+resolves by diffing the directory against the index, and as file modify
+events for files written in watched directories.  A file modified in place
+does not change the mtime of its directory, so such changes in polled
+directories are only found by a deep reconciliation, which also runs when
+the inotify queue overflows.
+
+Without a budget, TreeWatcher watches the tree with a watchdog observer, but
+schedules no watch over the directories the EventHandler excludes (ignored or
+unselected): the largest subtrees without an excluded directory are watched
+recursively, and the directories that hold one are watched alone.
+"""
+
+import os
+import time
+import heapq
+import ctypes
+import random
+import select
+import struct
+import threading
+import os.path as osp
+from errno import ENOSPC
+
+from twisted.logger import Logger
+from twisted.internet import defer, task
+from twisted.internet.threads import deferToThread
+from twisted.application.service import Service
+
+from watchdog import events
+from watchdog.observers import Observer
+from watchdog.utils import UnsupportedLibcError
+
+from pydio.util.ignore import IGNORE_FILE
+
+try:
+    from watchdog.observers.inotify_c import (
+        InotifyConstants as IN, inotify_init, inotify_add_watch,
+        inotify_rm_watch,
+    )
+except (ImportError, UnsupportedLibcError):  # not Linux
+    IN = None
+else:
+    EVENT_MASK = (
+        IN.IN_CREATE | IN.IN_DELETE | IN.IN_MOVED_FROM | IN.IN_MOVED_TO |
+        IN.IN_CLOSE_WRITE | IN.IN_ATTRIB | IN.IN_DELETE_SELF |
+        IN.IN_MOVE_SELF | IN.IN_DONT_FOLLOW | IN.IN_ONLYDIR
+    )
+    ENTRY_CHANGES = (
+        IN.IN_CREATE | IN.IN_DELETE | IN.IN_MOVED_FROM | IN.IN_MOVED_TO
+    )
+
+EVENT_HEADER = struct.Struct("iIII")  # struct inotify_event, without name
+READ_SIZE = 64 << 10
+
+# activity scores below this are reset, so that long-idle directories rank
+# by depth alone
+MIN_SCORE = .01
+
+
+class _Dir:
+    """A watched or polled directory"""
+
+    __slots__ = ("path", "depth", "mtime", "score", "watched", "interval",
+                 "due")
+
+    def __init__(self, path, depth, mtime, interval, due, score=0.):
+        self.path = path
+        self.depth = depth
+        self.mtime = mtime
+        self.score = score
+        self.watched = False
+        self.interval = interval
+        self.due = due
+
+
+class Inotify:
+    """An inotify instance, to which watches are added one directory at a
+    time.  Unlike watchdog's, it reports queue overflows instead of dropping
+    them, and tolerates events for watches that were just removed.
+    """
+
+    def __init__(self):
+        self.fd = inotify_init()
+        if self.fd == -1:
+            self._raise()
+        self._kill_r, self._kill_w = os.pipe()
+        self._lock = threading.Lock()
+        self._paths = {}  # watch descriptor -> path
+        self._wds = {}
+
+    @staticmethod
+    def _raise(path=None):
+        err = ctypes.get_errno()
+        raise OSError(err, os.strerror(err), path)
+
+    def add(self, path):
+        wd = inotify_add_watch(self.fd, os.fsencode(path), EVENT_MASK)
+        if wd == -1:
+            self._raise(path)
+        with self._lock:
+            self._paths[wd] = path
+            self._wds[path] = wd
+
+    def remove(self, path):
+        """Remove a watch.  Its path is kept until the kernel acknowledges
+        the removal, since events may still be queued for it.
+        """
+        with self._lock:
+            wd = self._wds.pop(path, None)
+        if wd is not None:
+            inotify_rm_watch(self.fd, wd)
+
+    def read(self):
+        """Block until events arrive, and return a list of (directory path,
+        mask, entry name).  A queue overflow is reported with a path of
+        None.  Returns None once the instance is closed.
+        """
+        ready, _, _ = select.select([self.fd, self._kill_r], [], [])
+        if self._kill_r in ready:
+            for fd in (self.fd, self._kill_r, self._kill_w):
+                os.close(fd)
+            return None
+
+        buf = os.read(self.fd, READ_SIZE)
+        evs, i = [], 0
+        with self._lock:
+            while i + EVENT_HEADER.size <= len(buf):
+                wd, mask, _, length = EVENT_HEADER.unpack_from(buf, i)
+                i += EVENT_HEADER.size
+                name = os.fsdecode(buf[i:i + length].rstrip(b"\0"))
+                i += length
+
+                if mask & IN.IN_Q_OVERFLOW:
+                    evs.append((None, mask, name))
+                elif mask & IN.IN_IGNORED:
+                    path = self._paths.pop(wd, None)
+                    if self._wds.get(path) == wd:
+                        del self._wds[path]
+                elif wd in self._paths:
+                    evs.append((self._paths[wd], mask, name))
+        return evs
+
+    def close(self):
+        """Wake the reading thread, which closes the instance"""
+        os.write(self._kill_w, b"!")
+
+
+class HybridWatcher(Service):
+    """Watches the tree under `path` for an EventHandler, with at most
+    `budget` inotify watches.  Without inotify, every directory is polled.
+    """
+
+    log = Logger()
+
+    def __init__(self, handler, path, budget=8192, min_interval=1.,
+                 max_interval=60., rebalance_interval=30., decay=.5,
+                 clock=None):
+        if clock is None:
+            from twisted.internet import reactor as clock
+        self._clock = clock
+
+        self.handler = handler
+        self.path = osp.normpath(path)
+        self.budget = budget if IN is not None else 0
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.rebalance_interval = rebalance_interval
+        self.decay = decay
+
+        self.dirs = {}
+        self._polls = []  # heap of (due, path), stale entries skipped
+        self._inotify = None
+        self._reader = None
+
+        self._poll_loop = task.LoopingCall(self.poll)
+        self._poll_loop.clock = clock
+        self._rebalance_loop = task.LoopingCall(self.rebalance)
+        self._rebalance_loop.clock = clock
+
+        self.polls = 0
+        self.poll_time = 0.
+        self.poll_changes = 0
+        self.inotify_events = 0
+        self.overflows = 0
+        self.promotions = 0
+        self.demotions = 0
+
+    @defer.inlineCallbacks
+    def startService(self):
+        super().startService()
+        yield self.discover(self.path, hot=False)
+
+        if self.budget:
+            self._inotify = Inotify()
+            self._inotify.add(self.path)
+            self.dirs[self.path].watched = True
+            self._reader = threading.Thread(
+                target=self._read, name="HybridWatcher", daemon=True,
+            )
+            self._reader.start()
+
+        yield self.rebalance()
+        self._poll_loop.start(self.min_interval, now=False)
+        self._rebalance_loop.start(self.rebalance_interval, now=False)
+
+    def stopService(self):
+        super().stopService()
+        for loop in (self._poll_loop, self._rebalance_loop):
+            if loop.running:
+                loop.stop()
+        if self._inotify is None:
+            return defer.succeed(None)
+
+        self._inotify.close()
+        self._inotify = None
+        return deferToThread(self._reader.join)
+
+    # discovery
+
+    def _walk(self, top):
+        """Return the (path, mtime) of `top` and of the directories beneath
+        it that are not known yet.  Blocking.
+        """
+        found, stack = [], [top]
+        while stack:
+            path = stack.pop()
+            if path != top and path in self.dirs:
+                continue  # its subtree is known too
+            try:
+                mtime = os.stat(path).st_mtime
+                with os.scandir(path) as it:
+                    stack.extend(
+                        e.path for e in it
+                        if e.is_dir(follow_symlinks=False)
+                        and self.handler.filter_path(e.path, True)
+                    )
+            except OSError:
+                continue  # removed meanwhile
+            if path not in self.dirs:
+                found.append((path, mtime))
+        return found
+
+    def discover(self, path, hot=True):
+        """Register the directories under `path` that are not known yet.
+        Directories found after startup are `hot`: they are polled often
+        until they settle, and rank high for promotion.
+        """
+        return deferToThread(self._walk, path).addCallback(self._add, hot)
+
+    def _add(self, found, hot):
+        now = self._clock.seconds()
+        base = self.path.count(os.sep)
+        for path, mtime in found:
+            if hot:
+                interval, due, score = self.min_interval, now, 1.
+            else:  # spread the first polls of a large tree
+                interval = self.max_interval
+                due, score = now + random.uniform(0, interval), 0.
+            d = _Dir(path, path.count(os.sep) - base, mtime, interval, due,
+                     score)
+            self.dirs[path] = d
+            heapq.heappush(self._polls, (d.due, path))
+
+    def _forget(self, path):
+        """Forget a directory and its subtree, e.g. once it was removed"""
+        prefix = osp.join(path, "")
+        gone = [p for p in self.dirs if p == path or p.startswith(prefix)]
+        watched = [p for p in gone if self.dirs.pop(p).watched]
+        if watched and self._inotify is not None:
+            deferToThread(self._unwatch, watched)
+
+    # change reporting
+
+    def _changed(self, path):
+        """Report a change to the entries of the directory `path`"""
+        if path not in self.dirs:
+            return defer.succeed(None)
+        if path != self.path and not self.handler.filter_path(path, True):
+            self._forget(path)  # ignored since it was discovered
+            return defer.succeed(None)
+        d = self.handler.handle(events.DirModifiedEvent(path))
+        d.addCallback(lambda _: self.discover(path))
+        return d.addErrback(lambda f: self.log.failure(
+            "could not record changes to {p}", f, p=path,
+        ))
+
+    def _modified(self, path):
+        if self.handler.filter_path(path):
+            d = self.handler.handle(events.FileModifiedEvent(path))
+            d.addErrback(lambda f: self.log.failure(
+                "could not record changes to {p}", f, p=path,
+            ))
+
+    # inotify
+
+    def _read(self):
+        from twisted.internet import reactor
+
+        inotify = self._inotify
+        while True:
+            evs = inotify.read()
+            if evs is None:
+                return
+            reactor.callFromThread(self._inotify_events, evs)
+
+    def _inotify_events(self, evs):
+        self.inotify_events += len(evs)
+        changed, modified = set(), set()
+        for dir_path, mask, name in evs:
+            if dir_path is None:
+                self._overflowed()
+                continue
+            if mask & (IN.IN_DELETE_SELF | IN.IN_MOVE_SELF):
+                self._forget(dir_path)
+                changed.add(osp.dirname(dir_path))
+                continue
+
+            path = osp.join(dir_path, name)
+            if dir_path in self.dirs:
+                self.dirs[dir_path].score += 1
+            if mask & ENTRY_CHANGES:
+                changed.add(dir_path)
+                if mask & IN.IN_ISDIR and mask & (
+                    IN.IN_DELETE | IN.IN_MOVED_FROM
+                ):
+                    self._forget(path)
+            elif not mask & IN.IN_ISDIR:
+                modified.add(path)
+
+        for path in changed:
+            self._changed(path)
+        for path in modified:
+            if osp.dirname(path) not in changed:
+                self._modified(path)
+
+    def _overflowed(self):
+        """Events were lost: reconcile the whole tree"""
+        self.overflows += 1
+        self.log.warn("inotify queue overflow under {p}; reconciling",
+                      p=self.path)
+        self.handler.reconcile(deep=True).addErrback(
+            lambda f: self.log.failure("reconciliation failed", f)
+        )
+
+    def _unwatch(self, paths):
+        inotify = self._inotify
+        if inotify is not None:
+            for path in paths:
+                inotify.remove(path)
+
+    def _watch(self, paths):
+        """Add watches, then stat the directories, so that no change is lost
+        between the last poll and the watch.  Returns the (path, mtime) of
+        the watched directories, and True if the watch limit was hit.
+        Blocking.
+        """
+        inotify, watched = self._inotify, []
+        for path in paths:
+            if inotify is None:
+                break  # stopped
+            try:
+                inotify.add(path)
+                watched.append((path, os.stat(path).st_mtime))
+            except OSError as e:
+                if e.errno == ENOSPC:
+                    return watched, True
+        return watched, False
+
+    # polling
+
+    def _stat(self, paths):
+        t0 = time.perf_counter()
+        mtimes = []
+        for path in paths:
+            try:
+                mtimes.append(os.stat(path).st_mtime)
+            except OSError:
+                mtimes.append(None)
+        return mtimes, time.perf_counter() - t0
+
+    @defer.inlineCallbacks
+    def poll(self):
+        """Stat the polled directories that are due"""
+        now = self._clock.seconds()
+        due = []
+        while self._polls and self._polls[0][0] <= now:
+            t, path = heapq.heappop(self._polls)
+            d = self.dirs.get(path)
+            if d is not None and not d.watched and d.due == t:
+                due.append(d)
+        if not due:
+            return
+
+        mtimes, elapsed = yield deferToThread(
+            self._stat, [d.path for d in due],
+        )
+        self.polls += len(due)
+        self.poll_time += elapsed
+
+        now = self._clock.seconds()
+        changed = set()
+        for d, mtime in zip(due, mtimes):
+            if self.dirs.get(d.path) is not d or d.watched:
+                continue  # forgotten or promoted meanwhile
+            if mtime is None:
+                self._forget(d.path)
+                changed.add(osp.dirname(d.path))
+                continue
+
+            if mtime != d.mtime:
+                d.mtime, d.interval = mtime, self.min_interval
+                d.score += 1
+                self.poll_changes += 1
+                changed.add(d.path)
+            else:
+                d.interval = min(d.interval * 2, self.max_interval)
+            d.due = now + d.interval
+            heapq.heappush(self._polls, (d.due, d.path))
+
+        # the next poll waits for these changes to be recorded
+        yield defer.gatherResults([self._changed(p) for p in changed])
+
+    # watch assignment
+
+    @defer.inlineCallbacks
+    def rebalance(self):
+        """Watch the `budget` most active directories, shallowest first, and
+        poll the others.
+        """
+        if self._inotify is not None:
+            wanted = {self.path}
+            wanted.update(d.path for d in heapq.nsmallest(
+                self.budget - 1,
+                (d for d in self.dirs.values() if d.path != self.path),
+                key=lambda d: (-d.score, d.depth, d.path),
+            ))
+            demote = [p for p, d in self.dirs.items()
+                      if d.watched and p not in wanted]
+            promote = [p for p in wanted if not self.dirs[p].watched]
+
+            yield deferToThread(self._unwatch, demote)
+            now = self._clock.seconds()
+            for path in demote:
+                d = self.dirs.get(path)
+                if d is not None:
+                    d.watched = False
+                    d.interval, d.due = self.min_interval, now
+                    heapq.heappush(self._polls, (d.due, path))
+            self.demotions += len(demote)
+
+            watched, full = yield deferToThread(self._watch, promote)
+            for path, mtime in watched:
+                d = self.dirs.get(path)
+                if d is None:
+                    continue
+                d.watched = True
+                if mtime != d.mtime:  # changed since it was last polled
+                    d.mtime = mtime
+                    self._changed(path)
+            self.promotions += len(watched)
+
+            if full:
+                self.budget = sum(1 for d in self.dirs.values() if d.watched)
+                self.log.warn("inotify watch limit reached; watching at most "
+                              "{n} directories", n=self.budget)
+
+        for d in self.dirs.values():
+            d.score = d.score * self.decay if d.score > MIN_SCORE else 0.
+
+    def stats(self):
+        polled = [d for d in self.dirs.values() if not d.watched]
+        n = len(self.dirs)
+        return dict(
+            directories=n, watched=n - len(polled), polled=len(polled),
+            budget=self.budget,
+            coverage=(n - len(polled)) / n if n else 1.,
+            poll_rate=sum(1 / d.interval for d in polled),
+            polls=self.polls, poll_time=self.poll_time,
+            poll_changes=self.poll_changes,
+            inotify_events=self.inotify_events, overflows=self.overflows,
+            promotions=self.promotions, demotions=self.demotions,
+        )
+
+
+class TreeWatcher(Service):
+    """Watches the tree under `path` for an EventHandler with a watchdog
+    observer, skipping the directories the handler excludes.  The watches of
+    a subtree are recomputed when an ignore file in it changes, when an
+    excluded directory appears in or is moved into a recursively watched
+    subtree, and when `discover` is called, e.g. after a selection change.
+
+    A file moved between two watches is reported as deleted and created.
+    """
+
+    log = Logger()
+
+    def __init__(self, handler, path, recursive=True, observer=None):
+        super().__init__()
+        self.handler = handler
+        self.path = osp.normpath(path)
+        self.recursive = recursive
+        self.observer = observer or Observer()
+
+        self.watches = {}  # path -> ObservedWatch
+        self.watching = None  # fires once the tree is first watched
+        self._lock = defer.DeferredLock()
+
+    def startService(self):
+        super().startService()
+        self.observer.start()
+        self.watching = self.discover(self.path)
+
+    def stopService(self):
+        super().stopService()
+        self.observer.stop()
+        return deferToThread(self.observer.join)
+
+    def dispatch(self, ev):
+        """Forward an event to the handler.  Called by the observer"""
+        from twisted.internet import reactor
+
+        self.handler.dispatch(ev)
+        for path in self._affected(ev):
+            reactor.callFromThread(self.discover, path)
+
+    def _affected(self, ev):
+        """The directories whose watches `ev` may change"""
+        if not self.recursive:
+            return []
+        paths = [osp.dirname(p)
+                 for p in (ev.src_path, getattr(ev, "dest_path", ""))
+                 if osp.basename(p) == IGNORE_FILE]
+        if ev.is_directory:
+            if ev.event_type == events.EVENT_TYPE_MOVED:
+                paths += [ev.src_path, ev.dest_path]
+            elif ev.event_type in (events.EVENT_TYPE_CREATED,
+                                   events.EVENT_TYPE_DELETED):
+                paths.append(ev.src_path)
+        return [osp.normpath(p) for p in paths]
+
+    def discover(self, path):
+        """Watch the directories under `path` the handler now records, and
+        stop watching the others
+        """
+        d = self._lock.run(deferToThread, self._rewatch, osp.normpath(path))
+        return d.addErrback(lambda f: self.log.failure(
+            "could not watch {p}", f, p=path,
+        ))
+
+    def _covering(self, path):
+        """The recursive watch above `path`, or None"""
+        while path != self.path:
+            path = osp.dirname(path)
+            w = self.watches.get(path)
+            if w is not None:
+                return path if w.is_recursive else None
+        return None
+
+    def _rewatch(self, path):
+        """Blocking"""
+        top = self._covering(path)
+        if top is None:
+            top = path
+        elif not osp.isdir(path) or self._plan(path) == {path: True}:
+            return  # nothing excluded appeared in the recursive watch
+        self._apply(self._plan(top), top)
+
+    def _plan(self, top):
+        """Return {path: recursive} for the watches of the subtree `top`.
+        Blocking.
+        """
+        if not self.recursive:
+            return {top: False}
+        if top != self.path and not self.handler.filter_path(top, True):
+            return {}
+        try:
+            with os.scandir(top) as it:
+                subdirs = [e.path for e in it
+                           if e.is_dir(follow_symlinks=False)]
+        except OSError:
+            return {}  # removed meanwhile
+
+        plans = [(p, self._plan(p)) for p in subdirs]
+        if all(plan == {p: True} for p, plan in plans):
+            return {top: True}
+        watches = {top: False}
+        for _, plan in plans:
+            watches.update(plan)
+        return watches
+
+    def _apply(self, plan, top):
+        """Schedule the watches of `plan` before unscheduling the others of
+        the subtree `top`, so that no change goes unwatched.  Blocking.
+        """
+        prefix = osp.join(top, "")
+        old = {p: w for p, w in self.watches.items()
+               if p == top or p.startswith(prefix)}
+        for path, recursive in sorted(plan.items()):
+            w = old.get(path)
+            if w is not None and w.is_recursive == recursive:
+                continue
+            try:
+                self.watches[path] = self.observer.schedule(
+                    self, path, recursive=recursive,
+                )
+            except OSError as e:
+                if e.errno == ENOSPC:
+                    self.log.warn("inotify watch limit reached; {p} is not "
+                                  "watched", p=path)
+
+        for path, w in old.items():
+            if self.watches.get(path) is w and path in plan:
+                continue
+            if self.watches.get(path) is w:
+                del self.watches[path]
+            self.observer.unschedule(w)
@@ -27,5 +27,16 @@ class Workspace(MultiService):
         if not self.istorage.available:
             raise AssertionError("{0} is not available", self.istorage)
 
+    @property
+    def queue(self):
+        return self.iengine.queue
+
+    @property
+    def index(self):
+        return self.iengine.index
+
     def get_changes(self):
-        self.iengine.stream.next()
+        return self.iengine.stream.next()
+
+    def ack_changes(self):
+        self.iengine.stream.ack()
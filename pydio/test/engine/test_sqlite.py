@@ -2,18 +2,46 @@
 from twisted.trial.unittest import TestCase
 
 import os.path as osp
-from pickle import dumps
-from os import stat, mkdir
+from datetime import datetime, timedelta, timezone
+from os import mkdir
 
 from twisted.internet import defer
-from twisted.internet import task, reactor
+from twisted.internet import task
 
 from zope.interface.verify import verifyClass, verifyObject
 
 from pydio.util.adbapi import ConnectionManager
-from pydio.engine import sqlite, IDiffEngine, IStateManager, IDiffStream
+from pydio.engine import (
+    sqlite, IDiffEngine, IStateManager, IDiffStream, IWorkQueue, ITransferLog,
+    ISignatureStore, IChunkIndex, IPathIndex, ISnapshotStore, ICursorStore,
+)
+from pydio.util.delta import Signature
 
 
+# SQL_INIT_FILE before schema versioning
+BASELINE_SQL = """
+CREATE TABLE ajxp_changes ( seq INTEGER PRIMARY KEY AUTOINCREMENT, node_id NUMERIC, type TEXT, source TEXT, target TEXT, deleted_md5 TEXT );
+CREATE TABLE ajxp_index ( node_id INTEGER PRIMARY KEY AUTOINCREMENT, node_path TEXT, bytesize NUMERIC, md5 TEXT, mtime NUMERIC, stat_result BLOB);
+CREATE TABLE ajxp_last_buffer ( id INTEGER PRIMARY KEY AUTOINCREMENT, type TEXT, location TEXT, source TEXT, target TEXT );
+CREATE TABLE ajxp_node_status ("node_id" INTEGER PRIMARY KEY  NOT NULL , "status" TEXT NOT NULL  DEFAULT 'NEW', "detail" TEXT);
+CREATE TABLE events (id INTEGER PRIMARY KEY AUTOINCREMENT, type text, message text, source text, target text, action text, status text, date text);
+
+CREATE TRIGGER LOG_DELETE AFTER DELETE ON ajxp_index BEGIN INSERT INTO ajxp_changes (node_id,source,target,type,deleted_md5) VALUES (old.node_id, old.node_path, "NULL", "delete", old.md5); END;
+CREATE TRIGGER LOG_INSERT AFTER INSERT ON ajxp_index BEGIN INSERT INTO ajxp_changes (node_id,source,target,type) VALUES (new.node_id, "NULL", new.node_path, "create"); END;
+CREATE TRIGGER LOG_UPDATE_CONTENT AFTER UPDATE ON "ajxp_index" FOR EACH ROW BEGIN INSERT INTO "ajxp_changes" (node_id,source,target,type) VALUES (new.node_id, old.node_path, new.node_path, CASE WHEN old.node_path = new.node_path THEN "content" ELSE "path" END);END;
+CREATE TRIGGER STATUS_DELETE AFTER DELETE ON "ajxp_index" BEGIN DELETE FROM ajxp_node_status WHERE node_id=old.node_id; END;
+CREATE TRIGGER STATUS_INSERT AFTER INSERT ON "ajxp_index" BEGIN INSERT INTO ajxp_node_status (node_id) VALUES (new.node_id); END;
+
+CREATE INDEX changes_node_id ON ajxp_changes( node_id );
+CREATE INDEX changes_type ON ajxp_changes( type );
+CREATE INDEX changes_node_source ON ajxp_changes( source );
+CREATE INDEX index_node_id ON ajxp_index( node_id );
+CREATE INDEX index_node_path ON ajxp_index( node_path );
+CREATE INDEX index_bytesize ON ajxp_index( bytesize );
+CREATE INDEX index_md5 ON ajxp_index( md5 );
+CREATE INDEX node_status_status ON ajxp_node_status( status );
+"""
+
 def mk_dummy_inode(path, isdir=False):
     return {
         "node_path": path,
@@ -45,6 +73,21 @@ class TestEngine(TestCase):
             ok = yield self.engine._db.runQuery(stmnt, (t,))
             self.assertTrue(ok, "table {0} does not exist".format(t))
 
+    @defer.inlineCallbacks
+    def test_resume(self):
+        path = osp.join(self.mktemp(), "db.sqlite")
+        engine = sqlite.Engine(path)
+        yield engine._init_db()
+        yield engine.updater.create(mk_dummy_inode("/foo.txt"))
+        yield engine._db.close()
+
+        engine = sqlite.Engine(path)
+        yield engine._init_db()
+        self.assertIsNotNone(engine.index.peek("/foo.txt"))
+        (version,), = yield engine._db.runQuery("PRAGMA user_version;")
+        self.assertEqual(version, sqlite.SCHEMA_VERSION)
+        yield engine._db.close()
+
     def test_IDiffEngine(self):
         verifyClass(IDiffEngine, sqlite.Engine)
 
@@ -54,6 +97,48 @@ class TestEngine(TestCase):
     def test_stream(self):
         verifyObject(IDiffStream, self.engine.stream)
 
+    def test_queue(self):
+        verifyObject(IWorkQueue, self.engine.queue)
+
+    def test_transfers(self):
+        verifyObject(ITransferLog, self.engine.transfers)
+
+    def test_signatures(self):
+        verifyObject(ISignatureStore, self.engine.signatures)
+
+    def test_chunks(self):
+        verifyObject(IChunkIndex, self.engine.chunks)
+
+    def test_index(self):
+        verifyObject(IPathIndex, self.engine.index)
+        self.assertIs(self.engine.updater.index, self.engine.index)
+
+    def test_snapshots(self):
+        verifyObject(ISnapshotStore, self.engine.snapshots)
+
+    def test_cursor(self):
+        verifyObject(ICursorStore, self.engine.cursor)
+        self.assertIs(self.engine.updater.snapshots, self.engine.snapshots)
+
+
+class TestEngineAppLogging(TestCase):
+    def setUp(self):
+        self.engine = sqlite.Engine(":memory:", triggers=False)
+
+    @defer.inlineCallbacks
+    def test_init_db(self):
+        yield self.engine._init_db()
+
+        triggers = yield self.engine._db.runQuery(
+            "SELECT name FROM sqlite_master WHERE type='trigger';"
+        )
+        self.assertEqual(triggers, [])
+        self.assertTrue(self.engine.updater.log_changes)
+
+        yield self.engine.updater.create(mk_dummy_inode("/foo.txt"))
+        changes = yield self.engine.stream.next()
+        self.assertEqual([c["type"] for c in changes], ["create"])
+
 
 class TestStateManager(TestCase):
     def test_IStateManager(self):
@@ -65,6 +150,158 @@ class TestDiffStream(TestCase):
         verifyClass(IDiffStream, sqlite.DiffStream)
 
 
+class TestWorkQueue(TestCase):
+    def test_IWorkQueue(self):
+        verifyClass(IWorkQueue, sqlite.WorkQueue)
+
+
+class TestTransferLog(TestCase):
+    def test_ITransferLog(self):
+        verifyClass(ITransferLog, sqlite.TransferLog)
+
+
+class TestSignatureStore(TestCase):
+    def test_ISignatureStore(self):
+        verifyClass(ISignatureStore, sqlite.SignatureStore)
+
+
+class TestChunkIndex(TestCase):
+    def test_IChunkIndex(self):
+        verifyClass(IChunkIndex, sqlite.ChunkIndex)
+
+
+class TestMigration(TestCase):
+    def setUp(self):
+        self.db = ConnectionManager(":memory:")
+
+    def tearDown(self):
+        self.db.close()
+
+    def indexes(self):
+        d = self.db.runQuery(
+            "SELECT name FROM sqlite_master "
+            "WHERE type='index' AND sql IS NOT NULL ORDER BY name;"
+        )
+        return d.addCallback(lambda rows: [name for name, in rows])
+
+    @defer.inlineCallbacks
+    def test_create(self):
+        version = yield self.db.runInteraction(sqlite.migrate)
+        self.assertIsNone(version)
+        (version,), = yield self.db.runQuery("PRAGMA user_version;")
+        self.assertEqual(version, sqlite.SCHEMA_VERSION)
+
+    @defer.inlineCallbacks
+    def test_migrate_unversioned(self):
+        def baseline(c):
+            c.executescript(BASELINE_SQL)
+            c.executemany(
+                "INSERT INTO ajxp_index (node_path, md5) VALUES (?,?);",
+                [("/foo", "old"), ("/bar", "bar"), ("/foo", "new")],
+            )
+
+        yield self.db.runInteraction(baseline)
+
+        version = yield self.db.runInteraction(sqlite.migrate)
+        self.assertEqual(version, 0)
+
+        indexes = yield self.indexes()
+        self.assertEqual(indexes, [
+            "file_chunks_digest", "index_md5", "index_node_path",
+            "node_status_status",
+        ])
+
+        rows = yield self.db.runQuery(
+            "SELECT node_path, md5 FROM ajxp_index ORDER BY node_path;"
+        )
+        self.assertEqual(rows, [("/bar", "bar"), ("/foo", "new")])
+
+        (version,), = yield self.db.runQuery("PRAGMA user_version;")
+        self.assertEqual(version, sqlite.SCHEMA_VERSION)
+
+    @defer.inlineCallbacks
+    def test_open_baseline(self):
+        path = osp.join(self.mktemp(), "db.sqlite")
+        mkdir(osp.dirname(path))
+        db = ConnectionManager(path)
+        yield db.runInteraction(lambda c: c.executescript(BASELINE_SQL))
+        yield db.runOperation(
+            "INSERT INTO ajxp_index (node_path, md5) VALUES ('/old.txt', 'x');"
+        )
+        yield db.close()
+
+        engine = sqlite.Engine(path)
+        yield engine._init_db()
+        self.addCleanup(engine._db.close)
+
+        inode = mk_dummy_inode("/new.txt")
+        inode.update(blake2b="b2", sha256="s256", block_size=4, blocks=b"\0")
+        yield engine.updater.create(inode)
+        yield engine.updater.modify(mk_dummy_inode("/old.txt"))
+        claimed = yield engine.queue.claim()
+        self.assertEqual(sorted(i["node_path"] for i in claimed),
+                         ["/new.txt", "/old.txt"])
+
+        yield engine.transfers.save("/new.txt", "up", 2, 1024, "md5")
+        progress = yield engine.transfers.get("/new.txt", "up")
+        self.assertEqual(progress, (2, 1024, "md5"))
+
+    @defer.inlineCallbacks
+    def test_migrate_snapshots(self):
+        yield self.db.runInteraction(sqlite.migrate)
+        yield self.db.runInteraction(lambda c: c.executescript(
+            "DROP TABLE ajxp_snapshots; PRAGMA user_version = 2;"
+        ))
+
+        version = yield self.db.runInteraction(sqlite.migrate)
+        self.assertEqual(version, 2)
+        yield sqlite.SnapshotStore(self.db).save([("/dir", 1., b"digest")])
+
+    @defer.inlineCallbacks
+    def test_migrate_cursor(self):
+        yield self.db.runInteraction(sqlite.migrate)
+        yield self.db.runInteraction(lambda c: c.executescript(
+            "DROP TABLE ajxp_cursor; PRAGMA user_version = 4;"
+        ))
+
+        version = yield self.db.runInteraction(sqlite.migrate)
+        self.assertEqual(version, 4)
+        yield sqlite.CursorStore(self.db).save("cursor")
+
+    @defer.inlineCallbacks
+    def test_migrate_status_update(self):
+        yield self.db.runInteraction(sqlite.migrate)
+        yield self.db.runInteraction(lambda c: c.executescript("""
+            DROP TRIGGER STATUS_UPDATE;
+            CREATE TRIGGER STATUS_UPDATE AFTER UPDATE ON "ajxp_index" FOR EACH ROW BEGIN UPDATE ajxp_node_status SET status='NEW' WHERE node_id=new.node_id; END;
+            PRAGMA user_version = 3;
+        """))
+
+        version = yield self.db.runInteraction(sqlite.migrate)
+        self.assertEqual(version, 3)
+        yield self.db.runInteraction(sqlite.set_triggers, True)
+        (sql,), = yield self.db.runQuery(
+            "SELECT sql FROM sqlite_master WHERE name='STATUS_UPDATE';"
+        )
+        self.assertIn("WHEN old.md5 IS NOT new.md5", sql)
+
+    @defer.inlineCallbacks
+    def test_covering_md5(self):
+        yield self.db.runInteraction(sqlite.migrate)
+        plan = yield self.db.runQuery(
+            "EXPLAIN QUERY PLAN SELECT i.node_path FROM ajxp_index i "
+            "JOIN ajxp_node_status s USING (node_id) "
+            "WHERE i.md5=? AND s.status='DONE' LIMIT 1;",
+            ("abc",),
+        )
+        self.assertIn("COVERING INDEX index_md5", plan[0][-1])
+
+
+class TestPathIndex(TestCase):
+    def test_IPathIndex(self):
+        verifyClass(IPathIndex, sqlite.PathIndex)
+
+
 class TestStateManagement(TestCase):
     """Test state management"""
 
@@ -184,6 +421,43 @@ class TestStateManagement(TestCase):
             "expected 1 row, got {0}".format(len(rows))
           )
 
+    @defer.inlineCallbacks
+    def test_inode_delete_sibling(self):
+        """Deleting /foo leaves /foobar alone"""
+        yield self.d
+
+        for path in ("/foo", "/foo/bar", "/foobar", "/foo_"):
+            yield self.stateman.create(mk_dummy_inode(path))
+        yield self.stateman.delete(mk_dummy_inode("/foo"), directory=True)
+
+        rows = yield self.db.runQuery(
+            "SELECT node_path FROM ajxp_index ORDER BY node_path;",
+        )
+        self.assertEqual(rows, [("/foo_",), ("/foobar",)])
+
+    @defer.inlineCallbacks
+    def test_create_existing(self):
+        """Creating an indexed path updates it in place"""
+        yield self.d
+
+        inode = mk_dummy_inode("/foo.txt")
+        yield self.stateman.create(inode)
+        inode["md5"] = "abc"
+        yield self.stateman.create(inode)
+
+        rows = yield self.db.runQuery("SELECT node_id, md5 FROM ajxp_index;")
+        self.assertEqual(rows, [(1, "abc")])
+        rows = yield self.db.runQuery("SELECT type FROM ajxp_changes;")
+        self.assertEqual(rows, [("create",), ("content",)])
+
+    @defer.inlineCallbacks
+    def test_modify_unindexed(self):
+        yield self.d
+
+        yield self.stateman.modify(mk_dummy_inode("/foo.txt"))
+        rows = yield self.db.runQuery("SELECT node_path FROM ajxp_index;")
+        self.assertEqual(rows, [("/foo.txt",)])
+
     @defer.inlineCallbacks
     def test_inode_modify_file(self):
         yield self.d
@@ -241,5 +515,867 @@ class TestStateManagement(TestCase):
 
 
 
+class TestWorkQueueing(TestCase):
+    """Test status transitions in ajxp_node_status"""
+
+    def setUp(self):
+        self.db = ConnectionManager(":memory:")
+        self.stateman = sqlite.StateManager(self.db)
+        self.clock = task.Clock()
+        self.queue = sqlite.WorkQueue(
+            self.db, max_attempts=2, backoff=10., clock=self.clock,
+        )
+
+        with open(sqlite.SQL_INIT_FILE) as f:
+            script = f.read()
+
+        self.d = self.db.runInteraction(lambda c, s: c.executescript(s), script)
+
+    def tearDown(self):
+        self.db.close()
+
+    @defer.inlineCallbacks
+    def populate(self, n):
+        yield self.d
+        for i in range(n):
+            yield self.stateman.create(mk_dummy_inode("/file{0}.txt".format(i)))
+
+    @defer.inlineCallbacks
+    def status_of(self, node_id):
+        (status,), = yield self.db.runQuery(
+            "SELECT status FROM ajxp_node_status WHERE node_id=?;", (node_id,),
+        )
+        defer.returnValue(status)
+
+    @defer.inlineCallbacks
+    def test_claim_batch(self):
+        yield self.populate(5)
+
+        batch = yield self.queue.claim(3)
+        self.assertEqual(len(batch), 3)
+        self.assertEqual(
+            set(batch[0]),
+            {"node_id", "node_path", "bytesize", "md5", "mtime"},
+        )
+
+        queued = yield self.queue.count("QUEUED")
+        self.assertEqual(queued, 3)
+
+        rest = yield self.queue.claim(3)
+        self.assertEqual(len(rest), 2, "claimed inodes were handed out twice")
+
+    @defer.inlineCallbacks
+    def test_claim_empty(self):
+        yield self.d
+        batch = yield self.queue.claim(3)
+        self.assertEqual(batch, [])
+
+    @defer.inlineCallbacks
+    def test_lifecycle(self):
+        yield self.populate(1)
+
+        (inode,) = yield self.queue.claim(1)
+        nid = inode["node_id"]
+
+        yield self.queue.start([nid])
+        status = yield self.status_of(nid)
+        self.assertEqual(status, "TRANSFERRING")
+
+        yield self.queue.done([nid])
+        status = yield self.status_of(nid)
+        self.assertEqual(status, "DONE")
+
+    @defer.inlineCallbacks
+    def test_done_requires_transferring(self):
+        yield self.populate(1)
+
+        (inode,) = yield self.queue.claim(1)
+        yield self.queue.done([inode["node_id"]])
+        status = yield self.status_of(inode["node_id"])
+        self.assertEqual(status, "QUEUED")
+
+    @defer.inlineCallbacks
+    def test_fail_backoff(self):
+        yield self.populate(1)
+
+        (inode,) = yield self.queue.claim(1)
+        yield self.queue.fail(inode["node_id"], "connection lost")
+
+        batch = yield self.queue.claim(1)
+        self.assertFalse(batch, "inode was retried before its backoff expired")
+
+        self.clock.advance(10)
+        batch = yield self.queue.claim(1)
+        self.assertEqual(len(batch), 1, "inode was not retried after backoff")
+
+    @defer.inlineCallbacks
+    def test_fail_exhausted(self):
+        yield self.populate(1)
+
+        for _ in range(2):
+            self.clock.advance(60)
+            (inode,) = yield self.queue.claim(1)
+            yield self.queue.fail(inode["node_id"])
+
+        status = yield self.status_of(inode["node_id"])
+        self.assertEqual(status, "FAILED")
+
+    @defer.inlineCallbacks
+    def test_modify_requeues(self):
+        yield self.populate(1)
+
+        (inode,) = yield self.queue.claim(1)
+        yield self.queue.start([inode["node_id"]])
+
+        changed = dict(mk_dummy_inode(inode["node_path"]), md5="changed")
+        yield self.stateman.modify(changed)
+        status = yield self.status_of(inode["node_id"])
+        self.assertEqual(status, "NEW")
+
+    @defer.inlineCallbacks
+    def test_unchanged_stays_done(self):
+        yield self.populate(1)
+        (inode,) = yield self.queue.claim(1)
+        yield self.queue.start([inode["node_id"]])
+        yield self.queue.done([inode["node_id"]])
+        (changes,), = yield self.db.runQuery(
+            "SELECT COUNT(*) FROM ajxp_changes;"
+        )
+
+        yield self.stateman.modify(mk_dummy_inode(inode["node_path"]))
+        counts = yield self.queue.counts()
+        self.assertEqual(counts, {"DONE": 1})
+        (after,), = yield self.db.runQuery("SELECT COUNT(*) FROM ajxp_changes;")
+        self.assertEqual(after, changes, "an unchanged file was logged")
+
+    @defer.inlineCallbacks
+    def test_digests_stay_done(self):
+        yield self.populate(1)
+        (inode,) = yield self.queue.claim(1)
+        yield self.queue.start([inode["node_id"]])
+        yield self.queue.done([inode["node_id"]])
+
+        yield self.stateman.modify(
+            dict(mk_dummy_inode(inode["node_path"]), sha256="s256"),
+        )
+        rows = yield self.db.runQuery("SELECT sha256 FROM ajxp_index;")
+        self.assertEqual(rows, [("s256",)])
+        counts = yield self.queue.counts()
+        self.assertEqual(counts, {"DONE": 1})
+
+    @defer.inlineCallbacks
+    def test_recover(self):
+        yield self.populate(3)
+
+        a, b, _ = yield self.queue.claim(3)
+        yield self.queue.start([a["node_id"]])
+
+        n = yield self.queue.recover()
+        self.assertEqual(n, 3)
+
+        pending = yield self.queue.count("NEW")
+        self.assertEqual(pending, 3)
+
+
+class TestTransferProgress(TestCase):
+    def setUp(self):
+        self.db = ConnectionManager(":memory:")
+        self.progress = sqlite.TransferLog(self.db)
+
+        with open(sqlite.SQL_INIT_FILE) as f:
+            script = f.read()
+
+        self.d = self.db.runInteraction(lambda c, s: c.executescript(s), script)
+
+    def tearDown(self):
+        self.db.close()
+
+    @defer.inlineCallbacks
+    def test_save_get_clear(self):
+        yield self.d
+
+        missing = yield self.progress.get("/foo.txt", "up")
+        self.assertIsNone(missing)
+
+        yield self.progress.save("/foo.txt", "up", 10, 100, "abc")
+        yield self.progress.save("/foo.txt", "up", 20, 100, "abc")
+        saved = yield self.progress.get("/foo.txt", "up")
+        self.assertEqual(tuple(saved), (20, 100, "abc"))
+
+        other = yield self.progress.get("/foo.txt", "down")
+        self.assertIsNone(other, "directions are not tracked separately")
+
+        yield self.progress.clear("/foo.txt", "up")
+        saved = yield self.progress.get("/foo.txt", "up")
+        self.assertIsNone(saved)
+
+
+class TestSignatureStorage(TestCase):
+    def setUp(self):
+        self.db = ConnectionManager(":memory:")
+        self.stateman = sqlite.StateManager(self.db)
+        self.signatures = sqlite.SignatureStore(self.db)
+
+        with open(sqlite.SQL_INIT_FILE) as f:
+            script = f.read()
+
+        self.d = self.db.runInteraction(lambda c, s: c.executescript(s), script)
+
+    def tearDown(self):
+        self.db.close()
+
+    @defer.inlineCallbacks
+    def test_save_get(self):
+        yield self.d
+
+        inode = mk_dummy_inode("/foo.txt")
+        yield self.stateman.create(inode)
+
+        sig = Signature("abc", 2048, 1024, b"\x00" * 40)
+        yield self.signatures.save("/foo.txt", sig)
+        saved = yield self.signatures.get("/foo.txt")
+        self.assertEqual(saved, sig)
+
+    @defer.inlineCallbacks
+    def test_unindexed(self):
+        yield self.d
+
+        yield self.signatures.save("/nope.txt", Signature("abc", 0, 1024, b""))
+        rows = yield self.db.runQuery("SELECT * FROM ajxp_signatures;")
+        self.assertFalse(rows, "signature stored for an unindexed path")
+
+    @defer.inlineCallbacks
+    def test_delete_cascades(self):
+        yield self.d
+
+        inode = mk_dummy_inode("/foo.txt")
+        yield self.stateman.create(inode)
+        yield self.signatures.save("/foo.txt", Signature("abc", 0, 1024, b""))
+        yield self.stateman.delete(inode)
+
+        rows = yield self.db.runQuery("SELECT * FROM ajxp_signatures;")
+        self.assertFalse(rows, "signature outlived its inode")
+
+    @defer.inlineCallbacks
+    def test_indexed(self):
+        yield self.d
+
+        inode = mk_dummy_inode("/foo.txt")
+        yield self.stateman.create(inode)
+        saved = yield self.signatures.indexed("/foo.txt")
+        self.assertIsNone(saved, "no block signature was indexed")
+
+        inode.update(block_size=1024, blocks=b"\x01" * 20, blake2b="b2")
+        yield self.stateman.modify(inode)
+        saved = yield self.signatures.indexed("/foo.txt")
+        self.assertEqual(
+            saved, Signature(inode["md5"], 1024, 1024, b"\x01" * 20),
+        )
+
+        rows = yield self.db.runQuery("SELECT blake2b FROM ajxp_index;")
+        self.assertEqual(rows, [("b2",)])
+
+
+class TestPathIndexing(TestCase):
+    def setUp(self):
+        self.db = ConnectionManager(":memory:")
+        self.index = sqlite.PathIndex(self.db)
+        self.stateman = sqlite.StateManager(self.db, self.index)
+
+        with open(sqlite.SQL_INIT_FILE) as f:
+            script = f.read()
+
+        self.d = self.db.runInteraction(lambda c, s: c.executescript(s), script)
+
+    def tearDown(self):
+        self.db.close()
+
+    def entry(self, node_id, path):
+        inode = mk_dummy_inode(path)
+        return sqlite.IndexEntry(
+            node_id, inode["md5"], inode["bytesize"], inode["mtime"],
+        )
+
+    @defer.inlineCallbacks
+    def test_write_through(self):
+        yield self.d
+
+        yield self.stateman.create(mk_dummy_inode("/foo.txt"))
+        self.assertEqual(self.index.peek("/foo.txt"), self.entry(1, "/foo.txt"))
+
+        inode = dict(mk_dummy_inode("/foo.txt"), md5="abc", bytesize=3)
+        yield self.stateman.modify(inode)
+        self.assertEqual(self.index.peek("/foo.txt"),
+                         sqlite.IndexEntry(1, "abc", 3, inode["mtime"]))
+
+        yield self.stateman.delete(inode)
+        self.assertIsNone(self.index.peek("/foo.txt"))
+        self.assertEqual(self.index.size, 0)
+
+    @defer.inlineCallbacks
+    def test_delete_directory(self):
+        yield self.d
+
+        for path in ("/dir", "/dir/a", "/dir/b", "/other"):
+            yield self.stateman.create(mk_dummy_inode(path))
+        yield self.stateman.delete(mk_dummy_inode("/dir", True), True)
+        self.assertEqual(list(self.index._entries), ["/other"])
+
+    @defer.inlineCallbacks
+    def test_children(self):
+        yield self.d
+
+        for path in ("/dir", "/dir/a", "/dir/b", "/dir/b/c", "/dir.txt",
+                     "/dir0"):
+            yield self.stateman.create(mk_dummy_inode(path))
+
+        children = yield self.index.children("/dir")
+        self.assertEqual(children, {
+            "/dir/a": self.entry(2, "/dir/a"),
+            "/dir/b": self.entry(3, "/dir/b"),
+        })
+        children = yield self.index.children("/dir/")
+        self.assertEqual(sorted(children), ["/dir/a", "/dir/b"])
+
+    @defer.inlineCallbacks
+    def test_subtree(self):
+        yield self.d
+
+        for path in ("/dir", "/dir/a", "/dir/b", "/dir/b/c", "/dir.txt",
+                     "/dir0"):
+            yield self.stateman.create(mk_dummy_inode(path))
+
+        subtree = yield self.index.subtree("/dir")
+        self.assertEqual(sorted(subtree),
+                         ["/dir", "/dir/a", "/dir/b", "/dir/b/c"])
+        self.assertEqual(subtree["/dir/b/c"], self.entry(4, "/dir/b/c"))
+
+    @defer.inlineCallbacks
+    def test_load(self):
+        yield self.d
+
+        yield sqlite.StateManager(self.db).create(mk_dummy_inode("/foo.txt"))
+        self.assertIsNone(self.index.peek("/foo.txt"))
+
+        n = yield self.index.load()
+        self.assertEqual(n, 1)
+        self.assertEqual(self.index.peek("/foo.txt"), self.entry(1, "/foo.txt"))
+
+    @defer.inlineCallbacks
+    def test_get_complete(self):
+        yield self.d
+
+        # not queried, since the index is complete
+        yield sqlite.StateManager(self.db).create(mk_dummy_inode("/foo.txt"))
+        entry = yield self.index.get("/foo.txt")
+        self.assertIsNone(entry)
+        self.assertEqual((self.index.hits, self.index.misses), (1, 0))
+
+    def test_eviction(self):
+        entry = self.entry(1, "/a")
+        cost = self.index._cost("/a", entry)
+        self.index.budget = 2 * cost
+
+        self.index.put("/a", entry)
+        self.index.put("/b", entry)
+        self.index.peek("/a")  # /b becomes the least recently used
+        self.index.put("/c", entry)
+
+        self.assertEqual(list(self.index._entries), ["/a", "/c"])
+        self.assertEqual(self.index.size, 2 * cost)
+        self.assertFalse(self.index.complete)
+
+    @defer.inlineCallbacks
+    def test_get_evicted(self):
+        yield self.d
+
+        self.index.budget = 1
+        yield self.stateman.create(mk_dummy_inode("/foo.txt"))
+        self.assertIsNone(self.index.peek("/foo.txt"), "entry was not evicted")
+
+        entry = yield self.index.get("/foo.txt")
+        self.assertEqual(entry, self.entry(1, "/foo.txt"))
+        self.assertEqual(self.index.misses, 1)
+
+        entry = yield self.index.get("/nope.txt")
+        self.assertIsNone(entry)
+
+
+class TestChunkIndexing(TestCase):
+    def setUp(self):
+        self.db = ConnectionManager(":memory:")
+        self.stateman = sqlite.StateManager(self.db)
+        self.chunks = sqlite.ChunkIndex(self.db)
+
+        with open(sqlite.SQL_INIT_FILE) as f:
+            script = f.read()
+
+        self.d = self.db.runInteraction(lambda c, s: c.executescript(s), script)
+
+    def tearDown(self):
+        self.db.close()
+
+    def digests(self):
+        d = self.db.runQuery("SELECT digest FROM ajxp_chunks;")
+        return d.addCallback(lambda rows: {bytes(d) for d, in rows})
+
+    @defer.inlineCallbacks
+    def create(self, path, chunks):
+        inode = mk_dummy_inode(path)
+        inode["chunks"] = chunks
+        yield self.stateman.create(inode)
+        defer.returnValue(inode)
+
+    @defer.inlineCallbacks
+    def test_create(self):
+        yield self.d
+
+        chunks = [(b"a" * 20, 100), (b"b" * 20, 50)]
+        yield self.create("/foo.bin", chunks)
+
+        saved = yield self.chunks.chunks_of("/foo.bin")
+        self.assertEqual(saved, chunks)
+
+        digests = yield self.digests()
+        self.assertEqual(digests, {b"a" * 20, b"b" * 20})
+
+    @defer.inlineCallbacks
+    def test_modify_replaces_chunks(self):
+        yield self.d
+
+        inode = yield self.create("/foo.bin", [(b"a" * 20, 100)])
+        inode["chunks"] = [(b"b" * 20, 10), (b"a" * 20, 100)]
+        yield self.stateman.modify(inode)
+
+        saved = yield self.chunks.chunks_of("/foo.bin")
+        self.assertEqual(saved, inode["chunks"])
+
+    @defer.inlineCallbacks
+    def test_stats(self):
+        yield self.d
+
+        shared = (b"s" * 20, 300)
+        yield self.create("/v1.bin", [shared, (b"a" * 20, 100)])
+        yield self.create("/v2.bin", [shared, (b"b" * 20, 100)])
+
+        stats = yield self.chunks.stats()
+        self.assertEqual(stats["logical"], 800)
+        self.assertEqual(stats["unique"], 500)
+        self.assertAlmostEqual(stats["ratio"], 1.6)
+
+    @defer.inlineCallbacks
+    def test_delete_and_prune(self):
+        yield self.d
+
+        inode = yield self.create("/foo.bin", [(b"a" * 20, 100)])
+        yield self.create("/bar.bin", [(b"b" * 20, 100)])
+        yield self.stateman.delete(inode)
+        pruned = yield self.chunks.prune()
+        self.assertEqual(pruned, 1)
+
+        digests = yield self.digests()
+        self.assertEqual(digests, {b"b" * 20})
+
+    @defer.inlineCallbacks
+    def test_synced_duplicate(self):
+        yield self.d
+
+        yield self.create("/foo.bin", [])
+        md5 = mk_dummy_inode("")["md5"]
+
+        dup = yield self.chunks.synced_duplicate(md5)
+        self.assertIsNone(dup, "unsynchronized file reported as duplicate")
+
+        yield self.db.runOperation("UPDATE ajxp_node_status SET status='DONE';")
+        dup = yield self.chunks.synced_duplicate(md5)
+        self.assertEqual(dup, "/foo.bin")
+
+
 class TestDiffStreaming(TestCase):
     """Test diff streaming"""
+
+    def setUp(self):
+        self.db = ConnectionManager(":memory:")
+        self.stateman = sqlite.StateManager(self.db)
+        self.stream = sqlite.DiffStream(self.db)
+
+        with open(sqlite.SQL_INIT_FILE) as f:
+            script = f.read()
+
+        self.d = self.db.runInteraction(lambda c, s: c.executescript(s), script)
+
+    def tearDown(self):
+        self.db.close()
+
+    @defer.inlineCallbacks
+    def test_next(self):
+        yield self.d
+
+        inode = mk_dummy_inode("/foo.txt")
+        yield self.stateman.create(inode)
+        yield self.stateman.modify(dict(inode, md5="changed"))
+
+        changes = yield self.stream.next()
+        self.assertEqual(
+            [c["type"] for c in changes], ["create", "content"],
+        )
+
+        changes = yield self.stream.next()
+        self.assertEqual(changes, (), "changes were streamed twice")
+
+        yield self.stateman.delete(inode)
+        (change,) = yield self.stream.next()
+        self.assertEqual(change["type"], "delete")
+
+
+class TestMaintenance(TestCase):
+    def setUp(self):
+        self.db = ConnectionManager(":memory:")
+        self.stateman = sqlite.StateManager(self.db)
+        self.stream = sqlite.DiffStream(self.db)
+        self.clock = task.Clock()
+        self.clock.advance(1e9)
+        self.maintenance = sqlite.Maintenance(
+            self.db, self.stream, max_events=3, max_event_age=3600,
+            clock=self.clock,
+        )
+
+        with open(sqlite.SQL_INIT_FILE) as f:
+            script = f.read()
+
+        self.d = self.db.runInteraction(lambda c, s: c.executescript(s), script)
+
+    def tearDown(self):
+        self.db.close()
+
+    def count(self, table):
+        d = self.db.runQuery("SELECT COUNT(*) FROM {0};".format(table))
+        return d.addCallback(lambda rows: rows[0][0])
+
+    @defer.inlineCallbacks
+    def test_auto_vacuum(self):
+        yield self.d
+        rows = yield self.db.runQuery("PRAGMA auto_vacuum;")
+        self.assertEqual(rows, [(2,)], "auto_vacuum is not INCREMENTAL")
+
+    @defer.inlineCallbacks
+    def test_enable_auto_vacuum(self):
+        yield self.d
+        yield self.db.runInteraction(lambda c: (
+            c.execute("PRAGMA auto_vacuum = NONE;"), c.execute("VACUUM;"),
+        ))
+
+        yield self.maintenance.enable_auto_vacuum()
+        rows = yield self.db.runQuery("PRAGMA auto_vacuum;")
+        self.assertEqual(rows, [(2,)])
+
+    @defer.inlineCallbacks
+    def test_prune_acked(self):
+        yield self.d
+
+        yield self.stateman.create(mk_dummy_inode("/foo.txt"))
+        yield self.stream.next()
+        yield self.stateman.create(mk_dummy_inode("/bar.txt"))
+
+        yield self.maintenance.run()
+        n = yield self.count("ajxp_changes")
+        self.assertEqual(n, 2, "unacknowledged changes were pruned")
+
+        self.stream.ack()
+        yield self.maintenance.run()
+        changes = yield self.db.runQuery("SELECT target FROM ajxp_changes;")
+        self.assertEqual(changes, [("/bar.txt",)])
+        self.assertEqual(self.maintenance.pruned, 1)
+
+        # the stream carries on from where it was
+        (change,) = yield self.stream.next()
+        self.assertEqual(change["target"], "/bar.txt")
+
+    @defer.inlineCallbacks
+    def test_rotate_events(self):
+        yield self.d
+
+        now = datetime.fromtimestamp(self.clock.seconds(), timezone.utc)
+        now = now.replace(tzinfo=None)
+        dates = [now - timedelta(hours=2)] + [now] * 4
+        yield self.db.runInteraction(lambda c: c.executemany(
+            "INSERT INTO events (message, date) VALUES (?,?);",
+            ((str(i), d.isoformat(" ")) for i, d in enumerate(dates)),
+        ))
+
+        yield self.maintenance.run()
+        rows = yield self.db.runQuery("SELECT message FROM events;")
+        self.assertEqual(rows, [("2",), ("3",), ("4",)])
+        self.assertEqual(self.maintenance.rotated, 2)
+
+    @defer.inlineCallbacks
+    def test_vacuum_when_idle(self):
+        yield self.d
+
+        yield self.db.runInteraction(lambda c: c.executemany(
+            "INSERT INTO events (message) VALUES (?);",
+            (("x" * 1000,) for _ in range(500)),
+        ))
+        self.maintenance.max_events = 0
+        yield self.stateman.create(mk_dummy_inode("/foo.txt"))
+
+        yield self.maintenance.run()
+        stats = yield self.maintenance.stats()
+        self.assertTrue(stats["freelist_count"] > 0)
+        self.assertEqual(self.maintenance.vacuumed, 0, "vacuumed while busy")
+
+        yield self.maintenance.run()  # no inode changed since the last pass
+        after = yield self.maintenance.stats()
+        self.assertEqual(after["freelist_count"], 0)
+        self.assertEqual(self.maintenance.vacuumed, stats["freelist_count"])
+        self.assertTrue(after["size"] < stats["size"])
+
+    @defer.inlineCallbacks
+    def test_prune_chunks_when_idle(self):
+        yield self.d
+
+        inode = mk_dummy_inode("/foo.bin")
+        inode["chunks"] = [(b"a" * 20, 100)]
+        yield self.stateman.create(inode)
+        yield self.stateman.delete(inode)
+
+        yield self.maintenance.run()
+        n = yield self.count("ajxp_chunks")
+        self.assertEqual(n, 1, "pruned while busy")
+
+        yield self.maintenance.run()
+        n = yield self.count("ajxp_chunks")
+        self.assertEqual(n, 0)
+        stats = yield self.maintenance.stats()
+        self.assertEqual(stats["chunks_pruned"], 1)
+
+    @defer.inlineCallbacks
+    def test_stats(self):
+        yield self.d
+        yield self.stateman.create(mk_dummy_inode("/foo.txt"))
+
+        stats = yield self.maintenance.stats()
+        self.assertEqual(stats["ajxp_index"], 1)
+        self.assertEqual(stats["ajxp_changes"], 1)
+        self.assertEqual(stats["size"],
+                         stats["page_size"] * stats["page_count"])
+
+
+class AppLogging:
+    """Run a test case with changes logged by the StateManager rather than by
+    triggers.
+    """
+
+    def setUp(self):
+        super().setUp()
+        self.stateman = sqlite.StateManager(
+            self.db, getattr(self, "index", None), log_changes=True,
+        )
+        self.d.addCallback(
+            lambda _: self.db.runInteraction(sqlite.set_triggers, False)
+        )
+
+
+class TestStateManagementAppLogging(AppLogging, TestStateManagement):
+    pass
+
+
+class TestWorkQueueingAppLogging(AppLogging, TestWorkQueueing):
+    pass
+
+
+class TestSignatureStorageAppLogging(AppLogging, TestSignatureStorage):
+    pass
+
+
+class TestPathIndexingAppLogging(AppLogging, TestPathIndexing):
+    pass
+
+
+class TestChunkIndexingAppLogging(AppLogging, TestChunkIndexing):
+    pass
+
+
+class TestDiffStreamingAppLogging(AppLogging, TestDiffStreaming):
+    pass
+
+
+class TestChangeLogging(TestCase):
+    """Changes logged by the StateManager match those logged by triggers"""
+
+    TABLES = (
+        "ajxp_changes", "ajxp_node_status", "ajxp_file_chunks",
+        "ajxp_signatures",
+    )
+
+    def setUp(self):
+        with open(sqlite.SQL_INIT_FILE) as f:
+            script = f.read()
+
+        self.dbs = []
+        for log_changes in (False, True):
+            db = ConnectionManager(":memory:")
+            d = db.runInteraction(lambda c, s: c.executescript(s), script)
+            d.addCallback(lambda _, db=db, enabled=not log_changes:
+                          db.runInteraction(sqlite.set_triggers, enabled))
+            self.dbs.append((db, sqlite.StateManager(
+                db, log_changes=log_changes,
+            ), d))
+
+    def tearDown(self):
+        for db, _, _ in self.dbs:
+            db.close()
+
+    @defer.inlineCallbacks
+    def dump(self, db):
+        tables = {}
+        for table in self.TABLES:
+            tables[table] = yield db.runQuery(
+                "SELECT * FROM {0} ORDER BY 1, 2;".format(table)
+            )
+        return tables
+
+    @defer.inlineCallbacks
+    def assertEquivalent(self, operations):
+        dumps = []
+        for db, stateman, d in self.dbs:
+            yield d
+            for op, inode in operations:
+                yield getattr(stateman, op)(dict(inode))
+            dump = yield self.dump(db)
+            dumps.append(dump)
+        self.assertEqual(dumps[0], dumps[1])
+
+    def test_set_triggers(self):
+        db, _, d = self.dbs[1]
+
+        def names(c):
+            c.execute("SELECT name FROM sqlite_master WHERE type='trigger';")
+            return {name for name, in c.fetchall()}
+
+        d.addCallback(lambda _: db.runInteraction(names))
+        d.addCallback(self.assertEqual, set())
+        d.addCallback(lambda _: db.runInteraction(sqlite.set_triggers, True))
+        d.addCallback(lambda _: db.runInteraction(names))
+        return d.addCallback(self.assertEqual, set(sqlite.TRIGGERS))
+
+    def test_create_modify_delete(self):
+        inode = mk_dummy_inode("/foo.txt")
+        changed = dict(inode, md5="0" * 32)
+        return self.assertEquivalent([
+            ("create", inode), ("modify", changed), ("create", inode),
+            ("delete", inode), ("create", changed),
+        ])
+
+    def test_subtree_delete(self):
+        ops = [("create", mk_dummy_inode("/dir", isdir=True))]
+        for i in range(5):
+            ops.append(("create", mk_dummy_inode("/dir/{0}.txt".format(i))))
+        ops.append(("create", mk_dummy_inode("/dir.txt")))
+        ops.append(("delete", mk_dummy_inode("/dir", isdir=True)))
+        return self.assertEquivalent(ops)
+
+    @defer.inlineCallbacks
+    def test_chunks_and_signatures(self):
+        inode = mk_dummy_inode("/foo.bin")
+        inode["chunks"] = [(b"a" * 20, 100), (b"b" * 20, 50)]
+        other = mk_dummy_inode("/bar.bin")
+        other["chunks"] = [(b"a" * 20, 100)]
+        yield self.assertEquivalent([("create", inode), ("create", other)])
+
+        dumps = []
+        for db, stateman, _ in self.dbs:
+            yield sqlite.SignatureStore(db).save(
+                "/foo.bin", Signature(inode["md5"], 150, 64, b"blocks"),
+            )
+            yield stateman.delete(dict(inode))
+            dump = yield self.dump(db)
+            dumps.append(dump)
+
+        self.assertEqual(dumps[0], dumps[1])
+        self.assertEqual(len(dumps[0]["ajxp_file_chunks"]), 1)
+        self.assertEqual(dumps[0]["ajxp_signatures"], [])
+
+
+class TestSnapshotStore(TestCase):
+    def setUp(self):
+        self.db = ConnectionManager(":memory:")
+        self.snapshots = sqlite.SnapshotStore(self.db)
+        self.stateman = sqlite.StateManager(self.db, snapshots=self.snapshots)
+        self.d = self.db.runInteraction(sqlite.migrate)
+
+    def tearDown(self):
+        self.db.close()
+
+    def test_ISnapshotStore(self):
+        verifyObject(ISnapshotStore, self.snapshots)
+
+    @defer.inlineCallbacks
+    def save(self, *paths):
+        yield self.d
+        yield self.snapshots.save(
+            (path, 1.5, path.encode()) for path in paths
+        )
+
+    @defer.inlineCallbacks
+    def test_save_load(self):
+        yield self.save("/dir", "/dir/sub")
+        yield self.snapshots.save([("/dir", 2., b"new")])
+
+        snapshots = yield self.snapshots.load()
+        self.assertEqual(snapshots, {
+            "/dir": (2., b"new"), "/dir/sub": (1.5, b"/dir/sub"),
+        })
+
+    @defer.inlineCallbacks
+    def test_empty(self):
+        yield self.d
+        empty = yield self.snapshots.empty()
+        self.assertTrue(empty)
+        yield self.save("/dir")
+        empty = yield self.snapshots.empty()
+        self.assertFalse(empty)
+
+    @defer.inlineCallbacks
+    def test_discard(self):
+        yield self.save("/dir", "/dir/sub", "/dir.d", "/other")
+        yield self.snapshots.discard("/dir")
+
+        snapshots = yield self.snapshots.load()
+        self.assertEqual(sorted(snapshots), ["/dir.d", "/other"])
+
+    @defer.inlineCallbacks
+    def test_deleted_with_directory(self):
+        yield self.save("/dir", "/dir/sub", "/other")
+        yield self.stateman.create(mk_dummy_inode("/dir", isdir=True))
+        yield self.stateman.delete(mk_dummy_inode("/dir", isdir=True), True)
+
+        snapshots = yield self.snapshots.load()
+        self.assertEqual(sorted(snapshots), ["/other"])
+
+
+class TestCursorStore(TestCase):
+    def setUp(self):
+        self.db = ConnectionManager(":memory:")
+        self.cursors = sqlite.CursorStore(self.db)
+        return self.db.runInteraction(sqlite.migrate)
+
+    def tearDown(self):
+        self.db.close()
+
+    def test_ICursorStore(self):
+        verifyObject(ICursorStore, self.cursors)
+
+    @defer.inlineCallbacks
+    def test_save_load(self):
+        cursor = yield self.cursors.load()
+        self.assertIsNone(cursor)
+
+        yield self.cursors.save("12")
+        yield self.cursors.save("34")
+        cursor = yield self.cursors.load()
+        self.assertEqual(cursor, "34")
+
+        yield self.cursors.save(None)
+        cursor = yield self.cursors.load()
+        self.assertIsNone(cursor)
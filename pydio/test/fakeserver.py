@@ -0,0 +1,456 @@
+#! /usr/bin/env python
+"""A local stand-in for the Pydio server API, built on twisted.web.
+
+Each workspace is a directory beneath `root`.  The server is meant for unit
+tests and throughput benchmarks, and can inject latency, dropped connections
+and a bandwidth limit to simulate an unreliable or slow remote link.  The
+bandwidth limit delays each response by the time its request and response
+bodies would take to cross the link.
+
+Each workspace has a change feed, served by the `changes` action: changes
+made through the API are recorded in it, and tests record the changes they
+make directly on disk with `PydioAPI.record`.  Resetting a feed invalidates
+the cursors handed out so far, as a server that lost its change log would.
+
+Run standalone with:
+
+    $ python -m pydio.test.fakeserver /tmp/wspace 8080
+"""
+
+import os
+import re
+import json
+import random
+import os.path as osp
+from hashlib import md5
+from itertools import islice
+from collections import deque, defaultdict
+from shutil import rmtree, copyfile
+from urllib.parse import unquote
+
+from twisted.logger import Logger
+from twisted.web import server, resource, http
+
+from pydio.util import compress, delta
+from pydio.util.selection import within
+
+MD5_DIRECTORY = "directory"
+PARTIAL_DIR = ".partial"
+RANGE = re.compile(r"bytes=(\d+)-(\d*)")
+
+
+def node_stat(root, path):
+    """Return a JSON-serializable inode for `path`, relative to `root`"""
+    full_path = osp.join(root, path.lstrip("/"))
+    st = os.stat(full_path)
+
+    if osp.isdir(full_path):
+        checksum = MD5_DIRECTORY
+    else:
+        h = md5()
+        with open(full_path, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 16), b""):
+                h.update(chunk)
+        checksum = h.hexdigest()
+
+    return dict(
+        node_path=path,
+        bytesize=st.st_size,
+        mtime=st.st_mtime,
+        md5=checksum,
+    )
+
+
+class ChangeFeed:
+    """The last `retention` changes made to a workspace, as (seq, type,
+    node_path) tuples.  A cursor is the seq of the last change a client
+    has seen.
+    """
+
+    def __init__(self, retention=100000):
+        self.retention = retention
+        self.seq = 0
+        self.oldest = 0  # older cursors are invalid
+        self._changes = deque()
+        self._waiters = []
+
+    def append(self, change_type, node_path):
+        self.seq += 1
+        self._changes.append((self.seq, change_type, node_path))
+        if len(self._changes) > self.retention:
+            self.oldest = self._changes.popleft()[0]
+
+        waiters, self._waiters = self._waiters, []
+        for notify in waiters:
+            notify()
+
+    def reset(self):
+        """Forget every change, which invalidates all cursors"""
+        self._changes.clear()
+        self.oldest = self.seq
+
+    def since(self, cursor, limit):
+        """Return up to `limit` changes after `cursor`, and whether more
+        follow.  Raises KeyError if the cursor is no longer valid.
+        """
+        if not self.oldest <= cursor <= self.seq:
+            raise KeyError(cursor)
+        start = cursor - self._changes[0][0] + 1 if self._changes else 0
+        page = list(islice(self._changes, start, start + limit))
+        return page, start + limit < len(self._changes)
+
+    def wait(self, notify):
+        self._waiters.append(notify)
+
+    def cancel(self, notify):
+        if notify in self._waiters:
+            self._waiters.remove(notify)
+
+
+class PydioAPI(resource.Resource):
+    """Serves `/api/<workspace>/<action>/<path>` from a local directory"""
+
+    isLeaf = True
+    log = Logger()
+
+    def __init__(self, root, latency=0., drop_rate=0., seed=None,
+                 bandwidth=None, encodings=tuple(compress.CODECS), clock=None):
+        super().__init__()
+        self.root = osp.abspath(root)
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.drop_rate = drop_rate
+        self.encodings = encodings
+        self.requests = 0
+        self.actions = defaultdict(int)
+        self.dropped = 0
+        self.feeds = defaultdict(ChangeFeed)
+        self.feed = True  # False to mimic servers without a change feed
+        self._rand = random.Random(seed)
+
+        if clock is None:
+            from twisted.internet import reactor as clock
+        self._clock = clock
+
+    def _resolve(self, request):
+        """Return (workspace root, action, path) for the request"""
+        segments = [unquote(s.decode()) for s in request.postpath]
+        if len(segments) < 3 or segments[0] != "api":
+            raise KeyError("/".join(segments))
+
+        _, workspace, action, *rest = segments
+        if action == "upload" and rest:
+            action, rest = "upload_" + rest[0], rest[1:]
+
+        ws_root = osp.join(self.root, workspace)
+        path = osp.normpath("/" + "/".join(rest))
+        if not osp.isdir(ws_root) or path.startswith("/.."):
+            raise KeyError(workspace)
+
+        return ws_root, action, path
+
+    def render(self, request):
+        self.requests += 1
+        if self.drop_rate and self._rand.random() < self.drop_rate:
+            self.dropped += 1
+            request.transport.abortConnection()
+            return server.NOT_DONE_YET
+
+        if not (self.latency or self.bandwidth):
+            return self._render(request)
+
+        received = request.content.seek(0, os.SEEK_END)
+        request.content.seek(0)
+        body = self._render(request)
+        if body == server.NOT_DONE_YET:
+            return body  # a long poll, which answers by itself
+
+        delay = self.latency
+        if self.bandwidth:
+            # each request is charged as if it had the link to itself
+            delay += (received + len(body)) / self.bandwidth
+
+        def respond():
+            request.write(body)
+            request.finish()
+
+        call = self._clock.callLater(delay, respond)
+        request.notifyFinish().addErrback(lambda _: call.cancel())
+        return server.NOT_DONE_YET
+
+    def _render(self, request):
+        try:
+            ws_root, action, path = self._resolve(request)
+            handler = getattr(self, "do_" + action)
+        except (KeyError, AttributeError):
+            request.setResponseCode(http.NOT_FOUND)
+            return b""
+
+        self.actions[action] += 1
+        try:
+            return handler(request, ws_root, path)
+        except FileNotFoundError:
+            request.setResponseCode(http.NOT_FOUND)
+            return b""
+
+    def _json(self, request, obj):
+        request.setHeader(b"content-type", b"application/json")
+        return json.dumps(obj).encode()
+
+    def record(self, workspace, change_type, node_path):
+        """Record a change made to a workspace, `change_type` being create,
+        modify or delete
+        """
+        self.feeds[workspace].append(change_type, node_path)
+
+    def _record(self, ws_root, change_type, path):
+        workspace = osp.basename(ws_root)
+        if change_type == "delete" or not osp.isdir(
+            osp.join(ws_root, path.lstrip("/"))
+        ):
+            self.record(workspace, change_type, path)
+            return
+
+        # a directory created by a move or a copy brings its content along
+        self.record(workspace, change_type, path)
+        top = osp.join(ws_root, path.lstrip("/"))
+        for dirpath, dirnames, filenames in os.walk(top):
+            for name in sorted(dirnames + filenames):
+                full_path = osp.join(dirpath, name)
+                self.record(workspace, "create",
+                            "/" + osp.relpath(full_path, ws_root))
+
+    def _changes(self, ws_root, path, feed, cursor, limit):
+        page, more = feed.since(cursor, limit)
+        changes = []
+        for seq, change_type, node_path in page:
+            if not within(node_path, path):
+                continue
+            try:
+                node = node_stat(ws_root, node_path)
+            except FileNotFoundError:  # removed since
+                change_type, node = "delete", dict(node_path=node_path)
+            changes.append(dict(seq=seq, type=change_type, node=node))
+        cursor = page[-1][0] if page else cursor
+        return dict(changes=changes, cursor=cursor, more=more)
+
+    def do_changes(self, request, ws_root, path):
+        """Report the changes within `path` since the `seq` cursor, at most
+        `limit` at once.  If there are none, wait up to `wait` seconds for
+        one.  Without a cursor, report the current one.
+        """
+        if not self.feed:
+            request.setResponseCode(http.NOT_FOUND)
+            return b""
+        feed = self.feeds[osp.basename(ws_root)]
+        if b"seq" not in request.args:
+            return self._json(request, dict(changes=[], cursor=feed.seq,
+                                            more=False))
+
+        cursor = int(request.args[b"seq"][0])
+        limit = int(request.args.get(b"limit", [1000])[0])
+        wait = float(request.args.get(b"wait", [0])[0])
+        try:
+            result = self._changes(ws_root, path, feed, cursor, limit)
+        except KeyError:
+            request.setResponseCode(http.GONE)
+            return b""
+        if result["changes"] or result["more"] or not wait:
+            return self._json(request, result)
+
+        def respond():
+            if call.active():
+                call.cancel()
+            feed.cancel(respond)
+            result = self._changes(ws_root, path, feed, cursor, limit)
+            request.write(self._json(request, result))
+            request.finish()
+
+        def cancel(_):
+            feed.cancel(respond)
+            if call.active():
+                call.cancel()
+
+        call = self._clock.callLater(wait, respond)
+        feed.wait(respond)
+        request.notifyFinish().addErrback(cancel)
+        return server.NOT_DONE_YET
+
+    def do_capabilities(self, request, ws_root, path):
+        return self._json(request, dict(encodings=list(self.encodings)))
+
+    def do_stat(self, request, ws_root, path):
+        return self._json(request, node_stat(ws_root, path))
+
+    def do_ls(self, request, ws_root, path):
+        full_path = osp.join(ws_root, path.lstrip("/"))
+        children = [
+            node_stat(ws_root, osp.join(path, name))
+            for name in sorted(os.listdir(full_path))
+        ]
+        return self._json(request, children)
+
+    def do_download(self, request, ws_root, path):
+        full_path = osp.join(ws_root, path.lstrip("/"))
+        size = osp.getsize(full_path)
+
+        rng = RANGE.match((request.getHeader(b"range") or b"").decode())
+        with open(full_path, "rb") as f:
+            if rng is None:
+                return f.read()
+
+            start = int(rng.group(1))
+            end = min(int(rng.group(2) or size - 1), size - 1)
+            request.setResponseCode(http.PARTIAL_CONTENT)
+            request.setHeader(
+                b"content-range",
+                "bytes {0}-{1}/{2}".format(start, end, size).encode(),
+            )
+            f.seek(start)
+            data = f.read(max(end - start + 1, 0))
+
+        accepted = (request.getHeader(b"accept-encoding") or b"").decode()
+        accepted = [
+            c for c in (a.strip() for a in accepted.split(","))
+            if c in self.encodings
+        ]
+        codec = compress.choose(path, data, accepted) if accepted else None
+        if codec is not None:
+            encoded = compress.encode(data, codec)
+            if len(encoded) < len(data):
+                request.setHeader(b"content-encoding", codec[0].encode())
+                data = encoded
+        return data
+
+    def _partial_path(self, ws_root, path):
+        name = md5(path.encode()).hexdigest()
+        return osp.join(self.root, PARTIAL_DIR, osp.basename(ws_root), name)
+
+    def do_upload_offset(self, request, ws_root, path):
+        """Report how many bytes of an interrupted upload were received"""
+        partial = self._partial_path(ws_root, path)
+        offset = osp.getsize(partial) if osp.exists(partial) else 0
+        return self._json(request, dict(offset=offset))
+
+    def do_upload_chunk(self, request, ws_root, path):
+        """Append a chunk at `offset`.  A chunk at offset 0 discards any
+        previous partial upload.  The file is moved into place once `total`
+        bytes have been received.
+        """
+        offset = int(request.args[b"offset"][0])
+        total = int(request.args[b"total"][0])
+
+        partial = self._partial_path(ws_root, path)
+        os.makedirs(osp.dirname(partial), exist_ok=True)
+        current = osp.getsize(partial) if osp.exists(partial) else 0
+        if offset == 0:  # (re)start the upload from scratch
+            open(partial, "wb").close()
+            current = 0
+        elif offset != current:
+            request.setResponseCode(http.CONFLICT)
+            return self._json(request, dict(offset=current))
+
+        encoding = request.getHeader(b"content-encoding")
+        data = request.content.read()
+        if encoding is not None:
+            encoding = encoding.decode()
+            if encoding not in self.encodings:
+                request.setResponseCode(http.UNSUPPORTED_MEDIA_TYPE)
+                return b""
+            data = compress.decode(data, encoding)
+
+        with open(partial, "ab") as f:
+            f.write(data)
+            current = f.tell()
+
+        if current < total:
+            return self._json(request, dict(offset=current))
+
+        full_path = osp.join(ws_root, path.lstrip("/"))
+        os.makedirs(osp.dirname(full_path), exist_ok=True)
+        existed = osp.exists(full_path)
+        os.replace(partial, full_path)
+        self._record(ws_root, "modify" if existed else "create", path)
+        return self._json(request, dict(node_stat(ws_root, path), offset=current))
+
+    def do_upload_patch(self, request, ws_root, path):
+        """Rebuild a file from an encoded delta against its current content,
+        which must match the `basis` checksum.
+        """
+        basis = request.args[b"basis"][0].decode()
+        full_path = osp.join(ws_root, path.lstrip("/"))
+        if node_stat(ws_root, path)["md5"] != basis:
+            request.setResponseCode(http.CONFLICT)
+            return b""
+
+        tmp = full_path + ".pydio_patch"
+        with open(full_path, "rb") as src, open(tmp, "wb") as out:
+            delta.patch(src, request.content, out)
+        os.replace(tmp, full_path)
+        self._record(ws_root, "modify", path)
+        return self._json(request, node_stat(ws_root, path))
+
+    def do_upload_put(self, request, ws_root, path):
+        full_path = osp.join(ws_root, path.lstrip("/"))
+        os.makedirs(osp.dirname(full_path), exist_ok=True)
+        existed = osp.exists(full_path)
+        with open(full_path, "wb") as f:
+            f.write(request.content.read())
+        self._record(ws_root, "modify" if existed else "create", path)
+        return self._json(request, node_stat(ws_root, path))
+
+    def do_mkdir(self, request, ws_root, path):
+        full_path = osp.join(ws_root, path.lstrip("/"))
+        if not osp.isdir(full_path):
+            os.makedirs(full_path)
+            self._record(ws_root, "create", path)
+        return self._json(request, node_stat(ws_root, path))
+
+    def do_delete(self, request, ws_root, path):
+        full_path = osp.join(ws_root, path.lstrip("/"))
+        if osp.isdir(full_path):
+            rmtree(full_path)
+        else:
+            os.remove(full_path)
+        self._record(ws_root, "delete", path)
+        return b""
+
+    def do_rename(self, request, ws_root, path):
+        dest = osp.normpath("/" + request.args[b"dest"][0].decode().lstrip("/"))
+        os.renames(
+            osp.join(ws_root, path.lstrip("/")),
+            osp.join(ws_root, dest.lstrip("/")),
+        )
+        self._record(ws_root, "delete", path)
+        self._record(ws_root, "create", dest)
+        return self._json(request, node_stat(ws_root, dest))
+
+    def do_copy(self, request, ws_root, path):
+        dest = osp.normpath("/" + request.args[b"dest"][0].decode().lstrip("/"))
+        full_dest = osp.join(ws_root, dest.lstrip("/"))
+        os.makedirs(osp.dirname(full_dest), exist_ok=True)
+        existed = osp.exists(full_dest)
+        copyfile(osp.join(ws_root, path.lstrip("/")), full_dest)
+        self._record(ws_root, "modify" if existed else "create", dest)
+        return self._json(request, node_stat(ws_root, dest))
+
+
+def listen(root, port=0, interface="127.0.0.1", reactor=None, **kw):
+    """Serve `root` over HTTP.  Returns (IListeningPort, PydioAPI)."""
+    if reactor is None:
+        from twisted.internet import reactor
+
+    api = PydioAPI(root, **kw)
+    site = server.Site(api)
+    site.noisy = False
+    return reactor.listenTCP(port, site, interface=interface), api
+
+
+if __name__ == "__main__":
+    import sys
+    from twisted.internet import reactor
+    from twisted.logger import globalLogBeginner, textFileLogObserver
+
+    globalLogBeginner.beginLoggingTo([textFileLogObserver(sys.stdout)])
+    listen(sys.argv[1], port=int(sys.argv[2]) if sys.argv[2:] else 8080)
+    reactor.run()
@@ -10,12 +10,21 @@ from tempfile import TemporaryDirectory, mkdtemp
 from zope.interface import implementer
 from zope.interface.verify import verifyClass, DoesNotImplement
 
-from twisted.internet import defer
+from twisted.internet import defer, task
 
 from watchdog import events
 
 from pydio.engine import IStateManager
+from pydio.engine import sqlite
+from pydio.engine.sqlite import PathIndex, IndexEntry
+from pydio.util.adbapi import ConnectionManager
+from pydio.util import ratelimit
+from pydio.util.cdc import Chunker
+from pydio.util.selection import Selection
 from pydio.storage import fs, IStorage, IDiffHandler, ISelectiveEventHandler
+from pydio.storage import hashing
+from pydio.storage.journal import Journal
+from pydio.storage.watch import TreeWatcher
 
 
 @implementer(IStateManager)
@@ -69,15 +78,57 @@ class TestLocalDirectory(TestCase):
             "LocalDirectory's filters do not match input dict",
         )
 
+    def test_relative_path(self):
+        localdir = fs.LocalDirectory("/foo/bar")
+        self.assertEqual(localdir.relative_path("/foo/bar/baz/.qux"),
+                         "/baz/.qux")
+        self.assertEqual(localdir.relative_path("/foo/bar"), "/")
+
+    def test_absolute_path(self):
+        localdir = fs.LocalDirectory("/foo/bar")
+        self.assertEqual(localdir.absolute_path("/baz/.qux"),
+                         "/foo/bar/baz/.qux")
+
     def test_handler_scheduling(self):
         stateman = DummyStateManager()
         with TemporaryDirectory() as path:
             localdir = fs.LocalDirectory(path)
 
-            self.assertFalse(localdir._obs.emitters, "dirty observer")
             localdir.connect_state_manager(stateman)
-            self.assertEqual(len(localdir._obs.emitters), 1,
-                             "watch job not registerd")
+            (tree,) = localdir._trees
+            self.assertIs(tree.parent, localdir)
+            self.assertEqual(tree.path, path)
+            self.assertFalse(localdir._watchers)
+
+    def test_hybrid_watcher(self):
+        stateman = DummyStateManager()
+        with TemporaryDirectory() as path:
+            localdir = fs.LocalDirectory(path, watch_budget=16)
+            localdir.connect_state_manager(stateman)
+
+            self.assertFalse(localdir._trees)
+            (watcher,) = localdir._watchers
+            self.assertIs(watcher.parent, localdir)
+            self.assertEqual(localdir.watch_stats(), [watcher.stats()])
+
+
+    @defer.inlineCallbacks
+    def test_reconcile_passes(self):
+        clock = task.Clock()
+        with TemporaryDirectory() as path:
+            localdir = fs.LocalDirectory(path, reconcile_interval=1,
+                                         clock=clock)
+            passes = []
+            localdir.reconcile = lambda deep=False: defer.succeed(
+                passes.append(deep)
+            )
+            yield localdir.startService()
+            self.addCleanup(localdir.stopService)
+            clock.pump([1] * fs.DEEP_RECONCILE_EVERY)
+
+        self.assertEqual(
+            passes, [True] + [False] * (fs.DEEP_RECONCILE_EVERY - 1) + [True],
+        )
 
 
 class TestEventHandlerState(TestCase):
@@ -165,6 +216,12 @@ class TestEventHandlerPath(TestCase):
             "error normalizing indirect path",
         )
 
+    def test_filter_root_event(self):
+        h = fs.EventHandler(DummyStateManager(), "/foo/bar",
+                            filters=dict(include=["*"]))
+        self.assertFalse(h._filter_event(events.DirModifiedEvent("/foo/bar")))
+        self.assertTrue(h._filter_event(events.DirModifiedEvent("/foo/bar/baz")))
+
     def test_relative_path_clean(self):
         base_path = "/foo/bar"
         full_path = "/foo/bar/baz.qux"
@@ -289,6 +346,52 @@ class TestEventHandlerInodeChecksum(TestCase):
         self.assertEquals(checksum, inode["md5"])
 
 
+class TestEventHandlerChunking(TestCase):
+    def setUp(self):
+        self.ws = mkdtemp()
+        self.h = fs.EventHandler(DummyStateManager(), self.ws, chunker=Chunker)
+
+    def tearDown(self):
+        rmtree(self.ws)
+        del self.ws, self.h
+
+    def test_hash_file(self):
+        content = os.urandom(100000)
+        p = osp.join(self.ws, "foo.bin")
+        with open(p, "wb") as f:
+            f.write(content)
+
+        digests = hashing.hash_file(p, Chunker)
+        self.assertEqual(digests["md5"], md5(content).hexdigest())
+        self.assertEqual(sum(n for _, n in digests["chunks"]), len(content))
+
+    def test_hash_file_throttled(self):
+        p = osp.join(self.ws, "foo.bin")
+        with open(p, "wb") as f:
+            f.write(b"x" * (hashing.HASH_BLOCK_SIZE + 1))
+
+        calls = []
+        hashing.hash_file(p, throttle=lambda r, n: calls.append(r))
+        self.assertEqual(calls, [ratelimit.OPENS] + [ratelimit.READ] * 2)
+
+    def test_hash_file_without_chunker(self):
+        p = osp.join(self.ws, "foo.bin")
+        with open(p, "wb") as f:
+            f.write(b"content")
+        self.assertNotIn("chunks", hashing.hash_file(p))
+
+    @defer.inlineCallbacks
+    def test_file_on_create(self):
+        p = osp.join(self.ws, "foo.txt")
+        with open(p, "wb") as f:
+            f.write(b"now is the winter of our discontent")
+
+        ev = events.FileCreatedEvent(p)
+        inode = dict(node_path=p)
+        yield self.h._add_hash_to_inode(ev, inode)
+        self.assertEqual(len(inode["chunks"]), 1)
+
+
 class TestEventHandlerInodeStat(TestCase):
     def setUp(self):
         self.ws = mkdtemp()
@@ -394,6 +497,104 @@ class TestEventHandlerNewInode(TestCase):
     #     pass
 
 
+class TestEventHandlerIndex(TestCase):
+    def setUp(self):
+        self.ws = mkdtemp()
+        self.index = PathIndex(None)
+        self.h = fs.EventHandler(DummyStateManager(), self.ws, index=self.index)
+        self.h.compute_file_hash = lambda path: defer.succeed(dict(md5="new"))
+
+        self.path = osp.join(self.ws, "foo.txt")
+        with open(self.path, "wb") as f:
+            f.write(b"content")
+
+    def tearDown(self):
+        rmtree(self.ws)
+        del self.ws, self.h
+
+    @defer.inlineCallbacks
+    def test_unchanged(self):
+        self.index.put(self.path, IndexEntry(
+            1, "old", osp.getsize(self.path), osp.getmtime(self.path),
+        ))
+        inode = yield self.h.new_node(events.FileModifiedEvent(self.path))
+        self.assertIsNone(inode, "unchanged file was hashed")
+
+    @defer.inlineCallbacks
+    def test_changed(self):
+        self.index.put(self.path, IndexEntry(1, "old", 1, 0.))
+        inode = yield self.h.new_node(events.FileModifiedEvent(self.path))
+        self.assertEqual(inode["md5"], "new")
+
+    def test_unchanged_not_recorded(self):
+        self.index.put(self.path, IndexEntry(
+            1, "old", osp.getsize(self.path), osp.getmtime(self.path),
+        ))
+        # DummyStateManager.create would raise
+        return self.h.on_created(events.FileCreatedEvent(self.path))
+
+
+class TestEventHandlerExpected(TestCase):
+    """Files copied in by LocalTransfers are indexed without being read"""
+
+    def setUp(self):
+        self.ws = mkdtemp()
+        self.h = fs.EventHandler(DummyStateManager(), self.ws,
+                                 filters=dict(include=["*"]))
+        self.hashed = []
+        self.h.compute_file_hash = lambda path: defer.succeed(
+            dict(md5="hashed")
+        ).addCallback(lambda d: self.hashed.append(path) or d)
+
+        self.path = osp.join(self.ws, "foo.txt")
+        with open(self.path, "wb") as f:
+            f.write(b"content")
+        self.st = os.stat(self.path)
+
+    def tearDown(self):
+        rmtree(self.ws)
+
+    def new_node(self):
+        return self.h.new_node(events.FileCreatedEvent(self.path))
+
+    @defer.inlineCallbacks
+    def test_expected(self):
+        self.h.expect(self.path, self.st.st_size, self.st.st_mtime,
+                      dict(md5="copied"))
+        inode = yield self.new_node()
+        self.assertEqual(inode["md5"], "copied")
+        self.assertEqual(self.hashed, [])
+
+        inode = yield self.new_node()
+        self.assertEqual(inode["md5"], "hashed", "expected more than once")
+
+    @defer.inlineCallbacks
+    def test_changed_since(self):
+        self.h.expect(self.path, self.st.st_size, self.st.st_mtime - 1,
+                      dict(md5="copied"))
+        inode = yield self.new_node()
+        self.assertEqual(inode["md5"], "hashed")
+
+    @defer.inlineCallbacks
+    def test_missing_digests(self):
+        self.h._hasher.digests = ("md5", "sha256")
+        self.h.expect(self.path, self.st.st_size, self.st.st_mtime,
+                      dict(md5="copied"))
+        inode = yield self.new_node()
+        self.assertEqual(inode["md5"], "hashed")
+
+    def test_partial_filtered(self):
+        self.assertFalse(self.h.filter_path(self.path + ".pydio_cp"))
+        self.assertFalse(self.h.filter_path(self.path + ".pydio_dl"))
+
+    def test_partial_renamed(self):
+        created = []
+        self.h.on_created = created.append
+        self.h.dispatch(events.FileMovedEvent(self.path + ".pydio_cp",
+                                              self.path))
+        self.assertEqual(created, [events.FileCreatedEvent(self.path)])
+
+
 class TestEventhandlerEventDispatch(TestCase):
     def setUp(self):
         self.ws = mkdtemp()
@@ -436,3 +637,622 @@ class TestEventhandlerEventDispatch(TestCase):
     # @defer.inlineCallbacks
     # def test_file_on_moved(self):
     #     pass
+
+
+@implementer(IStateManager)
+class RecordingStateManager:
+    def __init__(self, stateman):
+        self.stateman = stateman
+        self.calls = []
+
+    def _record(self, method, inode, directory):
+        self.calls.append((method, inode["node_path"]))
+        return getattr(self.stateman, method)(inode, directory=directory)
+
+    def create(self, inode, directory=False):
+        return self._record("create", inode, directory)
+
+    def delete(self, inode, directory=False):
+        return self._record("delete", inode, directory)
+
+    def modify(self, inode, directory=False):
+        return self._record("modify", inode, directory)
+
+    def move(self, inode, directory=False):
+        return self._record("move", inode, directory)
+
+
+class TestEventHandlerModify(TestCase):
+    def setUp(self):
+        self.ws = mkdtemp()
+        self.db = ConnectionManager(":memory:")
+        self.index = PathIndex(self.db)
+        self.stateman = RecordingStateManager(
+            sqlite.StateManager(self.db, self.index),
+        )
+        self.h = fs.EventHandler(self.stateman, self.ws, index=self.index,
+                                 filters=dict(include=["*"]))
+        self.d = self.db.runInteraction(sqlite.migrate)
+
+    def tearDown(self):
+        self.db.close()
+        rmtree(self.ws)
+
+    def write(self, name, content=b"content"):
+        path = osp.join(self.ws, name)
+        with open(path, "wb") as f:
+            f.write(content)
+        return path
+
+    @defer.inlineCallbacks
+    def populate(self):
+        """Index a directory holding a file and a subdirectory"""
+        yield self.d
+        os.mkdir(osp.join(self.ws, "sub"))
+        self.write("sub/deep.txt")
+        yield self.h.on_modified(events.DirModifiedEvent(self.ws))
+        self.stateman.calls = []
+
+    @defer.inlineCallbacks
+    def test_unchanged(self):
+        yield self.populate()
+        evs = yield self.h.diff_directory(self.ws)
+        self.assertEqual(evs, [])
+
+    @defer.inlineCallbacks
+    def test_new_entries(self):
+        yield self.populate()
+        foo = self.write("foo.txt")
+        evs = yield self.h.diff_directory(self.ws)
+        self.assertEqual(evs, [events.FileCreatedEvent(foo)])
+
+        yield self.h.on_modified(events.DirModifiedEvent(self.ws))
+        self.assertEqual(self.stateman.calls, [("create", foo)])
+
+    @defer.inlineCallbacks
+    def test_subdirectory_not_descended(self):
+        yield self.d
+        os.mkdir(osp.join(self.ws, "sub"))
+        self.write("sub/deep.txt")
+        yield self.h.on_modified(events.DirModifiedEvent(self.ws))
+        self.assertEqual(
+            self.stateman.calls, [("create", osp.join(self.ws, "sub"))],
+        )
+
+    @defer.inlineCallbacks
+    def test_modified_file(self):
+        yield self.d
+        foo = self.write("foo.txt")
+        yield self.h.on_modified(events.DirModifiedEvent(self.ws))
+        os.utime(foo, (0, 0))
+
+        self.stateman.calls = []
+        yield self.h.on_modified(events.DirModifiedEvent(self.ws))
+        self.assertEqual(self.stateman.calls, [("modify", foo)])
+
+    @defer.inlineCallbacks
+    def test_deleted(self):
+        yield self.populate()
+        sub = osp.join(self.ws, "sub")
+        rmtree(sub)
+        yield self.h.on_modified(events.DirModifiedEvent(self.ws))
+        self.assertEqual(self.stateman.calls, [("delete", sub)])
+
+    @defer.inlineCallbacks
+    def test_replaced_by_file(self):
+        yield self.populate()
+        sub = osp.join(self.ws, "sub")
+        rmtree(sub)
+        self.write("sub")
+        yield self.h.on_modified(events.DirModifiedEvent(self.ws))
+        self.assertEqual(
+            self.stateman.calls, [("delete", sub), ("create", sub)],
+        )
+        entry = yield self.index.get(sub)
+        self.assertNotEqual(entry.md5, fs.MD5_DIRECTORY)
+
+    @defer.inlineCallbacks
+    def test_filtered(self):
+        yield self.d
+        self.h._filt = dict(include=["*"], exclude=["*.tmp"])
+        self.write("foo.tmp")
+        evs = yield self.h.diff_directory(self.ws)
+        self.assertEqual(evs, [])
+
+    @defer.inlineCallbacks
+    def test_removed_directory(self):
+        evs = yield self.h.diff_directory(osp.join(self.ws, "gone"))
+        self.assertEqual(evs, [])
+
+    @defer.inlineCallbacks
+    def test_file(self):
+        yield self.d
+        foo = self.write("foo.txt")
+        yield self.stateman.stateman.create(dict(
+            node_path=foo, md5="old", bytesize=0, mtime=0., stat_result=b"",
+        ))
+        yield self.h.on_modified(events.FileModifiedEvent(foo))
+        self.assertEqual(self.stateman.calls, [("modify", foo)])
+
+    def test_vanished_file(self):
+        return self.h.on_modified(
+            events.FileModifiedEvent(osp.join(self.ws, "gone.txt")),
+        )
+
+
+class TestEventHandlerJournal(TestCase):
+    def setUp(self):
+        self.ws = mkdtemp()
+        self.addCleanup(rmtree, self.ws)
+        self.journal_path = osp.join(mkdtemp(), "journal")
+        self.addCleanup(rmtree, osp.dirname(self.journal_path))
+
+        self.db = ConnectionManager(":memory:")
+        self.addCleanup(self.db.close)
+        self.index = PathIndex(self.db)
+        self.stateman = RecordingStateManager(
+            sqlite.StateManager(self.db, self.index),
+        )
+        self.d = self.db.runInteraction(sqlite.migrate)
+        self.h = self.handler()
+
+    def handler(self, **kw):
+        self.journal = Journal(self.journal_path)
+        self.addCleanup(self.journal.close)
+        return fs.EventHandler(self.stateman, self.ws, index=self.index,
+                               filters=dict(include=["*"]),
+                               journal=self.journal, **kw)
+
+    def write(self, name, content=b"content"):
+        path = osp.join(self.ws, name)
+        with open(path, "wb") as f:
+            f.write(content)
+        return path
+
+    @defer.inlineCallbacks
+    def test_handle(self):
+        yield self.d
+        foo = self.write("foo.txt")
+        yield self.h.handle(events.FileCreatedEvent(foo))
+        self.assertEqual(self.stateman.calls, [("create", foo)])
+        self.assertEqual(self.journal.pending(), [])
+        self.assertEqual(self.journal.stats()["appended"], 1)
+
+    @defer.inlineCallbacks
+    def test_pending_until_recorded(self):
+        yield self.d
+        foo = self.write("foo.txt")
+        recorded = defer.Deferred()
+        self.stateman.create = lambda inode, directory=False: recorded
+
+        d = self.h.handle(events.FileCreatedEvent(foo))
+        self.assertEqual(self.journal.pending(),
+                         [(1, events.FileCreatedEvent(foo))])
+        recorded.callback(None)
+        yield d
+        self.assertEqual(self.journal.pending(), [])
+
+    @defer.inlineCallbacks
+    def test_failure_stays_pending(self):
+        yield self.d
+        self.stateman.delete = lambda inode, directory=False: 1 / 0
+        ev = events.FileDeletedEvent(osp.join(self.ws, "foo.txt"))
+        yield self.assertFailure(self.h.handle(ev), ZeroDivisionError)
+        self.assertEqual(self.journal.pending(), [(1, ev)])
+
+    @defer.inlineCallbacks
+    def test_vanished(self):
+        yield self.d
+        ev = events.FileCreatedEvent(osp.join(self.ws, "gone.txt"))
+        yield self.h.handle(ev)
+        self.assertEqual(self.journal.pending(), [])
+
+    @defer.inlineCallbacks
+    def test_replay(self):
+        yield self.d
+        foo = self.write("foo.txt")
+        bar = osp.join(self.ws, "bar.txt")
+        self.journal.append(events.FileModifiedEvent(foo))
+        self.journal.append(events.FileDeletedEvent(bar))
+        self.journal.append(events.FileCreatedEvent(foo + ".pydio_dl"))
+
+        h = self.handler()  # restarted after a crash
+        n = yield h.replay()
+        self.assertEqual(n, 3)
+        self.assertEqual(self.stateman.calls,
+                         [("modify", foo), ("delete", bar)])
+        self.assertEqual(self.journal.pending(), [])
+        self.assertEqual(osp.getsize(self.journal_path), 0)
+
+    @defer.inlineCallbacks
+    def test_replay_failure(self):
+        yield self.d
+        foo = self.write("foo.txt")
+        self.journal.append(events.FileCreatedEvent(foo))
+        self.journal.append(events.FileModifiedEvent(foo))
+        h = self.handler()
+        self.stateman.create = lambda inode, directory=False: 1 / 0
+
+        yield h.replay()
+        self.flushLoggedErrors(ZeroDivisionError)
+        self.assertEqual(self.journal.pending(),
+                         [(1, events.FileCreatedEvent(foo))])
+
+    @defer.inlineCallbacks
+    def test_local_directory(self):
+        yield self.d
+        foo = self.write("foo.txt")
+        self.journal.append(events.FileCreatedEvent(foo))
+
+        ld = fs.LocalDirectory(self.ws, filters=dict(include=["*"]),
+                               journal=Journal(self.journal_path))
+        self.addCleanup(ld.journal.close)
+        ld.connect_state_manager(self.stateman)
+        yield ld.replay()
+        self.assertEqual(self.stateman.calls, [("create", foo)])
+        self.assertEqual(ld.journal.pending(), [])
+
+    def test_dispatch_filtered(self):
+        self.h.dispatch(events.FileCreatedEvent(
+            osp.join(self.ws, "foo.pydio_cp"),
+        ))
+        self.assertEqual(self.journal.stats()["appended"], 0)
+
+
+class TestEventHandlerReconcile(TestCase):
+    def setUp(self):
+        self.ws = mkdtemp()
+        self.db = ConnectionManager(":memory:")
+        self.index = PathIndex(self.db)
+        self.snapshots = sqlite.SnapshotStore(self.db)
+        self.stateman = RecordingStateManager(sqlite.StateManager(
+            self.db, self.index, snapshots=self.snapshots,
+        ))
+        self.h = fs.EventHandler(self.stateman, self.ws, index=self.index,
+                                 snapshots=self.snapshots,
+                                 filters=dict(include=["*"]))
+        self.d = self.db.runInteraction(sqlite.migrate)
+
+        for d in ("a", "a/aa", "b"):
+            os.mkdir(osp.join(self.ws, d))
+        for f in ("a/aa/1.txt", "b/2.txt", "3.txt"):
+            self.write(f)
+
+    def tearDown(self):
+        self.db.close()
+        rmtree(self.ws)
+
+    def write(self, name, content=b"content"):
+        path = osp.join(self.ws, name)
+        with open(path, "wb") as f:
+            f.write(content)
+        return path
+
+    @defer.inlineCallbacks
+    def reconcile(self, deep=False):
+        """Reconcile, and return the stats and the recorded calls"""
+        yield self.d
+        self.stateman.calls = []
+        stats = yield self.h.reconcile(deep)
+        return stats, sorted(self.stateman.calls)
+
+    @defer.inlineCallbacks
+    def test_initial(self):
+        stats, calls = yield self.reconcile()
+        self.assertEqual(stats["listed"], 4)
+        self.assertEqual(stats["rescanned"], 4)
+        self.assertEqual(calls, sorted(
+            ("create", osp.join(self.ws, p))
+            for p in ("a", "a/aa", "a/aa/1.txt", "b", "b/2.txt", "3.txt")
+        ))
+
+        snapshots = yield self.snapshots.load()
+        self.assertEqual(len(snapshots), 4)
+
+    @defer.inlineCallbacks
+    def test_unchanged(self):
+        yield self.reconcile()
+        stats, calls = yield self.reconcile()
+        self.assertEqual(calls, [])
+        self.assertEqual((stats["visited"], stats["listed"]), (4, 0))
+
+    @defer.inlineCallbacks
+    def test_offline_create(self):
+        yield self.reconcile()
+        new = self.write("a/aa/new.txt")
+
+        stats, calls = yield self.reconcile()
+        self.assertEqual(calls, [("create", new)])
+        self.assertEqual((stats["listed"], stats["rescanned"]), (1, 1))
+
+    @defer.inlineCallbacks
+    def test_offline_delete(self):
+        yield self.reconcile()
+        rmtree(osp.join(self.ws, "a"))
+
+        stats, calls = yield self.reconcile()
+        self.assertEqual(calls, [("delete", osp.join(self.ws, "a"))])
+        self.assertEqual(stats["listed"], 1)
+
+        snapshots = yield self.snapshots.load()
+        self.assertEqual(sorted(snapshots),
+                         [self.ws, osp.join(self.ws, "b")])
+
+    @defer.inlineCallbacks
+    def test_modified_in_place(self):
+        yield self.reconcile()
+        path = osp.join(self.ws, "b/2.txt")
+        os.utime(path, (0, 0))
+
+        _, calls = yield self.reconcile()
+        self.assertEqual(calls, [], "shallow walk listed an unchanged dir")
+
+        stats, calls = yield self.reconcile(deep=True)
+        self.assertEqual(calls, [("modify", path)])
+        self.assertEqual((stats["listed"], stats["rescanned"]), (4, 1))
+
+    @defer.inlineCallbacks
+    def test_rescan_saves_snapshot(self):
+        yield self.reconcile()
+        new = self.write("b/new.txt")
+        yield self.h.on_modified(events.DirModifiedEvent(osp.dirname(new)))
+
+        stats, calls = yield self.reconcile()
+        self.assertEqual(calls, [])
+        self.assertEqual(stats["listed"], 0)
+
+    def test_digest(self):
+        entries = {"/a": (False, 1, 2.), "/b": (True, 4096, 3.)}
+        self.assertEqual(fs.listing_digest(entries),
+                         fs.listing_digest(dict(reversed(entries.items()))))
+        self.assertNotEqual(fs.listing_digest(entries),
+                            fs.listing_digest(dict(entries, **{"/a": (
+                                False, 1, 2.5)})))
+        self.assertEqual(fs.listing_digest(entries),
+                         fs.listing_digest(dict(entries, **{"/b": (
+                             True, 4096, 4.)})), "subdir mtime in digest")
+
+
+class TestEventHandlerIgnore(TestCase):
+    def setUp(self):
+        self.ws = mkdtemp()
+        self.db = ConnectionManager(":memory:")
+        self.index = PathIndex(self.db)
+        self.snapshots = sqlite.SnapshotStore(self.db)
+        self.stateman = RecordingStateManager(sqlite.StateManager(
+            self.db, self.index, snapshots=self.snapshots,
+        ))
+        self.h = fs.EventHandler(self.stateman, self.ws, index=self.index,
+                                 snapshots=self.snapshots,
+                                 filters=dict(include=["*"]))
+        self.changed = []
+        self.h.ignores.on_change = self.changed.append
+        self.d = self.db.runInteraction(sqlite.migrate)
+
+        for d in ("node_modules", "node_modules/pkg", "src"):
+            os.mkdir(self.path(d))
+        for f in ("node_modules/pkg/index.js", "src/main.c", "src/main.o"):
+            self.write(f)
+
+    def tearDown(self):
+        self.db.close()
+        rmtree(self.ws)
+
+    def path(self, name):
+        return osp.join(self.ws, name)
+
+    def write(self, name, content=b"content"):
+        with open(self.path(name), "wb") as f:
+            f.write(content)
+        return self.path(name)
+
+    @defer.inlineCallbacks
+    def reconcile(self, deep=False, root=None):
+        yield self.d
+        self.stateman.calls = []
+        stats = yield self.h.reconcile(deep, root)
+        return stats, sorted(p for _, p in self.stateman.calls)
+
+    @defer.inlineCallbacks
+    def test_not_scanned(self):
+        ignore_file = self.write(fs.IGNORE_FILE, b"node_modules/\n*.o\n")
+        stats, paths = yield self.reconcile()
+        self.assertEqual(paths, sorted(
+            [ignore_file, self.path("src"), self.path("src/main.c")],
+        ))
+        self.assertEqual(stats["listed"], 2)
+
+    def test_events_filtered(self):
+        self.write(fs.IGNORE_FILE, b"node_modules/\n")
+        path = self.path("node_modules/pkg/index.js")
+        self.assertFalse(self.h._filter_event(events.FileModifiedEvent(path)))
+        self.assertFalse(self.h._filter_event(
+            events.DirCreatedEvent(self.path("node_modules")),
+        ))
+        self.assertTrue(self.h._filter_event(
+            events.FileCreatedEvent(self.path("node_modules.txt")),
+        ))
+
+    @defer.inlineCallbacks
+    def test_ignore_file_event(self):
+        yield self.reconcile()
+        self.assertTrue(self.h.filter_path(self.path("src/main.o")))
+
+        self.write("src/" + fs.IGNORE_FILE, b"*.o\n")
+        yield self.h.on_created(events.FileCreatedEvent(
+            self.path("src/" + fs.IGNORE_FILE),
+        ))
+        self.assertEqual(self.changed, [self.path("src")])
+        self.assertFalse(self.h.filter_path(self.path("src/main.o")))
+
+        # found by the listing of a modified directory
+        self.write(fs.IGNORE_FILE, b"node_modules/\n")
+        yield self.h.on_modified(events.DirModifiedEvent(self.ws))
+        self.assertEqual(self.changed, [self.path("src"), self.ws])
+
+    @defer.inlineCallbacks
+    def test_newly_ignored_not_deleted(self):
+        yield self.reconcile()
+        self.write(fs.IGNORE_FILE, b"node_modules/\n")
+        self.h.ignores.refresh(self.ws)
+
+        _, paths = yield self.reconcile(deep=True)
+        self.assertEqual(paths, [self.path(fs.IGNORE_FILE)])
+        entry = yield self.index.get(self.path("node_modules/pkg/index.js"))
+        self.assertIsNotNone(entry)
+
+    @defer.inlineCallbacks
+    def test_reincluded(self):
+        self.write(fs.IGNORE_FILE, b"node_modules/\n")
+        yield self.reconcile()
+        os.remove(self.path(fs.IGNORE_FILE))
+        self.h.ignores.refresh(self.ws)
+
+        _, paths = yield self.reconcile(deep=True, root=self.ws)
+        self.assertEqual(paths, sorted(self.path(p) for p in (
+            fs.IGNORE_FILE, "node_modules", "node_modules/pkg",
+            "node_modules/pkg/index.js",
+        )))
+
+    @defer.inlineCallbacks
+    def test_not_watched(self):
+        self.write(fs.IGNORE_FILE, b"node_modules/\n")
+        w = TreeWatcher(self.h, self.ws)
+        self.addCleanup(w.observer.unschedule_all)
+        yield w.discover(self.ws)
+        self.assertEqual(sorted(w.watches), [self.ws, self.path("src")])
+
+        os.remove(self.path(fs.IGNORE_FILE))
+        self.h.ignores.refresh(self.ws)
+        yield w.discover(self.ws)
+        self.assertEqual(list(w.watches), [self.ws])
+        self.assertTrue(w.watches[self.ws].is_recursive)
+
+
+class TestSelection(TestCase):
+    def setUp(self):
+        self.ws = mkdtemp()
+        self.db = ConnectionManager(":memory:")
+        self.index = PathIndex(self.db)
+        self.snapshots = sqlite.SnapshotStore(self.db)
+        self.stateman = RecordingStateManager(sqlite.StateManager(
+            self.db, self.index, snapshots=self.snapshots,
+        ))
+        self.stateman.index = self.index
+        self.stateman.snapshots = self.snapshots
+
+        self.ld = fs.LocalDirectory(
+            self.ws, filters=dict(include=["*"]),
+            selection=Selection(include=["/docs"], exclude=["/docs/old"]),
+        )
+        self.ld.connect_state_manager(self.stateman)
+        self.h = self.ld._handlers[0]
+        self.d = self.db.runInteraction(sqlite.migrate)
+
+        for d in ("docs", "docs/old", "photos", "photos/2019", "photos/2020"):
+            os.mkdir(self.path(d))
+        for f in ("docs/a.txt", "docs/old/b.txt", "photos/2019/c.jpg",
+                  "photos/2020/d.jpg", "e.txt"):
+            self.write(f)
+
+    def tearDown(self):
+        self.db.close()
+        rmtree(self.ws)
+
+    def path(self, name):
+        return osp.join(self.ws, name)
+
+    def write(self, name, content=b"content"):
+        with open(self.path(name), "wb") as f:
+            f.write(content)
+        return self.path(name)
+
+    @defer.inlineCallbacks
+    def indexed(self):
+        entries = yield self.index.subtree(self.ws)
+        return sorted(self.ld.relative_path(p) for p in entries)
+
+    @defer.inlineCallbacks
+    def test_not_scanned(self):
+        yield self.d
+        stats = yield self.h.reconcile()
+        self.assertEqual(stats["listed"], 2)
+        self.assertEqual((yield self.indexed()), ["/docs", "/docs/a.txt"])
+        self.assertFalse(self.h.filter_path(self.path("photos"), True))
+        self.assertFalse(self.h.filter_path(self.path("docs/old/b.txt")))
+
+    @defer.inlineCallbacks
+    def test_fetch(self):
+        yield self.d
+        yield self.h.reconcile()
+        self.stateman.calls = []
+
+        yield self.ld.set_selection(Selection(
+            include=["/docs", "/photos/2020"], exclude=["/docs/old"],
+        ))
+        self.assertEqual(sorted(p for _, p in self.stateman.calls), [
+            self.path("photos"), self.path("photos/2020"),
+            self.path("photos/2020/d.jpg"),
+        ])
+
+    @defer.inlineCallbacks
+    def test_watches(self):
+        yield self.d
+        (w,) = self.ld._trees
+        self.addCleanup(w.observer.unschedule_all)
+        yield w.discover(self.ws)
+        self.assertEqual(sorted(w.watches), [self.ws, self.path("docs")])
+
+        yield self.ld.set_selection(Selection(
+            include=["/docs", "/photos/2020"], exclude=["/docs/old"],
+        ))
+        self.assertEqual(sorted(w.watches), [
+            self.ws, self.path("docs"), self.path("photos"),
+            self.path("photos/2020"),
+        ])
+        self.assertTrue(w.watches[self.path("photos/2020")].is_recursive)
+
+        yield self.ld.set_selection(Selection(
+            include=["/docs"], exclude=["/docs/old"],
+        ))
+        self.assertEqual(sorted(w.watches), [self.ws, self.path("docs")])
+
+    @defer.inlineCallbacks
+    def test_evict(self):
+        yield self.d
+        yield self.ld.set_selection(Selection())
+        yield self.h.reconcile()
+        os.utime(self.path("photos/2019/c.jpg"), (0, 0))  # modified
+
+        synced = []
+
+        def is_synced(path, entry):
+            synced.append(path)
+            return defer.succeed(not path.endswith("d.jpg"))
+
+        self.stateman.calls = []
+        yield self.ld.set_selection(Selection(exclude=["/photos"]), is_synced)
+        self.assertEqual(synced, [self.path("photos/2020/d.jpg")])
+        self.assertEqual(self.stateman.calls,
+                         [("delete", self.path("photos"))])
+        self.assertNotIn("/photos", (yield self.indexed()))
+
+        # unsynced and modified files are kept, with their directories
+        self.assertTrue(osp.exists(self.path("photos/2019/c.jpg")))
+        self.assertTrue(osp.exists(self.path("photos/2020/d.jpg")))
+
+    @defer.inlineCallbacks
+    def test_evict_removes_synced(self):
+        yield self.d
+        yield self.ld.set_selection(Selection())
+        yield self.h.reconcile()
+
+        removed = yield self.h.evict(self.path("docs"), lambda path, entry: (
+            defer.succeed(True)
+        ))
+        self.assertEqual(removed, 0, "docs is still selected")
+
+        yield self.ld.set_selection(Selection(exclude=["/docs"]),
+                                    lambda path, entry: defer.succeed(True))
+        self.assertFalse(osp.exists(self.path("docs")))
+        self.assertTrue(osp.exists(self.path("e.txt")))
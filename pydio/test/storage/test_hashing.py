@@ -0,0 +1,252 @@
+#! /usr/bin/env python
+from twisted.trial.unittest import TestCase
+
+import os
+import time
+import os.path as osp
+from hashlib import md5, blake2b, sha256
+from shutil import rmtree
+from tempfile import mkdtemp
+from concurrent.futures import Future
+
+from zope.interface.verify import verifyClass
+
+from twisted.logger import Logger
+from twisted.internet import defer, reactor, task
+
+from pydio.storage import IHasher, hashing
+from pydio.util import ratelimit
+from pydio.util.cdc import Chunker
+from pydio.util.delta import signature
+from pydio.util.priority import PriorityScheduler
+
+
+class TestIHasher(TestCase):
+    def test_InlineHasher(self):
+        verifyClass(IHasher, hashing.InlineHasher)
+
+    def test_ThreadHasher(self):
+        verifyClass(IHasher, hashing.ThreadHasher)
+
+    def test_ProcessHasher(self):
+        verifyClass(IHasher, hashing.ProcessHasher)
+
+
+class HasherTestCase(TestCase):
+    def setUp(self):
+        self.dir = mkdtemp()
+
+    def tearDown(self):
+        rmtree(self.dir)
+
+    def write(self, name, content):
+        path = osp.join(self.dir, name)
+        with open(path, "wb") as f:
+            f.write(content)
+        return path
+
+
+class TestHashBatch(HasherTestCase):
+    def test_batch(self):
+        path = self.write("foo", b"foo")
+        results = hashing.hash_batch([path, osp.join(self.dir, "nope")])
+
+        self.assertEqual(results[0], (True, dict(md5=md5(b"foo").hexdigest())))
+        ok, e = results[1]
+        self.assertFalse(ok)
+        self.assertIsInstance(e, FileNotFoundError)
+
+
+class TestDigests(HasherTestCase):
+    def test_digest_names(self):
+        self.assertEqual(hashing.digest_names(), ("md5",))
+        self.assertEqual(
+            hashing.digest_names(["blake2b", "md5"]), ("md5", "blake2b"),
+        )
+        self.assertRaises(ValueError, hashing.digest_names, ["crc"])
+
+    def test_single_pass(self):
+        content = os.urandom(3 * hashing.HASH_BLOCK_SIZE + 100)
+        path = self.write("foo", content)
+
+        digests = hashing.hash_file(path, digests=hashing.DIGESTERS)
+        self.assertEqual(digests["md5"], md5(content).hexdigest())
+        self.assertEqual(digests["sha256"], sha256(content).hexdigest())
+        self.assertEqual(
+            digests["blake2b"], blake2b(content, digest_size=32).hexdigest(),
+        )
+
+        sig = signature(path, hashing.SIGNATURE_BLOCK_SIZE)
+        self.assertEqual(digests["block_size"], sig.block_size)
+        self.assertEqual(digests["blocks"], sig.blocks)
+
+    def test_signature_misaligned(self):
+        """Blocks are rebuilt from reads that straddle their boundaries"""
+        content = os.urandom(10000)
+        path = self.write("foo", content)
+
+        digester = hashing.SignatureDigester(1000)
+        for i in range(0, len(content), 777):
+            digester.update(content[i:i + 777])
+        self.assertEqual(
+            digester.result()["blocks"], signature(path, 1000).blocks,
+        )
+
+    def test_empty(self):
+        path = self.write("foo", b"")
+        digests = hashing.hash_file(path, digests=("md5", "signature"))
+        self.assertEqual(digests["blocks"], b"")
+
+    @defer.inlineCallbacks
+    def test_thread_hasher(self):
+        path = self.write("foo", b"foo")
+        hasher = hashing.ThreadHasher(digests=["blake2b"])
+        digests = yield hasher.hash(path)
+        self.assertEqual(set(digests), {"md5", "blake2b"})
+
+
+class TestThrottledHashing(HasherTestCase):
+    @defer.inlineCallbacks
+    def test_small_file(self):
+        # at 64 KB/s, charging a whole block would wait seconds
+        governor = ratelimit.Governor(dict(read=64 << 10))
+        charged = []
+        consume = governor.consume
+
+        def spy(resource, n=1):
+            charged.append((resource, n))
+            return consume(resource, n)
+
+        governor.consume = spy
+        path = self.write("small", b"x" * 1024)
+
+        t0 = time.monotonic()
+        yield hashing.ThreadHasher(governor=governor).hash(path)
+        self.assertEqual(charged, [(ratelimit.OPENS, 1),
+                                   (ratelimit.READ, 1024)])
+        self.assertTrue(time.monotonic() - t0 < 1)
+
+    def test_charges_block_sizes(self):
+        path = self.write("file", os.urandom(hashing.HASH_BLOCK_SIZE + 10))
+        charged = []
+        hashing.hash_file(path, throttle=lambda r, n: charged.append((r, n)))
+        self.assertEqual(charged, [
+            (ratelimit.OPENS, 1),
+            (ratelimit.READ, hashing.HASH_BLOCK_SIZE),
+            (ratelimit.READ, 10),
+        ])
+
+
+class TestScheduledHashing(HasherTestCase):
+    def setUp(self):
+        super().setUp()
+        self.scheduler = PriorityScheduler(1)
+
+    @defer.inlineCallbacks
+    def check_order(self, hasher):
+        large = self.write("large", b"x" * 5000)
+        small = self.write("small", b"x" * 10)
+
+        order = []
+        yield self.scheduler.acquire("/busy")
+        hashed = [hasher.hash(p).addCallback(lambda _, p=p: order.append(p))
+                  for p in (large, small)]
+        while self.scheduler.pending < 2:  # queued from the next iteration
+            yield task.deferLater(reactor, 0, lambda: None)
+        self.scheduler.release()
+
+        yield defer.gatherResults(hashed)
+        self.assertEqual(order, [small, large])
+        self.assertEqual(self.scheduler.running, 0)
+
+    def test_thread_hasher(self):
+        return self.check_order(hashing.ThreadHasher(scheduler=self.scheduler))
+
+    @defer.inlineCallbacks
+    def test_process_hasher(self):
+        hasher = hashing.ProcessHasher(workers=1, min_size=1000,
+                                       scheduler=self.scheduler)
+        self.addCleanup(hasher.close)
+        yield self.check_order(hasher)
+        self.assertIsNotNone(hasher._pool)
+
+
+class TestProcessHasher(HasherTestCase):
+    def setUp(self):
+        super().setUp()
+        self.hasher = hashing.ProcessHasher(workers=2, min_size=1000)
+
+    def tearDown(self):
+        self.hasher.close()
+        super().tearDown()
+
+    @defer.inlineCallbacks
+    def test_small_files_use_threads(self):
+        path = self.write("small", b"x" * 10)
+        digests = yield self.hasher.hash(path)
+        self.assertEqual(digests["md5"], md5(b"x" * 10).hexdigest())
+        self.assertIsNone(self.hasher._pool, "process pool was started")
+
+    @defer.inlineCallbacks
+    def test_batch(self):
+        contents = [os.urandom(2000) for _ in range(5)]
+        paths = [self.write(str(i), c) for i, c in enumerate(contents)]
+
+        results = yield defer.gatherResults(map(self.hasher.hash, paths))
+        self.assertEqual(
+            [r["md5"] for r in results],
+            [md5(c).hexdigest() for c in contents],
+        )
+        self.assertIsNotNone(self.hasher._pool)
+
+    @defer.inlineCallbacks
+    def test_chunker(self):
+        self.hasher.chunker = Chunker
+        path = self.write("foo", os.urandom(50000))
+        digests = yield self.hasher.hash(path)
+        self.assertEqual(sum(n for _, n in digests["chunks"]), 50000)
+
+    @defer.inlineCallbacks
+    def test_file_vanished(self):
+        path = self.write("foo", b"x" * 2000)
+        d = self.hasher.hash(path)
+        os.remove(path)
+        yield self.assertFailure(d, FileNotFoundError)
+
+    @defer.inlineCallbacks
+    def test_worker_failure(self):
+        class BrokenPool:
+            submits = shutdowns = 0
+
+            def submit(self, *a):
+                self.submits += 1
+                f = Future()
+                f.set_exception(RuntimeError("worker died"))
+                return f
+
+            def shutdown(self, wait=True):
+                self.shutdowns += 1
+
+        pool = self.hasher._pool = BrokenPool()
+        warnings = []
+        self.hasher.log = Logger(observer=warnings.append)
+        self.hasher.batch_size = 1
+        contents = [b"x" * 2000, b"y" * 2000]
+        paths = [self.write(str(i), c) for i, c in enumerate(contents)]
+
+        results = yield defer.gatherResults(map(self.hasher.hash, paths))
+        self.assertEqual(
+            [r["md5"] for r in results],
+            [md5(c).hexdigest() for c in contents],
+        )
+        self.assertIsNone(self.hasher._pool)
+        self.assertEqual(pool.submits, 2)
+        self.assertEqual(pool.shutdowns, 1)
+        self.assertEqual(len(warnings), 1)
+
+    @defer.inlineCallbacks
+    def test_digests(self):
+        self.hasher.digests = ("md5", "signature")
+        path = self.write("foo", os.urandom(2000))
+        digests = yield self.hasher.hash(path)
+        self.assertEqual(digests["blocks"], signature(path).blocks)
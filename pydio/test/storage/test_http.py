@@ -0,0 +1,492 @@
+#! /usr/bin/env python
+from twisted.trial.unittest import TestCase
+
+import os
+import os.path as osp
+from hashlib import md5
+from shutil import rmtree
+from tempfile import mkdtemp
+
+from zope.interface import implementer
+from zope.interface.verify import verifyClass
+
+from twisted.internet import defer
+
+from pydio.engine import IStateManager, sqlite
+from pydio.storage import http, IStorage
+from pydio.test import fakeserver
+from pydio.util.selection import Selection
+
+
+@implementer(IStateManager)
+class RecordingStateManager:
+    def __init__(self):
+        self.calls = []
+
+    def create(self, inode, directory=False):
+        self.calls.append(("create", inode["node_path"]))
+
+    def delete(self, inode, directory=False):
+        self.calls.append(("delete", inode["node_path"]))
+
+    def modify(self, inode, directory=False):
+        self.calls.append(("modify", inode["node_path"]))
+
+    def move(self, inode, directory=False):
+        self.calls.append(("move", inode["node_path"]))
+
+
+class FakeServerTestCase(TestCase):
+    """Serves a temporary workspace named `ws` with a fake Pydio server"""
+
+    poolsize = 2
+    folder = "/"
+
+    def setUp(self):
+        self.root = mkdtemp()
+        self.ws = osp.join(self.root, "ws")
+        os.mkdir(self.ws)
+
+        self.port, self.api = fakeserver.listen(self.root)
+        server = "http://127.0.0.1:{0}".format(self.port.getHost().port)
+        self.client = http.Client(server, "ws", user="u", password="p",
+                                  timeout=5, poolsize=self.poolsize,
+                                  folder=self.folder)
+
+    @defer.inlineCallbacks
+    def tearDown(self):
+        yield self.client.close()
+        yield self.port.stopListening()
+        rmtree(self.root)
+
+    def write(self, path, content=b"now is the winter of our discontent"):
+        full_path = osp.join(self.ws, path)
+        os.makedirs(osp.dirname(full_path), exist_ok=True)
+        with open(full_path, "wb") as f:
+            f.write(content)
+        return md5(content).hexdigest()
+
+
+class TestRemoteDirectory(TestCase):
+    def test_IStorage(self):
+        verifyClass(IStorage, http.RemoteDirectory)
+
+    def test_pool_size(self):
+        rd = http.RemoteDirectory("http://localhost", "ws", poolsize=7)
+        self.assertEqual(rd.client.pool.maxPersistentPerHost, 7)
+        self.assertTrue(rd.client.pool.persistent)
+
+    def test_refresh_fires_at_once(self):
+        rd = http.RemoteDirectory("http://localhost", "ws")
+        rd._refresh = lambda roots=None: defer.succeed("done")
+        d = rd.refresh()
+        self.assertIsInstance(d, defer.Deferred)
+        self.assertEqual(self.successResultOf(d), "done")
+        self.assertIsNone(rd._refreshing)
+
+    def test_set_selection_fires_at_once(self):
+        rd = http.RemoteDirectory("http://localhost", "ws")
+        refreshed = []
+        rd._refresh = lambda roots=None: defer.succeed(refreshed.append(roots))
+        d = rd.set_selection(Selection(exclude=["/photos"]))
+        self.successResultOf(d)
+        self.assertEqual(refreshed, [["/photos"]])
+        self.assertIsNone(rd._refreshing)
+
+    def test_base_url(self):
+        c = http.Client("http://localhost/enterprise/", "my-files")
+        self.assertEqual(
+            c.url("stat", "/foo bar.txt"),
+            "http://localhost/enterprise/api/my-files/stat/foo%20bar.txt",
+        )
+
+
+class TestClient(FakeServerTestCase):
+    @defer.inlineCallbacks
+    def test_stat(self):
+        checksum = self.write("foo.txt")
+        inode = yield self.client.stat("/foo.txt")
+        self.assertEqual(inode["node_path"], "/foo.txt")
+        self.assertEqual(inode["md5"], checksum)
+
+    @defer.inlineCallbacks
+    def test_stat_missing(self):
+        inode = yield self.client.stat("/nope.txt")
+        self.assertIsNone(inode)
+
+    @defer.inlineCallbacks
+    def test_stat_many(self):
+        paths = ["/f{0}.txt".format(i) for i in range(10)]
+        for p in paths:
+            self.write(p.lstrip("/"))
+
+        stats = yield self.client.stat_many(paths + ["/nope.txt"])
+        self.assertEqual(len(stats), 11)
+        self.assertIsNone(stats["/nope.txt"])
+        self.assertEqual(stats["/f3.txt"]["node_path"], "/f3.txt")
+
+    @defer.inlineCallbacks
+    def test_walk(self):
+        self.write("a.txt")
+        self.write("sub/b.txt")
+        self.write("sub/deeper/c.txt")
+
+        nodes = yield self.client.walk()
+        self.assertEqual(
+            sorted(n["node_path"] for n in nodes),
+            ["/a.txt", "/sub", "/sub/b.txt", "/sub/deeper", "/sub/deeper/c.txt"],
+        )
+
+    @defer.inlineCallbacks
+    def test_upload_download(self):
+        content = b"x" * 100000
+        inode = yield self.client.upload("/up/load.bin", content)
+        self.assertEqual(inode["md5"], md5(content).hexdigest())
+
+        data = yield self.client.download("/up/load.bin")
+        self.assertEqual(data, content)
+
+    @defer.inlineCallbacks
+    def test_mkdir_move_delete(self):
+        yield self.client.mkdir("/dir")
+        self.write("dir/f.txt")
+
+        inode = yield self.client.move("/dir", "/moved")
+        self.assertEqual(inode["node_path"], "/moved")
+        self.assertTrue(osp.exists(osp.join(self.ws, "moved", "f.txt")))
+
+        yield self.client.delete("/moved")
+        self.assertFalse(osp.exists(osp.join(self.ws, "moved")))
+
+    @defer.inlineCallbacks
+    def test_download_missing(self):
+        with self.assertRaises(http.RequestError):
+            yield self.client.download("/nope.txt")
+
+    @defer.inlineCallbacks
+    def test_connection_reuse(self):
+        self.write("foo.txt")
+        yield self.client.stat_many(["/foo.txt"] * 20)
+
+        cached = sum(map(len, self.client.pool._connections.values()))
+        self.assertTrue(0 < cached <= self.poolsize,
+                        "expected pooled connections, got {0}".format(cached))
+
+
+class TestCompressionNegotiation(FakeServerTestCase):
+
+    TEXT = b"date,city,temperature\n" + b"2017-01-01,Paris,3.5\n" * 2000
+
+    @defer.inlineCallbacks
+    def test_encodings(self):
+        self.api.encodings = ("deflate", "brotli")
+        encodings = yield self.client.encodings()
+        self.assertEqual(encodings, ("deflate",))
+
+    @defer.inlineCallbacks
+    def test_disabled(self):
+        self.client.compression = False
+        encodings = yield self.client.encodings()
+        self.assertEqual(encodings, ())
+        self.assertEqual(self.api.requests, 0)
+
+    @defer.inlineCallbacks
+    def test_upload_chunk(self):
+        total = len(self.TEXT)
+        yield self.client.upload_chunk("/t.csv", 0, total, self.TEXT,
+                                       ("deflate", 6))
+        with open(osp.join(self.ws, "t.csv"), "rb") as f:
+            self.assertEqual(f.read(), self.TEXT)
+        self.assertTrue(self.client.compression_stats.ratio("deflate") > 5)
+
+    @defer.inlineCallbacks
+    def test_download_range(self):
+        self.write("t.csv", self.TEXT)
+        data = yield self.client.download_range("/t.csv", 10, 20000,
+                                                ("deflate",))
+        self.assertEqual(data, self.TEXT[10:20010])
+        self.assertIn("deflate", self.client.compression_stats.raw)
+
+    @defer.inlineCallbacks
+    def test_unsupported_encoding(self):
+        self.api.encodings = ()
+        d = self.client.upload_chunk("/t.csv", 0, len(self.TEXT), self.TEXT,
+                                     ("deflate", 6))
+        with self.assertRaises(http.RequestError):
+            yield d
+
+
+class TestRemoteDirectoryRefresh(FakeServerTestCase):
+    def setUp(self):
+        super().setUp()
+        # files are written behind the server's back, so it has no change
+        # feed to offer and every refresh lists the workspace
+        self.api.feed = False
+        self.rd = http.RemoteDirectory("http://localhost", "ws")
+        self.rd.client = self.client
+        self.sm = RecordingStateManager()
+        self.rd.connect_state_manager(self.sm)
+
+    @defer.inlineCallbacks
+    def test_refresh(self):
+        self.write("a.txt")
+        yield self.rd.refresh()
+        self.assertTrue(self.rd.available())
+        self.assertEqual(self.sm.calls, [("create", "/a.txt")])
+
+        del self.sm.calls[:]
+        self.write("a.txt", b"modified content")
+        self.write("b.txt")
+        yield self.rd.refresh()
+        self.assertEqual(
+            self.sm.calls,
+            [("modify", "/a.txt"), ("create", "/b.txt")],
+        )
+
+        del self.sm.calls[:]
+        os.remove(osp.join(self.ws, "a.txt"))
+        yield self.rd.refresh()
+        self.assertEqual(self.sm.calls, [("delete", "/a.txt")])
+
+    @defer.inlineCallbacks
+    def test_unreachable(self):
+        yield self.port.stopListening()
+        yield self.rd.refresh()
+        self.assertFalse(self.rd.available())
+        self.port, _ = fakeserver.listen(self.root)  # for tearDown
+
+    @defer.inlineCallbacks
+    def test_selection(self):
+        for path in ("a.txt", "docs/b.txt", "docs/old/c.txt", "photos/d.jpg"):
+            self.write(path)
+        self.rd.selection = Selection(include=["/docs"], exclude=["/docs/old"])
+        yield self.rd.refresh()
+        self.assertEqual(self.sm.calls,
+                         [("create", "/docs"), ("create", "/docs/b.txt")])
+
+    @defer.inlineCallbacks
+    def test_set_selection(self):
+        for path in ("docs/b.txt", "docs/old/c.txt", "photos/d.jpg"):
+            self.write(path)
+        self.rd.selection = Selection(include=["/docs"])
+        yield self.rd.refresh()
+
+        del self.sm.calls[:]
+        yield self.rd.set_selection(
+            Selection(include=["/docs", "/photos"], exclude=["/docs/old"]),
+        )
+        self.assertEqual(sorted(self.sm.calls), [
+            ("create", "/photos"), ("create", "/photos/d.jpg"),
+            ("delete", "/docs/old"), ("delete", "/docs/old/c.txt"),
+        ])
+        self.assertNotIn("/docs/b.txt", [
+            p for _, p in self.sm.calls
+        ])
+
+        # the next full listing agrees with the incremental one
+        del self.sm.calls[:]
+        yield self.rd.refresh()
+        self.assertEqual(self.sm.calls, [])
+
+
+class TestRemoteDirectoryRestart(FakeServerTestCase):
+    """Restarts against a persisted remote engine"""
+
+    def setUp(self):
+        super().setUp()
+        for name in ("a.txt", "b.txt", "dir/c.txt"):
+            self.write(name)
+        self.db_file = self.mktemp()
+
+    @defer.inlineCallbacks
+    def restart(self):
+        """Refresh once, as a freshly started client.  Fires with the types
+        of the changes logged and the number of directories listed.
+        """
+        engine = sqlite.Engine(self.db_file)
+        yield engine._init_db()
+        (seq,), = yield engine._db.runQuery(
+            "SELECT IFNULL(MAX(seq), 0) FROM ajxp_changes;"
+        )
+
+        rd = http.RemoteDirectory("http://localhost", "ws")
+        rd.client = self.client
+        rd.connect_state_manager(engine.updater)
+        self.api.actions.clear()
+        yield rd.refresh()
+
+        rows = yield engine._db.runQuery(
+            "SELECT type, target, source FROM ajxp_changes WHERE seq>? "
+            "ORDER BY seq;", (seq,),
+        )
+        yield engine._db.close()
+        return rows, self.api.actions["ls"]
+
+    def remove(self, path):
+        os.remove(osp.join(self.ws, path))
+        self.api.record("ws", "delete", "/" + path)
+
+    @defer.inlineCallbacks
+    def test_follows_saved_cursor(self):
+        changes, listed = yield self.restart()
+        self.assertEqual(len(changes), 4)
+        self.assertTrue(listed)
+
+        self.remove("a.txt")  # while the client is stopped
+        changes, listed = yield self.restart()
+        self.assertEqual(listed, 0, "the workspace was listed again")
+        self.assertEqual(changes, [("delete", "NULL", "/a.txt")])
+
+    @defer.inlineCallbacks
+    def test_listing_reports_deletions(self):
+        yield self.restart()
+        self.remove("dir/c.txt")
+        self.api.feeds["ws"].reset()
+
+        changes, listed = yield self.restart()
+        self.assertTrue(listed)
+        self.assertIn(("delete", "NULL", "/dir/c.txt"), changes)
+
+
+class TestClientFolder(FakeServerTestCase):
+    folder = "sub/"
+
+    @defer.inlineCallbacks
+    def test_paths_relative_to_folder(self):
+        self.write("outside.txt")
+        self.write("sub/a.txt")
+        self.write("sub/deeper/b.txt")
+
+        nodes = yield self.client.walk()
+        self.assertEqual(sorted(n["node_path"] for n in nodes),
+                         ["/a.txt", "/deeper", "/deeper/b.txt"])
+
+        inode = yield self.client.stat("/a.txt")
+        self.assertEqual(inode["node_path"], "/a.txt")
+
+        inode = yield self.client.move("/a.txt", "/moved.txt")
+        self.assertEqual(inode["node_path"], "/moved.txt")
+        self.assertTrue(osp.exists(osp.join(self.ws, "sub/moved.txt")))
+
+
+class TestRemoteDirectoryFeed(FakeServerTestCase):
+    """A large workspace with a trickle of changes"""
+
+    def setUp(self):
+        super().setUp()
+        for d in range(20):
+            for f in range(25):
+                self.write("d{0}/f{1}.txt".format(d, f), b"x")
+
+        self.rd = http.RemoteDirectory("http://localhost", "ws", page_size=2)
+        self.rd.client = self.client
+        self.sm = RecordingStateManager()
+        self.rd.connect_state_manager(self.sm)
+
+    def change(self, path, content=b"new content"):
+        existed = osp.exists(osp.join(self.ws, path))
+        self.write(path, content)
+        self.api.record("ws", "modify" if existed else "create", "/" + path)
+
+    def remove(self, path):
+        os.remove(osp.join(self.ws, path))
+        self.api.record("ws", "delete", "/" + path)
+
+    @defer.inlineCallbacks
+    def listed(self):
+        """Refresh, and return the calls and the number of listings"""
+        del self.sm.calls[:]
+        self.api.actions.clear()
+        yield self.rd.refresh()
+        return self.sm.calls, self.api.actions["ls"]
+
+    @defer.inlineCallbacks
+    def test_initial_listing(self):
+        calls, listings = yield self.listed()
+        self.assertEqual(len(calls), 520)
+        self.assertEqual(listings, 21)
+        self.assertEqual(self.rd._cursor, 0)
+
+    @defer.inlineCallbacks
+    def test_delta(self):
+        yield self.listed()
+        self.change("d3/f1.txt")
+        self.change("d4/new.txt")
+        self.remove("d5/f0.txt")
+
+        calls, listings = yield self.listed()
+        self.assertEqual(listings, 0)
+        self.assertEqual(calls, [
+            ("modify", "/d3/f1.txt"), ("create", "/d4/new.txt"),
+            ("delete", "/d5/f0.txt"),
+        ])
+        self.assertEqual(self.api.actions["changes"], 2)  # page_size=2
+        self.assertEqual(self.rd._cursor, 3)
+
+        calls, listings = yield self.listed()
+        self.assertEqual((calls, listings), ([], 0))
+
+    @defer.inlineCallbacks
+    def test_changes_during_listing(self):
+        cursor = self.rd._current_cursor
+        def racing_cursor():
+            d = cursor()
+            self.change("d0/f0.txt", b"racing")  # seen by the listing
+            return d
+        self.rd._current_cursor = racing_cursor
+
+        yield self.listed()
+        calls, _ = yield self.listed()
+        self.assertEqual(calls, [], "repeated change reported twice")
+
+    @defer.inlineCallbacks
+    def test_invalidated_cursor(self):
+        yield self.listed()
+        self.change("d1/new.txt")
+        self.api.feeds["ws"].reset()
+
+        calls, listings = yield self.listed()
+        self.assertEqual(listings, 21)
+        self.assertIn(("create", "/d1/new.txt"), calls)
+        self.assertEqual(self.rd.listings, 2)
+
+    @defer.inlineCallbacks
+    def test_long_poll(self):
+        from twisted.internet import reactor
+
+        yield self.listed()
+        self.rd.long_poll = 5
+        reactor.callLater(.05, self.change, "d2/new.txt")
+
+        calls, listings = yield self.listed()
+        self.assertEqual(calls, [("create", "/d2/new.txt")])
+        self.assertEqual(self.api.actions["changes"], 1)
+
+    @defer.inlineCallbacks
+    def test_stop_during_long_poll(self):
+        yield self.listed()
+        self.rd.long_poll = 30
+        self.rd.startService()  # which refreshes at once
+        self.assertIsNotNone(self.rd._refreshing)
+        yield self.rd.stopService()
+        self.assertIsNone(self.rd._refreshing)
+
+    @defer.inlineCallbacks
+    def test_selection(self):
+        self.rd.selection = Selection(include=["/d1"])
+        yield self.listed()
+        self.change("d1/new.txt")
+        self.change("d2/new.txt")
+
+        calls, _ = yield self.listed()
+        self.assertEqual(calls, [("create", "/d1/new.txt")])
+
+    @defer.inlineCallbacks
+    def test_no_feed(self):
+        self.api.feed = False
+        yield self.listed()
+        self.change("d1/new.txt")
+        calls, listings = yield self.listed()
+        self.assertIn(("create", "/d1/new.txt"), calls)
+        self.assertEqual(listings, 21)
+        self.assertEqual(self.api.actions["changes"], 0)
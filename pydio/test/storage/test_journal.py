@@ -0,0 +1,157 @@
+#! /usr/bin/env python
+from twisted.trial.unittest import TestCase
+
+import os
+import os.path as osp
+from shutil import rmtree
+from tempfile import mkdtemp
+
+from twisted.internet import defer, task
+
+from watchdog import events
+
+from pydio.storage import journal
+from pydio.storage.journal import Journal
+
+CREATED = events.FileCreatedEvent("/ws/a.txt")
+MODIFIED = events.FileModifiedEvent("/ws/b.txt")
+MOVED = events.DirMovedEvent("/ws/c", "/ws/d")
+
+
+class TestRecords(TestCase):
+    def test_roundtrip(self):
+        data = b"".join([journal.encode(1, CREATED), journal.encode(2, MOVED),
+                         journal.encode(1)])
+        self.assertEqual(list(journal.records(data)),
+                         [(1, CREATED), (2, MOVED), (1, None)])
+
+    def test_surrogates(self):
+        ev = events.FileCreatedEvent("/ws/caf\udce9")
+        data = journal.encode(1, ev)
+        self.assertEqual(list(journal.records(data)), [(1, ev)])
+
+    def test_torn(self):
+        data = journal.encode(1, CREATED) + journal.encode(2, MODIFIED)[:-1]
+        self.assertEqual(list(journal.records(data)), [(1, CREATED)])
+
+    def test_corrupt(self):
+        second = bytearray(journal.encode(2, MODIFIED))
+        second[-2] ^= 1
+        data = journal.encode(1, CREATED) + bytes(second) + journal.encode(3)
+        self.assertEqual(list(journal.records(data)), [(1, CREATED)])
+
+
+class TestJournal(TestCase):
+    def setUp(self):
+        self.dir = mkdtemp()
+        self.addCleanup(rmtree, self.dir)
+        self.path = osp.join(self.dir, "journal")
+        self.clock = task.Clock()
+        self.j = self.open()
+
+    def open(self, **kw):
+        j = Journal(self.path, clock=self.clock, **kw)
+        self.addCleanup(j.close)
+        return j
+
+    def size(self):
+        return osp.getsize(self.path)
+
+    def test_append(self):
+        self.assertEqual(self.j.append(CREATED), 1)
+        self.assertEqual(self.j.append(MODIFIED), 2)
+        self.assertEqual(self.j.pending(), [(1, CREATED), (2, MODIFIED)])
+        self.assertEqual(self.size(), self.j.stats()["size"])
+
+    def test_commit(self):
+        self.j.append(CREATED)
+        self.j.append(MODIFIED)
+        size = self.size()
+        self.j.commit(1)
+        self.assertEqual(self.j.pending(), [(2, MODIFIED)])
+        self.assertTrue(self.size() > size, "no commit record")
+
+        self.j.commit(2)
+        self.j.commit(2)
+        self.assertEqual(self.size(), 0, "not truncated")
+        self.assertEqual(self.j.stats()["committed"], 2)
+
+    def test_recover(self):
+        for ev in (CREATED, MODIFIED, MOVED):
+            self.j.append(ev)
+        self.j.commit(2)
+
+        # no close: the process crashed
+        recovered = self.open()
+        self.assertEqual(recovered.pending(), [(1, CREATED), (3, MOVED)])
+        self.assertEqual(recovered.append(CREATED), 4)
+        self.assertEqual(
+            self.size(),
+            len(journal.encode(1, CREATED) + journal.encode(3, MOVED) +
+                journal.encode(4, CREATED)),
+            "the committed event was not dropped",
+        )
+
+    def test_recover_torn(self):
+        self.j.append(CREATED)
+        with open(self.path, "ab") as f:
+            f.write(journal.encode(2, MODIFIED)[:5])
+
+        recovered = self.open()
+        recovered.append(MOVED)
+        self.assertEqual(self.open().pending(), [(1, CREATED), (2, MOVED)])
+
+    def test_recover_empty(self):
+        self.j.append(CREATED)
+        self.j.commit(1)
+        self.assertEqual(self.open().pending(), [])
+
+    def test_intact(self):
+        self.assertFalse(self.j.intact, "a missing segment is intact")
+        self.j.append(CREATED)
+        self.j.append(MODIFIED)
+        self.j.commit(1)
+        self.assertTrue(self.open().intact)
+
+        with open(self.path, "ab") as f:
+            f.write(journal.encode(3, MOVED)[:5])
+        self.assertFalse(self.open().intact, "a torn segment is intact")
+        self.assertTrue(self.open().intact, "not rewritten")
+
+    @defer.inlineCallbacks
+    def test_sync(self):
+        yield self.j.sync()
+        self.assertEqual(self.j.syncs, 0, "nothing to sync")
+        self.j.append(CREATED)
+        self.j.append(MODIFIED)
+        yield self.j.sync()
+        yield self.j.sync()
+        self.assertEqual(self.j.syncs, 1)
+
+    @defer.inlineCallbacks
+    def test_group_commit(self):
+        self.j.startService()
+        self.j.append(CREATED)
+        self.j.append(MODIFIED)
+        self.assertEqual(self.j.syncs, 0)
+        self.clock.advance(self.j.sync_interval)
+        yield self.j._syncing
+        self.assertEqual(self.j.syncs, 1)
+
+        self.j.append(MOVED)
+        yield self.j.stopService()
+        self.assertEqual(self.j.syncs, 2)
+
+    @defer.inlineCallbacks
+    def test_compact(self):
+        j = self.open(max_size=1000)
+        j.append(CREATED)
+        for i in range(100):
+            j.commit(j.append(MODIFIED))
+        self.assertTrue(self.size() > 1000)
+
+        yield j.sync()
+        self.assertEqual(self.size(), len(journal.encode(1, CREATED)))
+        j.append(MOVED)
+        self.assertEqual(self.open().pending(), [(1, CREATED), (102, MOVED)])
+        self.assertFalse(os.path.exists(self.path + ".tmp"))
@@ -0,0 +1,147 @@
+#! /usr/bin/env python
+from twisted.trial.unittest import TestCase
+
+import os
+import errno
+import os.path as osp
+from hashlib import md5
+from shutil import rmtree
+from tempfile import mkdtemp
+
+from twisted.internet import defer
+
+from pydio.storage import localcopy
+
+CONTENT = os.urandom(3 << 20)
+
+
+class CopyTestCase(TestCase):
+    def setUp(self):
+        self.dir = mkdtemp()
+        self.src = osp.join(self.dir, "src.bin")
+        with open(self.src, "wb") as f:
+            f.write(CONTENT)
+        os.chmod(self.src, 0o640)
+        os.utime(self.src, ns=(1, 1234567890123456789))
+        self.dst = osp.join(self.dir, "dst.bin")
+
+        self.addCleanup(localcopy._unsupported.clear)
+
+    def tearDown(self):
+        rmtree(self.dir)
+
+    def assertCopied(self, path):
+        with open(path, "rb") as f:
+            self.assertEqual(f.read(), CONTENT)
+        st = os.stat(path)
+        self.assertEqual(st.st_mtime_ns, 1234567890123456789)
+        self.assertEqual(st.st_mode & 0o777, 0o640)
+        self.assertFalse(osp.exists(path + localcopy.PARTIAL_SUFFIX))
+
+
+class TestCopyFile(CopyTestCase):
+    def check_method(self, name):
+        methods = [(n, m) for n, m in localcopy.METHODS
+                   if n in (name, "read_write")]
+        if not any(n == name for n, _ in methods):
+            raise self.skipTest("{0} is not available".format(name))
+        used, st = localcopy.copy_file(self.src, self.dst, methods)
+        self.assertCopied(self.dst)
+        self.assertEqual(st.st_size, len(CONTENT))
+        return used
+
+    def test_default(self):
+        self.assertIn(self.check_method("reflink"), dict(localcopy.METHODS))
+
+    def test_copy_file_range(self):
+        self.check_method("copy_file_range")
+
+    def test_sendfile(self):
+        self.check_method("sendfile")
+
+    def test_read_write(self):
+        self.assertEqual(self.check_method("read_write"), "read_write")
+
+    def test_empty(self):
+        open(self.src, "wb").close()
+        localcopy.copy_file(self.src, self.dst)
+        self.assertEqual(osp.getsize(self.dst), 0)
+
+    def test_unsupported_falls_back(self):
+        calls = []
+
+        def unsupported(src, dst, size):
+            calls.append(size)
+            os.write(dst, b"garbage")
+            raise OSError(errno.EXDEV, "cross-device")
+
+        methods = [("fake", unsupported), ("read_write", localcopy.read_write)]
+        for _ in range(2):
+            used, _ = localcopy.copy_file(self.src, self.dst, methods)
+            self.assertEqual(used, "read_write")
+            self.assertCopied(self.dst)
+        self.assertEqual(calls, [len(CONTENT)], "not remembered")
+
+    def test_failure_cleans_up(self):
+        def failing(src, dst, size):
+            os.write(dst, b"partial")
+            raise OSError(errno.EIO, "I/O error")
+
+        self.assertRaises(OSError, localcopy.copy_file, self.src, self.dst,
+                          [("failing", failing)])
+        self.assertEqual(sorted(os.listdir(self.dir)), ["src.bin"])
+
+
+class DummyDirectory:
+    def __init__(self, path):
+        self.path = path
+        self.expected = []
+
+    def relative_path(self, path):
+        return "/" + osp.relpath(path, self.path)
+
+    def absolute_path(self, path):
+        return osp.join(self.path, path.lstrip("/"))
+
+    def expect(self, path, bytesize, mtime, digests):
+        self.expected.append((path, bytesize, mtime, digests))
+
+
+class TestLocalTransfers(CopyTestCase):
+    def setUp(self):
+        super().setUp()
+        self.local = DummyDirectory(self.dir)
+        self.remote = DummyDirectory(mkdtemp())
+        self.addCleanup(rmtree, self.remote.path)
+        self.transfers = localcopy.LocalTransfers(self.local, self.remote)
+
+        st = os.stat(self.src)
+        self.inode = dict(node_path=self.src, bytesize=st.st_size,
+                          mtime=st.st_mtime, md5=md5(CONTENT).hexdigest())
+
+    @defer.inlineCallbacks
+    def test_upload(self):
+        yield self.transfers.upload_node(self.inode, "/sub/dir/src.bin")
+        dst = osp.join(self.remote.path, "sub/dir/src.bin")
+        self.assertCopied(dst)
+        self.assertEqual(self.remote.expected, [(
+            dst, len(CONTENT), self.inode["mtime"],
+            dict(md5=self.inode["md5"]),
+        )])
+        self.assertEqual(self.transfers.bytes_copied, len(CONTENT))
+        self.assertEqual(sum(self.transfers.copies.values()), 1)
+
+    @defer.inlineCallbacks
+    def test_download(self):
+        self.inode["node_path"] = osp.join(self.remote.path, "src.bin")
+        os.rename(self.src, self.inode["node_path"])
+        yield self.transfers.download_node(self.inode, self.dst)
+        self.assertCopied(self.dst)
+        self.assertEqual(self.local.expected[0][0], self.dst)
+
+    @defer.inlineCallbacks
+    def test_directory(self):
+        inode = dict(node_path=self.dir, md5=localcopy.MD5_DIRECTORY)
+        yield self.transfers.upload_node(inode, "/a/b")
+        self.assertTrue(osp.isdir(osp.join(self.remote.path, "a/b")))
+        self.assertEqual(self.remote.expected, [])
@@ -0,0 +1,465 @@
+#! /usr/bin/env python
+import os
+import os.path as osp
+from hashlib import md5
+
+from twisted.internet import defer
+
+from pydio.engine import sqlite
+from pydio.util import ratelimit
+from pydio.util.adbapi import ConnectionManager
+from pydio.storage import transfer
+from pydio.test.storage.test_http import FakeServerTestCase
+
+CONTENT = os.urandom(10000)
+CHECKSUM = md5(CONTENT).hexdigest()
+
+
+class TransferTestCase(FakeServerTestCase):
+
+    drop_rate = 0.
+
+    @defer.inlineCallbacks
+    def setUp(self):
+        super().setUp()
+        self.api.drop_rate = self.drop_rate
+        self.api._rand.seed(4)
+
+        self.db = ConnectionManager(":memory:")
+        with open(sqlite.SQL_INIT_FILE) as f:
+            yield self.db.runInteraction(lambda c, s: c.executescript(s),
+                                         f.read())
+
+        self.progress = sqlite.TransferLog(self.db)
+        self.pipeline = transfer.TransferPipeline(
+            self.client, self.progress, chunk_size=1000, backoff=0.,
+            max_retries=50,
+        )
+
+        self.local = osp.join(self.root, "local")
+        os.mkdir(self.local)
+
+    @defer.inlineCallbacks
+    def tearDown(self):
+        yield super().tearDown()
+        self.db.close()
+
+    def write_local(self, name, content=CONTENT):
+        path = osp.join(self.local, name)
+        with open(path, "wb") as f:
+            f.write(content)
+        return path
+
+    def read(self, path):
+        with open(path, "rb") as f:
+            return f.read()
+
+    def spy(self, method):
+        calls = []
+        fn = getattr(self.client, method)
+
+        def wrapper(path, offset, *a):
+            calls.append(offset)
+            return fn(path, offset, *a)
+
+        setattr(self.client, method, wrapper)
+        return calls
+
+
+class TestTransferPipeline(TransferTestCase):
+    @defer.inlineCallbacks
+    def test_upload(self):
+        path = self.write_local("foo.bin")
+        offsets = self.spy("upload_chunk")
+
+        resp = yield self.pipeline.upload(path, "/foo.bin", CHECKSUM)
+        self.assertEqual(resp["md5"], CHECKSUM)
+        self.assertEqual(len(offsets), 10)
+        self.assertEqual(self.read(osp.join(self.ws, "foo.bin")), CONTENT)
+
+        saved = yield self.progress.get("/foo.bin", transfer.UPLOAD)
+        self.assertIsNone(saved, "progress was not cleared")
+
+    @defer.inlineCallbacks
+    def test_upload_reuses_buffer(self):
+        for name in ("a.bin", "b.bin"):
+            path = self.write_local(name)
+            yield self.pipeline.upload(path, "/" + name, CHECKSUM)
+            self.assertEqual(self.read(osp.join(self.ws, name)), CONTENT)
+        stats = self.pipeline.buffers.stats()
+        self.assertEqual((stats["allocated"], stats["reused"]), (1, 1))
+
+    @defer.inlineCallbacks
+    def test_upload_empty(self):
+        path = self.write_local("empty", b"")
+        yield self.pipeline.upload(path, "/empty", md5(b"").hexdigest())
+        self.assertEqual(self.read(osp.join(self.ws, "empty")), b"")
+
+    @defer.inlineCallbacks
+    def test_download(self):
+        self.write("foo.bin", CONTENT)
+        dest = osp.join(self.local, "sub", "foo.bin")
+        offsets = self.spy("download_range")
+
+        yield self.pipeline.download("/foo.bin", dest, CHECKSUM, len(CONTENT))
+        self.assertEqual(len(offsets), 10)
+        self.assertEqual(self.read(dest), CONTENT)
+        self.assertFalse(osp.exists(dest + transfer.PARTIAL_SUFFIX))
+
+    @defer.inlineCallbacks
+    def test_resume_upload(self):
+        path = self.write_local("foo.bin")
+        for offset in (0, 1000, 2000):
+            yield self.client.upload_chunk(
+                "/foo.bin", offset, len(CONTENT), CONTENT[offset:offset + 1000],
+            )
+        yield self.progress.save("/foo.bin", transfer.UPLOAD, 3000,
+                                 len(CONTENT), CHECKSUM)
+
+        offsets = self.spy("upload_chunk")
+        yield self.pipeline.upload(path, "/foo.bin", CHECKSUM)
+        self.assertEqual(offsets[0], 3000)
+        self.assertEqual(self.read(osp.join(self.ws, "foo.bin")), CONTENT)
+
+    @defer.inlineCallbacks
+    def test_resume_upload_after_restart(self):
+        path = self.write_local("foo.bin")
+        db_file = osp.join(self.root, "db", "local.sqlite")
+        engine = sqlite.Engine(db_file)
+        yield engine._init_db()
+        for offset in (0, 1000, 2000):
+            yield self.client.upload_chunk(
+                "/foo.bin", offset, len(CONTENT), CONTENT[offset:offset + 1000],
+            )
+        yield engine.transfers.save("/foo.bin", transfer.UPLOAD, 3000,
+                                    len(CONTENT), CHECKSUM)
+        yield engine._db.close()
+
+        engine = sqlite.Engine(db_file)  # the daemon restarted
+        yield engine._init_db()
+        self.addCleanup(engine._db.close)
+        pipeline = transfer.TransferPipeline(
+            self.client, engine.transfers, chunk_size=1000, backoff=0.,
+        )
+
+        offsets = self.spy("upload_chunk")
+        yield pipeline.upload(path, "/foo.bin", CHECKSUM)
+        self.assertEqual(offsets[0], 3000)
+        self.assertEqual(self.read(osp.join(self.ws, "foo.bin")), CONTENT)
+        saved = yield engine.transfers.get("/foo.bin", transfer.UPLOAD)
+        self.assertIsNone(saved, "progress was not cleared")
+
+    @defer.inlineCallbacks
+    def test_restart_changed_upload(self):
+        path = self.write_local("foo.bin")
+        yield self.progress.save("/foo.bin", transfer.UPLOAD, 3000,
+                                 len(CONTENT), "stale checksum")
+
+        offsets = self.spy("upload_chunk")
+        yield self.pipeline.upload(path, "/foo.bin", CHECKSUM)
+        self.assertEqual(offsets[0], 0)
+
+    @defer.inlineCallbacks
+    def test_resume_download(self):
+        self.write("foo.bin", CONTENT)
+        dest = osp.join(self.local, "foo.bin")
+        with open(dest + transfer.PARTIAL_SUFFIX, "wb") as f:
+            f.write(CONTENT[:4000])
+        yield self.progress.save(dest, transfer.DOWNLOAD, 4000,
+                                 len(CONTENT), CHECKSUM)
+
+        offsets = self.spy("download_range")
+        yield self.pipeline.download("/foo.bin", dest, CHECKSUM, len(CONTENT))
+        self.assertEqual(offsets[0], 4000)
+        self.assertEqual(self.read(dest), CONTENT)
+
+    @defer.inlineCallbacks
+    def test_resume_corrupt_download(self):
+        self.write("foo.bin", CONTENT)
+        dest = osp.join(self.local, "foo.bin")
+        with open(dest + transfer.PARTIAL_SUFFIX, "wb") as f:
+            f.write(b"x" * 4000)  # e.g. overwritten since it was saved
+        yield self.progress.save(dest, transfer.DOWNLOAD, 4000,
+                                 len(CONTENT), CHECKSUM)
+
+        offsets = self.spy("download_range")
+        yield self.pipeline.download("/foo.bin", dest, CHECKSUM, len(CONTENT))
+        self.assertEqual(offsets[0], 4000)
+        self.assertIn(0, offsets, "the download was not restarted")
+        self.assertEqual(self.read(dest), CONTENT)
+        saved = yield self.progress.get(dest, transfer.DOWNLOAD)
+        self.assertIsNone(saved)
+
+    @defer.inlineCallbacks
+    def test_download_missing(self):
+        dest = osp.join(self.local, "nope.bin")
+        d = self.pipeline.download("/nope.bin", dest, CHECKSUM, 10)
+        yield self.assertFailure(d, transfer.RequestError)
+
+    @defer.inlineCallbacks
+    def test_upload_node_skips_identical(self):
+        self.write("foo.bin", CONTENT)
+        path = self.write_local("foo.bin")
+        offsets = self.spy("upload_chunk")
+
+        inode = dict(node_path=path, md5=CHECKSUM, bytesize=len(CONTENT))
+        yield self.pipeline.upload_node(inode, "/foo.bin")
+        self.assertFalse(offsets, "identical content was uploaded")
+
+    @defer.inlineCallbacks
+    def test_download_node_dir(self):
+        inode = dict(node_path="/dir", md5=transfer.MD5_DIRECTORY, bytesize=0)
+        yield self.pipeline.download_node(inode, osp.join(self.local, "dir"))
+        self.assertTrue(osp.isdir(osp.join(self.local, "dir")))
+
+
+class TestDeltaUpload(TransferTestCase):
+    @defer.inlineCallbacks
+    def setUp(self):
+        yield super().setUp()
+        self.pipeline.signatures = sqlite.SignatureStore(self.db)
+        self.pipeline.block_size = 512
+        self.pipeline.min_delta_size = 0
+
+        self.path = self.write_local("foo.bin")
+        self.inode = dict(node_path=self.path, md5=CHECKSUM,
+                          bytesize=len(CONTENT))
+        yield sqlite.StateManager(self.db).create(self.inode)
+        yield self.pipeline.upload_node(self.inode, "/foo.bin")
+
+    @defer.inlineCallbacks
+    def modify(self, content):
+        self.write_local("foo.bin", content)
+        self.inode.update(md5=md5(content).hexdigest(), bytesize=len(content))
+        self.pipeline.bytes_sent = 0
+        yield self.pipeline.upload_node(self.inode, "/foo.bin")
+        self.assertEqual(self.read(osp.join(self.ws, "foo.bin")), content)
+
+    @defer.inlineCallbacks
+    def test_signature_saved(self):
+        sig = yield self.pipeline.signatures.get(self.path)
+        self.assertEqual(sig.md5, CHECKSUM)
+
+    @defer.inlineCallbacks
+    def test_indexed_signature_reused(self):
+        """The signature computed by the hasher spares reading the file"""
+        content = CONTENT + b"appended"
+        self.inode.update(block_size=512, blocks=b"indexed")
+        self.inode["md5"] = md5(content).hexdigest()
+        yield sqlite.StateManager(self.db).modify(self.inode)
+
+        yield self.modify(content)
+        sig = yield self.pipeline.signatures.get(self.path)
+        self.assertEqual(sig.blocks, b"indexed")
+
+    @defer.inlineCallbacks
+    def test_stale_indexed_signature(self):
+        self.inode.update(block_size=512, blocks=b"stale")
+        yield sqlite.StateManager(self.db).modify(self.inode)
+
+        yield self.modify(CONTENT + b"appended")
+        sig = yield self.pipeline.signatures.get(self.path)
+        self.assertNotEqual(sig.blocks, b"stale")
+        self.assertEqual(sig.md5, self.inode["md5"])
+
+    @defer.inlineCallbacks
+    def test_in_place_edit(self):
+        edited = bytearray(CONTENT)
+        edited[5000] ^= 0xff
+        yield self.modify(bytes(edited))
+        self.assertTrue(self.pipeline.bytes_sent < 1000,
+                        "sent {0} bytes".format(self.pipeline.bytes_sent))
+
+        sig = yield self.pipeline.signatures.get(self.path)
+        self.assertEqual(sig.md5, self.inode["md5"], "signature is stale")
+
+    @defer.inlineCallbacks
+    def test_insert_at_start(self):
+        yield self.modify(b"inserted" + CONTENT)
+        self.assertTrue(self.pipeline.bytes_sent < 100)
+
+    @defer.inlineCallbacks
+    def test_remote_diverged(self):
+        """Deltas against a basis the server no longer holds are not sent"""
+        self.write("foo.bin", b"changed on the server")
+        yield self.modify(CONTENT + b"appended")
+        self.assertEqual(self.pipeline.bytes_sent, len(CONTENT) + 8)
+
+    @defer.inlineCallbacks
+    def test_rewrite(self):
+        """Deltas that are not worth sending fall back to a full upload"""
+        content = os.urandom(len(CONTENT))
+        yield self.modify(content)
+        self.assertEqual(self.pipeline.bytes_sent, len(content))
+
+
+class TestDedupUpload(TransferTestCase):
+    @defer.inlineCallbacks
+    def setUp(self):
+        yield super().setUp()
+        self.pipeline.dedup = sqlite.ChunkIndex(self.db)
+        self.pipeline.to_remote = lambda p: "/" + osp.basename(p)
+
+        self.original = self.write_local("original.bin")
+        yield sqlite.StateManager(self.db).create(
+            dict(node_path=self.original, md5=CHECKSUM),
+        )
+        yield self.pipeline.upload(self.original, "/original.bin", CHECKSUM)
+        yield self.db.runOperation("UPDATE ajxp_node_status SET status='DONE';")
+        self.pipeline.bytes_sent = 0
+
+        path = self.write_local("copy.bin")
+        self.inode = dict(node_path=path, md5=CHECKSUM, bytesize=len(CONTENT))
+
+    @defer.inlineCallbacks
+    def test_copy(self):
+        yield self.pipeline.upload_node(self.inode, "/copy.bin")
+        self.assertEqual(self.pipeline.bytes_sent, 0)
+        self.assertEqual(self.read(osp.join(self.ws, "copy.bin")), CONTENT)
+
+    @defer.inlineCallbacks
+    def test_diverged(self):
+        self.write("original.bin", b"changed on the server")
+        yield self.pipeline.upload_node(self.inode, "/copy.bin")
+        self.assertEqual(self.pipeline.bytes_sent, len(CONTENT))
+        self.assertEqual(self.read(osp.join(self.ws, "copy.bin")), CONTENT)
+
+    @defer.inlineCallbacks
+    def test_source_missing(self):
+        os.remove(osp.join(self.ws, "original.bin"))
+        yield self.pipeline.upload_node(self.inode, "/copy.bin")
+        self.assertEqual(self.pipeline.bytes_sent, len(CONTENT))
+
+
+class TestCompressedTransfer(TransferTestCase):
+
+    TEXT = b"".join(
+        "{0},{1},{2:.2f}\n".format(i, "row", i * .37).encode()
+        for i in range(2000)
+    )
+
+    @defer.inlineCallbacks
+    def test_upload_text(self):
+        path = self.write_local("data.csv", self.TEXT)
+        yield self.pipeline.upload(path, "/data.csv", md5(self.TEXT).hexdigest())
+
+        self.assertEqual(self.read(osp.join(self.ws, "data.csv")), self.TEXT)
+        self.assertTrue(self.client.compression_stats.ratio() > 2)
+
+    @defer.inlineCallbacks
+    def test_skip_compressed_extension(self):
+        path = self.write_local("photo.jpg", self.TEXT)
+        yield self.pipeline.upload(path, "/photo.jpg")
+        self.assertEqual(self.read(osp.join(self.ws, "photo.jpg")), self.TEXT)
+        self.assertFalse(self.client.compression_stats.raw)
+
+    @defer.inlineCallbacks
+    def test_skip_random(self):
+        path = self.write_local("foo.bin")
+        yield self.pipeline.upload(path, "/foo.bin", CHECKSUM)
+        self.assertFalse(self.client.compression_stats.raw)
+
+    @defer.inlineCallbacks
+    def test_download_text(self):
+        self.write("data.csv", self.TEXT)
+        dest = osp.join(self.local, "data.csv")
+        yield self.pipeline.download("/data.csv", dest)
+        self.assertEqual(self.read(dest), self.TEXT)
+        self.assertTrue(self.client.compression_stats.ratio() > 2)
+
+    @defer.inlineCallbacks
+    def test_server_without_compression(self):
+        self.api.encodings = ()
+        path = self.write_local("data.csv", self.TEXT)
+        yield self.pipeline.upload(path, "/data.csv")
+        self.assertEqual(self.read(osp.join(self.ws, "data.csv")), self.TEXT)
+        self.assertFalse(self.client.compression_stats.raw)
+
+
+class RecordingGovernor:
+    def __init__(self):
+        self.consumed = {}
+
+    def consume(self, resource, n=1):
+        self.consumed[resource] = self.consumed.get(resource, 0) + n
+        return defer.succeed(None)
+
+
+class TestGovernedTransfer(TransferTestCase):
+    @defer.inlineCallbacks
+    def setUp(self):
+        yield super().setUp()
+        self.pipeline.governor = RecordingGovernor()
+
+    @defer.inlineCallbacks
+    def test_upload(self):
+        path = self.write_local("foo.bin")
+        yield self.pipeline.upload(path, "/foo.bin", CHECKSUM)
+        self.assertEqual(self.pipeline.governor.consumed, {
+            ratelimit.OPENS: 1,
+            ratelimit.READ: len(CONTENT),
+            ratelimit.UPLOAD: len(CONTENT),
+        })
+
+    @defer.inlineCallbacks
+    def test_download(self):
+        self.write("foo.bin", CONTENT)
+        dest = osp.join(self.local, "foo.bin")
+        yield self.pipeline.download("/foo.bin", dest, CHECKSUM, len(CONTENT))
+        self.assertEqual(self.pipeline.governor.consumed, {
+            ratelimit.OPENS: 1, ratelimit.DOWNLOAD: len(CONTENT),
+        })
+
+
+class TestPrioritizedTransfer(TransferTestCase):
+    @defer.inlineCallbacks
+    def test_small_first(self):
+        self.pipeline.scheduler.slots = 1
+        large = self.write_local("large.bin", CONTENT * 10)
+        small = self.write_local("small.txt", b"x")
+
+        order = []
+        yield self.pipeline.scheduler.acquire("/busy")
+        sent = [
+            self.pipeline.upload(
+                p, "/" + osp.basename(p), bytesize=osp.getsize(p),
+            ).addCallback(lambda _, p=p: order.append(osp.basename(p)))
+            for p in (large, small)
+        ]
+        self.pipeline.scheduler.release()
+
+        yield defer.gatherResults(sent)
+        self.assertEqual(order, ["small.txt", "large.bin"])
+        stats = self.pipeline.scheduler.stats()["classes"]["normal"]
+        self.assertEqual(stats["served"], 3)
+
+
+class TestUnreliableLink(TransferTestCase):
+
+    drop_rate = .3
+
+    @defer.inlineCallbacks
+    def test_upload(self):
+        path = self.write_local("foo.bin")
+        yield self.pipeline.upload(path, "/foo.bin", CHECKSUM)
+        self.assertTrue(self.api.dropped, "no requests were dropped")
+        self.assertEqual(self.read(osp.join(self.ws, "foo.bin")), CONTENT)
+
+    @defer.inlineCallbacks
+    def test_download(self):
+        self.write("foo.bin", CONTENT)
+        dest = osp.join(self.local, "foo.bin")
+        yield self.pipeline.download("/foo.bin", dest, CHECKSUM, len(CONTENT))
+        self.assertTrue(self.api.dropped, "no requests were dropped")
+        self.assertEqual(self.read(dest), CONTENT)
+
+    @defer.inlineCallbacks
+    def test_concurrent(self):
+        paths = [self.write_local("f{0}".format(i)) for i in range(4)]
+        yield defer.gatherResults([
+            self.pipeline.upload(p, "/" + osp.basename(p), CHECKSUM)
+            for p in paths
+        ])
+        for p in paths:
+            self.assertEqual(self.read(osp.join(self.ws, osp.basename(p))),
+                             CONTENT)
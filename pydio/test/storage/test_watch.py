@@ -0,0 +1,289 @@
+#! /usr/bin/env python
+from twisted.trial.unittest import TestCase
+
+import os
+import os.path as osp
+from shutil import rmtree
+from tempfile import mkdtemp
+
+from twisted.internet import defer, task
+
+from watchdog import events
+
+from pydio.storage import watch
+from pydio.util.ignore import IGNORE_FILE
+
+
+class RecordingHandler:
+    """Records the events a HybridWatcher reports"""
+
+    def __init__(self):
+        self.events = []
+        self.waiting = None
+        self.reconciled = []
+
+    def filter_path(self, path, is_dir=False):
+        return not path.endswith(".ignored")
+
+    def handle(self, ev):
+        self.events.append(ev)
+        if self.waiting is not None:
+            d, self.waiting = self.waiting, None
+            d.callback(ev)
+        return defer.succeed(None)
+
+    dispatch = handle
+
+    def reconcile(self, deep=False):
+        self.reconciled.append(deep)
+        return defer.succeed({})
+
+    def next_event(self):
+        self.waiting = defer.Deferred()
+        return self.waiting
+
+
+class TestHybridWatcher(TestCase):
+    def setUp(self):
+        self.ws = mkdtemp()
+        for d in ("a", "a/aa", "a/aa/aaa", "b", "c.ignored"):
+            os.mkdir(osp.join(self.ws, d))
+
+        self.clock = task.Clock()
+        self.handler = RecordingHandler()
+        self.w = watch.HybridWatcher(
+            self.handler, self.ws, budget=0, min_interval=1.,
+            max_interval=8., clock=self.clock,
+        )
+
+    def tearDown(self):
+        rmtree(self.ws)
+
+    def path(self, name):
+        return osp.join(self.ws, name)
+
+    @defer.inlineCallbacks
+    def test_discover(self):
+        yield self.w.discover(self.ws, hot=False)
+        self.assertEqual(
+            {p: d.depth for p, d in self.w.dirs.items()},
+            {self.ws: 0, self.path("a"): 1, self.path("a/aa"): 2,
+             self.path("a/aa/aaa"): 3, self.path("b"): 1},
+        )
+        for d in self.w.dirs.values():
+            self.assertEqual(d.interval, 8.)
+            self.assertTrue(0 <= d.due <= 8.)
+
+    @defer.inlineCallbacks
+    def test_poll_backoff(self):
+        yield self.w.discover(self.ws, hot=True)
+        b = self.w.dirs[self.path("b")]
+        self.assertEqual(b.interval, 1.)
+
+        for interval in (2., 4., 8., 8.):
+            self.clock.advance(b.interval)
+            yield self.w.poll()
+            self.assertEqual(b.interval, interval)
+        self.assertEqual(self.handler.events, [])
+        self.assertEqual(self.w.polls, 20)
+
+    @defer.inlineCallbacks
+    def test_poll_change(self):
+        yield self.w.discover(self.ws, hot=True)
+        b = self.w.dirs[self.path("b")]
+        self.clock.advance(1)
+        yield self.w.poll()
+
+        b.mtime -= 1  # as if an entry was created since the last poll
+        os.mkdir(self.path("b/new"))
+        self.clock.advance(b.interval)
+        yield self.w.poll()
+
+        self.assertEqual(self.handler.events,
+                         [events.DirModifiedEvent(self.path("b"))])
+        self.assertEqual(b.interval, 1.)
+        self.assertEqual(self.w.poll_changes, 1)
+        self.assertIn(self.path("b/new"), self.w.dirs, "subdir not found")
+
+    @defer.inlineCallbacks
+    def test_poll_removed(self):
+        yield self.w.discover(self.ws, hot=True)
+        rmtree(self.path("a"))
+        self.clock.advance(1)
+        yield self.w.poll()
+
+        self.assertEqual(sorted(self.w.dirs), [self.ws, self.path("b")])
+        self.assertIn(events.DirModifiedEvent(self.ws), self.handler.events)
+
+    @defer.inlineCallbacks
+    def test_ignored_after_discovery(self):
+        yield self.w.discover(self.ws, hot=True)
+        aa = self.path("a/aa")
+        self.handler.filter_path = lambda path, is_dir=False: path != aa
+        yield self.w._changed(aa)
+        self.assertEqual(sorted(self.w.dirs),
+                         [self.ws, self.path("a"), self.path("b")])
+        self.assertEqual(self.handler.events, [])
+
+    @defer.inlineCallbacks
+    def test_stats(self):
+        yield self.w.discover(self.ws, hot=True)
+        stats = self.w.stats()
+        self.assertEqual(stats["directories"], 5)
+        self.assertEqual(stats["watched"], 0)
+        self.assertEqual(stats["coverage"], 0.)
+        self.assertEqual(stats["poll_rate"], 5.)
+
+
+class TestHybridWatcherInotify(TestCase):
+    if watch.IN is None:
+        skip = "inotify is not available"
+
+    def setUp(self):
+        self.ws = mkdtemp()
+        for d in ("a", "a/aa", "a/aa/aaa", "b"):
+            os.mkdir(osp.join(self.ws, d))
+
+        self.handler = RecordingHandler()
+        self.w = watch.HybridWatcher(self.handler, self.ws, budget=3)
+        return self.w.startService()
+
+    @defer.inlineCallbacks
+    def tearDown(self):
+        yield self.w.stopService()
+        rmtree(self.ws)
+
+    def path(self, name):
+        return osp.join(self.ws, name)
+
+    def watched(self):
+        return sorted(p for p, d in self.w.dirs.items() if d.watched)
+
+    def test_shallowest_first(self):
+        self.assertEqual(self.watched(),
+                         [self.ws, self.path("a"), self.path("b")])
+        stats = self.w.stats()
+        self.assertEqual(stats["coverage"], 3 / 5)
+        self.assertEqual(stats["promotions"], 2)
+
+    @defer.inlineCallbacks
+    def test_inotify_create(self):
+        d = self.handler.next_event()
+        with open(self.path("b/new.txt"), "w"):
+            pass
+        ev = yield d
+        self.assertEqual(ev, events.DirModifiedEvent(self.path("b")))
+        self.assertTrue(self.w.inotify_events > 0)
+
+    @defer.inlineCallbacks
+    def test_promote_active(self):
+        self.w.dirs[self.path("a/aa/aaa")].score = 10.
+        yield self.w.rebalance()
+        self.assertEqual(self.watched(),
+                         [self.ws, self.path("a"), self.path("a/aa/aaa")])
+        self.assertEqual(self.w.demotions, 1)
+
+        b = self.w.dirs[self.path("b")]
+        self.assertEqual(b.interval, self.w.min_interval)
+
+        d = self.handler.next_event()
+        os.mkdir(self.path("a/aa/aaa/new"))
+        ev = yield d
+        self.assertEqual(ev, events.DirModifiedEvent(self.path("a/aa/aaa")))
+
+    @defer.inlineCallbacks
+    def test_changed_before_promotion(self):
+        aaa = self.w.dirs[self.path("a/aa/aaa")]
+        aaa.score, aaa.mtime = 10., 0.
+        yield self.w.rebalance()
+        self.assertIn(events.DirModifiedEvent(aaa.path), self.handler.events)
+
+    def test_overflow(self):
+        self.w._inotify_events([(None, watch.IN.IN_Q_OVERFLOW, "")])
+        self.assertEqual(self.handler.reconciled, [True])
+        self.assertEqual(self.w.stats()["overflows"], 1)
+
+    @defer.inlineCallbacks
+    def test_removed_directory(self):
+        d = self.handler.next_event()
+        rmtree(self.path("b"))
+        ev = yield d
+        self.assertEqual(ev, events.DirModifiedEvent(self.ws))
+        self.assertNotIn(self.path("b"), self.w.dirs)
+
+
+class TestTreeWatcher(TestCase):
+    def setUp(self):
+        self.ws = mkdtemp()
+        for d in ("a", "a/aa", "a/x.ignored", "a/x.ignored/sub", "b",
+                  "b/bb"):
+            os.mkdir(osp.join(self.ws, d))
+
+        self.handler = RecordingHandler()
+        self.w = watch.TreeWatcher(self.handler, self.ws)
+
+    def tearDown(self):
+        self.w.observer.unschedule_all()
+        rmtree(self.ws)
+
+    def path(self, name):
+        return osp.join(self.ws, name)
+
+    def watches(self):
+        return {osp.relpath(p, self.ws): w.is_recursive
+                for p, w in self.w.watches.items()}
+
+    @defer.inlineCallbacks
+    def test_skips_excluded(self):
+        yield self.w.discover(self.ws)
+        self.assertEqual(self.watches(), {
+            ".": False, "a": False, "a/aa": True, "b": True,
+        })
+        self.assertEqual(len(self.w.observer.emitters), 4)
+
+    @defer.inlineCallbacks
+    def test_excluded_appears(self):
+        yield self.w.discover(self.ws)
+        os.mkdir(self.path("b/bb/y.ignored"))
+        yield self.w.discover(self.path("b/bb/y.ignored"))
+        self.assertEqual(self.watches(), {
+            ".": False, "a": False, "a/aa": True, "b": False, "b/bb": False,
+        })
+
+        os.mkdir(self.path("a/aa/new"))  # in a recursive watch: unchanged
+        yield self.w.discover(self.path("a/aa/new"))
+        self.assertEqual(len(self.w.watches), 5)
+
+    @defer.inlineCallbacks
+    def test_excluded_removed(self):
+        yield self.w.discover(self.ws)
+        rmtree(self.path("a/x.ignored"))
+        yield self.w.discover(self.path("a"))
+        self.assertEqual(self.watches(), {".": False, "a": True, "b": True})
+        self.assertEqual(len(self.w.observer.emitters), 3)
+
+        rmtree(self.path("a"))
+        yield self.w.discover(self.path("a"))
+        self.assertEqual(self.watches(), {".": False, "b": True})
+
+    def test_affected(self):
+        self.assertEqual(self.w._affected(events.FileCreatedEvent(
+            self.path("a/" + IGNORE_FILE),
+        )), [self.path("a")])
+        self.assertEqual(self.w._affected(events.DirMovedEvent(
+            self.path("a/aa"), self.path("b/aa"),
+        )), [self.path("a/aa"), self.path("b/aa")])
+        self.assertEqual(self.w._affected(
+            events.DirModifiedEvent(self.path("a")),
+        ), [])
+        self.assertEqual(self.w._affected(
+            events.FileCreatedEvent(self.path("a/file")),
+        ), [])
+
+    @defer.inlineCallbacks
+    def test_not_recursive(self):
+        w = watch.TreeWatcher(self.handler, self.ws, recursive=False)
+        yield w.discover(self.ws)
+        self.assertEqual(list(w.watches), [self.ws])
+        self.assertFalse(w.watches[self.ws].is_recursive)
+        w.observer.unschedule_all()
@@ -4,9 +4,13 @@ from twisted.trial.unittest import TestCase
 from zope.interface import implementer
 from zope.interface.verify import DoesNotImplement, verifyClass
 
+from twisted.internet import defer
 from twisted.application.service import Service
 
 from pydio import IMerger, ISynchronizable, merger
+from pydio.engine.sqlite import PathIndex, IndexEntry
+from pydio.storage.fs import LocalDirectory
+from pydio.util.selection import Selection
 
 
 @implementer(ISynchronizable)
@@ -15,6 +19,7 @@ class DummySynchronizable(Service):
     purposes
     """
     idx = None
+    index = None
 
     def __init__(self, fail_assertion=False):
         super().__init__()
@@ -23,6 +28,9 @@ class DummySynchronizable(Service):
     def get_changes(self):
         raise NotImplementedError
 
+    def ack_changes(self):
+        pass
+
     def assert_ready(self):
         if self.fail_assertion:
             raise AssertionError("testing failure case")
@@ -79,3 +87,172 @@ class TestTwoWayMergerSync(TestCase):
 
     def test_assert_volume_ready__pass(self):
         return self.merger.assert_volumes_ready()
+
+
+class DummyQueue:
+    def __init__(self, inodes):
+        self.inodes = list(inodes)
+        self.started, self.finished, self.failed = [], [], []
+
+    def claim(self, n):
+        batch, self.inodes = self.inodes[:n], self.inodes[n:]
+        return defer.succeed(batch)
+
+    def start(self, node_ids):
+        self.started.extend(node_ids)
+        return defer.succeed(None)
+
+    def done(self, node_ids):
+        self.finished.extend(node_ids)
+        return defer.succeed(None)
+
+    def fail(self, node_id, detail=None):
+        self.failed.append(node_id)
+        return defer.succeed(None)
+
+
+class DummyStorage:
+    selection = None
+
+    def set_selection(self, selection, synced=None):
+        self.selection, self.synced = selection, synced
+        return defer.succeed(None)
+
+    def relative_path(self, path):
+        return path.replace("/local", "", 1)
+
+    def absolute_path(self, path):
+        return "/local" + path
+
+
+class DummyTransfers:
+    def __init__(self):
+        self.uploaded, self.downloaded = [], []
+
+    def upload_node(self, inode, path):
+        if inode.get("broken"):
+            return defer.fail(IOError("broken"))
+        self.uploaded.append(path)
+        return defer.succeed(None)
+
+    def download_node(self, inode, path):
+        self.downloaded.append(path)
+        return defer.succeed(None)
+
+
+class TestTwoWayMergerMerge(TestCase):
+    def setUp(self):
+        self.local = DummySynchronizable()
+        self.local.istorage = DummyStorage()
+        self.local.queue = DummyQueue([
+            dict(node_id=1, node_path="/local/a.txt"),
+            dict(node_id=2, node_path="/local/b.txt", broken=True),
+        ])
+
+        self.remote = DummySynchronizable()
+        self.remote.queue = DummyQueue([dict(node_id=7, node_path="/c.txt")])
+
+        self.transfers = DummyTransfers()
+
+    def mk_merger(self, direction=None):
+        return merger.TwoWayMerger(self.local, self.remote,
+                                   direction=direction,
+                                   transfers=self.transfers)
+
+    @defer.inlineCallbacks
+    def test_merge_bidirectional(self):
+        yield self.mk_merger().merge()
+
+        self.assertEqual(self.transfers.uploaded, ["/a.txt"])
+        self.assertEqual(self.transfers.downloaded, ["/local/c.txt"])
+
+        self.assertEqual(self.local.queue.started, [1, 2])
+        self.assertEqual(self.local.queue.finished, [1])
+        self.assertEqual(self.local.queue.failed, [2])
+        self.assertEqual(self.remote.queue.finished, [7])
+        self.assertEqual(len(self.flushLoggedErrors(IOError)), 1)
+
+    @defer.inlineCallbacks
+    def test_merge_up(self):
+        yield self.mk_merger("up").merge()
+        self.assertFalse(self.transfers.downloaded)
+        self.assertEqual(self.transfers.uploaded, ["/a.txt"])
+        self.flushLoggedErrors(IOError)
+
+    @defer.inlineCallbacks
+    def test_merge_down(self):
+        yield self.mk_merger("down").merge()
+        self.assertFalse(self.transfers.uploaded)
+        self.assertEqual(self.transfers.downloaded, ["/local/c.txt"])
+
+    def test_merge_without_transfers(self):
+        m = merger.TwoWayMerger(self.local, self.remote)
+        return m.merge()
+
+    @defer.inlineCallbacks
+    def test_merge_indexed(self):
+        """Transfers are skipped when the destination indexes the content"""
+        self.local.queue.inodes[0]["md5"] = "aaa"
+        self.remote.queue.inodes[0]["md5"] = "ccc"
+
+        self.remote.index = PathIndex(None)
+        self.remote.index.put("/a.txt", IndexEntry(1, "aaa", 3, 0.))
+        self.local.index = PathIndex(None)
+        self.local.index.put("/local/c.txt", IndexEntry(1, "old", 3, 0.))
+
+        yield self.mk_merger().merge()
+        self.assertEqual(self.transfers.uploaded, [])
+        self.assertEqual(self.transfers.downloaded, ["/local/c.txt"])
+        self.assertEqual(self.local.queue.finished, [1])
+        self.flushLoggedErrors(IOError)
+
+    @defer.inlineCallbacks
+    def test_merge_deselected(self):
+        m = self.mk_merger()
+        m.selection = Selection(exclude=["/a.txt", "/c.txt"])
+        yield m.merge()
+        self.assertEqual(self.transfers.uploaded, [])
+        self.assertEqual(self.transfers.downloaded, [])
+        self.assertEqual(self.local.queue.finished, [1])
+        self.assertEqual(self.remote.queue.finished, [7])
+        self.flushLoggedErrors(IOError)
+
+    @defer.inlineCallbacks
+    def test_set_selection(self):
+        self.remote.istorage = DummyStorage()
+        m = self.mk_merger()
+        selection = Selection(include=["/docs"])
+        yield m.set_selection(selection)
+        self.assertEqual(m.selection, selection)
+        self.assertEqual(self.local.istorage.selection, selection)
+        self.assertEqual(self.remote.istorage.selection, selection)
+        self.assertEqual(self.local.istorage.synced, m._synced)
+
+    @defer.inlineCallbacks
+    def test_synced(self):
+        self.remote.index = PathIndex(None)
+        self.remote.index.put("/a.txt", IndexEntry(1, "aaa", 3, 0.))
+        m = self.mk_merger()
+        self.assertTrue((yield m._synced(
+            "/local/a.txt", IndexEntry(2, "aaa", 3, 0.),
+        )))
+        self.assertFalse((yield m._synced(
+            "/local/a.txt", IndexEntry(2, "bbb", 3, 0.),
+        )))
+        self.assertFalse((yield m._synced(
+            "/local/new.txt", IndexEntry(3, "aaa", 3, 0.),
+        )))
+
+    @defer.inlineCallbacks
+    def test_local_remote(self):
+        """A local remote's index holds absolute paths"""
+        self.remote.istorage = LocalDirectory("/mirror")
+        self.remote.queue.inodes[0].update(node_path="/mirror/c.txt", md5="c")
+        self.local.queue.inodes[0]["md5"] = "a"
+        self.remote.index = PathIndex(None)
+        self.remote.index.put("/mirror/a.txt", IndexEntry(1, "a", 3, 0.))
+
+        yield self.mk_merger().merge()
+        self.assertEqual(self.transfers.uploaded, [])
+        self.assertEqual(self.transfers.downloaded, ["/local/c.txt"])
+        self.flushLoggedErrors(IOError)
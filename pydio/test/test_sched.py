@@ -1,9 +1,22 @@
 #! /usr/bin/env python
 from twisted.trial.unittest import TestCase
 
-from twisted.application.service import IService, IServiceCollection
+import os
+import os.path as osp
+from shutil import rmtree
+from tempfile import mkdtemp
+
+from twisted.internet import defer
+from twisted.application.service import (
+    IService, IServiceCollection, Service,
+)
+
+from watchdog import events
 
 from pydio import sched
+from pydio.storage import fs, hashing
+from pydio.storage.journal import Journal
+from pydio.util import priority, ratelimit
 
 
 class TestIService(TestCase):
@@ -24,3 +37,167 @@ class TestIService(TestCase):
             IService.implementedBy(sched.Job),
             "Job does not implement IService"
         )
+
+
+class TestJobLimits(TestCase):
+    def setUp(self):
+        self.global_gov = ratelimit.Governor(dict(read=1000))
+        self.gov = ratelimit.Governor(dict(upload=10), parent=self.global_gov)
+        self.job = sched.Job("job", Service(), Service(), self.gov)
+
+    def test_keeps_configured_limits(self):
+        self.job.limits.apply()
+        self.assertEqual(self.gov.limits, dict(upload=10))
+
+    def test_set_limits(self):
+        self.job.startService()
+        self.addCleanup(self.job.stopService)
+
+        self.job.set_limits(dict(upload=20, opens=5))
+        self.assertEqual(self.gov.buckets[ratelimit.UPLOAD].rate, 20)
+        self.assertEqual(self.gov.buckets[ratelimit.OPENS].rate, 5)
+
+
+class TestJobPriorities(TestCase):
+    def setUp(self):
+        self.hashing = priority.PriorityScheduler(
+            priorities=priority.Priorities(root="/home/me/sync"),
+        )
+        self.transfers = priority.PriorityScheduler()
+        self.job = sched.Job("job", Service(), Service(), queues=dict(
+            hashing=self.hashing, transfers=self.transfers,
+        ))
+
+    def test_set_priorities(self):
+        self.job.set_priorities({"/backups": "low"})
+        self.assertEqual(
+            self.hashing.priorities.classify("/home/me/sync/backups/a"),
+            priority.LOW,
+        )
+        self.assertEqual(self.transfers.priorities.classify("/backups/a"),
+                         priority.LOW)
+
+    def test_unknown_class(self):
+        self.assertRaises(ValueError, self.job.set_priorities,
+                          {"/backups": "later"})
+
+
+class TestBuildJob(TestCase):
+    def setUp(self):
+        self.dir = mkdtemp()
+        self.addCleanup(rmtree, self.dir)
+        self.local = osp.join(self.dir, "local")
+        os.makedirs(osp.join(self.local, "sub"))
+        for name in ("a.txt", "b.txt", "sub/c.txt"):
+            self.write(name)
+
+        self.cfg = dict(
+            directory=self.local,
+            filters=dict(include=["*"], exclude=[]),
+            data_dir=osp.join(self.dir, "data"),
+        )
+
+        self.hashed = []
+        hash_file = hashing.hash_file
+
+        def spy(path, *args):
+            self.hashed.append(osp.relpath(path, self.local))
+            return hash_file(path, *args)
+
+        self.patch(hashing, "hash_file", spy)
+
+        self.walks = []
+        walk = fs.EventHandler.walk
+
+        def walk_spy(handler, *args):
+            self.walks.append(args)
+            return walk(handler, *args)
+
+        self.patch(fs.EventHandler, "walk", walk_spy)
+
+    def write(self, name, content=b"content"):
+        path = osp.join(self.local, name)
+        with open(path + ".tmp", "wb") as f:
+            f.write(content)
+        os.replace(path + ".tmp", path)  # as editors save files
+
+    @defer.inlineCallbacks
+    def run_job(self, **cfg):
+        """Build the job, start its local workspace, and stop it once the
+        directory is reconciled.  Fires with the paths hashed meanwhile.
+        """
+        del self.hashed[:], self.walks[:]
+        job = sched.build_job("job", dict(self.cfg, **cfg))
+        lw = job.merger.local
+        ready = lw.iengine.startService()
+        yield lw.istorage.startService()
+        yield ready
+        yield lw.istorage.stopService()
+        yield lw.iengine.stopService()
+        if lw.istorage.journal is not None:
+            lw.istorage.journal.close()
+        defer.returnValue(sorted(self.hashed))
+
+    def test_data_dir(self):
+        self.assertEqual(sched.data_dir("job", {}),
+                         osp.join(sched.DATA_DIR, "job"))
+        self.assertEqual(sched.data_dir("job", dict(data_dir="~/db")),
+                         osp.expanduser("~/db"))
+
+    @defer.inlineCallbacks
+    def test_restart(self):
+        hashed = yield self.run_job()
+        self.assertEqual(hashed, ["a.txt", "b.txt", "sub/c.txt"])
+        self.assertTrue(
+            osp.exists(osp.join(self.cfg["data_dir"], "local.sqlite")),
+        )
+
+        self.write("b.txt", b"changed")
+        self.write("sub/d.txt")
+        hashed = yield self.run_job()
+        self.assertEqual(hashed, ["b.txt", "sub/d.txt"])
+
+        hashed = yield self.run_job()
+        self.assertEqual(hashed, [])
+
+    @defer.inlineCallbacks
+    def test_modified_in_place_while_stopped(self):
+        yield self.run_job()
+        mtime = os.stat(self.local).st_mtime
+        with open(osp.join(self.local, "b.txt"), "ab") as f:
+            f.write(b" appended")
+        self.assertEqual(os.stat(self.local).st_mtime, mtime)
+
+        hashed = yield self.run_job()
+        self.assertEqual(hashed, ["b.txt"])
+
+    @defer.inlineCallbacks
+    def test_replay_journal(self):
+        journal = osp.join(self.dir, "journal")
+        hashed = yield self.run_job(journal=journal)
+        self.assertEqual(hashed, ["a.txt", "b.txt", "sub/c.txt"])
+        self.assertEqual(len(self.walks), 1, "a missing journal was trusted")
+
+        # crash with an event pending, after a change in place
+        j = Journal(journal)
+        j.append(events.FileModifiedEvent(osp.join(self.local, "b.txt")))
+        j.close()
+        with open(osp.join(self.local, "b.txt"), "ab") as f:
+            f.write(b" changed")
+
+        hashed = yield self.run_job(journal=journal)
+        self.assertEqual(hashed, ["b.txt"])
+        self.assertEqual(self.walks, [], "the tree was walked")
+
+    @defer.inlineCallbacks
+    def test_corrupt_journal(self):
+        journal = osp.join(self.dir, "journal")
+        yield self.run_job(journal=journal, reconcile_interval=3600)
+        self.assertEqual(len(self.walks), 1, "reconciled twice on start")
+
+        with open(journal, "wb") as f:
+            f.write(b"torn")
+        self.write("sub/d.txt")
+        hashed = yield self.run_job(journal=journal, reconcile_interval=3600)
+        self.assertEqual(hashed, ["sub/d.txt"])
+        self.assertEqual(len(self.walks), 1)
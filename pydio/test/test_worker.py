@@ -0,0 +1,166 @@
+#! /usr/bin/env python
+from twisted.trial.unittest import TestCase
+
+import os
+import signal
+import os.path as osp
+from tempfile import mkdtemp
+from shutil import rmtree
+
+from twisted.internet import defer, reactor, task
+
+from pydio import sched, worker
+from pydio.test.storage.test_http import FakeServerTestCase
+
+
+@defer.inlineCallbacks
+def wait_for(predicate, timeout=20., interval=.1):
+    """Poll `predicate`, which may return a Deferred, until it is true"""
+    for _ in range(int(timeout / interval)):
+        result = yield defer.maybeDeferred(predicate)
+        if result:
+            defer.returnValue(result)
+        yield task.deferLater(reactor, interval, lambda: None)
+    raise AssertionError("timed out waiting for {0}".format(predicate))
+
+
+class TestJSONArgument(TestCase):
+    def test_roundtrip(self):
+        arg = worker.JSON()
+        obj = {"job": {"limits": {"read": 1.5}, "filters": ["*"]}}
+        self.assertEqual(arg.fromString(arg.toString(obj)), obj)
+
+
+class TestSchedulerProcesses(TestCase):
+    def jobs(self, n):
+        return {"job{0}".format(i): dict(directory="/nope") for i in range(n)}
+
+    def test_partition(self):
+        s = sched.Scheduler(self.jobs(5), processes=2)
+        self.assertEqual(
+            [sorted(w.jobs) for w in s.workers],
+            [["job0", "job2", "job4"], ["job1", "job3"]],
+        )
+        self.assertFalse(s.jobs, "jobs were built in-process")
+
+    def test_fewer_jobs_than_processes(self):
+        s = sched.Scheduler(self.jobs(1), limits=dict(read=100), processes=4)
+        self.assertEqual(len(s.workers), 1)
+        self.assertEqual(s.workers[0].limits, dict(read=100))
+
+    def test_shared_limits(self):
+        s = sched.Scheduler(self.jobs(2), limits=dict(read=100), processes=2)
+        self.assertEqual([w.limits for w in s.workers], [dict(read=50)] * 2)
+
+    def test_share_schedule(self):
+        window = dict(start_time=dict(h=9), end_time=dict(h=17),
+                      limits=dict(upload=10))
+        shared = sched.share_schedule([window], 2)
+        self.assertEqual(shared[0]["limits"], dict(upload=5))
+        self.assertEqual(shared[0]["start_time"], dict(h=9))
+
+
+class TestWorkerProcess(FakeServerTestCase):
+    """Runs a job in a real worker process, against the fake server"""
+
+    timeout = 60
+
+    def setUp(self):
+        super().setUp()
+        self.local = mkdtemp()
+        self.data = mkdtemp()
+        cfg = dict(
+            directory=self.local,
+            data_dir=self.data,
+            filters=dict(include=["*"], exclude=[]),
+            server="http://127.0.0.1:{0}".format(self.port.getHost().port),
+            workspace="ws",
+            frequency=.1,
+        )
+        self.worker = worker.WorkerProcess(
+            "w", {"job": cfg}, restart_delay=.1,
+        )
+        self.worker.startService()
+
+    @defer.inlineCallbacks
+    def tearDown(self):
+        if self.worker.running:
+            yield self.worker.stopService()
+        rmtree(self.local)
+        rmtree(self.data)
+        yield super().tearDown()
+
+    @defer.inlineCallbacks
+    def running(self):
+        status = yield self.worker.status()
+        defer.returnValue(status["job"]["running"])
+
+    @defer.inlineCallbacks
+    def test_status(self):
+        yield wait_for(self.running)
+        self.assertTrue(self.worker.pid)
+
+    @defer.inlineCallbacks
+    def test_indexing(self):
+        yield wait_for(self.running)
+
+        # link a complete file into place, so that only a creation is seen
+        staged = osp.join(self.root, "foo.txt")
+        with open(staged, "wb") as f:
+            f.write(b"hello")
+        os.link(staged, osp.join(self.local, "foo.txt"))
+
+        @defer.inlineCallbacks
+        def indexed():
+            status = yield self.worker.status()
+            defer.returnValue(sum(status["job"].get("local", {}).values()))
+
+        yield wait_for(indexed)
+
+    @defer.inlineCallbacks
+    def test_restart_after_crash(self):
+        yield wait_for(self.running)
+        pid = self.worker.pid
+        os.kill(pid, signal.SIGKILL)
+
+        yield wait_for(lambda: self.worker.restarts == 1)
+        yield wait_for(self.running)
+        self.assertNotEqual(self.worker.pid, pid)
+
+    @defer.inlineCallbacks
+    def test_set_limits(self):
+        yield wait_for(self.running)
+        yield self.worker.set_limits(dict(upload=1000), job="job")
+
+        status = yield self.worker.status()
+        self.assertEqual(status["job"]["limits"], dict(upload=1000))
+
+    @defer.inlineCallbacks
+    def test_set_selection(self):
+        yield wait_for(self.running)
+        yield self.worker.set_selection("job", exclude=["/build"])
+
+        status = yield self.worker.status()
+        self.assertEqual(status["job"]["selection"],
+                         dict(include=["/"], exclude=["/build"]))
+        self.assertEqual(self.worker.jobs["job"]["selection"],
+                         dict(include=[], exclude=["/build"]))
+
+    @defer.inlineCallbacks
+    def test_set_priorities(self):
+        yield wait_for(self.running)
+        yield self.worker.set_priorities("job", {"/backups": "low"})
+
+        status = yield self.worker.status()
+        self.assertEqual(sorted(status["job"]["queues"]),
+                         ["hashing", "transfers"])
+        self.assertEqual(self.worker.jobs["job"]["priorities"],
+                         {"/backups": "low"})
+
+    @defer.inlineCallbacks
+    def test_stop(self):
+        yield wait_for(self.running)
+        yield self.worker.stopService()
+        self.assertIsNone(self.worker.pid)
+        status = yield self.worker.status()
+        self.assertEqual(status, {"job": dict(running=False)})
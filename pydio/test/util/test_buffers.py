@@ -0,0 +1,118 @@
+#! /usr/bin/env python
+from twisted.trial.unittest import TestCase
+
+import io
+
+from twisted.internet import defer
+from twisted.web.client import FileBodyProducer
+
+from pydio.util import buffers
+from pydio.util.buffers import BufferPool, BufferReader
+
+
+class TestBufferPool(TestCase):
+    def test_reuse(self):
+        pool = BufferPool(16)
+        a = pool.acquire()
+        self.assertEqual(len(a), 16)
+        pool.release(a)
+        self.assertIs(pool.acquire(), a)
+        self.assertEqual(pool.stats(),
+                         dict(size=16, allocated=1, reused=1, free=0))
+
+    def test_concurrent(self):
+        pool = BufferPool(16)
+        a, b = pool.acquire(), pool.acquire()
+        self.assertIsNot(a, b)
+        self.assertEqual(pool.allocated, 2)
+
+    def test_max_free(self):
+        pool = BufferPool(16, max_free=1)
+        a, b = pool.acquire(), pool.acquire()
+        pool.release(a)
+        pool.release(b)
+        self.assertEqual(pool.stats()["free"], 1)
+
+    def test_foreign_buffer(self):
+        self.assertRaises(ValueError, BufferPool(16).release, bytearray(8))
+
+    def test_lease(self):
+        pool = BufferPool(16)
+        with self.assertRaises(ZeroDivisionError):
+            with pool.lease():
+                1 / 0
+        self.assertEqual(pool.stats()["free"], 1)
+
+
+class TestRead(TestCase):
+    def test_readinto(self):
+        f = io.BytesIO(b"0123456789")
+        buf = bytearray(4)
+        self.assertEqual(buffers.readinto(f, buf), b"0123")
+        self.assertEqual(buffers.readinto(f, buf, 2), b"45")
+        self.assertEqual(buffers.readinto(f, buf), b"6789")
+        self.assertEqual(buffers.readinto(f, buf), b"")
+
+    def test_short_reads(self):
+        class Trickle(io.RawIOBase):
+            def __init__(self, data):
+                self.data = data
+
+            def readinto(self, b):
+                if not self.data:
+                    return 0
+                b[0], self.data = self.data[0], self.data[1:]
+                return 1
+
+        block = buffers.readinto(Trickle(b"abc"), bytearray(8))
+        self.assertEqual(block, b"abc")
+
+    def test_blocks(self):
+        pool = BufferPool(4)
+        calls = []
+        f = io.BytesIO(b"0123456789")
+        blocks = [bytes(b) for b in buffers.blocks(
+            f, pool, lambda: calls.append(1),
+        )]
+        self.assertEqual(blocks, [b"0123", b"4567", b"89"])
+        self.assertEqual(len(calls), 4)
+        self.assertEqual(pool.stats()["free"], 1)
+
+    def test_blocks_share_buffer(self):
+        f = io.BytesIO(b"01234567")
+        gen = buffers.blocks(f, BufferPool(4))
+        first = next(gen)
+        next(gen)
+        self.assertEqual(first, b"4567", "blocks are views of one buffer")
+        gen.close()
+
+
+class TestBufferReader(TestCase):
+    def test_read(self):
+        r = BufferReader(memoryview(bytearray(b"0123456789"))[2:])
+        self.assertEqual(r.read(3), b"234")
+        self.assertIsInstance(r.read(3), bytes)
+        self.assertEqual(r.read(), b"89")
+        self.assertEqual(r.read(3), b"")
+
+    def test_seek(self):
+        r = BufferReader(b"0123456789")
+        self.assertEqual(r.seek(0, 2), 10)
+        self.assertEqual(r.tell(), 10)
+        r.seek(-3, 1)
+        self.assertEqual(r.read(), b"789")
+
+    @defer.inlineCallbacks
+    def test_body_producer(self):
+        data = bytearray(b"x" * 100000)
+        producer = FileBodyProducer(BufferReader(memoryview(data)))
+        self.assertEqual(producer.length, len(data))
+
+        written = []
+
+        class Consumer:
+            write = written.append
+
+        yield producer.startProducing(Consumer())
+        self.assertEqual(b"".join(written), data)
+        self.assertTrue(all(isinstance(w, bytes) for w in written))
@@ -0,0 +1,59 @@
+#! /usr/bin/env python
+from twisted.trial.unittest import TestCase
+
+import random
+
+from pydio.util import cdc
+
+DATA = random.Random(42).getrandbits(8 * 300000).to_bytes(300000, "little")
+
+
+def chunk_all(data, feed=1 << 16, **kw):
+    ck = cdc.Chunker(**kw)
+    chunks = []
+    for i in range(0, len(data), feed):
+        chunks.extend(ck.update(data[i:i + feed]))
+    return chunks + ck.final()
+
+
+class TestChunker(TestCase):
+    def test_sizes(self):
+        chunks = chunk_all(DATA)
+        sizes = [n for _, n in chunks]
+
+        self.assertEqual(sum(sizes), len(DATA))
+        self.assertTrue(all(n <= 64 << 10 for n in sizes))
+        self.assertTrue(all(n >= 2 << 10 for n in sizes[:-1]))
+
+        avg = sum(sizes) / len(sizes)
+        self.assertTrue(4 << 10 < avg < 16 << 10,
+                        "average chunk size is {0}".format(avg))
+
+    def test_deterministic(self):
+        self.assertEqual(chunk_all(DATA), chunk_all(DATA))
+
+    def test_feed_size_independent(self):
+        self.assertEqual(chunk_all(DATA, feed=1000), chunk_all(DATA, feed=1 << 20))
+
+    def test_insertion_resyncs(self):
+        before = {d for d, _ in chunk_all(DATA)}
+        after = {d for d, _ in chunk_all(b"inserted" + DATA)}
+        self.assertTrue(len(before - after) <= 2,
+                        "{0} chunks changed".format(len(before - after)))
+
+    def test_max_size(self):
+        chunks = chunk_all(b"\x00" * 200000)
+        self.assertEqual([n for _, n in chunks][:3], [64 << 10] * 3)
+
+    def test_empty(self):
+        self.assertEqual(chunk_all(b""), [])
+
+    def test_reuse_after_final(self):
+        ck = cdc.Chunker()
+        first = ck.update(DATA) + ck.final()
+        second = ck.update(DATA) + ck.final()
+        self.assertEqual(first, second)
+
+    def test_invalid_sizes(self):
+        self.assertRaises(ValueError, cdc.Chunker, min_size=8, avg_size=4,
+                          max_size=16)
@@ -0,0 +1,63 @@
+#! /usr/bin/env python
+from twisted.trial.unittest import TestCase
+
+import os
+
+from pydio.util import compress
+
+TEXT = b"".join(b"line %d of a plain text log file\n" % i for i in range(3000))
+
+
+class TestChoose(TestCase):
+    def test_text(self):
+        self.assertIsNotNone(compress.choose("/notes.txt", TEXT))
+
+    def test_random(self):
+        self.assertIsNone(compress.choose("/foo.bin", os.urandom(1 << 16)))
+
+    def test_compressed_extension(self):
+        self.assertIsNone(compress.choose("/photo.JPG", TEXT))
+
+    def test_small_sample(self):
+        self.assertIsNone(compress.choose("/notes.txt", b"hello"))
+
+    def test_accepted(self):
+        self.assertIsNone(compress.choose("/notes.txt", TEXT, accepted=()))
+        codec = compress.choose("/notes.txt", TEXT, accepted=("deflate",))
+        self.assertEqual(codec[0], "deflate")
+
+    def test_redundant_prefers_strong_codec(self):
+        sample = b"ab" * 10000
+        self.assertEqual(compress.choose("/a.csv", sample), ("lzma", 1))
+
+
+class TestCodecs(TestCase):
+    def test_roundtrip(self):
+        for name in compress.CODECS:
+            encoded = compress.encode(TEXT, (name, 1))
+            self.assertTrue(len(encoded) < len(TEXT))
+            self.assertEqual(compress.decode(encoded, name), TEXT)
+
+    def test_identity(self):
+        self.assertEqual(compress.encode(TEXT, None), TEXT)
+        self.assertEqual(compress.decode(TEXT, None), TEXT)
+
+    def test_unknown(self):
+        self.assertRaises(ValueError, compress.decode, TEXT, "brotli")
+
+    def test_entropy(self):
+        self.assertEqual(compress.entropy(b"aaaa"), 0.)
+        self.assertAlmostEqual(compress.entropy(bytes(range(256))), 8.)
+
+
+class TestStats(TestCase):
+    def test_ratio(self):
+        stats = compress.Stats()
+        stats.add("deflate", 1000, 100, .1)
+        stats.add("lzma", 1000, 400, .2)
+        self.assertEqual(stats.ratio("deflate"), 10.)
+        self.assertEqual(stats.ratio(), 4.)
+        self.assertEqual(stats.as_dict()["lzma"]["seconds"], .2)
+
+    def test_empty(self):
+        self.assertEqual(compress.Stats().ratio(), 1.)
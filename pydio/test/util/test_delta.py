@@ -0,0 +1,109 @@
+#! /usr/bin/env python
+from twisted.trial.unittest import TestCase
+
+import os
+import os.path as osp
+from io import BytesIO
+from zlib import adler32
+from shutil import rmtree
+from tempfile import mkdtemp
+
+from pydio.util import delta
+
+BASIS = os.urandom(100003)
+
+
+class TestDelta(TestCase):
+    block_size = 1024
+
+    def setUp(self):
+        self.wd = mkdtemp()
+        self.basis = self.write("basis", BASIS)
+        self.sig = delta.signature(self.basis, self.block_size)
+
+    def tearDown(self):
+        rmtree(self.wd)
+
+    def write(self, name, content):
+        path = osp.join(self.wd, name)
+        with open(path, "wb") as f:
+            f.write(content)
+        return path
+
+    def roundtrip(self, content):
+        """Compute, encode and apply a delta.  Returns the instructions."""
+        path = self.write("new", content)
+        ops = delta.delta(path, self.sig)
+
+        stream = BytesIO(b"".join(delta.encode(path, ops)))
+        self.assertEqual(len(stream.getvalue()), delta.encoded_size(ops))
+
+        out = BytesIO()
+        with open(self.basis, "rb") as basis:
+            delta.patch(basis, stream, out)
+        self.assertEqual(out.getvalue(), content, "patch is not faithful")
+        return ops
+
+    def test_signature(self):
+        self.assertEqual(self.sig.bytesize, len(BASIS))
+        self.assertEqual(len(self.sig.blocks), 98 * delta.BLOCK.size)
+
+    def test_rolling_checksum(self):
+        """The rolling update must agree with zlib.adler32"""
+        B, data = 16, os.urandom(64)
+        weak = adler32(data[:B])
+        a, b = weak & 0xffff, weak >> 16
+        for i in range(len(data) - B):
+            a = (a - data[i] + data[i + B]) % delta.MOD_ADLER
+            b = (b - B * data[i] + a - 1) % delta.MOD_ADLER
+            self.assertEqual((b << 16) | a, adler32(data[i + 1:i + 1 + B]))
+
+    def test_unchanged(self):
+        ops = self.roundtrip(BASIS)
+        self.assertEqual(ops, [(delta.COPY, 0, len(BASIS))])
+
+    def test_append(self):
+        ops = self.roundtrip(BASIS + b"appended")
+        self.assertTrue(delta.literal_size(ops) < 2 * self.block_size)
+
+    def test_in_place_edit(self):
+        edited = bytearray(BASIS)
+        edited[50000] ^= 0xff
+        ops = self.roundtrip(bytes(edited))
+        self.assertEqual(delta.literal_size(ops), self.block_size)
+
+    def test_insert_at_start(self):
+        ops = self.roundtrip(b"inserted" + BASIS)
+        self.assertEqual(delta.literal_size(ops), len(b"inserted"))
+
+    def test_cut(self):
+        ops = self.roundtrip(BASIS[:30000] + BASIS[40000:])
+        self.assertTrue(delta.literal_size(ops) < 2 * self.block_size)
+
+    def test_unrelated(self):
+        content = os.urandom(5000)
+        ops = self.roundtrip(content)
+        self.assertEqual(delta.literal_size(ops), len(content))
+
+    def test_max_literal(self):
+        path = self.write("new", os.urandom(5000))
+        self.assertIsNone(delta.delta(path, self.sig, max_literal=1000))
+
+        path = self.write("new", b"inserted" + BASIS)
+        self.assertIsNotNone(delta.delta(path, self.sig, max_literal=8))
+        self.assertIsNone(delta.delta(path, self.sig, max_literal=7))
+
+    def test_empty(self):
+        self.assertEqual(self.roundtrip(b""), [])
+
+    def test_truncated_stream(self):
+        stream = BytesIO(delta.HEADER.pack(delta.DATA, 0, 10) + b"short")
+        self.assertRaises(IOError, delta.patch, BytesIO(), stream, BytesIO())
+
+    def test_delta_reader(self):
+        path = self.write("new", b"prefix" + BASIS)
+        ops = delta.delta(path, self.sig)
+
+        reader = delta.DeltaReader(path, ops)
+        data = b"".join(iter(lambda: reader.read(7), b""))
+        self.assertEqual(data, b"".join(delta.encode(path, ops)))
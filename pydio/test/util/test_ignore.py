@@ -0,0 +1,149 @@
+#! /usr/bin/env python
+from twisted.trial.unittest import TestCase
+
+import os
+import os.path as osp
+from shutil import rmtree
+from tempfile import mkdtemp
+
+from pydio.util import ignore
+
+
+class TestRuleSet(TestCase):
+    def match(self, lines, relpath, is_dir=False):
+        return ignore.RuleSet.parse(lines.split("\n")).match(relpath, is_dir)
+
+    def test_empty(self):
+        self.assertIsNone(ignore.RuleSet.parse(["", "# comment", "  "]))
+
+    def test_basename_any_depth(self):
+        self.assertTrue(self.match("*.o", "main.o"))
+        self.assertTrue(self.match("*.o", "src/lib/main.o"))
+        self.assertIsNone(self.match("*.o", "main.c"))
+        self.assertIsNone(self.match("*.o", "main.o.c"))
+
+    def test_anchored(self):
+        self.assertTrue(self.match("/build", "build", True))
+        self.assertIsNone(self.match("/build", "src/build", True))
+        self.assertTrue(self.match("doc/*.html", "doc/index.html"))
+        self.assertIsNone(self.match("doc/*.html", "doc/api/index.html"))
+        self.assertIsNone(self.match("doc/*.html", "src/doc/index.html"))
+
+    def test_dir_only(self):
+        self.assertTrue(self.match("node_modules/", "node_modules", True))
+        self.assertTrue(self.match("node_modules/", "a/node_modules", True))
+        self.assertIsNone(self.match("node_modules/", "node_modules", False))
+
+    def test_double_star(self):
+        self.assertTrue(self.match("**/cache", "cache", True))
+        self.assertTrue(self.match("**/cache", "a/b/cache", True))
+        self.assertTrue(self.match("a/**/b", "a/b"))
+        self.assertTrue(self.match("a/**/b", "a/x/y/b"))
+        self.assertTrue(self.match("logs/**", "logs/2020/app.log"))
+        self.assertIsNone(self.match("logs/**", "logs"))
+
+    def test_wildcards_stop_at_separator(self):
+        self.assertIsNone(self.match("a/*", "a/b/c"))
+        self.assertTrue(self.match("a/?", "a/b"))
+        self.assertIsNone(self.match("a?b", "a/b"))
+
+    def test_sets(self):
+        self.assertTrue(self.match("*.[oa]", "lib.a"))
+        self.assertIsNone(self.match("*.[!oa]", "lib.a"))
+        self.assertTrue(self.match("*.[!oa]", "lib.c"))
+
+    def test_negation_last_wins(self):
+        lines = "*.log\n!keep.log"
+        self.assertTrue(self.match(lines, "debug.log"))
+        self.assertFalse(self.match(lines, "keep.log"))
+        self.assertTrue(self.match(lines + "\n*.log", "keep.log"))
+
+    def test_escapes(self):
+        self.assertTrue(self.match("\\#notes", "#notes"))
+        self.assertTrue(self.match("\\!bang", "!bang"))
+        self.assertTrue(self.match("trailing\\ ", "trailing "))
+        self.assertTrue(self.match("spaces   ", "spaces"))
+        self.assertTrue(self.match("a.b", "a.b"))
+        self.assertIsNone(self.match("a.b", "axb"))
+
+
+class TestIgnoreRules(TestCase):
+    def setUp(self):
+        self.ws = mkdtemp()
+        for d in ("src", "src/node_modules", "src/lib"):
+            os.mkdir(self.path(d))
+        self.rules = ignore.IgnoreRules(self.ws)
+
+    def tearDown(self):
+        rmtree(self.ws)
+
+    def path(self, name):
+        return osp.join(self.ws, name)
+
+    def write(self, dir_name, *lines):
+        with open(self.path(osp.join(dir_name, ignore.IGNORE_FILE)),
+                  "w") as f:
+            f.write("\n".join(lines) + "\n")
+
+    def test_no_ignore_files(self):
+        self.assertFalse(self.rules.ignored(self.path("src/lib/a.o")))
+        self.assertIsNone(self.rules.matcher(self.path("src")))
+
+    def test_nested(self):
+        self.write("", "*.o", "node_modules/")
+        self.write("src/lib", "!*.o")
+        self.assertTrue(self.rules.ignored(self.path("src/a.o")))
+        self.assertFalse(self.rules.ignored(self.path("src/lib/a.o")))
+        self.assertTrue(
+            self.rules.ignored(self.path("src/node_modules"), True),
+        )
+
+    def test_parent_ignored(self):
+        self.write("", "node_modules/")
+        self.write("src/node_modules", "!*")
+        path = self.path("src/node_modules/pkg/index.js")
+        self.assertTrue(self.rules.ignored(path))
+
+    def test_outside_root(self):
+        self.write("", "*")
+        self.assertFalse(self.rules.ignored(self.ws, True))
+        self.assertFalse(self.rules.ignored("/elsewhere/file"))
+
+    def test_matcher(self):
+        self.write("", "*.o")
+        self.write("src", "/lib/")
+        ignored = self.rules.matcher(self.path("src"))
+        self.assertTrue(ignored(self.path("src/lib"), True))
+        self.assertTrue(ignored(self.path("src/a.o")))
+        self.assertFalse(ignored(self.path("src/a.c")))
+
+    def test_cached(self):
+        self.write("", "*.o")
+        for _ in range(3):
+            self.rules.ignored(self.path("src/lib/a.o"))
+        self.assertEqual(self.rules.loads, 1)
+
+    def test_refresh(self):
+        changed = []
+        self.rules.on_change = changed.append
+
+        self.assertFalse(self.rules.ignored(self.path("a.o")))
+        self.write("", "*.o")
+        self.assertFalse(self.rules.ignored(self.path("a.o")), "not cached")
+
+        self.assertTrue(self.rules.refresh(self.ws))
+        self.assertTrue(self.rules.ignored(self.path("a.o")))
+        self.assertFalse(self.rules.refresh(self.ws))
+        self.assertEqual(changed, [self.ws])
+
+        os.remove(self.path(ignore.IGNORE_FILE))
+        self.assertTrue(self.rules.refresh(self.ws))
+        self.assertFalse(self.rules.ignored(self.path("a.o")))
+
+    def test_refresh_unseen(self):
+        changed = []
+        self.rules.on_change = changed.append
+        self.write("src", "*.o")
+        self.assertFalse(self.rules.refresh(self.path("src")))
+        self.assertEqual(changed, [])
+        self.assertTrue(self.rules.ignored(self.path("src/a.o")))
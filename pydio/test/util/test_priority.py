@@ -0,0 +1,140 @@
+#! /usr/bin/env python
+from twisted.trial.unittest import TestCase
+
+from twisted.internet import defer, task
+
+from pydio.util import priority
+from pydio.util.priority import Priorities, PriorityScheduler
+
+KB, GB = 1 << 10, 1 << 30
+
+
+class TestPriorities(TestCase):
+    def test_default(self):
+        self.assertEqual(Priorities().classify("/any/path"), priority.NORMAL)
+
+    def test_deepest_wins(self):
+        p = Priorities({"/backups": "low", "/backups/keys": "high",
+                        "docs/todo.txt": "high"})
+        self.assertEqual(p.classify("/backups/2020.tar"), priority.LOW)
+        self.assertEqual(p.classify("/backups/keys/id_rsa"), priority.HIGH)
+        self.assertEqual(p.classify("/backupsx"), priority.NORMAL)
+        self.assertEqual(p.classify("/docs/todo.txt"), priority.HIGH)
+        self.assertEqual(p.classify("/docs/done.txt"), priority.NORMAL)
+
+    def test_root(self):
+        p = Priorities({"/backups": "low"}, root="/home/me/sync/")
+        self.assertEqual(p.classify("/home/me/sync/backups/a"), priority.LOW)
+        self.assertEqual(p.classify("/home/me/sync"), priority.NORMAL)
+
+    def test_unknown_class(self):
+        self.assertRaises(ValueError, Priorities, {"/a": "urgent"})
+
+
+class TestPriorityScheduler(TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.clock.advance(1e6)
+        self.s = PriorityScheduler(1, clock=self.clock)
+        self.order = []
+
+    def queue(self, path, size=None, mtime=None):
+        d = self.s.acquire(path, size, mtime)
+        d.addCallback(lambda _: self.order.append(path))
+        return d
+
+    def drain(self):
+        while self.s.running:
+            self.s.release()
+
+    def test_immediate(self):
+        self.queue("/a")
+        self.assertEqual(self.order, ["/a"])
+        self.assertEqual(self.s.running, 1)
+
+    def test_small_first(self):
+        self.queue("/busy")
+        self.queue("/backup.tar", 50 * GB)
+        self.queue("/doc.txt", 10 * KB)
+        self.drain()
+        self.assertEqual(self.order, ["/busy", "/doc.txt", "/backup.tar"])
+
+    def test_recent_first(self):
+        now = self.clock.seconds()
+        self.queue("/busy")
+        self.queue("/old.txt", KB, now - 86400)
+        self.queue("/new.txt", KB, now - 1)
+        self.drain()
+        self.assertEqual(self.order, ["/busy", "/new.txt", "/old.txt"])
+
+    def test_priority_class(self):
+        self.s.priorities = Priorities({"/urgent": "high", "/bulk": "low"})
+        self.queue("/busy")
+        self.queue("/bulk/small", KB)
+        self.queue("/normal", 10 * KB)
+        self.queue("/urgent/large", GB)
+        self.drain()
+        self.assertEqual(self.order[1:],
+                         ["/urgent/large", "/normal", "/bulk/small"])
+
+    def test_aging(self):
+        self.queue("/busy")
+        self.queue("/backup.tar", 50 * GB)  # 5120s at 10 MB/s
+        self.clock.advance(5200)
+        self.queue("/doc.txt", 10 * KB)
+        self.drain()
+        self.assertEqual(self.order[1:], ["/backup.tar", "/doc.txt"])
+
+    def test_run(self):
+        results = []
+        blocker = defer.Deferred()
+        self.s.run("/a", None, None, lambda: blocker).addCallback(
+            results.append,
+        )
+        self.s.run("/b", None, None, lambda: "b").addCallback(results.append)
+        self.assertEqual(results, [])
+        blocker.callback("a")
+        self.assertEqual(sorted(results), ["a", "b"])
+        self.assertEqual(self.s.running, 0)
+
+    def test_run_failure_releases(self):
+        d = self.s.run("/a", None, None, lambda: 1 / 0)
+        self.failureResultOf(d, ZeroDivisionError)
+        self.assertEqual(self.s.running, 0)
+
+    def test_cancel(self):
+        self.queue("/busy")
+        d = self.queue("/cancelled")
+        self.queue("/next")
+        d.cancel()
+        self.failureResultOf(d, defer.CancelledError)
+        self.drain()
+        self.assertEqual(self.order, ["/busy", "/next"])
+        self.assertEqual(self.s.pending, 0)
+
+    def test_set_priorities(self):
+        self.queue("/busy")
+        self.queue("/a", KB)
+        self.queue("/b", GB)
+        self.s.set_priorities(Priorities({"/b": "high"}))
+        self.drain()
+        self.assertEqual(self.order[1:], ["/b", "/a"])
+
+    def test_stats(self):
+        self.s.priorities = Priorities({"/bulk": "low"})
+        self.queue("/busy")
+        self.queue("/bulk/a")
+        self.queue("/b")
+        self.assertEqual(self.s.stats()["pending"], 2)
+        self.assertEqual(self.s.stats()["classes"]["low"]["queued"], 1)
+
+        self.clock.advance(2)
+        self.s.release()
+        self.clock.advance(3)
+        self.s.release()
+
+        classes = self.s.stats()["classes"]
+        self.assertEqual(classes["normal"],
+                         dict(queued=0, served=2, wait_max=2., wait_mean=1.))
+        self.assertEqual(classes["low"],
+                         dict(queued=0, served=1, wait_max=5., wait_mean=5.))
@@ -0,0 +1,153 @@
+#! /usr/bin/env python
+from twisted.trial.unittest import TestCase
+
+from datetime import datetime
+
+from twisted.internet import task
+
+from pydio.util import ratelimit
+
+
+class TestTokenBucket(TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+
+    def fired(self, d):
+        fired = []
+        d.addCallback(fired.append)
+        return fired
+
+    def test_unlimited(self):
+        b = ratelimit.TokenBucket(clock=self.clock)
+        self.assertTrue(self.fired(b.consume(1 << 30)))
+
+    def test_rate(self):
+        b = ratelimit.TokenBucket(100, clock=self.clock)
+        self.clock.advance(1)  # fill the bucket
+
+        self.assertTrue(self.fired(b.consume(100)))
+        second = self.fired(b.consume(50))
+        self.assertFalse(second)
+
+        self.clock.advance(.4)
+        self.assertFalse(second)
+        self.clock.advance(.1)
+        self.assertTrue(second)
+
+    def test_fifo(self):
+        b = ratelimit.TokenBucket(10, clock=self.clock)
+        large, small = self.fired(b.consume(10)), self.fired(b.consume(1))
+        self.clock.advance(.5)
+        self.assertFalse(small, "request served out of order")
+        self.clock.advance(.5)
+        self.assertTrue(large)
+        self.assertFalse(small)
+        self.clock.advance(.1)
+        self.assertTrue(small)
+
+    def test_larger_than_burst(self):
+        b = ratelimit.TokenBucket(10, clock=self.clock)
+        self.clock.advance(1)
+        self.assertTrue(self.fired(b.consume(30)))
+
+        # the bucket is 20 tokens in debt
+        after = self.fired(b.consume(1))
+        self.clock.advance(2)
+        self.assertFalse(after)
+        self.clock.advance(.1)
+        self.assertTrue(after)
+
+    def test_set_rate_reschedules(self):
+        b = ratelimit.TokenBucket(1, clock=self.clock)
+        pending = self.fired(b.consume(1))
+        b.set_rate(10)
+        self.clock.advance(.1)
+        self.assertTrue(pending)
+
+    def test_set_unlimited(self):
+        b = ratelimit.TokenBucket(1, clock=self.clock)
+        pending = self.fired(b.consume(100))
+        b.set_rate(None)
+        self.assertTrue(pending)
+
+    def test_paused(self):
+        b = ratelimit.TokenBucket(0, clock=self.clock)
+        first, second = self.fired(b.consume(1)), self.fired(b.consume(1))
+        self.clock.advance(60)
+        self.assertFalse(first)
+        self.assertEqual(b.pending, 2)
+
+        b.set_rate(1)
+        self.clock.advance(1)
+        self.assertTrue(first)
+        self.assertFalse(second)
+        self.clock.advance(1)
+        self.assertTrue(second)
+
+    def test_negative_rate(self):
+        self.assertRaises(ValueError, ratelimit.TokenBucket, -1,
+                          clock=self.clock)
+
+    def test_cancel(self):
+        b = ratelimit.TokenBucket(1, clock=self.clock)
+        d = b.consume(1)
+        d.addErrback(lambda _: None)
+        d.cancel()
+        self.assertEqual(b.pending, 0)
+
+
+class TestGovernor(TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+
+    def test_unknown_resource(self):
+        self.assertRaises(ValueError, ratelimit.Governor, dict(disk=10))
+
+    def test_parent(self):
+        parent = ratelimit.Governor(dict(upload=10), clock=self.clock)
+        child = ratelimit.Governor(dict(upload=1000), parent=parent,
+                                   clock=self.clock)
+        fired = []
+        child.consume(ratelimit.UPLOAD, 10).addCallback(fired.append)
+        self.clock.advance(.5)
+        self.assertFalse(fired, "global limit was not enforced")
+        self.clock.advance(.5)
+        self.assertTrue(fired)
+
+    def test_set_limits(self):
+        g = ratelimit.Governor(dict(read=10), clock=self.clock)
+        g.set_limits(dict(opens=5))
+        self.assertIsNone(g.buckets[ratelimit.READ].rate)
+        self.assertEqual(g.buckets[ratelimit.OPENS].rate, 5)
+
+
+class TestSchedule(TestCase):
+    def setUp(self):
+        self.schedule = ratelimit.Schedule(dict(upload=100), [
+            dict(start_time=dict(h=9), end_time=dict(h=18, m=30),
+                 limits=dict(upload=10)),
+            dict(start_time=dict(h=23), end_time=dict(h=2),
+                 limits=dict(upload=1000)),
+        ])
+
+    def limits(self, h, m=0):
+        return self.schedule.limits_at(datetime(2017, 1, 1, h, m))
+
+    def test_window(self):
+        self.assertEqual(self.limits(9), dict(upload=10))
+        self.assertEqual(self.limits(18, 29), dict(upload=10))
+        self.assertEqual(self.limits(18, 30), dict(upload=100))
+
+    def test_wraps_midnight(self):
+        self.assertEqual(self.limits(23, 30), dict(upload=1000))
+        self.assertEqual(self.limits(1), dict(upload=1000))
+        self.assertEqual(self.limits(2), dict(upload=100))
+
+    def test_scheduled_limits(self):
+        g = ratelimit.Governor(dict(read=1))
+        svc = ratelimit.ScheduledLimits(g)
+        svc.apply()
+        self.assertEqual(g.limits, dict(read=1), "limits were reset")
+
+        svc.schedule = ratelimit.Schedule(dict(read=2))
+        self.assertEqual(g.limits, dict(read=2))
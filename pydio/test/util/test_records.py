@@ -0,0 +1,45 @@
+#! /usr/bin/env python
+from twisted.trial.unittest import TestCase
+
+import pickle
+
+from pydio.util.records import Inode, Change
+
+
+class TestRecord(TestCase):
+    def test_positional(self):
+        inode = Inode(1, "/foo", 3, "abc", 1.5)
+        self.assertEqual(inode, dict(
+            node_id=1, node_path="/foo", bytesize=3, md5="abc", mtime=1.5,
+        ))
+        self.assertEqual(inode.md5, "abc")
+
+    def test_missing_fields(self):
+        inode = Inode(node_path="/foo")
+        self.assertNotIn("md5", inode)
+        self.assertIsNone(inode.get("md5"))
+        self.assertRaises(KeyError, lambda: inode["md5"])
+        self.assertEqual(list(inode), ["node_path"])
+
+    def test_update(self):
+        inode = Inode(node_path="/foo")
+        inode.update(dict(md5="abc", chunks=[]))
+        self.assertEqual(dict(inode), dict(node_path="/foo", md5="abc",
+                                           chunks=[]))
+
+    def test_extra_keys(self):
+        inode = Inode(node_path="/foo", owner="bob")
+        self.assertEqual(inode["owner"], "bob")
+        self.assertEqual(len(inode), 2)
+
+        del inode["owner"]
+        self.assertNotIn("owner", inode)
+        self.assertRaises(KeyError, inode.__delitem__, "owner")
+        self.assertRaises(KeyError, inode.__delitem__, "md5")
+
+    def test_no_instance_dict(self):
+        self.assertFalse(hasattr(Change(1), "__dict__"))
+
+    def test_pickle(self):
+        inode = Inode(1, "/foo", owner="bob")
+        self.assertEqual(pickle.loads(pickle.dumps(inode)), inode)
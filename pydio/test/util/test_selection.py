@@ -0,0 +1,76 @@
+#! /usr/bin/env python
+from twisted.trial.unittest import TestCase
+
+from pydio.util import selection
+from pydio.util.selection import Selection
+
+
+class TestPaths(TestCase):
+    def test_normalize(self):
+        self.assertEqual(selection.normalize(""), "/")
+        self.assertEqual(selection.normalize("a//b/./c/"), "/a/b/c")
+
+    def test_within(self):
+        self.assertTrue(selection.within("/a/b", "/a"))
+        self.assertTrue(selection.within("/a", "/a"))
+        self.assertTrue(selection.within("/a", "/"))
+        self.assertFalse(selection.within("/ab", "/a"))
+
+    def test_outermost(self):
+        self.assertEqual(selection.outermost(["/a/b", "/a", "/c", "/a"]),
+                         ["/a", "/c"])
+
+
+class TestSelection(TestCase):
+    def test_everything(self):
+        s = Selection()
+        self.assertTrue(s.everything)
+        self.assertTrue(s.selected("/any/path"))
+        self.assertEqual(s, Selection.from_config(None))
+
+    def test_include(self):
+        s = Selection(include=["/photos/2020", "docs"])
+        self.assertTrue(s.selected("/docs/a.txt"))
+        self.assertTrue(s.selected("/photos/2020/img.jpg"))
+        self.assertFalse(s.selected("/photos/2019/img.jpg"))
+        self.assertFalse(s.selected("/photos"))
+        self.assertFalse(s.selected("/docsx"))
+
+    def test_traversed(self):
+        s = Selection(include=["/photos/2020"])
+        self.assertTrue(s.traversed("/"))
+        self.assertTrue(s.traversed("/photos"))
+        self.assertTrue(s.traversed("/photos/2020/a/b"))
+        self.assertFalse(s.traversed("/photos/2019"))
+        self.assertFalse(s.traversed("/notes.txt"))
+
+    def test_exclude(self):
+        s = Selection(exclude=["/build", "/docs/old"])
+        self.assertFalse(s.selected("/build/out.o"))
+        self.assertFalse(s.traversed("/docs/old"))
+        self.assertTrue(s.traversed("/docs"))
+        self.assertTrue(s.selected("/docs/new"))
+
+    def test_exclude_within_include(self):
+        s = Selection(include=["/a"], exclude=["/a/b"])
+        self.assertTrue(s.selected("/a/c"))
+        self.assertFalse(s.selected("/a/b/c"))
+        self.assertFalse(s.traversed("/a/b"))
+
+    def test_changes_exclude(self):
+        old, new = Selection(), Selection(exclude=["/build"])
+        self.assertEqual(new.changes(old), ([], ["/build"]))
+        self.assertEqual(old.changes(new), (["/build"], []))
+
+    def test_changes_narrowed(self):
+        old, new = Selection(include=["/a"]), Selection(include=["/a/b"])
+        self.assertEqual(new.changes(old), ([], ["/a"]))
+        self.assertEqual(old.changes(new), (["/a"], []))
+
+    def test_changes_swapped(self):
+        old, new = Selection(include=["/a"]), Selection(include=["/b"])
+        self.assertEqual(new.changes(old), (["/b"], ["/a"]))
+
+    def test_unchanged(self):
+        s = Selection(include=["/a"], exclude=["/a/b"])
+        self.assertEqual(s.changes(Selection(["/a/"], ["a/b"])), ([], []))
@@ -0,0 +1,113 @@
+#! /usr/bin/env python
+"""Reusable read buffers.
+
+Blocks are read with `readinto` into bytearrays taken from a BufferPool, and
+handed on as memoryviews: digesters, chunkers and codecs all accept buffers,
+so a block is read once and never copied into a new bytes object.  Twisted's
+transports only take bytes, so a BufferReader copies request bodies a slice
+at a time as they are written.  A buffer must only be released once nothing
+uses its views anymore; the next reader overwrites it.
+
+Pools are safe to use from threads.  Each keeps at most `max_free` idle
+buffers, and allocates a new one when all of them are in use.
+"""
+
+import threading
+from contextlib import contextmanager
+
+
+class BufferPool:
+    """Lends bytearrays of `size` bytes"""
+
+    def __init__(self, size, max_free=8):
+        self.size = size
+        self.max_free = max_free
+        self._free = []
+        self._lock = threading.Lock()
+        self.allocated = 0  # buffers created
+        self.reused = 0     # buffers lent again instead of created
+
+    def acquire(self):
+        with self._lock:
+            if self._free:
+                self.reused += 1
+                return self._free.pop()
+            self.allocated += 1
+        return bytearray(self.size)
+
+    def release(self, buf):
+        if len(buf) != self.size:
+            raise ValueError("buffer does not belong to this pool")
+        with self._lock:
+            if len(self._free) < self.max_free:
+                self._free.append(buf)
+
+    @contextmanager
+    def lease(self):
+        buf = self.acquire()
+        try:
+            yield buf
+        finally:
+            self.release(buf)
+
+    def stats(self):
+        return dict(size=self.size, allocated=self.allocated,
+                    reused=self.reused, free=len(self._free))
+
+
+def readinto(f, buf, size=None):
+    """Read up to `size` bytes (the whole of `buf` by default) from the file
+    object `f` into `buf`.  Returns a memoryview of the bytes read, which is
+    shorter only at the end of the file.
+    """
+    view = memoryview(buf)[:size]
+    n = 0
+    while n < len(view):
+        read = f.readinto(view[n:])
+        if not read:
+            break
+        n += read
+    return view[:n]
+
+
+def blocks(f, pool, before_read=None):
+    """Yield the content of the file object `f` as memoryviews of a single
+    buffer from `pool`, each valid until the next one is requested.  If
+    given, `before_read()` is called before each read.
+    """
+    with pool.lease() as buf:
+        while True:
+            if before_read is not None:
+                before_read()
+            block = readinto(f, buf)
+            if not block:
+                break
+            yield block
+
+
+class BufferReader:
+    """Read-only file object over a bytes-like object, for use with
+    FileBodyProducer.  Unlike io.BytesIO, it does not copy the whole buffer
+    up front: each read copies only the bytes it returns.
+    """
+
+    def __init__(self, buf):
+        self._view = memoryview(buf).cast("B")
+        self._pos = 0
+
+    def read(self, n=-1):
+        end = len(self._view) if n is None or n < 0 else self._pos + n
+        data = self._view[self._pos:end].tobytes()
+        self._pos += len(data)
+        return data
+
+    def seek(self, offset, whence=0):
+        base = (0, self._pos, len(self._view))[whence]
+        self._pos = max(0, base + offset)
+        return self._pos
+
+    def tell(self):
+        return self._pos
+
+    def close(self):
+        self._view.release()
@@ -0,0 +1,115 @@
+#! /usr/bin/env python
+"""Content-defined chunking with a gear rolling hash (FastCDC-style).
+
+Chunk boundaries depend only on the bytes preceding them, so an insertion or a
+deletion only changes the chunks around it, and near-duplicate files share
+most of their chunks.  Normalized chunking uses a stricter mask before the
+average chunk size and a looser one after it, which narrows the distribution
+of chunk sizes.
+"""
+
+import random
+from hashlib import blake2b
+
+MASK_64 = (1 << 64) - 1
+
+
+def _gear_table(seed=0x9ed10):
+    # A fixed seed keeps boundaries stable across runs and machines
+    rand = random.Random(seed)
+    return tuple(rand.getrandbits(64) for _ in range(256))
+
+
+GEAR = _gear_table()
+
+
+def _mask(bits):
+    """A mask with `bits` bits set, spread over the high half of the hash"""
+    mask, step = 0, 32 // bits
+    for k in range(bits):
+        mask |= 1 << (63 - k * step)
+    return mask
+
+
+class Chunker:
+    """Splits streams into content-defined chunks.
+
+    Feed data with `update`, which returns the chunks completed so far as
+    (digest, size) pairs, and call `final` at the end of the stream.  Only the
+    current partial chunk is buffered.
+    """
+
+    def __init__(self, min_size=2 << 10, avg_size=8 << 10, max_size=64 << 10,
+                 digest_size=20):
+        if not min_size < avg_size < max_size:
+            raise ValueError("expected min_size < avg_size < max_size")
+
+        self.min_size = min_size
+        self.avg_size = avg_size
+        self.max_size = max_size
+        self.digest_size = digest_size
+
+        bits = avg_size.bit_length() - 1
+        self._mask_s = _mask(bits + 2)
+        self._mask_l = _mask(bits - 2)
+        self.reset()
+
+    def reset(self):
+        self._buf = bytearray()
+        self._start = 0
+        self._scanned = 0
+        self._hash = 0
+
+    def _cut(self, n):
+        start = self._start
+        digest = blake2b(
+            memoryview(self._buf)[start:start + n],
+            digest_size=self.digest_size,
+        ).digest()
+        self._start += n
+        self._scanned = self._hash = 0
+        return digest, n
+
+    def _boundary(self):
+        """Return the size of the next chunk, or None if the buffered data
+        does not yet contain a boundary.
+        """
+        buf, start = self._buf, self._start
+        n = len(buf) - start
+        h, gear = self._hash, GEAR
+        i = max(self._scanned, self.min_size)
+
+        for end, mask in ((min(self.avg_size, n), self._mask_s),
+                          (min(self.max_size, n), self._mask_l)):
+            while i < end:
+                h = ((h << 1) + gear[buf[start + i]]) & MASK_64
+                i += 1
+                if not h & mask:
+                    return i
+
+        if i >= self.max_size:
+            return self.max_size
+
+        self._scanned, self._hash = i, h
+        return None
+
+    def update(self, data):
+        del self._buf[:self._start]
+        self._start = 0
+        self._buf += data
+
+        chunks = []
+        while len(self._buf) - self._start >= self.min_size:
+            n = self._boundary()
+            if n is None:
+                break
+            chunks.append(self._cut(n))
+        return chunks
+
+    def final(self):
+        chunks = []
+        while len(self._buf) > self._start:
+            n = self._boundary() or len(self._buf) - self._start
+            chunks.append(self._cut(n))
+        self.reset()
+        return chunks
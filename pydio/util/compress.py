@@ -0,0 +1,114 @@
+#! /usr/bin/env python
+"""Per-file selection of a transfer compression codec.
+
+Files whose extension marks them as already compressed are sent as is.  For
+other files, the Shannon entropy of a sample from the start of the file picks
+between no compression, a fast deflate, and a stronger codec for highly
+redundant content such as text, CSV or flat XML.
+
+Each transfer chunk is encoded independently, so that offsets and resumption
+work on uncompressed sizes and no more than one chunk is held in memory.
+"""
+
+import os.path as osp
+import lzma
+import math
+import zlib
+from collections import Counter
+
+SAMPLE_SIZE = 1 << 16
+
+# already-compressed formats, including zip-based office documents
+COMPRESSED_EXTENSIONS = frozenset("""
+    7z aac avi bz2 docx epub flac gif gz heic jar jpeg jpg lz4 m4a mkv mov mp3
+    mp4 odp ods odt ogg opus pdf png pptx rar tgz webm webp xlsx xz zip zst
+""".split())
+
+CODECS = {
+    "deflate": (
+        lambda data, level: zlib.compress(data, level),
+        zlib.decompress,
+    ),
+    "lzma": (
+        lambda data, level: lzma.compress(data, preset=level),
+        lzma.decompress,
+    ),
+}
+
+
+def entropy(sample):
+    """Shannon entropy of `sample`, in bits per byte"""
+    if not sample:
+        return 0.
+    n = len(sample)
+    return -sum(c / n * math.log2(c / n) for c in Counter(sample).values())
+
+
+def choose(path, sample, accepted=tuple(CODECS), max_entropy=7.5,
+           strong_entropy=4.5):
+    """Return the (codec, level) to use for the file at `path`, or None if it
+    should not be compressed.  `sample` is a prefix of the file and `accepted`
+    lists the codecs supported by the other end.
+    """
+    ext = osp.splitext(path)[1].lstrip(".").lower()
+    if ext in COMPRESSED_EXTENSIONS or len(sample) < 512:
+        return None
+
+    h = entropy(sample[:SAMPLE_SIZE])
+    if h > max_entropy:
+        return None
+    if h < strong_entropy and "lzma" in accepted:
+        return "lzma", 1
+    if "deflate" in accepted:
+        return "deflate", 6 if h < strong_entropy else 1
+    return None
+
+
+def encode(data, codec):
+    """Compress `data` with a (codec, level) pair, or return it unchanged if
+    `codec` is None.
+    """
+    if codec is None:
+        return data
+    name, level = codec
+    return CODECS[name][0](data, level)
+
+
+def decode(data, name):
+    if not name:
+        return data
+    try:
+        return CODECS[name][1](data)
+    except KeyError:
+        raise ValueError("unsupported content encoding {0}".format(name))
+
+
+class Stats:
+    """Running totals of raw and encoded bytes, and of the time spent
+    compressing them, per codec.
+    """
+
+    def __init__(self):
+        self.raw = Counter()
+        self.encoded = Counter()
+        self.seconds = Counter()
+
+    def add(self, name, raw, encoded, seconds):
+        self.raw[name] += raw
+        self.encoded[name] += encoded
+        self.seconds[name] += seconds
+
+    def ratio(self, name=None):
+        """Raw bytes per encoded byte, for one codec or overall"""
+        if name is None:
+            raw, encoded = sum(self.raw.values()), sum(self.encoded.values())
+        else:
+            raw, encoded = self.raw[name], self.encoded[name]
+        return raw / encoded if encoded else 1.
+
+    def as_dict(self):
+        return {
+            name: dict(raw=self.raw[name], encoded=self.encoded[name],
+                       ratio=self.ratio(name), seconds=self.seconds[name])
+            for name in self.raw
+        }
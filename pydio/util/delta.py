@@ -0,0 +1,234 @@
+#! /usr/bin/env python
+"""rsync-style block signatures and deltas.
+
+A signature describes a basis file as a sequence of fixed-size blocks, each
+identified by a weak rolling checksum (adler32) and a strong hash (md5).  A
+delta describes a new file as a sequence of COPY instructions, which reference
+blocks of the basis, and DATA instructions, which carry literal bytes.
+
+Aligned blocks are checked with zlib at C speed.  The byte-by-byte rolling
+search only runs through regions that do not match the basis, so the Python
+overhead is proportional to the size of the change rather than of the file.
+"""
+
+import os
+import mmap
+import struct
+from zlib import adler32
+from hashlib import md5
+from collections import namedtuple
+
+BLOCK = struct.Struct(">I16s")
+HEADER = struct.Struct(">BQQ")
+MOD_ADLER = 65521
+
+COPY = 0
+DATA = 1
+
+Signature = namedtuple("Signature", "md5 bytesize block_size blocks")
+
+
+def signature(path, block_size=1 << 16):
+    """Compute the Signature of the file at `path`"""
+    h, blocks, size = md5(), [], 0
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            h.update(block)
+            size += len(block)
+            blocks.append(BLOCK.pack(adler32(block), md5(block).digest()))
+    return Signature(h.hexdigest(), size, block_size, b"".join(blocks))
+
+
+def _index(sig):
+    """Map weak checksums to {strong hash: block number}"""
+    index = {}
+    for i, (weak, strong) in enumerate(BLOCK.iter_unpack(sig.blocks)):
+        index.setdefault(weak, {}).setdefault(strong, i)
+    return index
+
+
+def _append(ops, op, offset, length):
+    """Append an instruction, coalescing it with the previous one if they are
+    contiguous.
+    """
+    if ops:
+        prev_op, prev_offset, prev_length = ops[-1]
+        if prev_op == op and prev_offset + prev_length == offset:
+            ops[-1] = (op, prev_offset, prev_length + length)
+            return
+    ops.append((op, offset, length))
+
+
+def delta(path, sig, max_literal=None):
+    """Return a list of (op, offset, length) instructions that rebuild the file
+    at `path` from the basis described by `sig`.  COPY offsets refer to the
+    basis, DATA offsets to the file at `path`.
+
+    Returns None as soon as the delta would carry more than `max_literal`
+    literal bytes, so that hopeless searches are abandoned early.
+    """
+    with open(path, "rb") as f:
+        n = os.fstat(f.fileno()).st_size
+        if n == 0:
+            return []
+
+        m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            return _delta(m, n, sig, max_literal)
+        finally:
+            m.close()
+
+
+def _roll(m, i, end, B, lookup):
+    """Slide a B-byte window from offset `i` until it matches a basis block or
+    reaches `end`.  Returns (offset, block number) or (end, None).
+    """
+    weak = adler32(m[i:i + B])
+    a, b = weak & 0xffff, weak >> 16
+    j = lookup(weak, i, B)
+    while j is None and i < end:
+        out, new = m[i], m[i + B]
+        a = (a - out + new) % MOD_ADLER
+        b = (b - B * out + a - 1) % MOD_ADLER
+        i += 1
+        j = lookup((b << 16) | a, i, B)
+    return i, j
+
+
+def _literal_fraction(m, n, B, lookup, samples=16):
+    """Estimate the fraction of the file that does not match the basis.
+
+    Any offset inside a region shared with the basis lines up with a basis
+    block within B bytes, so each sample costs at most B rolling steps.
+    """
+    step = n // samples
+    misses = 0
+    for k in range(samples):
+        i = k * step
+        _, j = _roll(m, i, min(i + B, n - B), B, lookup)
+        misses += j is None
+    return misses / samples
+
+
+def _delta(m, n, sig, max_literal):
+    B = sig.block_size
+    index = _index(sig)
+    ops = []
+
+    def lookup(weak, i, length):
+        candidates = index.get(weak)
+        if candidates is not None:
+            return candidates.get(md5(m[i:i + length]).digest())
+
+    if max_literal is None:
+        max_literal = n
+    elif n > 64 * B and _literal_fraction(m, n, B, lookup) * n > max_literal:
+        return None
+
+    i = lit = 0
+    while i < n:
+        length = min(B, n - i)
+        block = m[i:i + length]
+        j = lookup(adler32(block), i, length)
+        if j is not None:
+            if i > lit:
+                _append(ops, DATA, lit, i - lit)
+                max_literal -= i - lit
+            _append(ops, COPY, j * B, length)
+            i = lit = i + length
+            continue
+
+        if n - i <= B:
+            break
+
+        # Roll the window forward until it lines up with a basis block
+        i, j = _roll(m, i, min(lit + max_literal + 1, n - B), B, lookup)
+        if j is None:
+            if i - lit > max_literal:
+                return None
+            break
+
+        _append(ops, DATA, lit, i - lit)
+        _append(ops, COPY, j * B, B)
+        max_literal -= i - lit
+        i = lit = i + B
+
+    if n - lit > max_literal:
+        return None
+    if n > lit:
+        _append(ops, DATA, lit, n - lit)
+    return ops
+
+
+def literal_size(ops):
+    """Number of literal bytes carried by a delta"""
+    return sum(length for op, _, length in ops if op == DATA)
+
+
+def encode(path, ops, chunk_size=1 << 20):
+    """Yield the wire encoding of a delta, reading literal data from `path`"""
+    with open(path, "rb") as f:
+        for op, offset, length in ops:
+            yield HEADER.pack(op, offset, length)
+            if op == DATA:
+                f.seek(offset)
+                while length > 0:
+                    data = f.read(min(chunk_size, length))
+                    if not data:
+                        raise IOError("{0} shrank while encoding".format(path))
+                    length -= len(data)
+                    yield data
+
+
+def encoded_size(ops):
+    return HEADER.size * len(ops) + literal_size(ops)
+
+
+def _copy(src, dst, length, chunk_size=1 << 20):
+    while length > 0:
+        data = src.read(min(chunk_size, length))
+        if not data:
+            raise IOError("unexpected end of delta stream")
+        dst.write(data)
+        length -= len(data)
+
+
+def patch(basis, stream, out):
+    """Apply an encoded delta read from the file-like `stream`, writing the
+    result to `out`.  `basis` must be seekable.
+    """
+    while True:
+        header = stream.read(HEADER.size)
+        if not header:
+            return
+        if len(header) < HEADER.size:
+            raise IOError("truncated delta header")
+
+        op, offset, length = HEADER.unpack(header)
+        if op == COPY:
+            basis.seek(offset)
+            _copy(basis, out, length)
+        elif op == DATA:
+            _copy(stream, out, length)
+        else:
+            raise IOError("unknown delta instruction {0}".format(op))
+
+
+class DeltaReader:
+    """File-like adapter over `encode`, for use with FileBodyProducer"""
+
+    def __init__(self, path, ops):
+        self._gen = encode(path, ops)
+        self._buf = b""
+
+    def read(self, n):
+        while len(self._buf) < n:
+            try:
+                self._buf += next(self._gen)
+            except StopIteration:
+                break
+        data, self._buf = self._buf[:n], self._buf[n:]
+        return data
+
+    def close(self):
+        self._gen.close()
@@ -0,0 +1,239 @@
+#! /usr/bin/env python
+"""Per-directory ignore files, with gitignore syntax.
+
+A `.pydioignore` file applies to the entries of its directory and of all its
+subdirectories.  Each line holds a glob; a `!` prefix re-includes what an
+earlier pattern excluded, a trailing `/` only matches directories, and a
+pattern that contains a `/` is anchored to the directory of the ignore file,
+while other patterns match at any depth.  `*` and `?` do not match `/`, and
+`**` matches any number of directories.  Rules of deeper ignore files take
+precedence, and within a file the last matching rule wins.  As with git, an
+entry cannot be re-included if one of its parent directories is ignored.
+
+Rules are compiled to regular expressions once per ignore file and cached,
+so that matching a path costs no I/O.  The cache is invalidated by `refresh`,
+which callers invoke when they see an ignore file change.
+"""
+
+import os
+import re
+import os.path as osp
+from collections import namedtuple
+
+IGNORE_FILE = ".pydioignore"
+
+# any number of leading directories, including none
+_ANY_DIRS = "(?:.*/)?"
+
+Rule = namedtuple("Rule", ("regex", "negate", "dir_only"))
+
+
+def translate(pattern):
+    """Translate a glob to a regex matching paths relative to the directory
+    of its ignore file, with `/` as the separator.
+    """
+    out, i, n = [], 0, len(pattern)
+    while i < n:
+        if pattern.startswith("**/", i):
+            out.append(_ANY_DIRS)
+            i += 3
+            continue
+        if pattern.startswith("**", i):
+            out.append(".*")
+            i += 2
+            continue
+
+        c = pattern[i]
+        i += 1
+        if c == "*":
+            out.append("[^/]*")
+        elif c == "?":
+            out.append("[^/]")
+        elif c == "\\" and i < n:
+            out.append(re.escape(pattern[i]))
+            i += 1
+        elif c == "[":
+            # a `]` right after the opening bracket is part of the set
+            j = pattern.find("]", i + 1 if pattern[i:i + 1] in "!]" else i)
+            if j == -1:
+                out.append(re.escape(c))
+                continue
+            body = pattern[i:j].replace("\\", "\\\\")
+            if body.startswith("!"):
+                body = "^" + body[1:]
+            out.append("[" + body + "]")
+            i = j + 1
+        else:
+            out.append(re.escape(c))
+    return "".join(out)
+
+
+def parse_rule(line):
+    """Compile a line of an ignore file.  Returns None for blank lines and
+    comments.
+    """
+    line = line.rstrip("\r\n")
+    if not line.strip() or line.startswith("#"):
+        return None
+
+    # trailing spaces are dropped unless escaped
+    while line.endswith(" ") and not line.endswith("\\ "):
+        line = line[:-1]
+
+    negate = line.startswith("!")
+    if negate:
+        line = line[1:]
+    elif line.startswith(("\\!", "\\#")):
+        line = line[1:]
+
+    dir_only = line.endswith("/")
+    line = line.rstrip("/")
+    if not line:
+        return None
+
+    regex = translate(line.lstrip("/"))
+    if "/" not in line:
+        regex = _ANY_DIRS + regex
+    return Rule(re.compile(regex + r"\Z", re.DOTALL), negate, dir_only)
+
+
+class RuleSet:
+    """The compiled rules of one ignore file"""
+
+    __slots__ = ("rules",)
+
+    def __init__(self, rules):
+        self.rules = tuple(reversed(rules))
+
+    @classmethod
+    def parse(cls, lines):
+        """Compile the lines of an ignore file.  Returns None if it holds no
+        rules.
+        """
+        rules = [r for r in map(parse_rule, lines) if r is not None]
+        return cls(rules) if rules else None
+
+    def match(self, relpath, is_dir):
+        """True if the last rule matching `relpath` ignores it, False if it
+        re-includes it, None if no rule matches.
+        """
+        for rule in self.rules:
+            if rule.dir_only and not is_dir:
+                continue
+            if rule.regex.match(relpath):
+                return not rule.negate
+        return None
+
+
+class IgnoreRules:
+    """Caches the compiled ignore files found under `root`.
+
+    Ignore files are read the first time a path below their directory is
+    matched.  `on_change(dir_path)` is called, possibly from a thread, when
+    `refresh` finds that an ignore file that was already read has changed.
+    """
+
+    def __init__(self, root, name=IGNORE_FILE, on_change=None):
+        self.root = osp.normpath(root)
+        self.name = name
+        self.on_change = on_change
+        self.loads = 0
+
+        # dir_path: (stat key of the ignore file or None, RuleSet or None)
+        self._cache = {}
+
+    def _key(self, dir_path):
+        try:
+            st = os.stat(osp.join(dir_path, self.name))
+        except OSError:
+            return None
+        return st.st_ino, st.st_size, st.st_mtime_ns
+
+    def _load(self, dir_path, key):
+        rules = None
+        if key is not None:
+            self.loads += 1
+            path = osp.join(dir_path, self.name)
+            try:
+                with open(path, encoding="utf-8",
+                          errors="surrogateescape") as f:
+                    rules = RuleSet.parse(f)
+            except OSError:
+                key = None
+        self._cache[dir_path] = key, rules
+        return rules
+
+    def rules(self, dir_path):
+        """The RuleSet of the directory `dir_path`, or None"""
+        try:
+            return self._cache[dir_path][1]
+        except KeyError:
+            return self._load(dir_path, self._key(dir_path))
+
+    def refresh(self, dir_path):
+        """Reload the ignore file of `dir_path` if it was created, modified or
+        removed since it was read.  Returns True if it was.
+        """
+        dir_path = osp.normpath(dir_path)
+        key = self._key(dir_path)
+        cached = self._cache.get(dir_path)
+        if cached is None:
+            self._load(dir_path, key)
+            return False  # nothing was matched against the old rules
+        if cached[0] == key:
+            return False
+
+        self._load(dir_path, key)
+        if self.on_change is not None:
+            self.on_change(dir_path)
+        return True
+
+    def _ancestors(self, path):
+        """The directories from the root down to the parent of `path`"""
+        rel = osp.relpath(path, self.root)
+        if rel == os.curdir or rel.startswith(os.pardir):
+            return []
+        dirs = [self.root]
+        for part in rel.split(os.sep)[:-1]:
+            dirs.append(osp.join(dirs[-1], part))
+        return dirs
+
+    def _matcher(self, dirs):
+        chain = []
+        for d in dirs:
+            rules = self.rules(d)
+            if rules is not None:
+                chain.append((len(osp.join(d, "")), rules))
+        return chain
+
+    @staticmethod
+    def _match(chain, path, is_dir):
+        # deeper rule sets are consulted first, since they take precedence
+        for prefix, rules in reversed(chain):
+            rel = path[prefix:]
+            if os.sep != "/":
+                rel = rel.replace(os.sep, "/")
+            result = rules.match(rel, is_dir)
+            if result is not None:
+                return result
+        return False
+
+    def ignored(self, path, is_dir=False):
+        """True if `path` or one of its parent directories is ignored"""
+        path = osp.normpath(path)
+        dirs = self._ancestors(path)
+        for k in range(1, len(dirs)):
+            if self._match(self._matcher(dirs[:k]), dirs[k], True):
+                return True
+        return self._match(self._matcher(dirs), path, is_dir)
+
+    def matcher(self, dir_path):
+        """A function of (path, is_dir) telling if an entry of the directory
+        `dir_path` is ignored, assuming the directory itself is not.  Returns
+        None if no rules apply to its entries.
+        """
+        dir_path = osp.normpath(dir_path)
+        chain = self._matcher(self._ancestors(osp.join(dir_path, "x")))
+        if not chain:
+            return None
+        return lambda path, is_dir=False: self._match(chain, path, is_dir)
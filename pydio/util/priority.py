@@ -0,0 +1,203 @@
+#! /usr/bin/env python
+"""Priority scheduling of the hashing and transfer stages.
+
+A PriorityScheduler runs at most `slots` operations at once.  The others
+wait in a queue ordered by a virtual deadline: the time the operation was
+queued, plus a handicap, in seconds, that grows with the priority class of
+its path, the size of its file and the time since that file was modified.
+Small files and freshly saved ones thus overtake large or old ones, and the
+files of a high-priority folder overtake those of the same size elsewhere,
+by fifteen minutes.  Since operations queued
+later get later deadlines, one that waits long enough always runs: a file
+of the `low` class runs before any `normal` file of the same size and age
+queued more than an hour and three quarters after it.
+
+Priority classes are assigned to subtrees, with paths relative to the
+job's folder as in pydio.util.selection; the deepest matching rule wins.
+"""
+
+import heapq
+import os.path as osp
+from math import log2
+from collections import defaultdict
+
+from twisted.internet import defer
+
+from pydio.util.selection import normalize, within
+
+HIGH = "high"
+NORMAL = "normal"
+LOW = "low"
+
+# handicap of each priority class, in seconds of waiting
+CLASSES = {HIGH: 0., NORMAL: 900., LOW: 7200.}
+
+
+class Priorities:
+    """Maps paths to priority classes.  `rules` maps subtrees or files to
+    class names; other paths are `normal`.  Paths below `root`, if given,
+    are made relative to it first.
+    """
+
+    def __init__(self, rules=None, root=None):
+        rules = {normalize(p): c for p, c in (rules or {}).items()}
+        unknown = set(rules.values()) - CLASSES.keys()
+        if unknown:
+            raise ValueError(
+                "unknown priority classes {0}".format(sorted(unknown)),
+            )
+
+        # the longest of two nested paths is the deepest
+        self.rules = sorted(rules.items(), key=lambda r: -len(r[0]))
+        self.root = osp.normpath(root) if root else None
+
+    def as_dict(self):
+        return dict(self.rules)
+
+    def relative(self, path):
+        if self.root is not None and within(path, self.root):
+            return normalize(path[len(self.root):])
+        return normalize(path)
+
+    def classify(self, path):
+        """The priority class of `path`"""
+        path = self.relative(path)
+        for root, cls in self.rules:
+            if within(path, root):
+                return cls
+        return NORMAL
+
+
+class WaitStats:
+    """Queue wait times of the operations of one priority class"""
+
+    __slots__ = ("queued", "served", "total", "max")
+
+    def __init__(self):
+        self.queued = self.served = 0
+        self.total = self.max = 0.
+
+    def add(self, wait):
+        self.served += 1
+        self.total += wait
+        self.max = max(self.max, wait)
+
+    def as_dict(self):
+        return dict(
+            queued=self.queued, served=self.served, wait_max=self.max,
+            wait_mean=self.total / self.served if self.served else 0.,
+        )
+
+
+class PriorityScheduler:
+    """Runs at most `slots` operations at once, in order of virtual deadline.
+
+    The size handicap is one second per `size_rate` bytes, so that files
+    queue roughly shortest first, and the recency handicap `recency_weight`
+    seconds per doubling of the time since the file was modified.  Unknown
+    sizes and mtimes count as zero.
+    Must be used from the reactor thread.
+    """
+
+    def __init__(self, slots=4, priorities=None, size_rate=10 << 20,
+                 recency_weight=1., clock=None):
+        if clock is None:
+            from twisted.internet import reactor as clock
+        self._clock = clock
+
+        self.slots = slots
+        self.priorities = priorities or Priorities()
+        self.size_rate = size_rate
+        self.recency_weight = recency_weight
+        self.running = 0
+
+        # [deadline, seq, cls, path, size, mtime, queued at, Deferred or None]
+        self._queue = []
+        self._seq = 0
+        self._waits = defaultdict(WaitStats)
+
+    def handicap(self, cls, size, mtime, now):
+        """Seconds added to the deadline of an operation queued at `now`"""
+        h = CLASSES[cls]
+        if size and self.size_rate:
+            h += size / self.size_rate
+        if mtime is not None:
+            h += self.recency_weight * log2(1 + max(0., now - mtime))
+        return h
+
+    def acquire(self, path, size=None, mtime=None):
+        """Fire once a slot is available to the operation on `path`.  Call
+        `release` when it is done.
+        """
+        cls = self.priorities.classify(path)
+        now = self._clock.seconds()
+        if self.running < self.slots and not self._queue:
+            self.running += 1
+            self._waits[cls].add(0.)
+            return defer.succeed(self)
+
+        d = defer.Deferred(lambda d: self._cancel(entry))
+        deadline = now + self.handicap(cls, size, mtime, now)
+        entry = [deadline, self._seq, cls, path, size, mtime, now, d]
+        self._seq += 1
+        self._waits[cls].queued += 1
+        heapq.heappush(self._queue, entry)
+        self._drain()
+        return d
+
+    def _cancel(self, entry):
+        entry[-1] = None
+        self._waits[entry[2]].queued -= 1
+
+    def release(self):
+        self.running -= 1
+        self._drain()
+
+    def _drain(self):
+        now = self._clock.seconds()
+        while self._queue and self.running < self.slots:
+            entry = heapq.heappop(self._queue)
+            d = entry[-1]
+            if d is None:
+                continue  # cancelled
+            stats = self._waits[entry[2]]
+            stats.queued -= 1
+            stats.add(now - entry[6])
+            self.running += 1
+            d.callback(self)
+
+    def run(self, path, size, mtime, f, *args, **kw):
+        """Call `f(*args, **kw)` once a slot is available, and release it when
+        the Deferred it returns fires.
+        """
+        def release(result):
+            self.release()
+            return result
+
+        def call(_):
+            return defer.maybeDeferred(f, *args, **kw).addBoth(release)
+
+        return self.acquire(path, size, mtime).addCallback(call)
+
+    def set_priorities(self, priorities):
+        """Replace the priority rules, including for queued operations"""
+        self.priorities = priorities
+        for entry in self._queue:
+            cls = priorities.classify(entry[3])
+            if entry[-1] is not None and cls != entry[2]:
+                self._waits[entry[2]].queued -= 1
+                self._waits[cls].queued += 1
+            entry[0] = entry[6] + self.handicap(cls, *entry[4:7])
+            entry[2] = cls
+        heapq.heapify(self._queue)
+
+    @property
+    def pending(self):
+        return sum(1 for e in self._queue if e[-1] is not None)
+
+    def stats(self):
+        """Queue wait times per priority class, in seconds"""
+        return dict(
+            slots=self.slots, running=self.running, pending=self.pending,
+            classes={c: s.as_dict() for c, s in sorted(self._waits.items())},
+        )
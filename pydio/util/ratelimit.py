@@ -0,0 +1,195 @@
+#! /usr/bin/env python
+"""Token-bucket rate limits for disk and network usage.
+
+A Governor holds one bucket per resource.  Each job has its own Governor,
+whose parent is the global one shared by all jobs, so that an operation waits
+for both the job's limits and the global ones.  Rates may be changed at any
+time; waiting operations are rescheduled at the new rate.
+"""
+
+from collections import deque
+from datetime import datetime
+
+from twisted.internet import defer
+from twisted.internet.threads import blockingCallFromThread
+from twisted.application.internet import TimerService
+
+READ = "read"          # bytes read from disk per second
+UPLOAD = "upload"      # bytes sent per second
+DOWNLOAD = "download"  # bytes received per second
+OPENS = "opens"        # files opened per second
+
+RESOURCES = (READ, UPLOAD, DOWNLOAD, OPENS)
+
+
+class TokenBucket:
+    """Allows `rate` units per second on average, with bursts of up to `burst`
+    units.  A rate of None means unlimited, and a rate of 0 holds every
+    request until the rate is raised.
+
+    Requests are served in order.  A request larger than the burst size waits
+    for a full bucket and leaves it in debt, so that the long-run rate holds.
+    """
+
+    def __init__(self, rate=None, burst=None, clock=None):
+        if clock is None:
+            from twisted.internet import reactor as clock
+        self._clock = clock
+
+        self._waiters = deque()
+        self._call = None
+        self.rate = None
+        self.burst = None
+        self._tokens = 0.
+        self._stamp = clock.seconds()
+        self.set_rate(rate, burst)
+
+    def set_rate(self, rate, burst=None):
+        """Change the rate, which takes effect immediately, including for
+        pending requests.  `burst` defaults to one second's worth of tokens.
+        """
+        if rate is not None and rate < 0:
+            raise ValueError("negative rate {0}".format(rate))
+        self._refill()
+        self.rate = rate
+        self.burst = burst or rate
+        if rate is not None:
+            self._tokens = min(self._tokens, self.burst)
+        self._drain()
+
+    def _refill(self):
+        now = self._clock.seconds()
+        if self.rate is not None:
+            self._tokens = min(
+                self.burst, self._tokens + (now - self._stamp) * self.rate,
+            )
+        self._stamp = now
+
+    def consume(self, n=1):
+        """Return a Deferred that fires once `n` units may be used"""
+        d = defer.Deferred(lambda d: self._waiters.remove((n, d)))
+        self._waiters.append((n, d))
+        self._drain()
+        return d
+
+    def _drain(self):
+        if self._call is not None and self._call.active():
+            self._call.cancel()
+        self._call = None
+
+        self._refill()
+        ready = []
+        while self._waiters:
+            n, d = self._waiters[0]
+            if self.rate == 0:
+                break  # paused; set_rate drains again
+            if self.rate is not None:
+                needed = min(n, self.burst)
+                if self._tokens < needed:
+                    delay = (needed - self._tokens) / self.rate
+                    self._call = self._clock.callLater(delay, self._drain)
+                    break
+                self._tokens -= n
+
+            self._waiters.popleft()
+            ready.append(d)
+
+        # fire once the bucket is consistent, since callbacks may consume more
+        for d in ready:
+            d.callback(None)
+
+    @property
+    def pending(self):
+        return len(self._waiters)
+
+
+class Governor:
+    """A set of token buckets, one per resource in RESOURCES.  `limits` maps
+    resource names to rates; missing resources are unlimited.
+    """
+
+    def __init__(self, limits=None, parent=None, clock=None):
+        self.parent = parent
+        self.buckets = {r: TokenBucket(clock=clock) for r in RESOURCES}
+        self.limits = {}
+        self.set_limits(limits)
+
+    def set_limits(self, limits):
+        limits = dict(limits or {})
+        unknown = limits.keys() - set(RESOURCES)
+        if unknown:
+            raise ValueError("unknown resources {0}".format(sorted(unknown)))
+
+        self.limits = limits
+        for resource, bucket in self.buckets.items():
+            bucket.set_rate(limits.get(resource))
+
+    @defer.inlineCallbacks
+    def consume(self, resource, n=1):
+        yield self.buckets[resource].consume(n)
+        if self.parent is not None:
+            yield self.parent.consume(resource, n)
+
+    def blocking_consume(self, resource, n=1):
+        """Wait for `n` units from a thread other than the reactor's"""
+        from twisted.internet import reactor
+        blockingCallFromThread(reactor, self.consume, resource, n)
+
+
+def _minutes(t):
+    return t["h"] * 60 + t.get("m", 0)
+
+
+class Schedule:
+    """Time-of-day limits.
+
+    `windows` is a list of dicts with a `start_time` and an `end_time`, each
+    written `{h: 9, m: 30}` like a job's `start_time`, and the `limits` that
+    apply between them.  Windows may wrap around midnight.  `default` applies
+    outside all windows.
+    """
+
+    def __init__(self, default=None, windows=()):
+        self.default = default or {}
+        self.windows = [
+            (_minutes(w["start_time"]), _minutes(w["end_time"]), w["limits"])
+            for w in windows
+        ]
+
+    def limits_at(self, when=None):
+        when = when or datetime.now()
+        now = when.hour * 60 + when.minute
+        for start, end, limits in self.windows:
+            if start <= end:
+                active = start <= now < end
+            else:
+                active = now >= start or now < end
+            if active:
+                return limits
+        return self.default
+
+
+class ScheduledLimits(TimerService):
+    """Applies a Schedule to a Governor, checking it every `interval`
+    seconds.  Assigning a new schedule takes effect immediately.  Without a
+    schedule, the governor keeps its current limits.
+    """
+
+    def __init__(self, governor, schedule=None, interval=60):
+        super().__init__(interval, self.apply)
+        self.governor = governor
+        self._schedule = schedule or Schedule(governor.limits)
+
+    @property
+    def schedule(self):
+        return self._schedule
+
+    @schedule.setter
+    def schedule(self, schedule):
+        self._schedule = schedule
+        self.apply()
+
+    def apply(self):
+        limits = self._schedule.limits_at()
+        if limits != self.governor.limits:
+            self.governor.set_limits(limits)
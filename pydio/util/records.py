@@ -0,0 +1,109 @@
+#! /usr/bin/env python
+"""Compact, dict-compatible records for inodes and changes.
+
+Inodes and changes used to be plain dicts, which cost several hundred bytes
+each and make every field access a hash lookup.  Records keep their known
+fields in `__slots__` and behave as mutable mappings, so that code written
+against dicts, including other IStateManager implementations, keeps
+working.  A field that was never set is absent, exactly like a missing dict
+key.  Unknown keys are stored in a per-record dict, created on first use.
+"""
+
+from collections.abc import MutableMapping
+
+_MISSING = object()
+
+
+def _make_init(fields):
+    """Generate an __init__ that assigns each field directly, which is several
+    times faster than a loop over setattr.
+    """
+    lines = ["def __init__(self, {0}, **kw):".format(
+        ", ".join(f + "=_MISSING" for f in fields)
+    )]
+    for f in fields:
+        lines.append("    if {0} is not _MISSING: self.{0} = {0}".format(f))
+    lines.append("    if kw: self.update(kw)")
+
+    ns = dict(_MISSING=_MISSING)
+    exec("\n".join(lines), ns)
+    return ns["__init__"]
+
+
+class Record(MutableMapping):
+    """Base class for records.  Subclasses list their fields in `_fields`
+    and use it as their `__slots__`.  Positional arguments fill the fields in
+    order.
+
+    Code that knows it holds a record should prefer attribute access, which
+    is much faster than item access.
+    """
+
+    __slots__ = ("_extra",)
+    _fields = ()
+
+    def __init_subclass__(cls, **kw):
+        super().__init_subclass__(**kw)
+        cls._keys = frozenset(cls._fields)
+        cls.__init__ = _make_init(cls._fields)
+
+    def __getitem__(self, key):
+        try:
+            if key in self._keys:
+                return getattr(self, key)
+            return self._extra[key]
+        except AttributeError:
+            raise KeyError(key) from None
+
+    def __setitem__(self, key, value):
+        if key in self._keys:
+            setattr(self, key, value)
+            return
+
+        try:
+            self._extra[key] = value
+        except AttributeError:
+            self._extra = {key: value}
+
+    def __delitem__(self, key):
+        try:
+            if key in self._keys:
+                delattr(self, key)
+            else:
+                del self._extra[key]
+        except AttributeError:
+            raise KeyError(key) from None
+
+    def __iter__(self):
+        for name in self._fields:
+            if hasattr(self, name):
+                yield name
+        yield from getattr(self, "_extra", ())
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __repr__(self):
+        return "{0}({1!r})".format(type(self).__name__, dict(self))
+
+    def __reduce__(self):
+        return type(self), (), None, None, iter(self.items())
+
+
+class Inode(Record):
+    """An inode, as passed from the storage layer to the IStateManager and
+    from the IWorkQueue to the merger.
+    """
+
+    _fields = (
+        "node_id", "node_path", "bytesize", "md5", "mtime", "stat_result",
+        "blake2b", "sha256", "block_size", "blocks", "chunks",
+    )
+    __slots__ = _fields
+
+
+class Change(Record):
+    """A row of `ajxp_changes`, as produced by an IDiffStream"""
+
+    _fields = ("seq", "node_id", "type", "source", "target", "deleted_md5")
+    __slots__ = _fields
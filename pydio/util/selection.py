@@ -0,0 +1,97 @@
+#! /usr/bin/env python
+"""Selective sync: the subtrees of a workspace that a job synchronizes.
+
+Paths are relative to the synchronized folder (the job's `remote_folder` on
+the server, its `directory` locally) and start with a slash; `/` is the
+folder itself.  A path is selected if it lies within an included subtree,
+or anywhere when nothing is included, and not within an excluded one.  The
+ancestors of an included subtree are traversed, so that it can be reached,
+but their other entries are not selected.
+"""
+
+
+def normalize(path):
+    """`path` with a leading slash and without empty or `.` components"""
+    return "/" + "/".join(p for p in path.split("/") if p not in ("", "."))
+
+
+def within(path, root):
+    """True if `path` is `root` or lies beneath it"""
+    return root == "/" or path == root or path.startswith(root + "/")
+
+
+def covers(roots, path):
+    """True if `path` lies within one of `roots` or is an ancestor of one"""
+    return any(within(path, r) or within(r, path) for r in roots)
+
+
+def outermost(roots):
+    """`roots` without the paths that lie beneath another of them"""
+    roots = sorted(set(roots))
+    return [r for r in roots
+            if not any(r != o and within(r, o) for o in roots)]
+
+
+class Selection:
+    """A set of included and excluded subtrees"""
+
+    __slots__ = ("include", "exclude")
+
+    def __init__(self, include=(), exclude=()):
+        self.include = tuple(outermost(map(normalize, include))) or ("/",)
+        self.exclude = tuple(outermost(map(normalize, exclude)))
+
+    @classmethod
+    def from_config(cls, cfg):
+        """Build the selection described by a job's `selection` option"""
+        return cls(**(cfg or {}))
+
+    def __eq__(self, other):
+        return isinstance(other, Selection) and (
+            (self.include, self.exclude) == (other.include, other.exclude)
+        )
+
+    def __repr__(self):
+        return "Selection(include={0!r}, exclude={1!r})".format(
+            self.include, self.exclude,
+        )
+
+    @property
+    def everything(self):
+        return self.include == ("/",) and not self.exclude
+
+    def as_dict(self):
+        return dict(include=list(self.include), exclude=list(self.exclude))
+
+    def excluded(self, path):
+        return any(within(path, e) for e in self.exclude)
+
+    def selected(self, path):
+        """True if `path` and its content are synchronized"""
+        path = normalize(path)
+        return any(within(path, i) for i in self.include) and (
+            not self.excluded(path)
+        )
+
+    def traversed(self, path):
+        """True if `path` is selected, or is a directory holding a selected
+        subtree.  Paths that are not traversed are never listed, hashed,
+        indexed or watched.
+        """
+        path = normalize(path)
+        if self.excluded(path):
+            return False
+        return any(within(path, i) or within(i, path) for i in self.include)
+
+    def changes(self, old):
+        """Return the outermost subtrees to fetch and to evict when the
+        selection changes from `old` to this one.  Only the paths beneath
+        them whose selection changed need to be fetched or evicted.
+        """
+        candidates = set(self.include + self.exclude + old.include +
+                         old.exclude)
+        fetch = [p for p in candidates
+                 if self.selected(p) and not old.selected(p)]
+        evict = [p for p in candidates
+                 if old.selected(p) and not self.selected(p)]
+        return outermost(fetch), outermost(evict)
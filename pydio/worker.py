@@ -0,0 +1,351 @@
+#! /usr/bin/env python
+"""Run groups of jobs in worker processes supervised by the Scheduler.
+
+Each worker is a separate Python process running its own reactor and
+Scheduler, so that hashing, filtering and SQLite work are spread over several
+cores.  The supervisor and its workers exchange AMP commands over the
+worker's stdin and stdout.  A worker that exits unexpectedly is restarted,
+with an exponential backoff, without affecting the other workers.
+"""
+
+import os
+import sys
+import json
+import os.path as osp
+
+from twisted.logger import Logger
+from twisted.internet import defer, protocol, error
+from twisted.protocols import amp
+from twisted.application.service import Service
+
+
+class JSON(amp.Argument):
+    def toString(self, obj):
+        return json.dumps(obj, separators=(",", ":")).encode()
+
+    def fromString(self, data):
+        return json.loads(data.decode())
+
+
+class Start(amp.Command):
+    """Configure and start the worker's jobs"""
+    arguments = [(b"jobs", JSON()), (b"limits", JSON()), (b"schedule", JSON())]
+    response = []
+
+
+class Status(amp.Command):
+    """Report {job name: status} for the worker's jobs"""
+    arguments = []
+    response = [(b"status", JSON())]
+
+
+class SetLimits(amp.Command):
+    """Replace the limits of one job, or the worker's global limits if `job`
+    is omitted.
+    """
+    arguments = [
+        (b"job", amp.Unicode(optional=True)),
+        (b"limits", JSON()),
+        (b"schedule", JSON()),
+    ]
+    response = []
+    errors = {KeyError: b"UNKNOWN_JOB"}
+
+
+class SetSelection(amp.Command):
+    """Replace the subtrees synchronized by a job"""
+    arguments = [
+        (b"job", amp.Unicode()),
+        (b"include", JSON()),
+        (b"exclude", JSON()),
+    ]
+    response = []
+    errors = {KeyError: b"UNKNOWN_JOB"}
+
+
+class SetPriorities(amp.Command):
+    """Replace the priority classes of a job's subtrees"""
+    arguments = [(b"job", amp.Unicode()), (b"priorities", JSON())]
+    response = []
+    errors = {KeyError: b"UNKNOWN_JOB", ValueError: b"BAD_PRIORITIES"}
+
+
+class Stop(amp.Command):
+    """Stop the worker's jobs and exit"""
+    arguments = []
+    response = []
+    requiresAnswer = False
+
+
+class WorkerProtocol(amp.AMP):
+    """Worker side of the supervision protocol.  The worker exits when its
+    jobs are stopped or when the supervisor goes away.
+    """
+
+    log = Logger()
+
+    def __init__(self, reactor=None):
+        super().__init__()
+        if reactor is None:
+            from twisted.internet import reactor
+        self._reactor = reactor
+        self.scheduler = None
+
+    @Start.responder
+    def start(self, jobs, limits, schedule):
+        from pydio.sched import Scheduler
+
+        self.scheduler = Scheduler(jobs, limits=limits, schedule=schedule)
+        self.scheduler.startService()
+        return {}
+
+    @Status.responder
+    def status(self):
+        if self.scheduler is None:
+            return {"status": {}}
+        return self.scheduler.status().addCallback(lambda s: {"status": s})
+
+    @SetLimits.responder
+    def set_limits(self, limits, schedule, job=None):
+        if job is None:
+            self.scheduler.set_limits(limits, schedule)
+        else:
+            self.scheduler.job(job).set_limits(limits, schedule)
+        return {}
+
+    @SetSelection.responder
+    def set_selection(self, job, include, exclude):
+        d = self.scheduler.job(job).set_selection(include, exclude)
+        return d.addCallback(lambda _: {})
+
+    @SetPriorities.responder
+    def set_priorities(self, job, priorities):
+        self.scheduler.job(job).set_priorities(priorities)
+        return {}
+
+    @Stop.responder
+    def stop(self):
+        self.transport.loseConnection()
+        return {}
+
+    @defer.inlineCallbacks
+    def connectionLost(self, reason):
+        super().connectionLost(reason)
+        if self.scheduler is not None and self.scheduler.running:
+            yield self.scheduler.stopService()
+        if self._reactor.running:
+            self._reactor.stop()
+
+
+def _worker_env():
+    """The supervisor's environment, with this copy of pydio importable"""
+    root = osp.dirname(osp.dirname(osp.abspath(__file__)))
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join(
+        p for p in (root, env.get("PYTHONPATH")) if p
+    )
+    return env
+
+
+class _StdinTransport:
+    """Presents a child process' stdin as the transport of an AMP protocol"""
+
+    def __init__(self, transport):
+        self._transport = transport
+
+    def write(self, data):
+        self._transport.write(data)
+
+    def writeSequence(self, seq):
+        self._transport.writeSequence(seq)
+
+    def loseConnection(self):
+        self._transport.closeStdin()
+
+    def getPeer(self):
+        return ("subprocess", self._transport.pid)
+
+    def getHost(self):
+        return ("supervisor", os.getpid())
+
+
+class _WorkerProcessProtocol(protocol.ProcessProtocol):
+    """Connects an AMP client to a worker process' stdio"""
+
+    def __init__(self, supervisor):
+        self.supervisor = supervisor
+        self.amp = amp.AMP()
+
+    def connectionMade(self):
+        self.amp.makeConnection(_StdinTransport(self.transport))
+        self.supervisor._connected(self)
+
+    def outReceived(self, data):
+        self.amp.dataReceived(data)
+
+    def processEnded(self, reason):
+        self.amp.connectionLost(reason)
+        self.supervisor._ended(self, reason)
+
+
+class WorkerProcess(Service):
+    """Runs `jobs` ({job name: configuration options}) in a worker process.
+
+    The worker is restarted if it exits while the service is running.  The
+    restart delay doubles after each crash, from `restart_delay` up to
+    `max_restart_delay`, and is reset once a worker has stayed up for
+    `max_restart_delay` seconds.
+    """
+
+    log = Logger()
+
+    def __init__(self, name, jobs, limits=None, schedule=(),
+                 restart_delay=1., max_restart_delay=60., stop_timeout=10.,
+                 reactor=None):
+        self.setName(name)
+        self.jobs = jobs
+        self.limits = limits
+        self.schedule = list(schedule)
+        self.restart_delay = restart_delay
+        self.max_restart_delay = max_restart_delay
+        self.stop_timeout = stop_timeout
+        self.restarts = 0
+
+        if reactor is None:
+            from twisted.internet import reactor
+        self._reactor = reactor
+
+        self._proto = None
+        self._started_at = None
+        self._delay = restart_delay
+        self._restart = None
+        self._stopped = None
+
+    def __str__(self):
+        return "<WorkerProcess {0} ({1} jobs)>".format(self.name, len(self.jobs))
+
+    def startService(self):
+        super().startService()
+        self._spawn()
+
+    def _spawn(self):
+        self._restart = None
+        self.log.info("starting {w}", w=self)
+        self._reactor.spawnProcess(
+            _WorkerProcessProtocol(self), sys.executable,
+            [sys.executable, "-m", "pydio.worker"],
+            env=_worker_env(), childFDs={0: "w", 1: "r", 2: 2},
+        )
+
+    def _connected(self, proto):
+        self._proto = proto
+        self._started_at = self._reactor.seconds()
+        d = proto.amp.callRemote(
+            Start, jobs=self.jobs, limits=self.limits, schedule=self.schedule,
+        )
+        d.addErrback(
+            lambda f: self.log.failure("could not start jobs in {w}", f, w=self)
+        )
+
+    def _ended(self, proto, reason):
+        self._proto = None
+        if self._stopped is not None:
+            self._stopped.callback(None)
+            self._stopped = None
+            return
+
+        if not self.running:
+            return
+
+        uptime = self._reactor.seconds() - self._started_at
+        if uptime >= self.max_restart_delay:
+            self._delay = self.restart_delay
+
+        self.log.error("{w} exited ({r}); restarting in {d}s",
+                       w=self, r=reason.value, d=self._delay)
+        self.restarts += 1
+        self._restart = self._reactor.callLater(self._delay, self._spawn)
+        self._delay = min(self._delay * 2, self.max_restart_delay)
+
+    @property
+    def pid(self):
+        return None if self._proto is None else self._proto.transport.pid
+
+    def call(self, command, **kw):
+        """Send an AMP command to the worker"""
+        if self._proto is None:
+            return defer.fail(error.ConnectionLost("{0} is down".format(self)))
+        return self._proto.amp.callRemote(command, **kw)
+
+    def status(self):
+        """Fire with {job name: status}.  Jobs of a worker that is down are
+        reported as not running.
+        """
+        down = {name: dict(running=False) for name in self.jobs}
+        d = self.call(Status)
+        d.addCallback(lambda r: r["status"])
+        return d.addErrback(lambda _: down)
+
+    def set_limits(self, limits=None, schedule=(), job=None):
+        if job is None:
+            self.limits, self.schedule = limits, list(schedule)
+        else:
+            self.jobs[job].update(limits=limits, schedule=list(schedule))
+
+        kw = dict(limits=limits, schedule=list(schedule))
+        if job is not None:
+            kw["job"] = job
+        return self.call(SetLimits, **kw).addErrback(lambda f: f.trap(
+            error.ConnectionLost, error.ConnectionDone,
+        ))  # the new limits are applied when the worker restarts
+
+    def set_selection(self, job, include=(), exclude=()):
+        self.jobs[job]["selection"] = dict(include=list(include),
+                                           exclude=list(exclude))
+        return self.call(
+            SetSelection, job=job, include=list(include),
+            exclude=list(exclude),
+        ).addErrback(lambda f: f.trap(
+            error.ConnectionLost, error.ConnectionDone,
+        ))  # the new selection is applied when the worker restarts
+
+    def set_priorities(self, job, priorities):
+        self.jobs[job]["priorities"] = dict(priorities)
+        return self.call(
+            SetPriorities, job=job, priorities=dict(priorities),
+        ).addErrback(lambda f: f.trap(
+            error.ConnectionLost, error.ConnectionDone,
+        ))  # the new priorities are applied when the worker restarts
+
+    def stopService(self):
+        super().stopService()
+        if self._restart is not None and self._restart.active():
+            self._restart.cancel()
+        if self._proto is None:
+            return defer.succeed(None)
+
+        self._stopped = d = defer.Deferred()
+        proto = self._proto
+        proto.amp.callRemote(Stop)
+
+        def kill():
+            if not d.called:
+                self.log.warn("killing unresponsive {w}", w=self)
+                proto.transport.signalProcess("KILL")
+
+        call = self._reactor.callLater(self.stop_timeout, kill)
+        return d.addBoth(lambda r: call.active() and call.cancel())
+
+
+def main():
+    from twisted.internet import reactor, stdio
+    from twisted.logger import globalLogBeginner, textFileLogObserver
+
+    # stdout carries the AMP stream; log to stderr instead
+    globalLogBeginner.beginLoggingTo([textFileLogObserver(sys.stderr)])
+    stdio.StandardIO(WorkerProtocol(reactor))
+    reactor.run()
+
+
+if __name__ == "__main__":
+    main()